@@ -0,0 +1,107 @@
+#include "stdafx.h"
+#include <stdio.h>
+#include <vector>
+#include "DeviceEnumeratorLinux.h"
+#include "StubDataInterface.h"
+#include "Lock.h"
+
+// A replacement for DeviceEnumeratorLinux.cpp that finds the simulated detectors added with kr_stub_AddDevice
+// instead of the USB devices. Build with this file and StubDataInterface.cpp in place of DeviceEnumeratorLinux.cpp and
+// USBKromekDataInterfaceLinux.cpp to run the driver without hardware (see setup.py).
+
+namespace
+{
+    // The stub devices live until the program exits, like the interfaces made by the linux enumerator they are
+    // never deleted by the device manager. The same interface is returned by every enumeration so that the
+    // device manager sees an already attached device
+    std::vector<kmk::StubDataInterface*> stubInterfaces;
+    kmk::CriticalSection stubInterfacesSection;
+
+    // The enumerator that is currently initialised, to raise the devices changed callback when a device is added
+    kmk::DeviceEnumerator *pActiveEnumerator = NULL;
+    kmk::DevicesChangedCallbackFunc activeCallbackFunc = NULL;
+    void *activeCallbackArg = NULL;
+}
+
+int kr_stub_AddDevice(unsigned short productID, unsigned short vendorID, double countRate, unsigned int randomSeed)
+{
+    kmk::DevicesChangedCallbackFunc callbackFunc = NULL;
+    void *callbackArg = NULL;
+    int numDevices;
+    {
+        kmk::Lock lock(stubInterfacesSection);
+        char devicePath[64];
+        char serial[32];
+        snprintf(devicePath, sizeof(devicePath), "/dev/kromekstub%d", (int)stubInterfaces.size());
+        snprintf(serial, sizeof(serial), "STUB%04d", (int)stubInterfaces.size());
+        kmk::StubDataInterface *pInterface = new kmk::StubDataInterface(devicePath, productID, vendorID, serial, countRate, randomSeed);
+        pInterface->Initialize();
+        stubInterfaces.push_back(pInterface);
+        numDevices = (int)stubInterfaces.size();
+
+        if (pActiveEnumerator != NULL)
+        {
+            callbackFunc = activeCallbackFunc;
+            callbackArg = activeCallbackArg;
+        }
+    }
+
+    // Raise the callback outside of the lock, the device manager enumerates the devices again
+    if (callbackFunc != NULL)
+    {
+        (*callbackFunc)(callbackArg);
+    }
+    return numDevices;
+}
+
+namespace kmk
+{
+    DeviceEnumerator::DeviceEnumerator()
+        : _devicesChangedCallbackFunc(NULL)
+        , _devicesChangedCallbackArg(NULL)
+        , _finishThreadEvent(false, false, L"")
+    {
+
+    }
+
+    DeviceEnumerator::~DeviceEnumerator()
+    {
+        Shutdown();
+    }
+
+    void DeviceEnumerator::EnumerateDevices(const ValidDeviceIdentifier &deviceIdentifier, std::vector<IDataInterface*> &listOut)
+    {
+        kmk::Lock lock(stubInterfacesSection);
+        std::vector<StubDataInterface*>::iterator it;
+        for (it = stubInterfaces.begin(); it != stubInterfaces.end(); ++it)
+        {
+            if (deviceIdentifier.productId == (*it)->GetProductID() && deviceIdentifier.vendorId == (*it)->GetVendorID())
+            {
+                listOut.push_back(*it);
+            }
+        }
+    }
+
+    bool DeviceEnumerator::Initialize(DevicesChangedCallbackFunc callbackFunc, void *pCallbackArg)
+    {
+        _devicesChangedCallbackFunc = callbackFunc;
+        _devicesChangedCallbackArg = pCallbackArg;
+
+        kmk::Lock lock(stubInterfacesSection);
+        pActiveEnumerator = this;
+        activeCallbackFunc = callbackFunc;
+        activeCallbackArg = pCallbackArg;
+        return true;
+    }
+
+    void DeviceEnumerator::Shutdown()
+    {
+        kmk::Lock lock(stubInterfacesSection);
+        if (pActiveEnumerator == this)
+        {
+            pActiveEnumerator = NULL;
+            activeCallbackFunc = NULL;
+            activeCallbackArg = NULL;
+        }
+    }
+}
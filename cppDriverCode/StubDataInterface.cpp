@@ -0,0 +1,247 @@
+#include "stdafx.h"
+
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <vector>
+
+#include "IDevice.h"
+#include "SpectrometerData.h"
+#include "StubDataInterface.h"
+#include "Lock.h"
+#include "kmkTime.h"
+
+// Id and size of the interval counts report, see IntervalCountProcessor.cpp
+#define DATA_IN_REPORT 4
+#define REPORT_SIZE 63
+#define REPORT_CHANNELS 31
+
+// Time in ms between the batches of reports
+#define STUB_READ_INTERVAL 10
+
+// Shape of the simulated spectrum
+#define STUB_PEAK_FRACTION 0.3
+#define STUB_PEAK_CHANNEL 1800.0
+#define STUB_PEAK_SIGMA 40.0
+#define STUB_BACKGROUND_SCALE 600.0
+
+namespace kmk
+{
+
+StubDataInterface::StubDataInterface(const char *pDevicePath, int productID, int vendorID, const char *pSerial, double countRate, unsigned int randomSeed)
+: _devicePath(pDevicePath)
+, _readThreadRunning(false)
+, _dataReadyCallback(NULL)
+, _dataReadyCallbackArg(NULL)
+, _errorCallback(NULL)
+, _errorCallbackArg(NULL)
+, _vendorID(vendorID)
+, _productID(productID)
+, _firmwareVersion(1)
+, _countRate(countRate)
+, _randomSeed(randomSeed)
+{
+    if (pSerial != NULL)
+        _serialNumber = pSerial;
+}
+
+StubDataInterface::~StubDataInterface(void)
+{
+    StopReading();
+}
+
+bool StubDataInterface::Initialize()
+{
+    return true;
+}
+
+unsigned int StubDataInterface::GetHash()
+{
+    // Same hash as USBKromekDataInterface
+    unsigned int hash = 0;
+    for(size_t i = 0; i < _devicePath.length(); ++i)
+        hash = 65599 * hash + _devicePath.c_str()[i];
+    return hash ^ (hash >> 16);
+}
+
+unsigned short StubDataInterface::GetVendorID()
+{
+    return _vendorID;
+}
+
+unsigned short StubDataInterface::GetProductID()
+{
+    return _productID;
+}
+
+String StubDataInterface::GetInterfaceProperty(const String& name)
+{
+    InterfaceProperties::iterator i = _ifProperties.find(name);
+    return (i != _ifProperties.end()) ? i->second : L"";
+}
+
+void StubDataInterface::SetDataReadyCallback(DataReadyCallbackFunc pFunc, void *pArg)
+{
+    kmk::Lock lock(_readCriticalSection);
+    _dataReadyCallback = pFunc;
+    _dataReadyCallbackArg = pArg;
+}
+
+void StubDataInterface::SetErrorCallback(ErrorCallbackFunc func, void *pArg)
+{
+    kmk::Lock lock(_readCriticalSection);
+    _errorCallback = func;
+    _errorCallbackArg = pArg;
+}
+
+bool StubDataInterface::BeginReading()
+{
+    kmk::Lock lock(_readCriticalSection);
+
+    if (_readThreadRunning)
+        return false;
+
+    _readThreadRunning = true;
+
+    if (!_readThread.Start(ReadDataThread, this))
+    {
+        _readThreadRunning = false;
+        return false;
+    }
+
+    return true;
+}
+
+bool StubDataInterface::StopReading()
+{
+    {
+        kmk::Lock lock(_readCriticalSection);
+
+        if (!_readThreadRunning)
+            return false;
+
+        _readThreadRunning = false;
+    }
+
+    // Wait for the thread to end before continuing
+    _readThread.WaitForTermination();
+    return true;
+}
+
+bool StubDataInterface::GetConfigurationSetting(unsigned char *pReportdata, size_t dataLength)
+{
+    if (pReportdata[0] == CONFIGURATION_GETSERIAL)
+    {
+        strncpy((char*)&pReportdata[1], _serialNumber.c_str(), dataLength - 1);
+    }
+    else if (pReportdata[0] == CONFIGURATION_GETVERSION)
+    {
+        memcpy(&pReportdata[1], &_firmwareVersion, sizeof(unsigned short));
+        return true;
+    }
+    else
+    {
+        return false;
+    }
+
+    // Post the returned data
+    if (_dataReadyCallback != NULL)
+    {
+        (*_dataReadyCallback)(_dataReadyCallbackArg, pReportdata, dataLength);
+    }
+
+    return true;
+}
+
+bool StubDataInterface::SetConfigurationSetting(unsigned char * /*pData*/, size_t /*dataLength*/)
+{
+    return true;
+}
+
+int StubDataInterface::RandomChannel()
+{
+    double uniform1 = (rand_r(&_randomSeed) + 1.0) / ((double)RAND_MAX + 2.0);
+    double uniform2 = (rand_r(&_randomSeed) + 1.0) / ((double)RAND_MAX + 2.0);
+    double channel;
+    if (uniform1 < STUB_PEAK_FRACTION)
+    {
+        // Box-Muller, uniform1 / STUB_PEAK_FRACTION is again uniform on (0, 1)
+        channel = STUB_PEAK_CHANNEL + STUB_PEAK_SIGMA * sqrt(-2.0 * log(uniform1 / STUB_PEAK_FRACTION)) * cos(2.0 * M_PI * uniform2);
+    }
+    else
+    {
+        channel = -STUB_BACKGROUND_SCALE * log(uniform2);
+    }
+
+    if (channel < 0.0)
+        return 0;
+    if (channel > TOTAL_RESULT_CHANNELS - 1)
+        return TOTAL_RESULT_CHANNELS - 1;
+    return (int)channel;
+}
+
+void StubDataInterface::MakeDataReports(int numEvents, std::vector<BYTE> &reportsOut)
+{
+    int numReports = (numEvents + REPORT_CHANNELS - 1) / REPORT_CHANNELS;
+    reportsOut.assign(numReports * REPORT_SIZE, 0);
+    for (int eventIndex = 0; eventIndex < numEvents; ++eventIndex)
+    {
+        BYTE *pReport = &reportsOut[(eventIndex / REPORT_CHANNELS) * REPORT_SIZE];
+        int offset = 1 + 2 * (eventIndex % REPORT_CHANNELS);
+        int channel = RandomChannel();
+
+        pReport[0] = DATA_IN_REPORT;
+        // 12 bit channel number, the least significant bit marks a valid value
+        pReport[offset] = (BYTE)((channel >> 4) & 0xFF);
+        pReport[offset + 1] = (BYTE)(((channel & 0xF) << 4) | 0x1);
+    }
+}
+
+// Thread function that makes data reports until stopped. Pass all data up via the DataReadyCallback
+int StubDataInterface::ReadDataThread(void *pArg)
+{
+    StubDataInterface *pThis = (StubDataInterface*)pArg;
+
+    std::vector<BYTE> dataBuffer;
+    int64_t lastTime = kmk::Time::GetTimeMs();
+    double numEventsOwed = 0.0;
+
+    while(true)
+    {
+        {
+            kmk::Lock lock(pThis->_readCriticalSection);
+            if (!pThis->_readThreadRunning)
+                break;
+        }
+
+        kmk::Thread::Sleep(STUB_READ_INTERVAL);
+
+        // The number of events in the time since the last batch, keeping the fraction of an event for the next one
+        int64_t now = kmk::Time::GetTimeMs();
+        numEventsOwed += pThis->_countRate * (double)(now - lastTime) / 1000.0;
+        lastTime = now;
+        int numEvents = (int)numEventsOwed;
+        numEventsOwed -= numEvents;
+        if (numEvents <= 0)
+            continue;
+
+        pThis->MakeDataReports(numEvents, dataBuffer);
+
+        DataReadyCallbackFunc dataReadyCallback;
+        void *dataReadyCallbackArg;
+        {
+            kmk::Lock lock(pThis->_readCriticalSection);
+            dataReadyCallback = pThis->_dataReadyCallback;
+            dataReadyCallbackArg = pThis->_dataReadyCallbackArg;
+        }
+
+        if (dataReadyCallback != NULL)
+        {
+            (*dataReadyCallback)(dataReadyCallbackArg, &dataBuffer[0], dataBuffer.size());
+        }
+    }
+
+    return 0;
+}
+
+}
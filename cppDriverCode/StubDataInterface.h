@@ -0,0 +1,84 @@
+#pragma once
+
+#include "IDataInterface.h"
+#include "types.h"
+#include "Thread.h"
+#include "CriticalSection.h"
+#include <vector>
+
+namespace kmk
+{
+
+// A simulated detector that replaces USBKromekDataInterface (USBKromekDataInterfaceLinux.h) so that the driver and the
+// python extension can be run and tested without hardware. The read thread makes the same 63 byte data reports as
+// the detector (see IntervalCountProcessor::ProcessDataReport) at a mean count rate and passes them to the data ready
+// callback. Channels are drawn from a gaussian peak on an exponential background.
+class StubDataInterface : public IDataInterface
+{
+private:
+    std::string _devicePath;
+    kmk::Thread _readThread;
+    bool _readThreadRunning;
+
+    // Callback to pass data to once generated
+    DataReadyCallbackFunc _dataReadyCallback;
+    void *_dataReadyCallbackArg;
+
+    // Callback raised whenever an error occurs
+    ErrorCallbackFunc _errorCallback;
+    void *_errorCallbackArg;
+
+    unsigned short _vendorID;
+    unsigned short _productID;
+    std::string _serialNumber;
+    unsigned short _firmwareVersion;
+
+    // Mean number of events per second
+    double _countRate;
+    unsigned int _randomSeed;
+
+    kmk::CriticalSection _readCriticalSection;
+    InterfaceProperties _ifProperties;
+
+    // Main thread routine
+    static int ReadDataThread(void *pThis);
+
+    // Draw a channel number for one event
+    int RandomChannel();
+
+    // Fill reportsOut with numEvents events in data reports of up to 31 events
+    void MakeDataReports(int numEvents, std::vector<BYTE> &reportsOut);
+
+public:
+
+    unsigned int GetHash();
+    unsigned short GetVendorID();
+    unsigned short GetProductID();
+
+    StubDataInterface(const char *pDevicePath, int productID, int vendorID, const char *pSerial, double countRate, unsigned int randomSeed);
+    ~StubDataInterface();
+
+    bool Initialize();
+
+    // Begin generating data until StopReading is called
+    bool BeginReading();
+
+    // Stop generating data
+    bool StopReading();
+
+    // The serial number and firmware version are answered like USBKromekDataInterface, the other settings are ignored
+    bool GetConfigurationSetting(unsigned char *pDataBuffer, size_t dataLength);
+    bool SetConfigurationSetting(unsigned char *pData, size_t dataLength);
+
+    void SetDataReadyCallback(DataReadyCallbackFunc pFunc, void *pArg);
+    void SetErrorCallback(ErrorCallbackFunc func, void *pArg);
+
+    String GetInterfaceProperty(const String& name);
+};
+
+}
+
+// Add a simulated detector to those found by the stub DeviceEnumerator (DeviceEnumeratorStub.cpp). If the driver is
+// already initialised the device changed callback is raised so that the device is added straight away.
+// Returns the number of stub devices.
+int kr_stub_AddDevice(unsigned short productID, unsigned short vendorID, double countRate, unsigned int randomSeed);
@@ -0,0 +1,50 @@
+#pragma once
+
+#include "DeviceMgr.h"
+#include "GR1.h"
+#include "GR05.h"
+#include "TN15.h"
+#include "K102.h"
+#include "SIGMA_25.h"
+#include "SIGMA_50.h"
+#include "RadAngel.h"
+
+// D3 vendor and product id, the D3 vendor id is not kromeks (see DeviceMgr::CreateDevices)
+#define D3_VENDOR_ID 0x0483
+#define D3_PRODUCT_ID 0x5740
+
+// The list of detectors the driver will look for, passed into DriverMgr::Initialise by kr_Initialise.
+// Every product is listed under both the old and the new Kromek vendor id as DeviceMgr::CreateDevices accepts either.
+inline void GetDeviceList(kmk::ValidDeviceIdentifierVector &devicesOut)
+{
+	const unsigned short productIds[] =
+	{
+		kmk::GR1::ProductId,
+		kmk::GR1A::ProductId,
+		kmk::GR05::ProductId,
+		kmk::TN15::ProductId,
+		kmk::K102::ProductId,
+		kmk::SIGMA_25::ProductId,
+		kmk::SIGMA_50::ProductId,
+		kmk::RadAngel::ProductId,
+		kmk::SIGMA_25_D3S::D3SProductId
+	};
+	const unsigned short vendorIds[] = {OLD_KROMEK_VENDOR_ID, KROMEK_VENDOR_ID};
+
+	devicesOut.clear();
+	for (size_t vendorIndex = 0; vendorIndex < sizeof(vendorIds) / sizeof(vendorIds[0]); ++vendorIndex)
+	{
+		for (size_t productIndex = 0; productIndex < sizeof(productIds) / sizeof(productIds[0]); ++productIndex)
+		{
+			kmk::ValidDeviceIdentifier identifier;
+			identifier.productId = productIds[productIndex];
+			identifier.vendorId = vendorIds[vendorIndex];
+			devicesOut.push_back(identifier);
+		}
+	}
+
+	kmk::ValidDeviceIdentifier d3Identifier;
+	d3Identifier.productId = D3_PRODUCT_ID;
+	d3Identifier.vendorId = D3_VENDOR_ID;
+	devicesOut.push_back(d3Identifier);
+}
@@ -53,7 +53,7 @@ namespace kmk
 		#else
 			timespec now;
 			clock_gettime(CLOCK_TYPE, &now);
-			return (now.tv_nsec + SecondsToTicks(now.tv_sec));
+			return ((now.tv_nsec / TICK_TIME_NS) + SecondsToTicks(now.tv_sec));
 		#endif
 		}
 
@@ -84,7 +84,7 @@ namespace kmk
 		#else
 			timespec now;
 			clock_gettime(CLOCK_REALTIME, &now); // TODO: Check this is UTC?
-			return (now.tv_nsec + SecondsToTicks(now.tv_sec));
+			return ((now.tv_nsec / TICK_TIME_NS) + SecondsToTicks(now.tv_sec));
 		#endif
 		}
 
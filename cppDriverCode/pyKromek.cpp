@@ -1,9 +1,1015 @@
 //
 //  pyKromek.cpp
-//  
+//
 //
 //  Created by Caleb Wheeler on 1/26/17.
 //
 //
+//  A python extension for the Kromek driver, the kr_* API in SpectrometerDriver.h.
+//
+//  - The acquired counts are copied by kr_GetAcquiredData into a spectrumBuffer, which exports its memory through the
+//    buffer protocol so that numpy.asarray(spectrumBuffer) is a live view of the counts without a copy.
+//  - The DataReceivedCallback of the driver is called from the driver's threads once for every event. Those calls only
+//    append the event to a C++ buffer, they never take the GIL. A dispatch thread hands the collected events to the
+//    python callback in eventBatch objects, holding the GIL once per batch. An eventBatch owns its events and exports
+//    them through the buffer protocol, numpy.frombuffer(eventBatch, dtype=eventDtype) reads them without a copy.
+//  - All driver calls release the GIL, so the driver's threads are never blocked by python.
+//
+//  Built with PYKROMEK_STUB_DEVICE defined (see setup.py) the driver finds simulated detectors (StubDataInterface.h)
+//  added with pyKromek.addStubDevice instead of USB devices.
 
 #include "pyKromek.hpp"
+
+#include <string.h>
+#include <deque>
+#include <string>
+
+#include "SpectrometerDriver.h"
+#include "Thread.h"
+#include "CriticalSection.h"
+#include "Lock.h"
+#include "Event.h"
+
+#ifdef PYKROMEK_STUB_DEVICE
+#include "StubDataInterface.h"
+#endif
+
+#if PY_MAJOR_VERSION >= 3
+#define PYKROMEK_PY3
+#endif
+
+#define DEVICE_STRING_LENGTH 256
+
+static PyObject *pyKromekError = NULL;
+
+///////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+// spectrumBuffer
+
+static int spectrumBuffer_getbuffer(PyObject *pSelf, Py_buffer *pView, int flags)
+{
+    spectrumBufferObject *pThis = (spectrumBufferObject*)pSelf;
+    pThis->shape[0] = TOTAL_RESULT_CHANNELS;
+    pThis->strides[0] = sizeof(unsigned int);
+
+    pView->buf = pThis->counts;
+    pView->obj = pSelf;
+    Py_INCREF(pSelf);
+    pView->len = sizeof(pThis->counts);
+    pView->readonly = 0;
+    pView->itemsize = sizeof(unsigned int);
+    pView->format = (flags & PyBUF_FORMAT) ? (char*)"I" : NULL;
+    pView->ndim = 1;
+    pView->shape = (flags & PyBUF_ND) ? pThis->shape : NULL;
+    pView->strides = ((flags & PyBUF_STRIDES) == PyBUF_STRIDES) ? pThis->strides : NULL;
+    pView->suboffsets = NULL;
+    pView->internal = NULL;
+    return 0;
+}
+
+#ifndef PYKROMEK_PY3
+// The old buffer protocol, used by numpy.frombuffer on python 2
+static Py_ssize_t spectrumBuffer_getreadbuffer(PyObject *pSelf, Py_ssize_t segment, void **ppData)
+{
+    if (segment != 0)
+    {
+        PyErr_SetString(PyExc_SystemError, "accessing non-existent buffer segment");
+        return -1;
+    }
+    *ppData = ((spectrumBufferObject*)pSelf)->counts;
+    return sizeof(((spectrumBufferObject*)pSelf)->counts);
+}
+
+static Py_ssize_t spectrumBuffer_getsegcount(PyObject * /*pSelf*/, Py_ssize_t *pLength)
+{
+    if (pLength != NULL)
+        *pLength = sizeof(((spectrumBufferObject*)NULL)->counts);
+    return 1;
+}
+#endif
+
+static PyBufferProcs spectrumBuffer_as_buffer = {
+#ifndef PYKROMEK_PY3
+    (readbufferproc)spectrumBuffer_getreadbuffer,
+    (writebufferproc)spectrumBuffer_getreadbuffer,
+    (segcountproc)spectrumBuffer_getsegcount,
+    NULL,
+#endif
+    (getbufferproc)spectrumBuffer_getbuffer,
+    NULL,
+};
+
+static PyObject *spectrumBuffer_new(PyTypeObject *pType, PyObject * /*args*/, PyObject * /*kwargs*/)
+{
+    spectrumBufferObject *pThis = (spectrumBufferObject*)pType->tp_alloc(pType, 0);
+    if (pThis != NULL)
+        memset(pThis->counts, 0, sizeof(pThis->counts));
+    return (PyObject*)pThis;
+}
+
+static Py_ssize_t spectrumBuffer_length(PyObject * /*pSelf*/)
+{
+    return TOTAL_RESULT_CHANNELS;
+}
+
+static PySequenceMethods spectrumBuffer_as_sequence = {
+    (lenfunc)spectrumBuffer_length,
+};
+
+static PyTypeObject spectrumBufferType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "pyKromek.spectrumBuffer",              // tp_name
+    sizeof(spectrumBufferObject),           // tp_basicsize
+    0,                                      // tp_itemsize
+    0,                                      // tp_dealloc
+    0,                                      // tp_print
+    0,                                      // tp_getattr
+    0,                                      // tp_setattr
+    0,                                      // tp_compare
+    0,                                      // tp_repr
+    0,                                      // tp_as_number
+    &spectrumBuffer_as_sequence,            // tp_as_sequence
+    0,                                      // tp_as_mapping
+    0,                                      // tp_hash
+    0,                                      // tp_call
+    0,                                      // tp_str
+    0,                                      // tp_getattro
+    0,                                      // tp_setattro
+    &spectrumBuffer_as_buffer,              // tp_as_buffer
+#ifndef PYKROMEK_PY3
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER,
+#else
+    Py_TPFLAGS_DEFAULT,
+#endif
+    "The counts of TOTAL_RESULT_CHANNELS channels, filled in by getAcquiredData. numpy.asarray(spectrumBuffer)\n"
+    "is a uint32 view of the counts that follows every later getAcquiredData into the same buffer.",
+};
+
+///////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+// eventBatch
+
+static int eventBatch_getbuffer(PyObject *pSelf, Py_buffer *pView, int flags)
+{
+    // The events are read only, a request for a writable buffer is refused
+    if ((flags & PyBUF_WRITABLE) == PyBUF_WRITABLE)
+    {
+        PyErr_SetString(PyExc_BufferError, "an eventBatch is read only");
+        pView->obj = NULL;
+        return -1;
+    }
+    eventBatchObject *pThis = (eventBatchObject*)pSelf;
+    size_t numOfBytes = pThis->pEvents->size() * sizeof(pyKromekEvent);
+    pThis->shape[0] = numOfBytes;
+    pThis->strides[0] = 1;
+
+    // Exported as bytes, the record layout is given by the dtype in python
+    pView->buf = pThis->pEvents->empty() ? NULL : &(*pThis->pEvents)[0];
+    pView->obj = pSelf;
+    Py_INCREF(pSelf);
+    pView->len = numOfBytes;
+    pView->readonly = 1;
+    pView->itemsize = 1;
+    pView->format = (flags & PyBUF_FORMAT) ? (char*)"B" : NULL;
+    pView->ndim = 1;
+    pView->shape = (flags & PyBUF_ND) ? pThis->shape : NULL;
+    pView->strides = ((flags & PyBUF_STRIDES) == PyBUF_STRIDES) ? pThis->strides : NULL;
+    pView->suboffsets = NULL;
+    pView->internal = NULL;
+    return 0;
+}
+
+#ifndef PYKROMEK_PY3
+static Py_ssize_t eventBatch_getreadbuffer(PyObject *pSelf, Py_ssize_t segment, void **ppData)
+{
+    eventBatchObject *pThis = (eventBatchObject*)pSelf;
+    if (segment != 0)
+    {
+        PyErr_SetString(PyExc_SystemError, "accessing non-existent buffer segment");
+        return -1;
+    }
+    *ppData = pThis->pEvents->empty() ? NULL : &(*pThis->pEvents)[0];
+    return pThis->pEvents->size() * sizeof(pyKromekEvent);
+}
+
+static Py_ssize_t eventBatch_getsegcount(PyObject *pSelf, Py_ssize_t *pLength)
+{
+    if (pLength != NULL)
+        *pLength = ((eventBatchObject*)pSelf)->pEvents->size() * sizeof(pyKromekEvent);
+    return 1;
+}
+#endif
+
+static PyBufferProcs eventBatch_as_buffer = {
+#ifndef PYKROMEK_PY3
+    (readbufferproc)eventBatch_getreadbuffer,
+    NULL,
+    (segcountproc)eventBatch_getsegcount,
+    NULL,
+#endif
+    (getbufferproc)eventBatch_getbuffer,
+    NULL,
+};
+
+static void eventBatch_dealloc(PyObject *pSelf)
+{
+    delete ((eventBatchObject*)pSelf)->pEvents;
+    Py_TYPE(pSelf)->tp_free(pSelf);
+}
+
+static Py_ssize_t eventBatch_length(PyObject *pSelf)
+{
+    return ((eventBatchObject*)pSelf)->pEvents->size();
+}
+
+static PySequenceMethods eventBatch_as_sequence = {
+    (lenfunc)eventBatch_length,
+};
+
+static PyTypeObject eventBatchType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "pyKromek.eventBatch",                  // tp_name
+    sizeof(eventBatchObject),               // tp_basicsize
+    0,                                      // tp_itemsize
+    (destructor)eventBatch_dealloc,         // tp_dealloc
+    0,                                      // tp_print
+    0,                                      // tp_getattr
+    0,                                      // tp_setattr
+    0,                                      // tp_compare
+    0,                                      // tp_repr
+    0,                                      // tp_as_number
+    &eventBatch_as_sequence,                // tp_as_sequence
+    0,                                      // tp_as_mapping
+    0,                                      // tp_hash
+    0,                                      // tp_call
+    0,                                      // tp_str
+    0,                                      // tp_getattro
+    0,                                      // tp_setattro
+    &eventBatch_as_buffer,                  // tp_as_buffer
+#ifndef PYKROMEK_PY3
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER,
+#else
+    Py_TPFLAGS_DEFAULT,
+#endif
+    "A batch of count events from the driver, len() is the number of events. Read it with\n"
+    "numpy.frombuffer(eventBatch, dtype=[('timestamp', '<i8'), ('deviceID', '<u4'), ('channel', '<u2'),\n"
+    "('numCounts', '<u2')]), the time stamps are in driver ticks of 100 ns.",
+};
+
+// Make an eventBatch that takes the events out of pEvents, leaving it empty. Call with the GIL held
+static PyObject *NewEventBatch(std::vector<pyKromekEvent> &events)
+{
+    eventBatchObject *pBatch = PyObject_New(eventBatchObject, &eventBatchType);
+    if (pBatch == NULL)
+        return NULL;
+    pBatch->pEvents = new std::vector<pyKromekEvent>();
+    pBatch->pEvents->swap(events);
+    return (PyObject*)pBatch;
+}
+
+///////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+// Batched delivery of the data received callbacks
+
+namespace
+{
+    struct EventCollector
+    {
+        kmk::CriticalSection section;
+        std::vector<pyKromekEvent> pendingEvents;
+        size_t batchSize;
+        size_t maxPendingEvents;
+        unsigned int flushIntervalMs;
+
+        PyObject *pCallback;
+        kmk::Thread dispatchThread;
+        kmk::Event wakeEvent;
+        bool dispatchThreadRunning;
+
+        unsigned long long numOfEvents;
+        unsigned long long numOfBatches;
+        unsigned long long numOfDroppedEvents;
+
+        EventCollector()
+        : batchSize(4096)
+        , maxPendingEvents(1 << 20)
+        , flushIntervalMs(100)
+        , pCallback(NULL)
+        , wakeEvent(true, false, L"")
+        , dispatchThreadRunning(false)
+        , numOfEvents(0)
+        , numOfBatches(0)
+        , numOfDroppedEvents(0)
+        {
+        }
+    };
+
+    EventCollector collector;
+
+    struct DriverError
+    {
+        unsigned int deviceID;
+        int errorCode;
+        std::string message;
+    };
+
+    kmk::CriticalSection errorSection;
+    std::deque<DriverError> driverErrors;
+    const size_t MAX_STORED_ERRORS = 1000;
+
+    PyObject *pDeviceChangedCallback = NULL;
+}
+
+// Called from the driver threads for every event. Never touches python.
+static void stdcall DataReceivedProc(void * /*pCallbackObject*/, unsigned int deviceID, long long timestamp, int channelNumber, int numCounts)
+{
+    bool wakeDispatcher = false;
+    {
+        kmk::Lock lock(collector.section);
+        if (collector.pendingEvents.size() < collector.maxPendingEvents)
+        {
+            pyKromekEvent event;
+            event.timestamp = timestamp;
+            event.deviceID = deviceID;
+            event.channel = (uint16_t)channelNumber;
+            event.numCounts = (uint16_t)numCounts;
+            collector.pendingEvents.push_back(event);
+            collector.numOfEvents++;
+            wakeDispatcher = (collector.pendingEvents.size() == collector.batchSize);
+        }
+        else
+        {
+            // Python is not keeping up
+            collector.numOfDroppedEvents++;
+        }
+    }
+
+    if (wakeDispatcher)
+        collector.wakeEvent.Signal();
+}
+
+// Hand the pending events to the python callback. Call with the GIL held
+static int DeliverPendingEvents()
+{
+    std::vector<pyKromekEvent> events;
+    PyObject *pCallback;
+    {
+        kmk::Lock lock(collector.section);
+        if (collector.pendingEvents.empty() || collector.pCallback == NULL)
+            return 0;
+        events.reserve(collector.batchSize);
+        events.swap(collector.pendingEvents);
+        collector.numOfBatches++;
+        pCallback = collector.pCallback;
+        Py_INCREF(pCallback);
+    }
+
+    int returnCode = 0;
+    PyObject *pBatch = NewEventBatch(events);
+    if (pBatch == NULL)
+    {
+        returnCode = -1;
+    }
+    else
+    {
+        PyObject *pResult = PyObject_CallFunctionObjArgs(pCallback, pBatch, NULL);
+        if (pResult == NULL)
+            returnCode = -1;
+        Py_XDECREF(pResult);
+        Py_DECREF(pBatch);
+    }
+    Py_DECREF(pCallback);
+    return returnCode;
+}
+
+static int DispatchThreadProc(void * /*pArg*/)
+{
+    while (true)
+    {
+        unsigned int flushIntervalMs;
+        {
+            kmk::Lock lock(collector.section);
+            if (!collector.dispatchThreadRunning)
+                break;
+            flushIntervalMs = collector.flushIntervalMs;
+        }
+
+        // Woken when a batch is full, otherwise deliver whatever there is every flush interval
+        collector.wakeEvent.Wait(flushIntervalMs);
+
+        bool hasEvents;
+        {
+            kmk::Lock lock(collector.section);
+            hasEvents = !collector.pendingEvents.empty() && collector.pCallback != NULL;
+        }
+        if (!hasEvents)
+            continue;
+
+        PyGILState_STATE gilState = PyGILState_Ensure();
+        if (DeliverPendingEvents() < 0)
+        {
+            // An exception in the callback, print it and keep going
+            PyErr_Print();
+        }
+        PyGILState_Release(gilState);
+    }
+    return 0;
+}
+
+// Stop the dispatch thread. Call with the GIL held
+static void StopDispatchThread()
+{
+    {
+        kmk::Lock lock(collector.section);
+        if (!collector.dispatchThreadRunning)
+            return;
+        collector.dispatchThreadRunning = false;
+    }
+    collector.wakeEvent.Signal();
+
+    // The dispatch thread may be waiting for the GIL
+    Py_BEGIN_ALLOW_THREADS
+    collector.dispatchThread.WaitForTermination();
+    Py_END_ALLOW_THREADS
+}
+
+static void stdcall ErrorProc(void * /*pCallbackObject*/, unsigned int deviceID, int errorCode, const char *pMessage)
+{
+    kmk::Lock lock(errorSection);
+    DriverError error;
+    error.deviceID = deviceID;
+    error.errorCode = errorCode;
+    error.message = (pMessage != NULL) ? pMessage : "";
+    driverErrors.push_back(error);
+    if (driverErrors.size() > MAX_STORED_ERRORS)
+        driverErrors.pop_front();
+}
+
+// Devices are added and removed rarely, the python callback is called straight away
+static void stdcall DeviceChangedProc(unsigned int deviceID, BOOL added, void * /*pObject*/)
+{
+    PyGILState_STATE gilState = PyGILState_Ensure();
+    if (pDeviceChangedCallback != NULL)
+    {
+        PyObject *pResult = PyObject_CallFunction(pDeviceChangedCallback, (char*)"Ii", deviceID, (int)added);
+        if (pResult == NULL)
+            PyErr_Print();
+        Py_XDECREF(pResult);
+    }
+    PyGILState_Release(gilState);
+}
+
+static PyObject *RaiseDriverError(int errorCode, const char *pFunctionName)
+{
+    PyObject *pErrorArgs = Py_BuildValue("(is)", errorCode, pFunctionName);
+    if (pErrorArgs != NULL)
+    {
+        PyErr_SetObject(pyKromekError, pErrorArgs);
+        Py_DECREF(pErrorArgs);
+    }
+    return NULL;
+}
+
+///////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+// Module functions, the kr_* API
+
+static PyObject *pyKromek_getVersionInformation(PyObject * /*self*/, PyObject * /*args*/)
+{
+    int product = 0, major = 0, minor = 0, build = 0;
+    kr_GetVersionInformation(&product, &major, &minor, &build);
+    return Py_BuildValue("(iiii)", product, major, minor, build);
+}
+
+static PyObject *pyKromek_initialise(PyObject * /*self*/, PyObject * /*args*/)
+{
+    int errorCode;
+    Py_BEGIN_ALLOW_THREADS
+    errorCode = kr_Initialise(ErrorProc, NULL);
+    Py_END_ALLOW_THREADS
+    if (errorCode != ERROR_OK)
+        return RaiseDriverError(errorCode, "kr_Initialise");
+    Py_RETURN_NONE;
+}
+
+static PyObject *pyKromek_destruct(PyObject * /*self*/, PyObject * /*args*/)
+{
+    Py_BEGIN_ALLOW_THREADS
+    kr_Destruct();
+    Py_END_ALLOW_THREADS
+
+    // Deliver the last events before stopping
+    StopDispatchThread();
+    if (DeliverPendingEvents() < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *pyKromek_getNextDetector(PyObject * /*self*/, PyObject *args)
+{
+    unsigned int deviceID = 0;
+    if (!PyArg_ParseTuple(args, "|I", &deviceID))
+        return NULL;
+    unsigned int nextDeviceID;
+    Py_BEGIN_ALLOW_THREADS
+    nextDeviceID = kr_GetNextDetector(deviceID);
+    Py_END_ALLOW_THREADS
+    return Py_BuildValue("I", nextDeviceID);
+}
+
+static PyObject *pyKromek_getDetectorIDs(PyObject * /*self*/, PyObject * /*args*/)
+{
+    std::vector<unsigned int> deviceIDs;
+    Py_BEGIN_ALLOW_THREADS
+    unsigned int deviceID = kr_GetNextDetector(0);
+    while (deviceID != 0)
+    {
+        deviceIDs.push_back(deviceID);
+        deviceID = kr_GetNextDetector(deviceID);
+    }
+    Py_END_ALLOW_THREADS
+
+    PyObject *pList = PyList_New(deviceIDs.size());
+    if (pList == NULL)
+        return NULL;
+    for (size_t index = 0; index < deviceIDs.size(); ++index)
+        PyList_SET_ITEM(pList, index, PyLong_FromUnsignedLong(deviceIDs[index]));
+    return pList;
+}
+
+static PyObject *pyKromek_setDeviceChangedCallback(PyObject * /*self*/, PyObject *args)
+{
+    PyObject *pCallback;
+    if (!PyArg_ParseTuple(args, "O", &pCallback))
+        return NULL;
+    if (pCallback != Py_None && !PyCallable_Check(pCallback))
+    {
+        PyErr_SetString(PyExc_TypeError, "callback must be callable or None");
+        return NULL;
+    }
+
+    Py_XDECREF(pDeviceChangedCallback);
+    if (pCallback == Py_None)
+    {
+        pDeviceChangedCallback = NULL;
+    }
+    else
+    {
+        Py_INCREF(pCallback);
+        pDeviceChangedCallback = pCallback;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    kr_SetDeviceChangedCallback(DeviceChangedProc, NULL);
+    Py_END_ALLOW_THREADS
+    Py_RETURN_NONE;
+}
+
+static PyObject *pyKromek_setDataReceivedCallback(PyObject * /*self*/, PyObject *args, PyObject *kwargs)
+{
+    PyObject *pCallback;
+    Py_ssize_t batchSize = 4096;
+    double flushInterval = 0.1;
+    Py_ssize_t maxPendingEvents = 1 << 20;
+    static const char *keywords[] = {"callback", "batchSize", "flushInterval", "maxPendingEvents", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|ndn", (char**)keywords, &pCallback, &batchSize, &flushInterval,
+                                     &maxPendingEvents))
+        return NULL;
+    if (pCallback != Py_None && !PyCallable_Check(pCallback))
+    {
+        PyErr_SetString(PyExc_TypeError, "callback must be callable or None");
+        return NULL;
+    }
+    if (batchSize < 1 || maxPendingEvents < batchSize || flushInterval <= 0.0)
+    {
+        PyErr_SetString(PyExc_ValueError, "batchSize must be at least 1, maxPendingEvents at least batchSize and "
+                        "flushInterval more than 0");
+        return NULL;
+    }
+
+    if (pCallback == Py_None)
+    {
+        // Stop receiving events, the events that are waiting are delivered to the old callback
+        Py_BEGIN_ALLOW_THREADS
+        kr_SetDataReceivedCallback(NULL, NULL);
+        Py_END_ALLOW_THREADS
+        StopDispatchThread();
+        int deliverResult = DeliverPendingEvents();
+        PyObject *pOldCallback;
+        {
+            kmk::Lock lock(collector.section);
+            pOldCallback = collector.pCallback;
+            collector.pCallback = NULL;
+        }
+        Py_XDECREF(pOldCallback);
+        if (deliverResult < 0)
+            return NULL;
+        Py_RETURN_NONE;
+    }
+
+    bool startThread;
+    PyObject *pOldCallback;
+    Py_INCREF(pCallback);
+    {
+        kmk::Lock lock(collector.section);
+        pOldCallback = collector.pCallback;
+        collector.pCallback = pCallback;
+        collector.batchSize = batchSize;
+        collector.maxPendingEvents = maxPendingEvents;
+        collector.flushIntervalMs = (unsigned int)(flushInterval * 1000.0 + 0.5);
+        if (collector.flushIntervalMs == 0)
+            collector.flushIntervalMs = 1;
+        collector.pendingEvents.reserve(batchSize);
+        startThread = !collector.dispatchThreadRunning;
+        collector.dispatchThreadRunning = true;
+    }
+    Py_XDECREF(pOldCallback);
+
+    if (startThread && !collector.dispatchThread.Start(DispatchThreadProc, NULL))
+    {
+        kmk::Lock lock(collector.section);
+        collector.dispatchThreadRunning = false;
+        PyErr_SetString(PyExc_RuntimeError, "could not start the event dispatch thread");
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    kr_SetDataReceivedCallback(DataReceivedProc, NULL);
+    Py_END_ALLOW_THREADS
+    Py_RETURN_NONE;
+}
+
+static PyObject *pyKromek_flushEvents(PyObject * /*self*/, PyObject * /*args*/)
+{
+    if (DeliverPendingEvents() < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *pyKromek_getEventStatistics(PyObject * /*self*/, PyObject * /*args*/)
+{
+    kmk::Lock lock(collector.section);
+    return Py_BuildValue("{s:K,s:K,s:K,s:n}",
+                         "numOfEvents", collector.numOfEvents,
+                         "numOfBatches", collector.numOfBatches,
+                         "numOfDroppedEvents", collector.numOfDroppedEvents,
+                         "numOfPendingEvents", (Py_ssize_t)collector.pendingEvents.size());
+}
+
+static PyObject *pyKromek_getErrors(PyObject * /*self*/, PyObject * /*args*/)
+{
+    std::deque<DriverError> errors;
+    {
+        kmk::Lock lock(errorSection);
+        errors.swap(driverErrors);
+    }
+    PyObject *pList = PyList_New(errors.size());
+    if (pList == NULL)
+        return NULL;
+    for (size_t index = 0; index < errors.size(); ++index)
+    {
+        PyObject *pError = Py_BuildValue("(Iis)", errors[index].deviceID, errors[index].errorCode,
+                                         errors[index].message.c_str());
+        if (pError == NULL)
+        {
+            Py_DECREF(pList);
+            return NULL;
+        }
+        PyList_SET_ITEM(pList, index, pError);
+    }
+    return pList;
+}
+
+static PyObject *pyKromek_getAcquiredData(PyObject * /*self*/, PyObject *args, PyObject *kwargs)
+{
+    unsigned int deviceID;
+    PyObject *pBuffer = Py_None;
+    int clearCounts = 0;
+    static const char *keywords[] = {"deviceID", "spectrumBuffer", "clearCounts", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "I|Oi", (char**)keywords, &deviceID, &pBuffer, &clearCounts))
+        return NULL;
+
+    if (pBuffer == Py_None)
+    {
+        pBuffer = spectrumBuffer_new(&spectrumBufferType, NULL, NULL);
+        if (pBuffer == NULL)
+            return NULL;
+    }
+    else if (PyObject_TypeCheck(pBuffer, &spectrumBufferType))
+    {
+        Py_INCREF(pBuffer);
+    }
+    else
+    {
+        PyErr_SetString(PyExc_TypeError, "spectrumBuffer must be a pyKromek.spectrumBuffer or None");
+        return NULL;
+    }
+
+    unsigned int totalCounts = 0, realTime = 0, liveTime = 0;
+    unsigned int flags = clearCounts ? GAD_CLEAR_COUNTS : 0;
+    unsigned int *pCounts = ((spectrumBufferObject*)pBuffer)->counts;
+    int errorCode;
+    Py_BEGIN_ALLOW_THREADS
+    errorCode = kr_GetAcquiredDataEx(deviceID, pCounts, &totalCounts, &realTime, &liveTime, flags);
+    Py_END_ALLOW_THREADS
+    if (errorCode != ERROR_OK)
+    {
+        Py_DECREF(pBuffer);
+        return RaiseDriverError(errorCode, "kr_GetAcquiredData");
+    }
+    return Py_BuildValue("(NIII)", pBuffer, totalCounts, realTime, liveTime);
+}
+
+// The functions that take a device id and only return an error code
+typedef int (stdcall *DeviceFunc)(unsigned int deviceID);
+
+static PyObject *CallDeviceFunc(PyObject *args, DeviceFunc func, const char *pFunctionName)
+{
+    unsigned int deviceID;
+    if (!PyArg_ParseTuple(args, "I", &deviceID))
+        return NULL;
+    int errorCode;
+    Py_BEGIN_ALLOW_THREADS
+    errorCode = (*func)(deviceID);
+    Py_END_ALLOW_THREADS
+    if (errorCode != ERROR_OK)
+        return RaiseDriverError(errorCode, pFunctionName);
+    Py_RETURN_NONE;
+}
+
+static PyObject *pyKromek_clearAcquiredData(PyObject * /*self*/, PyObject *args)
+{
+    return CallDeviceFunc(args, kr_ClearAcquiredData, "kr_ClearAcquiredData");
+}
+
+static PyObject *pyKromek_stopDataAcquisition(PyObject * /*self*/, PyObject *args)
+{
+    return CallDeviceFunc(args, kr_StopDataAcquisition, "kr_StopDataAcquisition");
+}
+
+static PyObject *pyKromek_isAcquiringData(PyObject * /*self*/, PyObject *args)
+{
+    unsigned int deviceID;
+    if (!PyArg_ParseTuple(args, "I", &deviceID))
+        return NULL;
+    int isAcquiring;
+    Py_BEGIN_ALLOW_THREADS
+    isAcquiring = kr_IsAcquiringData(deviceID);
+    Py_END_ALLOW_THREADS
+    return PyBool_FromLong(isAcquiring);
+}
+
+static PyObject *pyKromek_beginDataAcquisition(PyObject * /*self*/, PyObject *args)
+{
+    unsigned int deviceID, realTime = 0, liveTime = 0;
+    if (!PyArg_ParseTuple(args, "I|II", &deviceID, &realTime, &liveTime))
+        return NULL;
+    int errorCode;
+    Py_BEGIN_ALLOW_THREADS
+    errorCode = kr_BeginDataAcquisition(deviceID, realTime, liveTime);
+    Py_END_ALLOW_THREADS
+    if (errorCode != ERROR_OK)
+        return RaiseDriverError(errorCode, "kr_BeginDataAcquisition");
+    Py_RETURN_NONE;
+}
+
+// The functions that copy a string property of the device into a buffer
+typedef int (stdcall *DeviceStringFunc)(unsigned int deviceID, char *pBuffer, int bufferSize, int *pNumBytesOut);
+
+static PyObject *CallDeviceStringFunc(PyObject *args, DeviceStringFunc func, const char *pFunctionName)
+{
+    unsigned int deviceID;
+    if (!PyArg_ParseTuple(args, "I", &deviceID))
+        return NULL;
+    char buffer[DEVICE_STRING_LENGTH];
+    int numBytesOut = 0;
+    int errorCode;
+    Py_BEGIN_ALLOW_THREADS
+    errorCode = (*func)(deviceID, buffer, DEVICE_STRING_LENGTH, &numBytesOut);
+    Py_END_ALLOW_THREADS
+    if (errorCode != ERROR_OK)
+        return RaiseDriverError(errorCode, pFunctionName);
+    if (numBytesOut < 0 || numBytesOut >= DEVICE_STRING_LENGTH)
+        numBytesOut = 0;
+#ifdef PYKROMEK_PY3
+    return PyUnicode_FromStringAndSize(buffer, numBytesOut);
+#else
+    return PyString_FromStringAndSize(buffer, numBytesOut);
+#endif
+}
+
+static PyObject *pyKromek_getDeviceName(PyObject * /*self*/, PyObject *args)
+{
+    return CallDeviceStringFunc(args, kr_GetDeviceName, "kr_GetDeviceName");
+}
+
+static PyObject *pyKromek_getDeviceManufacturer(PyObject * /*self*/, PyObject *args)
+{
+    return CallDeviceStringFunc(args, kr_GetDeviceManufacturer, "kr_GetDeviceManufacturer");
+}
+
+static PyObject *pyKromek_getDeviceSerial(PyObject * /*self*/, PyObject *args)
+{
+    return CallDeviceStringFunc(args, kr_GetDeviceSerial, "kr_GetDeviceSerial");
+}
+
+// The functions that return an integer property of the device
+typedef int (stdcall *DeviceIntFunc)(unsigned int deviceID, int *pValueOut);
+
+static PyObject *CallDeviceIntFunc(PyObject *args, DeviceIntFunc func, const char *pFunctionName)
+{
+    unsigned int deviceID;
+    if (!PyArg_ParseTuple(args, "I", &deviceID))
+        return NULL;
+    int value = 0;
+    int errorCode;
+    Py_BEGIN_ALLOW_THREADS
+    errorCode = (*func)(deviceID, &value);
+    Py_END_ALLOW_THREADS
+    if (errorCode != ERROR_OK)
+        return RaiseDriverError(errorCode, pFunctionName);
+    return Py_BuildValue("i", value);
+}
+
+static PyObject *pyKromek_getDeviceVendorID(PyObject * /*self*/, PyObject *args)
+{
+    return CallDeviceIntFunc(args, kr_GetDeviceVendorID, "kr_GetDeviceVendorID");
+}
+
+static PyObject *pyKromek_getDeviceProductID(PyObject * /*self*/, PyObject *args)
+{
+    return CallDeviceIntFunc(args, kr_GetDeviceProductID, "kr_GetDeviceProductID");
+}
+
+static PyObject *pyKromek_sendInt8ConfigurationCommand(PyObject * /*self*/, PyObject *args)
+{
+    unsigned int deviceID;
+    int configurationID;
+    unsigned char command;
+    if (!PyArg_ParseTuple(args, "IiB", &deviceID, &configurationID, &command))
+        return NULL;
+    int errorCode;
+    Py_BEGIN_ALLOW_THREADS
+    errorCode = kr_SendInt8ConfigurationCommand(deviceID, (ConfigurationCommandsEnum)configurationID, command);
+    Py_END_ALLOW_THREADS
+    if (errorCode != ERROR_OK)
+        return RaiseDriverError(errorCode, "kr_SendInt8ConfigurationCommand");
+    Py_RETURN_NONE;
+}
+
+static PyObject *pyKromek_sendInt16ConfigurationCommand(PyObject * /*self*/, PyObject *args)
+{
+    unsigned int deviceID;
+    int configurationID;
+    unsigned short command;
+    if (!PyArg_ParseTuple(args, "IiH", &deviceID, &configurationID, &command))
+        return NULL;
+    int errorCode;
+    Py_BEGIN_ALLOW_THREADS
+    errorCode = kr_SendInt16ConfigurationCommand(deviceID, (ConfigurationCommandsEnum)configurationID, command);
+    Py_END_ALLOW_THREADS
+    if (errorCode != ERROR_OK)
+        return RaiseDriverError(errorCode, "kr_SendInt16ConfigurationCommand");
+    Py_RETURN_NONE;
+}
+
+#ifdef PYKROMEK_STUB_DEVICE
+static PyObject *pyKromek_addStubDevice(PyObject * /*self*/, PyObject *args, PyObject *kwargs)
+{
+    unsigned short productID = 0x0;
+    unsigned short vendorID = 0x4d8;
+    double countRate = 1000.0;
+    unsigned int seed = 1;
+    static const char *keywords[] = {"productID", "vendorID", "countRate", "seed", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|HHdI", (char**)keywords, &productID, &vendorID, &countRate,
+                                     &seed))
+        return NULL;
+    int numDevices;
+    Py_BEGIN_ALLOW_THREADS
+    numDevices = kr_stub_AddDevice(productID, vendorID, countRate, seed);
+    Py_END_ALLOW_THREADS
+    return Py_BuildValue("i", numDevices);
+}
+#endif
+
+static PyMethodDef pyKromekMethods[] = {
+    {"getVersionInformation", pyKromek_getVersionInformation, METH_NOARGS,
+        "getVersionInformation() -> (product, major, minor, build) of the driver library."},
+    {"initialise", pyKromek_initialise, METH_NOARGS,
+        "initialise() the driver library, before any other call except getVersionInformation."},
+    {"destruct", pyKromek_destruct, METH_NOARGS,
+        "destruct() shuts down the driver library and delivers the last events."},
+    {"getNextDetector", pyKromek_getNextDetector, METH_VARARGS,
+        "getNextDetector(deviceID=0) -> the id of the next detector, 0 at the end of the list."},
+    {"getDetectorIDs", pyKromek_getDetectorIDs, METH_NOARGS,
+        "getDetectorIDs() -> a list of the ids of all the attached detectors."},
+    {"setDeviceChangedCallback", pyKromek_setDeviceChangedCallback, METH_VARARGS,
+        "setDeviceChangedCallback(callback) where callback(deviceID, added) is called when a detector is connected\n"
+        "or disconnected, None to remove it."},
+    {"setDataReceivedCallback", (PyCFunction)pyKromek_setDataReceivedCallback, METH_VARARGS | METH_KEYWORDS,
+        "setDataReceivedCallback(callback, batchSize=4096, flushInterval=0.1, maxPendingEvents=1048576)\n"
+        "callback(eventBatch) is called from a separate thread with the events of all the detectors, when\n"
+        "batchSize events are waiting or every flushInterval seconds. Events beyond maxPendingEvents are dropped\n"
+        "and counted in getEventStatistics. None stops the events and delivers the waiting ones."},
+    {"flushEvents", pyKromek_flushEvents, METH_NOARGS,
+        "flushEvents() delivers the waiting events to the callback now, on this thread."},
+    {"getEventStatistics", pyKromek_getEventStatistics, METH_NOARGS,
+        "getEventStatistics() -> a dictionary of numOfEvents, numOfBatches, numOfDroppedEvents and\n"
+        "numOfPendingEvents."},
+    {"getErrors", pyKromek_getErrors, METH_NOARGS,
+        "getErrors() -> a list of (deviceID, errorCode, message) of the driver errors since the last call."},
+    {"getAcquiredData", (PyCFunction)pyKromek_getAcquiredData, METH_VARARGS | METH_KEYWORDS,
+        "getAcquiredData(deviceID, spectrumBuffer=None, clearCounts=False)\n"
+        "-> (spectrumBuffer, totalCounts, realTime, liveTime), the counts are copied into spectrumBuffer, or a new\n"
+        "one when None. With clearCounts the counts of the device are cleared after they are read."},
+    {"clearAcquiredData", pyKromek_clearAcquiredData, METH_VARARGS,
+        "clearAcquiredData(deviceID) clears the counts of the current or last acquisition."},
+    {"isAcquiringData", pyKromek_isAcquiringData, METH_VARARGS,
+        "isAcquiringData(deviceID) -> True if the detector is acquiring data."},
+    {"beginDataAcquisition", pyKromek_beginDataAcquisition, METH_VARARGS,
+        "beginDataAcquisition(deviceID, realTime=0, liveTime=0) in ms, 0 for no limit."},
+    {"stopDataAcquisition", pyKromek_stopDataAcquisition, METH_VARARGS,
+        "stopDataAcquisition(deviceID)"},
+    {"getDeviceName", pyKromek_getDeviceName, METH_VARARGS, "getDeviceName(deviceID) -> str"},
+    {"getDeviceManufacturer", pyKromek_getDeviceManufacturer, METH_VARARGS, "getDeviceManufacturer(deviceID) -> str"},
+    {"getDeviceSerial", pyKromek_getDeviceSerial, METH_VARARGS, "getDeviceSerial(deviceID) -> str"},
+    {"getDeviceVendorID", pyKromek_getDeviceVendorID, METH_VARARGS, "getDeviceVendorID(deviceID) -> int"},
+    {"getDeviceProductID", pyKromek_getDeviceProductID, METH_VARARGS, "getDeviceProductID(deviceID) -> int"},
+    {"sendInt8ConfigurationCommand", pyKromek_sendInt8ConfigurationCommand, METH_VARARGS,
+        "sendInt8ConfigurationCommand(deviceID, configurationID, command)"},
+    {"sendInt16ConfigurationCommand", pyKromek_sendInt16ConfigurationCommand, METH_VARARGS,
+        "sendInt16ConfigurationCommand(deviceID, configurationID, command)"},
+#ifdef PYKROMEK_STUB_DEVICE
+    {"addStubDevice", (PyCFunction)pyKromek_addStubDevice, METH_VARARGS | METH_KEYWORDS,
+        "addStubDevice(productID=0x0, vendorID=0x4d8, countRate=1000.0, seed=1) -> the number of stub devices.\n"
+        "Adds a simulated detector (a GR1 by default) making countRate events per second."},
+#endif
+    {NULL, NULL, 0, NULL}        /* Sentinel */
+};
+
+static int AddModuleConstants(PyObject *pModule)
+{
+    if (PyType_Ready(&spectrumBufferType) < 0 || PyType_Ready(&eventBatchType) < 0)
+        return -1;
+    spectrumBufferType.tp_new = spectrumBuffer_new;
+    Py_INCREF(&spectrumBufferType);
+    PyModule_AddObject(pModule, "spectrumBuffer", (PyObject*)&spectrumBufferType);
+    Py_INCREF(&eventBatchType);
+    PyModule_AddObject(pModule, "eventBatch", (PyObject*)&eventBatchType);
+
+    pyKromekError = PyErr_NewException((char*)"pyKromek.error", NULL, NULL);
+    if (pyKromekError == NULL)
+        return -1;
+    Py_INCREF(pyKromekError);
+    PyModule_AddObject(pModule, "error", pyKromekError);
+
+    PyModule_AddIntConstant(pModule, "TOTAL_RESULT_CHANNELS", TOTAL_RESULT_CHANNELS);
+    PyModule_AddIntConstant(pModule, "GAD_CLEAR_COUNTS", GAD_CLEAR_COUNTS);
+    PyModule_AddIntConstant(pModule, "EVENT_SIZE", sizeof(pyKromekEvent));
+    PyModule_AddIntConstant(pModule, "ERROR_OK", ERROR_OK);
+    PyModule_AddIntConstant(pModule, "ERROR_NOT_INITIALISED", ERROR_NOT_INITIALISED);
+    PyModule_AddIntConstant(pModule, "ERROR_INVALID_DEVICE_ID", ERROR_INVALID_DEVICE_ID);
+    PyModule_AddIntConstant(pModule, "ERROR_ACQUISITION_COMPLETE", ERROR_ACQUISITION_COMPLETE);
+    PyModule_AddIntConstant(pModule, "HIDREPORTNUMBER_SETLLD", HIDREPORTNUMBER_SETLLD);
+    PyModule_AddIntConstant(pModule, "HIDREPORTNUMBER_SETGAIN", HIDREPORTNUMBER_SETGAIN);
+    PyModule_AddIntConstant(pModule, "HIDREPORTNUMBER_SETPOLARITY", HIDREPORTNUMBER_SETPOLARITY);
+    PyModule_AddIntConstant(pModule, "HIDREPORTNUMBER_SETBIAS16", HIDREPORTNUMBER_SETBIAS16);
+#ifdef PYKROMEK_STUB_DEVICE
+    PyModule_AddIntConstant(pModule, "stubDevice", 1);
+#else
+    PyModule_AddIntConstant(pModule, "stubDevice", 0);
+#endif
+
+    // The driver threads call back into python
+    PyEval_InitThreads();
+    return 0;
+}
+
+#ifdef PYKROMEK_PY3
+static struct PyModuleDef pyKromekModule = {
+    PyModuleDef_HEAD_INIT,
+    "pyKromek",
+    "A python extension for the Kromek driver, the kr_* API in SpectrometerDriver.h.",
+    -1,
+    pyKromekMethods
+};
+
+PyMODINIT_FUNC
+PyInit_pyKromek(void)
+{
+    PyObject *pModule = PyModule_Create(&pyKromekModule);
+    if (pModule == NULL)
+        return NULL;
+    if (AddModuleConstants(pModule) < 0)
+    {
+        Py_DECREF(pModule);
+        return NULL;
+    }
+    return pModule;
+}
+#else
+PyMODINIT_FUNC
+initpyKromek(void)
+{
+    PyObject *pModule = Py_InitModule3("pyKromek", pyKromekMethods,
+                                       "A python extension for the Kromek driver, the kr_* API in SpectrometerDriver.h.");
+    if (pModule == NULL)
+        return;
+    AddModuleConstants(pModule);
+}
+#endif
@@ -1,6 +1,6 @@
 //
 //  pyKromek.hpp
-//  
+//
 //
 //  Created by Caleb Wheeler on 1/26/17.
 //
@@ -9,6 +9,41 @@
 #ifndef pyKromek_hpp
 #define pyKromek_hpp
 
+#include <Python.h>
 #include <stdio.h>
+#include <vector>
+
+#include "types.h"
+#include "SpectrometerData.h"
+
+// One count event from the DataReceivedCallback of the driver. Events are collected in C++ and handed to python in
+// batches (eventBatch objects) with this memory layout, numpy reads them without a copy with the dtype
+// [('timestamp', '<i8'), ('deviceID', '<u4'), ('channel', '<u2'), ('numCounts', '<u2')]
+struct pyKromekEvent
+{
+    int64_t timestamp;      // driver ticks of 100 ns
+    uint32_t deviceID;
+    uint16_t channel;
+    uint16_t numCounts;
+};
+
+// pyKromek.spectrumBuffer, TOTAL_RESULT_CHANNELS unsigned ints that kr_GetAcquiredData writes the counts into and that
+// python views through the buffer protocol
+typedef struct
+{
+    PyObject_HEAD
+    unsigned int counts[TOTAL_RESULT_CHANNELS];
+    Py_ssize_t shape[1];
+    Py_ssize_t strides[1];
+} spectrumBufferObject;
+
+// pyKromek.eventBatch, a batch of events that owns its memory and is viewed through the buffer protocol
+typedef struct
+{
+    PyObject_HEAD
+    std::vector<pyKromekEvent> *pEvents;
+    Py_ssize_t shape[1];
+    Py_ssize_t strides[1];
+} eventBatchObject;
 
 #endif /* pyKromek_hpp */
@@ -1,6 +1,15 @@
 from distutils.core import setup, Extension
 setupSpam = False
 setupPyKromek = True
+# Build pyKromek with simulated detectors (StubDataInterface.h) instead of USB devices, for running without hardware
+# or where libudev is not available
+useStubDevice = False
+
+# Driver code common to the usb and the stub builds
+driverSources = ['CriticalSection.cpp', 'Event.cpp', 'Lock.cpp', 'Thread.cpp', 'RollingQueue.cpp',
+                 'IntervalCountProcessor.cpp', 'D3DataProcessor.cpp', 'DeviceBase.cpp', 'Detector.cpp',
+                 'GR1.cpp', 'GR05.cpp', 'SIGMA_25.cpp', 'SIGMA_50.cpp', 'TN15.cpp', 'K102.cpp', 'RadAngel.cpp',
+                 'DeviceMgr.cpp', 'DriverMgr.cpp', 'SpectrometerDriver.cpp']
 
 if setupSpam:
     spamModule = Extension('spam', sources=['cppDriverCode/spammodule.c'])
@@ -8,6 +17,22 @@ if setupSpam:
           ext_modules = [spamModule])
 
 if setupPyKromek:
-    pyKromekModule = Extension('pyKromek', sources=['cppDriverCode/pyKromekModule.cpp'])
-    setup(name='pyKromek', version='1.0', description='A python extension for C++ Kromek driver code?',
-          ext_modules = [pyKromekModule],)
\ No newline at end of file
+    defineMacros = [('_UNICODE', None)]
+    libraries = []
+    if useStubDevice:
+        driverSources += ['StubDataInterface.cpp', 'DeviceEnumeratorStub.cpp']
+        defineMacros.append(('PYKROMEK_STUB_DEVICE', None))
+    else:
+        driverSources += ['USBKromekDataInterfaceLinux.cpp', 'DeviceEnumeratorLinux.cpp']
+        libraries.append('udev')
+
+    pyKromekModule = Extension('pyKromek',
+                               sources=['cppDriverCode/pyKromek.cpp'] +
+                                       ['cppDriverCode/' + source for source in driverSources],
+                               include_dirs=['cppDriverCode'],
+                               define_macros=defineMacros,
+                               libraries=libraries,
+                               extra_compile_args=['-pthread', '-Wno-enum-compare'],
+                               extra_link_args=['-pthread'])
+    setup(name='pyKromek', version='1.0', description='A python extension for C++ Kromek driver code',
+          ext_modules = [pyKromekModule],)
@@ -10,3 +10,9 @@
 
 #define FILEVERSION 49,MAJORVERSION,MINORVERSION,REVISIONVERSION
 #define PRODUCTVERSION FILEVERSION
+
+// The names used by kr_GetVersionInformation
+#define VERSION_PRODUCT 49
+#define VERSION_MAJOR MAJORVERSION
+#define VERSION_MINOR MINORVERSION
+#define VERSION_BUILD REVISIONVERSION
@@ -1,5 +1,10 @@
 import string
 import numpy
+import os
+import glob
+import hashlib
+import time
+import warnings
 
 def isNum(testNum):
     try:
@@ -10,7 +15,36 @@ def isNum(testNum):
 
 
 
-def getTableData(filename, skiprows=1, delimiter=',', senseUnits=True):
+def getUnitFactors(columnUnits):
+    unitFactorsList = []
+    for unit in columnUnits:
+        unit = string.replace(string.replace(unit,')', ''), '(', '')
+        unit = string.replace(string.replace(unit,']', ''), '[', '')
+        if unit.lower() in ['v', 'a', 'm', 'kg, w', 's']:
+            unitFactorsList.append(float(1))
+        elif unit.lower() in ['mv', 'ma', 'mm', 'g', 'mw', 'ms']:
+            unitFactorsList.append(float(1e-3))
+        elif unit.lower() in ['uv', 'ua', 'um', 'mg', 'uw', 'us']:
+            unitFactorsList.append(float(1e-6))
+        elif unit.lower() in ['nv', 'na', 'nm', 'ng', 'nw', 'ns']:
+            unitFactorsList.append(float(1e-9))
+        else:
+            unitFactorsList.append(float(1))
+    return unitFactorsList
+
+
+def makeTableDict(columnNames, tableData, unitFactorsList=None):
+    tableDict = {}
+    for (n, columnName) in list(enumerate(columnNames)):
+        if unitFactorsList is not None:
+            tableDict[columnName] = tableData[:,n] * unitFactorsList[n]
+        else:
+            tableDict[columnName] = tableData[:,n]
+    return tableDict
+
+
+def getTableDataLoadtxt(filename, skiprows=1, delimiter=',', senseUnits=True):
+    # The original reader, the file is opened for the header and then read again by numpy.loadtxt
     f = open(filename, 'r')
     # the first line is the header information naming the columns of data
     firstLine = f.readline()
@@ -18,33 +52,129 @@ def getTableData(filename, skiprows=1, delimiter=',', senseUnits=True):
 
 
     if senseUnits:
-        unitFactorsList = []
         secondLine = f.readline()
         columnUnits = string.split(secondLine.strip(), delimiter)
-        for unit in columnUnits:
-            unit = string.replace(string.replace(unit,')', ''), '(', '')
-            unit = string.replace(string.replace(unit,']', ''), '[', '')
-            if unit.lower() in ['v', 'a', 'm', 'kg, w', 's']:
-                unitFactorsList.append(float(1))
-            elif unit.lower() in ['mv', 'ma', 'mm', 'g', 'mw', 'ms']:
-                unitFactorsList.append(float(1e-3))
-            elif unit.lower() in ['uv', 'ua', 'um', 'mg', 'uw', 'us']:
-                unitFactorsList.append(float(1e-6))
-            elif unit.lower() in ['nv', 'na', 'nm', 'ng', 'nw', 'ns']:
-                unitFactorsList.append(float(1e-9))
-            else:
-                unitFactorsList.append(float(1))
+        unitFactorsList = getUnitFactors(columnUnits)
+    else:
+        unitFactorsList = None
 
 
     f.close()
     tableData = numpy.loadtxt(filename, skiprows=skiprows, delimiter=delimiter)
-    tableDict = {}
-    for (n, columnName) in list(enumerate(columnNames)):
-        if senseUnits:
-            tableDict[columnName] = tableData[:,n] * unitFactorsList[n]
+    return makeTableDict(columnNames, tableData, unitFactorsList)
+
+
+def splitLeadingLines(fileText, numOfLines):
+    # the first numOfLines lines of the text and the index where the rest of the text starts
+    lines = []
+    startIndex = 0
+    for lineIndex in range(numOfLines):
+        endIndex = fileText.find('\n', startIndex)
+        if endIndex == -1:
+            lines.append(fileText[startIndex:])
+            startIndex = len(fileText)
         else:
-            tableDict[columnName] = tableData[:,n]
-    return tableDict
+            lines.append(fileText[startIndex:endIndex])
+            startIndex = endIndex + 1
+    return lines, startIndex
+
+
+def parseDataBlock(dataText, delimiter=','):
+    """
+    Parse all the rows of numbers in a block of text in a single call to numpy.fromstring.
+
+    :return: a 2-D array with a column for each column of data, or None if the text is not a complete table of numbers
+        (missing values, text, or rows with different numbers of columns).
+    """
+    dataText = dataText.strip()
+    if dataText == '':
+        return None
+    # the first line of data sets the number of columns
+    firstLineEnd = dataText.find('\n')
+    if firstLineEnd == -1:
+        firstLineEnd = len(dataText)
+    numOfColumns = len(string.split(dataText[:firstLineEnd].strip(), delimiter))
+    numOfRows = dataText.count('\n') + 1
+    # every row must have the same number of fields, ragged rows can add up to numOfRows * numOfColumns values
+    if len(delimiter) != 1:
+        return None
+    textCodes = numpy.frombuffer(dataText, dtype=numpy.uint8)
+    rowNumbers = numpy.cumsum(textCodes == ord('\n'))
+    delimitersPerRow = numpy.bincount(rowNumbers[textCodes == ord(delimiter)], minlength=numOfRows)
+    if numpy.any(delimitersPerRow != numOfColumns - 1):
+        return None
+    if delimiter.strip() != '':
+        if delimiter + delimiter in dataText:
+            # an empty value
+            return None
+        dataText = dataText.replace(delimiter, ' ')
+    # numpy.fromstring stops at the first value that is not a number, so text before the end gives too few values,
+    # but the end of a bad last value (4x, 0x10) is dropped without an error
+    try:
+        float(dataText.rsplit(None, 1)[-1])
+    except ValueError:
+        return None
+    with warnings.catch_warnings():
+        # newer versions of numpy warn when the text is not read to its end
+        warnings.simplefilter('error')
+        try:
+            flatData = numpy.fromstring(dataText, dtype=float, sep=' ')
+        except DeprecationWarning:
+            return None
+    if len(flatData) != numOfRows * numOfColumns:
+        return None
+    return flatData.reshape((numOfRows, numOfColumns))
+
+
+def getTableData(filename, skiprows=1, delimiter=',', senseUnits=True):
+    """
+    Read a table of numbers with a header line naming the columns. With senseUnits the second line is read as the
+    units of each column and the data is scaled to base units (mV to V, us to s, ...).
+
+    The file is read once and the data is parsed as a single block of text. Files that are not a simple table of
+    numbers are read with getTableDataLoadtxt (numpy.loadtxt) so that the behavior is unchanged. Files with only '\\r'
+    line endings are also read, and a UTF-8 byte order mark is removed from the first column name.
+    """
+    f = open(filename, 'rU')
+    fileText = f.read()
+    f.close()
+    if fileText.startswith('\xef\xbb\xbf'):
+        fileText = fileText[3:]
+    # the first line is the header information naming the columns of data
+    leadingLines, dataStartIndex = splitLeadingLines(fileText, 2)
+    columnNames = string.split(leadingLines[0].strip(), delimiter)
+
+    if senseUnits:
+        columnUnits = string.split(leadingLines[1].strip(), delimiter)
+        unitFactorsList = getUnitFactors(columnUnits)
+    else:
+        unitFactorsList = None
+
+    skippedLines, dataStartIndex = splitLeadingLines(fileText, skiprows)
+    tableData = parseDataBlock(fileText[dataStartIndex:], delimiter=delimiter)
+    if tableData is None or tableData.shape[1] < len(columnNames):
+        return getTableDataLoadtxt(filename, skiprows=skiprows, delimiter=delimiter, senseUnits=senseUnits)
+    return makeTableDict(columnNames, tableData, unitFactorsList)
+
+
+def getFolderTableData(folderName, fileNamePrefix='', filenameSuffix='', skiprows=1, delimiter=',',
+                       senseUnits=True, verbose=False):
+    """
+    Read all the tables in a folder that match fileNamePrefix + '*' + filenameSuffix with getTableData.
+
+    :return: a dictionary with the full file name as the key and the tableDict of that file as the value.
+    """
+    fileNames = sorted(glob.glob(os.path.join(folderName, fileNamePrefix + '*' + filenameSuffix)))
+    numOfFiles = len(fileNames)
+    modLen = max((int(numOfFiles / 200.0), 1))
+    folderTableDict = {}
+    for (fileIndex, fileName) in list(enumerate(fileNames)):
+        folderTableDict[fileName] = getTableData(fileName, skiprows=skiprows, delimiter=delimiter,
+                                                 senseUnits=senseUnits)
+        if verbose:
+            if fileIndex % modLen == 0:
+                print "File read-in is " + str('%02.2f' % (fileIndex * 100.0 / float(numOfFiles))) + " % complete."
+    return folderTableDict
 
 
 def getTableRowData(filename, delimiter=','):
@@ -64,3 +194,190 @@ def getTableRowData(filename, delimiter=','):
     f.close()
     return tableDict
 
+
+class parsedTableCache():
+    """
+    An on-disk cache of the tables parsed by getTableData, so that reading the same text file again is a binary
+    read. Each table is saved as a .npz file in cacheFolder, named by a hash of the absolute file name, the file's
+    modification time and size, and the skiprows, delimiter and senseUnits options. A changed file or different
+    options give a different name, so old entries are never used and are removed by the eviction.
+    When the cache is larger than maxCacheBytes the least recently used entries are deleted.
+    """
+    def __init__(self, cacheFolder, maxCacheBytes=int(2 * 1024**3)):
+        self.cacheFolder = cacheFolder
+        self.maxCacheBytes = maxCacheBytes
+        if not os.path.isdir(self.cacheFolder):
+            os.makedirs(self.cacheFolder)
+        self.cacheBytes = None
+
+    def getCacheFileName(self, filename, skiprows, delimiter, senseUnits):
+        absFileName = os.path.abspath(filename)
+        fileStat = os.stat(absFileName)
+        cacheKey = repr((absFileName, fileStat.st_mtime, fileStat.st_size, skiprows, delimiter, senseUnits))
+        return os.path.join(self.cacheFolder, hashlib.sha1(cacheKey).hexdigest() + '.npz')
+
+    def getTableData(self, filename, skiprows=1, delimiter=',', senseUnits=True):
+        cacheFileName = self.getCacheFileName(filename, skiprows, delimiter, senseUnits)
+        if os.path.isfile(cacheFileName):
+            try:
+                npzFile = numpy.load(cacheFileName)
+                columnNames = [str(columnName) for columnName in npzFile['columnNames']]
+                tableData = npzFile['tableData']
+                npzFile.close()
+                # the modification time of the cache file is the last time it was used, for the eviction
+                os.utime(cacheFileName, None)
+                return makeTableDict(columnNames, tableData)
+            except (IOError, OSError, ValueError, KeyError):
+                # a damaged or partly written entry, or one that was evicted by another process, is read again
+                pass
+        tableDict = getTableData(filename, skiprows=skiprows, delimiter=delimiter, senseUnits=senseUnits)
+        self.store(cacheFileName, tableDict)
+        return tableDict
+
+    def store(self, cacheFileName, tableDict):
+        columnNames = tableDict.keys()
+        tableData = numpy.array([tableDict[columnName] for columnName in columnNames]).T
+        # write to a temporary name and rename, so a partly written file is never read by another process
+        tempFileName = cacheFileName + '.' + str(os.getpid()) + '.tmp'
+        tempFileHandle = open(tempFileName, 'wb')
+        numpy.savez(tempFileHandle, columnNames=numpy.array(columnNames), tableData=tableData)
+        tempFileHandle.close()
+        os.rename(tempFileName, cacheFileName)
+        if self.cacheBytes is None:
+            self.cacheBytes = self.getCacheBytes()
+        else:
+            self.cacheBytes += os.path.getsize(cacheFileName)
+        if self.maxCacheBytes < self.cacheBytes:
+            self.evict()
+
+    def getCacheEntries(self):
+        # (last used time, size, file name) for every entry, the least recently used first
+        cacheEntries = []
+        for cacheFileName in glob.glob(os.path.join(self.cacheFolder, '*.npz')):
+            try:
+                fileStat = os.stat(cacheFileName)
+            except OSError:
+                continue
+            cacheEntries.append((fileStat.st_mtime, fileStat.st_size, cacheFileName))
+        return sorted(cacheEntries)
+
+    def getCacheBytes(self):
+        return sum([fileSize for (lastUsed, fileSize, cacheFileName) in self.getCacheEntries()])
+
+    def evict(self, targetFraction=0.9):
+        # remove the least recently used entries until the cache is below targetFraction of maxCacheBytes
+        cacheEntries = self.getCacheEntries()
+        cacheBytes = sum([fileSize for (lastUsed, fileSize, cacheFileName) in cacheEntries])
+        for (lastUsed, fileSize, cacheFileName) in cacheEntries:
+            if cacheBytes <= targetFraction * self.maxCacheBytes:
+                break
+            try:
+                os.remove(cacheFileName)
+            except OSError:
+                # removed already by another process
+                pass
+            cacheBytes -= fileSize
+        self.cacheBytes = cacheBytes
+
+    def clear(self):
+        for (lastUsed, fileSize, cacheFileName) in self.getCacheEntries():
+            os.remove(cacheFileName)
+        self.cacheBytes = 0
+
+
+def benchmarkGetTableData(fileNames, skiprows=1, delimiter=',', senseUnits=True, repeats=3, verbose=True):
+    """
+    Compares the time of getTableData to the numpy.loadtxt reader getTableDataLoadtxt, and checks that both give
+    the same values. Only the files that both readers can read are included in the times.
+
+    :return: a dictionary of the total time in seconds for each reader
+    """
+    timesDict = {'getTableData': 0.0, 'getTableDataLoadtxt': 0.0}
+    numOfComparedFiles = 0
+    for fileName in fileNames:
+        try:
+            startTime = time.time()
+            for repeatIndex in range(repeats):
+                fastTableDict = getTableData(fileName, skiprows=skiprows, delimiter=delimiter, senseUnits=senseUnits)
+            fastTime = time.time() - startTime
+        except (ValueError, IndexError):
+            if verbose:
+                print "neither reader can read", fileName
+            continue
+        try:
+            startTime = time.time()
+            for repeatIndex in range(repeats):
+                tableDict = getTableDataLoadtxt(fileName, skiprows=skiprows, delimiter=delimiter,
+                                                senseUnits=senseUnits)
+            loadtxtTime = time.time() - startTime
+        except (ValueError, IndexError):
+            if verbose:
+                print "getTableDataLoadtxt can not read", fileName
+            continue
+        for columnName in tableDict.keys():
+            if not numpy.array_equal(tableDict[columnName], fastTableDict[columnName]):
+                raise ValueError("getTableData and getTableDataLoadtxt are different for the column " +
+                                 str(columnName) + " in the file " + fileName)
+        timesDict['getTableData'] += fastTime
+        timesDict['getTableDataLoadtxt'] += loadtxtTime
+        numOfComparedFiles += 1
+
+    if verbose and numOfComparedFiles > 0:
+        print "Read", numOfComparedFiles, "files", repeats, "times with each reader, the values are identical."
+        for readerName in sorted(timesDict.keys()):
+            print readerName + ":", str('%.3f' % timesDict[readerName]), "s total,", \
+                str('%.3E' % (timesDict[readerName] / float(numOfComparedFiles * repeats))), "s per file,", \
+                str('%.2f' % (timesDict['getTableDataLoadtxt'] / timesDict[readerName])), \
+                "times faster than getTableDataLoadtxt"
+    return timesDict
+
+
+def makeSyntheticTraces(folderName, numOfFiles=20, numOfPoints=10000, numOfChannels=4, fileNamePrefix='trace_'):
+    # Oscilloscope like pulse files, a header line, a units line and a blank line, then tab delimited data.
+    numpy.random.seed(0)
+    timeData = numpy.linspace(-1.0, 99.0, numOfPoints)
+    channelNames = ['Channel ' + 'ABCDEFGH'[channelIndex] for channelIndex in range(numOfChannels)]
+    fileNames = []
+    for fileIndex in range(numOfFiles):
+        fileName = os.path.join(folderName, fileNamePrefix + str('%04i' % fileIndex) + '.txt')
+        traces = [timeData]
+        for channelIndex in range(numOfChannels):
+            height = -numpy.random.uniform(50.0, 250.0)
+            pulse = height * numpy.exp(-numpy.clip(timeData, 0.0, None) / 3.0) * (0.0 < timeData)
+            traces.append(pulse + numpy.random.normal(0.0, 1.0, numOfPoints))
+        header = 'Time\t' + '\t'.join(channelNames) + '\n' + '(us)' + '\t(mV)' * numOfChannels + '\n'
+        numpy.savetxt(fileName, numpy.array(traces).T, fmt='%.6f', delimiter='\t', header=header, comments='')
+        fileNames.append(fileName)
+    return fileNames
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    repeats = 3
+
+    # The test data CSVs, these are header (no units) and comma delimited
+    testDataFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testData')
+    print "Benchmark on the CSV files in", testDataFolder
+    testDataFileNames = sorted(glob.glob(os.path.join(testDataFolder, '*.csv')))
+    benchmarkGetTableData(testDataFileNames, skiprows=1, delimiter=',', senseUnits=False, repeats=repeats)
+
+    # Synthetic scope traces, like the files read in by pulse/pulseReadIn.py
+    syntheticFolder = tempfile.mkdtemp()
+    try:
+        print "\nBenchmark on synthetic scope traces in", syntheticFolder
+        syntheticFileNames = makeSyntheticTraces(syntheticFolder)
+        benchmarkGetTableData(syntheticFileNames, skiprows=3, delimiter='\t', senseUnits=True, repeats=repeats)
+        startTime = time.time()
+        folderTableDict = getFolderTableData(syntheticFolder, fileNamePrefix='trace_', filenameSuffix='.txt',
+                                             skiprows=3, delimiter='\t')
+        print "getFolderTableData read", len(folderTableDict), "files in", str('%.3f' % (time.time() - startTime)), "s"
+        tableCache = parsedTableCache(os.path.join(syntheticFolder, 'cache'))
+        for cacheRead in ['first (parse and store)', 'repeat (cached)']:
+            startTime = time.time()
+            for fileName in syntheticFileNames:
+                tableCache.getTableData(fileName, skiprows=3, delimiter='\t')
+            print "parsedTableCache", cacheRead, "read of", len(syntheticFileNames), "files in", \
+                str('%.3f' % (time.time() - startTime)), "s"
+    finally:
+        shutil.rmtree(syntheticFolder)
@@ -1,12 +1,21 @@
 import os
+import time
 import getpass
+from array import array
+import numpy
 
 
 ### A set of tools for unit conversion
-conversionToMeters = {'km': float(1e3), 'm': float(1), 'cm': float(1e-2), 'mm': float(1e-3), 'um': float(1e-6),
-                      'nm': float(1e-9), 'fm': float(1e-12)}
+conversionToMeters = {'pc': float(3.0856775807e16), 'km': float(1e3), 'm': float(1), 'cm': float(1e-2),
+                      'mm': float(1e-3), 'um': float(1e-6), 'nm': float(1e-9), 'Ang': float(1e-10),
+                      'fm': float(1e-15)}
 
-conversionTo_eV = {'TeV': float(1e12), 'GeV': float(1e9), 'MeV': float(1e6), 'keV': float(1e3), 'eV': float(1)}
+conversionTo_eV = {'PeV': float(1e15), 'TeV': float(1e12), 'GeV': float(1e9), 'MeV': float(1e6), 'keV': float(1e3),
+                   'eV': float(1), 'meV': float(1e-3)}
+
+# (factor, common unit) for every unit, for the streaming parser
+conversionToCommonUnits = dict([(unit, (factor, 'm')) for (unit, factor) in conversionToMeters.items()] +
+                               [(unit, (factor, 'eV')) for (unit, factor) in conversionTo_eV.items()])
 
 
 def getConversionFactor(unit):
@@ -248,7 +257,527 @@ def getGeantOutput(longFileName):
     return particleList
 
 
+"""
+Streaming read-in of the Geant4 tracking output into columnar numpy arrays.
+
+The file is read one line at a time in a single pass and the values go straight into typed column buffers in common
+units (m and eV), so the memory used is the size of the columns and not of the lines or of per value objects. For
+files too large for the columns themselves iterGeantTables gives them a chunk of steps at a time. The tables are:
+
+    steps:          'trackIndex', 'Track ID' and a column for each column of the 'Step#' header ('Step#', 'X', ...,
+                    'Volume', 'Process'), in the order of the file
+    tracks:         'trackIndex', 'Track ID', 'Parent ID', 'Particle' and 'thread', one row per G4Track Information
+    secondaries:    'trackIndex', 'Track ID', 'Step#' of the step that made them, 'X', 'Y', 'Z', 'KineE', 'Particle'
+
+trackIndex counts the tracks from 0 over the whole file, Track ID restarts with every event. Text columns ('Volume',
+'Process', 'Particle', ...) hold integer codes into the list tablesDict['names']. The lines of the worker threads of
+a multi-threaded run (G4WT0 > , G4WT1 > , ...) may be mixed, each thread is followed on its own.
+"""
+# the columns of the 'Step#' header that are text
+textColumnNames = set(['Volume', 'NextVolume', 'Process', 'ProcName'])
+secondaryColumnNames = ['X', 'Y', 'Z', 'KineE']
+# the number of step lines converted to numpy columns at once
+STEP_BATCH_SIZE = 10000
+
+
+def makeColumnBuffers(columnTypes):
+    # a compact growable buffer for each column, typeCodes of the array module
+    return dict([(columnName, array(typeCode)) for (columnName, typeCode) in columnTypes])
+
+
+def columnBuffersToArrays(columnBuffers):
+    tableDict = {}
+    for (columnName, columnBuffer) in columnBuffers.items():
+        if columnBuffer.typecode == 'd':
+            dtype = numpy.float64
+        else:
+            dtype = numpy.int32
+        tableDict[columnName] = numpy.frombuffer(columnBuffer.tostring(), dtype=dtype)
+    return tableDict
+
+
+def parseStepHeader(headerLine):
+    """
+    :return: a list of (columnName, typeCode, factor) for the step columns, factor is None when the values have
+             their own unit after them, or a dictionary of the common units of the columns given in the header.
+    """
+    columnSpec = []
+    unitsDict = {}
+    for headerItem in headerLine.split():
+        if '(' in headerItem:
+            columnName, unit = headerItem.rstrip(')').split('(')
+            factor, commonUnit = conversionToCommonUnits[unit]
+            unitsDict[columnName] = commonUnit
+        else:
+            columnName = headerItem
+            factor = None
+        if columnName == 'Step#':
+            columnSpec.append((columnName, 'i', None))
+        elif columnName in textColumnNames:
+            columnSpec.append((columnName, 'i', 'text'))
+        else:
+            columnSpec.append((columnName, 'd', factor))
+    return columnSpec, unitsDict
+
+
+class geantStreamParser():
+    """
+    The state of the streaming read-in of iterGeantTables, parseLine takes the lines of the file in order.
+    """
+    def __init__(self):
+        self.names = []
+        self.nameCodes = {}
+        self.units = {}
+        self.numOfTracks = 0
+        self.numOfIgnoredLines = 0
+        self.stepLayouts = {}
+        # the current track, step header and last step of each worker thread
+        self.threadStates = {}
+        self.stepColumnSpec = None
+        self.newBuffers()
+
+    def newBuffers(self):
+        self.stepBuffers = makeColumnBuffers([('trackIndex', 'i'), ('Track ID', 'i')])
+        # the split step lines wait in pendingStepTokens to be converted a batch at a time into stepColumnChunks
+        self.pendingStepTokens = []
+        self.stepColumnChunks = {}
+        self.trackBuffers = makeColumnBuffers([('trackIndex', 'i'), ('Track ID', 'i'), ('Parent ID', 'i'),
+                                               ('Particle', 'i'), ('thread', 'i')])
+        self.secondaryBuffers = makeColumnBuffers([('trackIndex', 'i'), ('Track ID', 'i'), ('Step#', 'i')] +
+                                                  [(columnName, 'd') for columnName in secondaryColumnNames] +
+                                                  [('Particle', 'i')])
+        self.numOfBufferedSteps = 0
+
+    def getNameCode(self, name):
+        nameCode = self.nameCodes.get(name)
+        if nameCode is None:
+            nameCode = len(self.names)
+            self.nameCodes[name] = nameCode
+            self.names.append(name)
+        return nameCode
+
+    def getUnitFactor(self, columnName, unit):
+        if unit not in conversionToCommonUnits:
+            raise ValueError("The unit " + repr(unit) + " of the column " + columnName + " is not known.")
+        factor, commonUnit = conversionToCommonUnits[unit]
+        if self.units.setdefault(columnName, commonUnit) != commonUnit:
+            raise ValueError("The column " + columnName + " has values in " + commonUnit + " and " +
+                             self.units[columnName])
+        return factor
+
+    def readValueAndUnit(self, tokens, tokenIndex, columnName, factor):
+        # a number followed by its unit when the header has no unit, returns the value and the next token index
+        value = float(tokens[tokenIndex])
+        tokenIndex += 1
+        if factor is None:
+            if tokenIndex < len(tokens) and tokens[tokenIndex] in conversionToCommonUnits:
+                factor = self.getUnitFactor(columnName, tokens[tokenIndex])
+                tokenIndex += 1
+            else:
+                factor = 1.0
+        return value * factor, tokenIndex
+
+    def parseTrackLine(self, line, thread):
+        trackDict = {}
+        for idKeyAndValue in line.replace('* G4Track Information:', '').split(','):
+            key, value = idKeyAndValue.split('=')
+            trackDict[key.strip()] = value.strip()
+        trackIndex = self.numOfTracks
+        self.numOfTracks += 1
+        self.trackBuffers['trackIndex'].append(trackIndex)
+        self.trackBuffers['Track ID'].append(int(trackDict['Track ID']))
+        self.trackBuffers['Parent ID'].append(int(trackDict['Parent ID']))
+        self.trackBuffers['Particle'].append(self.getNameCode(trackDict['Particle']))
+        self.trackBuffers['thread'].append(thread)
+        threadState = self.threadStates.setdefault(thread, {})
+        threadState['trackIndex'] = trackIndex
+        threadState['Track ID'] = int(trackDict['Track ID'])
+        threadState['Step#'] = -1
+
+    def parseStepLine(self, tokens, threadState):
+        self.stepBuffers['trackIndex'].append(threadState['trackIndex'])
+        self.stepBuffers['Track ID'].append(threadState['Track ID'])
+        # the step number is needed now for the secondaries, the rest of the line is converted later
+        threadState['Step#'] = int(tokens[0])
+        self.pendingStepTokens.append(tokens)
+        self.numOfBufferedSteps += 1
+        if STEP_BATCH_SIZE <= len(self.pendingStepTokens):
+            self.convertPendingSteps()
+
+    def getStepLayout(self, numOfTokens):
+        """
+        :return: a list of (columnName, typeCode, factor, token position, unit token position or None) for step lines
+                 of numOfTokens tokens, when every value without a unit in the header has one after it or none
+                 do, otherwise None.
+        """
+        if numOfTokens not in self.stepLayouts:
+            numOfUnitTokens = numOfTokens - len(self.stepColumnSpec)
+            numOfUnitColumns = len([factor for (columnName, typeCode, factor) in self.stepColumnSpec
+                                    if typeCode == 'd' and factor is None])
+            if numOfUnitTokens not in (0, numOfUnitColumns):
+                self.stepLayouts[numOfTokens] = None
+            else:
+                layout = []
+                tokenIndex = 0
+                for (columnName, typeCode, factor) in self.stepColumnSpec:
+                    if typeCode == 'd' and factor is None and numOfUnitTokens != 0:
+                        layout.append((columnName, typeCode, factor, tokenIndex, tokenIndex + 1))
+                        tokenIndex += 2
+                    else:
+                        layout.append((columnName, typeCode, factor, tokenIndex, None))
+                        tokenIndex += 1
+                self.stepLayouts[numOfTokens] = layout
+        return self.stepLayouts[numOfTokens]
+
+    def parseStepTokens(self, tokens, columnsDict, stepIndex):
+        # one step line at a time, for the lines that do not fit a layout
+        tokenIndex = 0
+        for (columnName, typeCode, factor) in self.stepColumnSpec:
+            if typeCode == 'd':
+                value, tokenIndex = self.readValueAndUnit(tokens, tokenIndex, columnName, factor)
+            elif factor == 'text':
+                value = self.getNameCode(tokens[tokenIndex])
+                tokenIndex += 1
+            else:
+                value = int(tokens[tokenIndex])
+                tokenIndex += 1
+            columnsDict[columnName][stepIndex] = value
+
+    def convertPendingSteps(self):
+        # the waiting step lines to numpy columns, a column at a time for the lines with the same layout
+        pendingStepTokens = self.pendingStepTokens
+        if not pendingStepTokens:
+            return
+        numOfSteps = len(pendingStepTokens)
+        columnsDict = {}
+        for (columnName, typeCode, factor) in self.stepColumnSpec:
+            columnsDict[columnName] = numpy.zeros(numOfSteps, dtype=numpy.float64 if typeCode == 'd' else numpy.int32)
+        numsOfTokens = numpy.array([len(tokens) for tokens in pendingStepTokens])
+        for numOfTokens in numpy.unique(numsOfTokens):
+            stepIndexes = numpy.nonzero(numsOfTokens == numOfTokens)[0]
+            layout = self.getStepLayout(numOfTokens)
+            if layout is None:
+                for stepIndex in stepIndexes:
+                    self.parseStepTokens(pendingStepTokens[stepIndex], columnsDict, stepIndex)
+                continue
+            # the token columns of these lines
+            tokenColumns = zip(*[pendingStepTokens[stepIndex] for stepIndex in stepIndexes])
+            for (columnName, typeCode, factor, tokenIndex, unitIndex) in layout:
+                if typeCode == 'd':
+                    # numpy parses a joined string much faster than astype of the strings
+                    values = numpy.fromstring(' '.join(tokenColumns[tokenIndex]), dtype=numpy.float64, sep=' ')
+                    if unitIndex is not None:
+                        unitFactors = dict([(unit, self.getUnitFactor(columnName, unit))
+                                            for unit in set(tokenColumns[unitIndex])])
+                        values *= numpy.array([unitFactors[unit] for unit in tokenColumns[unitIndex]])
+                    elif factor is not None:
+                        values *= factor
+                elif factor == 'text':
+                    nameCodes = dict([(name, self.getNameCode(name)) for name in set(tokenColumns[tokenIndex])])
+                    values = numpy.array([nameCodes[name] for name in tokenColumns[tokenIndex]], dtype=numpy.int32)
+                else:
+                    values = numpy.fromstring(' '.join(tokenColumns[tokenIndex]), dtype=numpy.int32, sep=' ')
+                columnsDict[columnName][stepIndexes] = values
+        for (columnName, columnValues) in columnsDict.items():
+            self.stepColumnChunks.setdefault(columnName, []).append(columnValues)
+        self.pendingStepTokens = []
+
+    def parseSecondaryLine(self, tokens, threadState):
+        secondaryBuffers = self.secondaryBuffers
+        tokenIndex = 0
+        for columnName in secondaryColumnNames:
+            value, tokenIndex = self.readValueAndUnit(tokens, tokenIndex, columnName, None)
+            secondaryBuffers[columnName].append(value)
+        secondaryBuffers['Particle'].append(self.getNameCode(tokens[tokenIndex]))
+        secondaryBuffers['trackIndex'].append(threadState['trackIndex'])
+        secondaryBuffers['Track ID'].append(threadState['Track ID'])
+        secondaryBuffers['Step#'].append(threadState['Step#'])
+
+    def parseLine(self, line):
+        # the worker thread prefix of multi-threaded runs, -1 without one
+        thread = -1
+        if line[:4] == 'G4WT':
+            prefixEnd = line.find(' >')
+            thread = int(line[4:prefixEnd])
+            line = line[prefixEnd + 2:]
+        tokens = line.split()
+        if not tokens:
+            return
+        firstToken = tokens[0]
+        threadState = self.threadStates.get(thread)
+        # the step lines first as they are most of the file
+        if firstToken.isdigit() and threadState is not None and self.stepColumnSpec is not None:
+            self.parseStepLine(tokens, threadState)
+        elif firstToken[:2] == '**':
+            return
+        elif firstToken == '*' and line.lstrip().startswith('* G4Track Information:'):
+            self.parseTrackLine(line.strip(), thread)
+        elif threadState is None:
+            # the initial states, before the first track of the thread
+            return
+        elif firstToken[0] == ':':
+            # secondaries, between the ':-----' lines at the start and end of the list
+            if firstToken == ':':
+                self.parseSecondaryLine(tokens[1:], threadState)
+            elif firstToken[:2] != ':-':
+                self.parseSecondaryLine([firstToken[1:]] + tokens[1:], threadState)
+        elif firstToken == 'Step#':
+            columnSpec, unitsDict = parseStepHeader(line)
+            if self.stepColumnSpec is None:
+                self.stepColumnSpec = columnSpec
+                self.units.update(unitsDict)
+            elif columnSpec != self.stepColumnSpec:
+                raise ValueError("The step header changed to: " + line.strip())
+        else:
+            self.numOfIgnoredLines += 1
+
+    def getTables(self):
+        """
+        :return: the tables of the lines parsed since the last call and empties the buffers, see iterGeantTables
+        """
+        tablesDict = {}
+        self.convertPendingSteps()
+        tablesDict['steps'] = columnBuffersToArrays(self.stepBuffers)
+        for (columnName, listOfChunks) in self.stepColumnChunks.items():
+            tablesDict['steps'][columnName] = numpy.concatenate(listOfChunks)
+        tablesDict['tracks'] = columnBuffersToArrays(self.trackBuffers)
+        tablesDict['secondaries'] = columnBuffersToArrays(self.secondaryBuffers)
+        tablesDict['names'] = list(self.names)
+        tablesDict['units'] = dict(self.units)
+        self.newBuffers()
+        return tablesDict
+
+
+def iterGeantTables(longFileName, maxStepsPerChunk=1000000):
+    """
+    A generator of the tables (see above) of the Geant4 output file, a chunk of about maxStepsPerChunk steps at a
+    time, in a single pass over the file. The names list of each chunk includes the names of the earlier chunks, so
+    the codes are the same in all the chunks.
+    """
+    parser = geantStreamParser()
+    with open(longFileName, 'r') as fileHandle:
+        for line in fileHandle:
+            parser.parseLine(line)
+            if maxStepsPerChunk <= parser.numOfBufferedSteps:
+                yield parser.getTables()
+    tablesDict = parser.getTables()
+    tablesDict['numOfIgnoredLines'] = parser.numOfIgnoredLines
+    yield tablesDict
+
+
+def concatenateGeantTables(listOfTablesDicts):
+    tablesDict = {}
+    for tableName in ['steps', 'tracks', 'secondaries']:
+        tableDict = {}
+        columnNames = set()
+        for chunkTablesDict in listOfTablesDicts:
+            columnNames.update(chunkTablesDict[tableName].keys())
+        for columnName in columnNames:
+            tableDict[columnName] = numpy.concatenate([chunkTablesDict[tableName][columnName]
+                                                       for chunkTablesDict in listOfTablesDicts
+                                                       if columnName in chunkTablesDict[tableName]])
+        tablesDict[tableName] = tableDict
+    tablesDict['names'] = listOfTablesDicts[-1]['names']
+    tablesDict['units'] = listOfTablesDicts[-1]['units']
+    tablesDict['numOfIgnoredLines'] = listOfTablesDicts[-1].get('numOfIgnoredLines', 0)
+    return tablesDict
+
+
+def getGeantTables(longFileName, maxStepsPerChunk=1000000):
+    # The whole file as one set of tables, see iterGeantTables
+    return concatenateGeantTables(list(iterGeantTables(longFileName, maxStepsPerChunk=maxStepsPerChunk)))
+
+
+def decodeNames(tablesDict, codes):
+    # the text of an array of name codes
+    return numpy.array(tablesDict['names'], dtype=object)[codes]
+
+
+def writeSyntheticGeantOutput(longFileName, numOfTracks=1000, numOfThreads=1, seed=0, interleaveThreads=True):
+    """
+    Writes a made up Geant4 tracking output file in the format read by parseData and iterGeantTables, for testing.
+    Each track is on a random one of numOfThreads worker threads. With interleaveThreads=True the tracks of the
+    threads are mixed a track at a time, like in a multi-threaded run, otherwise all the tracks of each thread are
+    written one after the other. The same seed gives the same tracks either way.
+    """
+    randomState = numpy.random.RandomState(seed)
+    lengthUnits = ['fm', 'um', 'mm', 'cm', 'm']
+    volumes = ['World', 'Scint', 'PMT1', 'PMT2', 'OutOfWorld']
+    processes = ['Transportation', 'OpAbsorption', 'OpRayleigh', 'Scintillation', 'compt', 'phot']
+    particles = ['opticalphoton', 'gamma', 'e-']
+
+    def formatValue(value, units, factors):
+        for (unit, factor) in zip(units, factors):
+            if abs(value) < 1000.0 * factor or unit == units[-1]:
+                return str('%.4g' % (value / factor)) + ' ' + unit
+        return str('%.4g' % value) + ' ' + units[-1]
+
+    def formatLength(value):
+        return formatValue(value, lengthUnits, [conversionToMeters[unit] for unit in lengthUnits])
+
+    def formatEnergy(value):
+        energyUnits = ['eV', 'keV', 'MeV']
+        return formatValue(value, energyUnits, [conversionTo_eV[unit] for unit in energyUnits])
+
+    # the first line of each thread, before its tracks
+    threadStartLines = ['G4WT' + str(thread) + ' > \n' for thread in range(numOfThreads)]
+    # (thread, lines) of each track, in the order they are made
+    trackBlocks = []
+    for trackIndex in range(numOfTracks):
+        thread = randomState.randint(numOfThreads)
+        prefix = 'G4WT' + str(thread) + ' > '
+        lines = []
+        trackBlocks.append((thread, lines))
+        lines.append(prefix + '*' * 100 + '\n')
+        lines.append(prefix + '* G4Track Information:   Particle = ' + particles[randomState.randint(3)] +
+                     ',   Track ID = ' + str(trackIndex % 50 + 1) + ',   Parent ID = ' + str(trackIndex % 50) + '\n')
+        lines.append(prefix + '*' * 100 + '\n')
+        lines.append(prefix + '\n')
+        lines.append(prefix + 'Step#      X         Y         Z        KineE    dEStep   StepLeng  TrakLeng    Volume     Process\n')
+        position = numpy.zeros(3)
+        energy = randomState.uniform(1.0, 3.0e6)
+        trackLength = 0.0
+        for stepNumber in range(randomState.randint(1, 30)):
+            if stepNumber == 0:
+                stepLength = 0.0
+                process = 'initStep'
+            else:
+                stepLength = randomState.exponential(0.05)
+                position += randomState.normal(0.0, stepLength, 3)
+                process = processes[randomState.randint(len(processes))]
+            trackLength += stepLength
+            energyDeposit = energy * randomState.uniform(0.0, 0.1) if stepNumber != 0 else 0.0
+            energy -= energyDeposit
+            values = [formatLength(value) for value in position] + \
+                     [formatEnergy(energy), formatEnergy(energyDeposit), formatLength(stepLength),
+                      formatLength(trackLength)]
+            lines.append(prefix + str('%5i' % stepNumber) + ''.join(['  ' + str('%9s' % value) for value in values]) +
+                         '  ' + str('%9s' % volumes[randomState.randint(len(volumes))]) + '  ' + process + '\n')
+            numOfSecondaries = randomState.poisson(0.3) if stepNumber != 0 else 0
+            if numOfSecondaries:
+                lines.append(prefix + '    :----- List of 2ndaries - #SpawnInStep=  ' + str(numOfSecondaries) +
+                             '(Rest= 0,Along= ' + str(numOfSecondaries) + ',Post= 0), #SpawnTotal=  ' +
+                             str(numOfSecondaries) + ' ---------------\n')
+                for secondaryIndex in range(numOfSecondaries):
+                    values = [formatLength(value) for value in position] + [formatEnergy(randomState.uniform(1, 4))]
+                    lines.append(prefix + '    : ' + ''.join(['  ' + str('%9s' % value) for value in values]) +
+                                 '   ' + particles[randomState.randint(3)] + '\n')
+                lines.append(prefix + '    :----------------------------------------------' +
+                             '      EndOf2ndaries Info ---------------\n')
+    with open(longFileName, 'w') as fileHandle:
+        fileHandle.writelines(threadStartLines)
+        if interleaveThreads:
+            # the tracks are on random threads, so in the order they were made the threads are mixed a track at a
+            # time, and the tracks of each thread are still in order
+            for (thread, lines) in trackBlocks:
+                fileHandle.writelines(lines)
+        else:
+            for threadIndex in range(numOfThreads):
+                for (thread, lines) in trackBlocks:
+                    if thread == threadIndex:
+                        fileHandle.writelines(lines)
+
+
+def benchmarkGeantReadIn(longFileName, verbose=True):
+    """
+    Compares getGeantOutput (readlines and a dictionary per track) with getGeantTables on a single threaded file and
+    checks that they read the same steps.
+
+    :return: a dictionary of the time in seconds of each method
+    """
+    timesDict = {}
+    startTime = time.time()
+    particleList = getGeantOutput(longFileName)
+    timesDict['getGeantOutput'] = time.time() - startTime
+
+    startTime = time.time()
+    tablesDict = getGeantTables(longFileName)
+    timesDict['getGeantTables'] = time.time() - startTime
+
+    steps = tablesDict['steps']
+    for columnName in ['Step#', 'X', 'Y', 'Z', 'KineE', 'dEStep', 'StepLeng', 'TrakLeng']:
+        listValues = numpy.concatenate([particleDict[columnName] for particleDict in particleList])
+        if not numpy.allclose(listValues, steps[columnName], rtol=1e-12, atol=0.0):
+            raise ValueError("getGeantOutput and getGeantTables read different values for " + columnName)
+    listVolumes = numpy.concatenate([particleDict['Volume'] for particleDict in particleList])
+    if not (listVolumes == decodeNames(tablesDict, steps['Volume'])).all():
+        raise ValueError("getGeantOutput and getGeantTables read different volumes")
+
+    if verbose:
+        print len(steps['Step#']), "steps of", len(tablesDict['tracks']['trackIndex']), "tracks and", \
+            len(tablesDict['secondaries']['trackIndex']), "secondaries, the same values with both read-ins."
+        print "getGeantOutput:", str('%.3f' % timesDict['getGeantOutput']), "s, getGeantTables:", \
+            str('%.3f' % timesDict['getGeantTables']), "s,", \
+            str('%.2f' % (timesDict['getGeantOutput'] / timesDict['getGeantTables'])), "times faster"
+    return timesDict
+
+
+def sortTableByThread(table, threads):
+    # the rows of each thread together, in the order they were read
+    sortIndexes = numpy.argsort(threads, kind='mergesort')
+    return dict([(columnName, table[columnName][sortIndexes]) for columnName in table.keys()
+                 if columnName != 'trackIndex'])
+
+
+def benchmarkInterleavedThreads(fileNameBase, numOfTracks=3000, numOfThreads=4, seed=0, verbose=True):
+    """
+    Writes the same multi-threaded tracks twice, with the threads interleaved a track at a time and one thread after
+    the other, and checks that getGeantTables reads the same tracks, steps and secondaries for each thread from both.
+
+    :return: a dictionary of the time in seconds of getGeantTables for each file
+    """
+    timesDict = {}
+    tablesDicts = {}
+    for (methodName, interleaveThreads) in [('interleaved', True), ('threadByThread', False)]:
+        longFileName = fileNameBase + '_' + methodName + '.out'
+        writeSyntheticGeantOutput(longFileName, numOfTracks=numOfTracks, numOfThreads=numOfThreads, seed=seed,
+                                  interleaveThreads=interleaveThreads)
+        startTime = time.time()
+        tablesDicts[methodName] = getGeantTables(longFileName)
+        timesDict[methodName] = time.time() - startTime
+        os.remove(longFileName)
+
+    sortedTables = {}
+    for (methodName, tablesDict) in tablesDicts.items():
+        trackThreads = tablesDict['tracks']['thread']
+        sortedTables[methodName] = {}
+        sortedTables[methodName]['tracks'] = sortTableByThread(tablesDict['tracks'], trackThreads)
+        for tableName in ['steps', 'secondaries']:
+            table = tablesDict[tableName]
+            sortedTables[methodName][tableName] = sortTableByThread(table, trackThreads[table['trackIndex']])
+        # the name codes are given in the order the names are read, compare the names
+        for (tableName, columnName) in [('tracks', 'Particle'), ('steps', 'Volume'), ('steps', 'Process'),
+                                        ('secondaries', 'Particle')]:
+            sortedTables[methodName][tableName][columnName] = \
+                decodeNames(tablesDict, sortedTables[methodName][tableName][columnName])
+    for tableName in ['tracks', 'steps', 'secondaries']:
+        interleavedTable = sortedTables['interleaved'][tableName]
+        threadByThreadTable = sortedTables['threadByThread'][tableName]
+        for columnName in sorted(threadByThreadTable.keys()):
+            if not numpy.array_equal(interleavedTable[columnName], threadByThreadTable[columnName]):
+                raise ValueError("The interleaved threads read different values for " + columnName + " of the " +
+                                 tableName)
+
+    if verbose:
+        steps = tablesDicts['interleaved']['steps']
+        print len(steps['Step#']), "steps of", numOfTracks, "tracks on", numOfThreads, \
+            "interleaved threads, the same values for each thread as one thread after the other."
+        print "interleaved:", str('%.3f' % timesDict['interleaved']), "s, thread by thread:", \
+            str('%.3f' % timesDict['threadByThread']), "s"
+    return timesDict
+
+
 if __name__ == "__main__":
+    doBenchmark = True
+    if doBenchmark:
+        import tempfile
+        syntheticFileName = os.path.join(tempfile.gettempdir(), 'syntheticGeant4.out')
+        writeSyntheticGeantOutput(syntheticFileName, numOfTracks=3000)
+        benchmarkGeantReadIn(syntheticFileName)
+        os.remove(syntheticFileName)
+        benchmarkInterleavedThreads(os.path.join(tempfile.gettempdir(), 'syntheticGeant4'), numOfTracks=3000,
+                                    numOfThreads=4)
+
     # the filenames
     fileNames = ["twopmts.out"]
 
@@ -266,8 +795,15 @@ if __name__ == "__main__":
             print getpass.getuser(), 'is your user name.'
 
 
-        particleList = getGeantOutput(longFileName)
-        print 'The read-in test has completed for ', longFileName
+        if os.path.exists(longFileName):
+            particleList = getGeantOutput(longFileName)
+            print 'The read-in test has completed for ', longFileName
+            tablesDict = getGeantTables(longFileName)
+            print 'The streaming read-in test has completed for ', longFileName, 'with', \
+                len(tablesDict['steps']['trackIndex']), 'steps'
+        else:
+            print longFileName, 'was not found.'
+
 
 
 
@@ -1,14 +1,62 @@
-from geant4.dataReadIn import getGeantOutput
+from geant4.dataReadIn import getGeantOutput, getGeantTables, decodeNames, textColumnNames
 from quickPlots import quickHistograms
-import getpass, os
+import getpass, os, time
+import numpy
 from matplotlib import pyplot as plt
 
 
 
 class singleGamma():
-    def __init__(self, longFileName):
-        self.outputParticleList = getGeantOutput(longFileName)
+    def __init__(self, longFileName, maxStepsPerChunk=1000000):
+        # the columnar step, track and secondary tables of geant4.dataReadIn.getGeantTables
+        self.tablesDict = getGeantTables(longFileName, maxStepsPerChunk=maxStepsPerChunk)
         self.filename = longFileName
+        self.steps = self.tablesDict['steps']
+        self.numOfTracks = len(self.tablesDict['tracks']['trackIndex'])
+
+    def getLastStepIndexes(self):
+        """
+        :return: the index in the step table of the last step of each track, in the order of trackIndex. The steps of a
+                 track are in file order, even when the lines of the threads of a multi-threaded run are mixed.
+        """
+        trackIndexes = self.steps['trackIndex']
+        stepOrder = numpy.argsort(trackIndexes, kind='mergesort')
+        sortedTrackIndexes = trackIndexes[stepOrder]
+        isLastStep = numpy.ones(len(stepOrder), dtype=bool)
+        isLastStep[:-1] = sortedTrackIndexes[1:] != sortedTrackIndexes[:-1]
+        return stepOrder[isLastStep]
+
+    def getColumnValues(self, columnName, stepIndexes):
+        # the values of a step column, text columns as strings
+        values = self.steps[columnName][stepIndexes]
+        if columnName in textColumnNames:
+            return decodeNames(self.tablesDict, values)
+        return values
+
+    def groupBy(self, stepIndexes, thingsToGroupBy):
+        """
+        :return: the grouping key tuples in sorted order of the codes, and the group number of each step.
+        """
+        # the codes of each column to 0..n-1, then the columns into one integer key
+        combinedKeys = numpy.zeros(len(stepIndexes), dtype=numpy.int64)
+        listOfColumnCodes = []
+        for groupElement in thingsToGroupBy:
+            columnCodes, columnIndexes = numpy.unique(self.steps[groupElement][stepIndexes], return_inverse=True)
+            combinedKeys = combinedKeys * len(columnCodes) + columnIndexes
+            listOfColumnCodes.append(columnCodes)
+        groupKeys, groupIndexes = numpy.unique(combinedKeys, return_inverse=True)
+        groupingKeys = []
+        for groupKey in groupKeys:
+            groupingKeyList = []
+            for (groupElement, columnCodes) in reversed(zip(thingsToGroupBy, listOfColumnCodes)):
+                code = columnCodes[groupKey % len(columnCodes)]
+                groupKey //= len(columnCodes)
+                if groupElement in textColumnNames:
+                    groupingKeyList.insert(0, self.tablesDict['names'][code])
+                else:
+                    groupingKeyList.insert(0, code)
+            groupingKeys.append(tuple(groupingKeyList))
+        return groupingKeys, groupIndexes
 
     def finalDestinations(self, valueToGet='KineE', thingsToGroupBy=['Volume','Process'], showPlots=True):
         """
@@ -23,17 +71,16 @@ class singleGamma():
         :param showPlots (bool): Toggles an optional plot to visualize the data.
         :return:
         """
-
+        lastStepIndexes = self.getLastStepIndexes()
+        groupingKeys, groupIndexes = self.groupBy(lastStepIndexes, thingsToGroupBy)
+        values = self.getColumnValues(valueToGet, lastStepIndexes)
+        # one stable sort puts the values of each group together, in track order
+        groupOrder = numpy.argsort(groupIndexes, kind='mergesort')
+        groupStarts = numpy.searchsorted(groupIndexes[groupOrder], numpy.arange(len(groupingKeys) + 1))
         self.finalDestinationDict = {}
-        for particleDict in self.outputParticleList:
-            groupingKeyList = []
-            for groupElement in thingsToGroupBy:
-                groupingKeyList.append(particleDict[groupElement][-1])
-            groupingKey = tuple(groupingKeyList)
-            if groupingKey in self.finalDestinationDict.keys():
-                self.finalDestinationDict[groupingKey].append(particleDict[valueToGet][-1])
-            else:
-                self.finalDestinationDict[groupingKey] = [particleDict[valueToGet][-1]]
+        for (groupIndex, groupingKey) in list(enumerate(groupingKeys)):
+            self.finalDestinationDict[groupingKey] = \
+                values[groupOrder[groupStarts[groupIndex]:groupStarts[groupIndex + 1]]]
 
 
         if showPlots:
@@ -41,10 +88,81 @@ class singleGamma():
                     plotFileName='hist', savePlots=False, doEps=False, showPlots=True,
                     verbose=True)
 
+    def finalDestinationHistograms(self, valueToGet='KineE', thingsToGroupBy=['Volume','Process'], bins=10,
+                                   valueRange=None):
+        """
+        Histograms of the last step values of finalDestinations for all the groups at once, with common bins and a
+        single bincount.
+
+        :param bins: the number of bins, or the bin edges.
+        :param valueRange: (min, max) of the bins, the range of the values by default.
+        :return: the bin edges and a dictionary of the counts of each grouping key.
+        """
+        lastStepIndexes = self.getLastStepIndexes()
+        groupingKeys, groupIndexes = self.groupBy(lastStepIndexes, thingsToGroupBy)
+        values = self.steps[valueToGet][lastStepIndexes]
+        binEdges = numpy.histogram_bin_edges(values, bins=bins, range=valueRange) \
+            if hasattr(numpy, 'histogram_bin_edges') else numpy.histogram(values, bins=bins, range=valueRange)[1]
+        numOfBins = len(binEdges) - 1
+        # numpy.histogram puts the right edge in the last bin
+        binIndexes = numpy.searchsorted(binEdges, values, side='right') - 1
+        binIndexes[values == binEdges[-1]] = numOfBins - 1
+        inRange = (0 <= binIndexes) & (binIndexes < numOfBins)
+        counts = numpy.bincount(groupIndexes[inRange] * numOfBins + binIndexes[inRange],
+                                minlength=len(groupingKeys) * numOfBins).reshape((len(groupingKeys), numOfBins))
+        return binEdges, dict(zip(groupingKeys, counts))
+
+
+def benchmarkFinalDestinations(longFileName, valueToGet='KineE', thingsToGroupBy=['Volume','Process'], verbose=True):
+    """
+    Compares the grouping of the last steps of each particle dictionary of getGeantOutput, with a dictionary lookup
+    for every particle, to the columnar singleGamma.finalDestinations, and checks that the groups are the same.
+
+    :return: a dictionary of the time in seconds of each method
+    """
+    timesDict = {}
+    particleList = getGeantOutput(longFileName)
+    startTime = time.time()
+    listDestinationDict = {}
+    for particleDict in particleList:
+        groupingKey = tuple([particleDict[groupElement][-1] for groupElement in thingsToGroupBy])
+        if groupingKey in listDestinationDict.keys():
+            listDestinationDict[groupingKey].append(particleDict[valueToGet][-1])
+        else:
+            listDestinationDict[groupingKey] = [particleDict[valueToGet][-1]]
+    timesDict['particleDicts'] = time.time() - startTime
+
+    testGamma = singleGamma(longFileName)
+    startTime = time.time()
+    testGamma.finalDestinations(valueToGet=valueToGet, thingsToGroupBy=thingsToGroupBy, showPlots=False)
+    timesDict['columnar'] = time.time() - startTime
+
+    if sorted(listDestinationDict.keys()) != sorted(testGamma.finalDestinationDict.keys()):
+        raise ValueError("The particle dictionaries and the columnar tables have different groups.")
+    for groupingKey in listDestinationDict.keys():
+        if not numpy.allclose(listDestinationDict[groupingKey], testGamma.finalDestinationDict[groupingKey]):
+            raise ValueError("The particle dictionaries and the columnar tables have different values for " +
+                             str(groupingKey))
+    if verbose:
+        print testGamma.numOfTracks, "tracks in", len(listDestinationDict), "groups, the same with both methods."
+        print "particleDicts:", str('%.4f' % timesDict['particleDicts']), "s, columnar:", \
+            str('%.4f' % timesDict['columnar']), "s,", \
+            str('%.2f' % (timesDict['particleDicts'] / timesDict['columnar'])), "times faster"
+    return timesDict
+
 
 
 
 if __name__ == "__main__":
+    doBenchmark = True
+    if doBenchmark:
+        import tempfile
+        from geant4.dataReadIn import writeSyntheticGeantOutput
+        syntheticFileName = os.path.join(tempfile.gettempdir(), 'syntheticGeant4.out')
+        writeSyntheticGeantOutput(syntheticFileName, numOfTracks=20000)
+        benchmarkFinalDestinations(syntheticFileName)
+        os.remove(syntheticFileName)
+
     # the filenames
     fileNames = ["twopmts.out"]
 
@@ -64,5 +182,8 @@ if __name__ == "__main__":
 
 
 
-        testGamma = singleGamma(longFileName)
-        testGamma.finalDestinations(valueToGet='KineE', thingsToGroupBy=['Volume','Process'], showPlots=True)
+        if os.path.exists(longFileName):
+            testGamma = singleGamma(longFileName)
+            testGamma.finalDestinations(valueToGet='KineE', thingsToGroupBy=['Volume','Process'], showPlots=True)
+        else:
+            print longFileName, 'was not found.'
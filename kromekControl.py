@@ -1,9 +1,529 @@
+"""
+Concurrent acquisition from several Kromek detectors.
 
+An acquisitionManager runs one worker thread per detector. A worker reads the events of its device a batch at a
+time (numpy arrays of kromekSpectrum.driverEventDtype) into the device's eventRingBuffer and spectrumAccumulator.
+getMergedEvents takes the events out of all the ring buffers and returns them as one time ordered stream, the
+events are only released once every running device has reported all its events up to their time stamp.
 
-import spam
+When the ring buffer of a device is full the worker either drops the new events, overwrites the oldest ones or
+waits for the reader (the 'policy' of eventRingBuffer). The number of dropped events, the time spent waiting and the
+highest fill level are kept for each device as backpressure metrics, see acquisitionManager.getMetrics.
 
-print spam.system("ls -l")
+The devices are simulatedDevice, made up detectors for testing without hardware, or driverDevice, a detector
+attached through the pyKromek extension (cppDriverCode/pyKromek.cpp) with one driverEventRouter for all of them.
+"""
+import sys
+import time
+import threading
+import Queue
+import numpy
+from kromekSpectrum import driverEventDtype, spectrumAccumulator, makeSyntheticSpectrumShape, \
+    TOTAL_RESULT_CHANNELS, TICKS_PER_SECOND
 
+# time stamp larger than any event, the time a stopped device has reported up to
+END_OF_TIME = numpy.iinfo(numpy.int64).max
 
 
+def getTimeTicks():
+    # the clock of the simulated devices, in ticks like the time stamps of the driver
+    return int(time.time() * TICKS_PER_SECOND)
 
+
+class eventRingBuffer():
+    """
+    A fixed size first in first out buffer of events, for one writer and one reader thread.
+
+    :param capacity: the number of events the buffer holds.
+    :param policy: what write does when the buffer is full, 'drop' the new events, 'overwrite' the oldest events
+                   or 'block' until the reader makes space (up to the timeout of write, then drop).
+    """
+    def __init__(self, capacity=65536, policy='drop'):
+        if policy not in ('drop', 'overwrite', 'block'):
+            raise ValueError("policy must be 'drop', 'overwrite' or 'block', not " + repr(policy))
+        self.capacity = int(capacity)
+        self.policy = policy
+        self.events = numpy.zeros(self.capacity, dtype=driverEventDtype)
+        self.condition = threading.Condition()
+        # the total number of events written and read, the fill level is the difference
+        self.numOfWritten = 0
+        self.numOfRead = 0
+        self.numOfDroppedEvents = 0
+        self.numOfOverwrittenEvents = 0
+        self.maxFillLevel = 0
+        self.blockedTime = 0.0
+
+    def getFillLevel(self):
+        with self.condition:
+            return self.numOfWritten - self.numOfRead
+
+    def copyIn(self, events):
+        # copy events into the buffer at the write position, wrapping around the end, call with the lock held
+        startIndex = self.numOfWritten % self.capacity
+        numOfFirst = min(len(events), self.capacity - startIndex)
+        self.events[startIndex:startIndex + numOfFirst] = events[:numOfFirst]
+        self.events[:len(events) - numOfFirst] = events[numOfFirst:]
+        self.numOfWritten += len(events)
+
+    def write(self, events, timeout=None):
+        """
+        :param events: an array of driverEventDtype.
+        :param timeout: for the 'block' policy, the longest time in seconds to wait for space, None waits forever.
+        :return: the number of events written.
+        """
+        numOfEvents = len(events)
+        with self.condition:
+            if self.policy == 'overwrite':
+                if self.capacity < numOfEvents:
+                    self.numOfOverwrittenEvents += numOfEvents - self.capacity
+                    events = events[-self.capacity:]
+                numOfOverwritten = max(self.numOfWritten - self.numOfRead + len(events) - self.capacity, 0)
+                self.numOfRead += numOfOverwritten
+                self.numOfOverwrittenEvents += numOfOverwritten
+                self.copyIn(events)
+                numOfWritten = numOfEvents
+            else:
+                numOfWritten = 0
+                if timeout is not None:
+                    stopTime = time.time() + timeout
+                while numOfWritten < numOfEvents:
+                    numOfFree = self.capacity - (self.numOfWritten - self.numOfRead)
+                    if 0 < numOfFree:
+                        numOfChunk = min(numOfFree, numOfEvents - numOfWritten)
+                        self.copyIn(events[numOfWritten:numOfWritten + numOfChunk])
+                        numOfWritten += numOfChunk
+                        self.condition.notify_all()
+                        continue
+                    if self.policy == 'drop':
+                        break
+                    # wait for the reader
+                    waitTime = None if timeout is None else stopTime - time.time()
+                    if waitTime is not None and waitTime <= 0.0:
+                        break
+                    waitStart = time.time()
+                    self.condition.wait(waitTime)
+                    self.blockedTime += time.time() - waitStart
+                self.numOfDroppedEvents += numOfEvents - numOfWritten
+            self.maxFillLevel = max(self.maxFillLevel, self.numOfWritten - self.numOfRead)
+            self.condition.notify_all()
+        return numOfWritten
+
+    def read(self, maxNumOfEvents=None):
+        """
+        :return: a copy of up to maxNumOfEvents of the oldest events, all of them for None, removed from the buffer.
+        """
+        with self.condition:
+            numOfEvents = self.numOfWritten - self.numOfRead
+            if maxNumOfEvents is not None:
+                numOfEvents = min(numOfEvents, maxNumOfEvents)
+            startIndex = self.numOfRead % self.capacity
+            numOfFirst = min(numOfEvents, self.capacity - startIndex)
+            events = numpy.concatenate((self.events[startIndex:startIndex + numOfFirst],
+                                        self.events[:numOfEvents - numOfFirst]))
+            self.numOfRead += numOfEvents
+            self.condition.notify_all()
+        return events
+
+
+class simulatedDevice():
+    """
+    A made up detector with Poisson events at countRate per second and channels drawn from probabilities, for
+    testing the acquisition without hardware. The time stamps are from getTimeTicks, shared by all the simulated
+    devices.
+
+    :param readInterval: the time in seconds between the batches of events, like the reads of the driver.
+    """
+    def __init__(self, deviceID, countRate=1000.0, probabilities=None, seed=0, readInterval=0.01):
+        self.deviceID = deviceID
+        self.countRate = float(countRate)
+        if probabilities is None:
+            probabilities = makeSyntheticSpectrumShape(seed=seed)
+        self.numOfChannels = len(probabilities)
+        self.cumulativeProbabilities = numpy.cumsum(probabilities) / numpy.sum(probabilities)
+        self.randomState = numpy.random.RandomState(seed)
+        self.readInterval = readInterval
+        self.lastTime = None
+        self.stopTime = None
+
+    def start(self):
+        self.lastTime = getTimeTicks()
+        self.stopTime = None
+
+    def stop(self):
+        # like the driver, the events up to the stop can still be read after it
+        self.stopTime = getTimeTicks()
+
+    def readEvents(self, timeout=None):
+        """
+        :return: the events since the last read, and the time in ticks up to which all the events have been returned.
+        """
+        sleepTime = self.readInterval - (getTimeTicks() - self.lastTime) / float(TICKS_PER_SECOND)
+        if timeout is not None:
+            sleepTime = min(sleepTime, timeout)
+        if 0.0 < sleepTime and self.stopTime is None:
+            time.sleep(sleepTime)
+        now = getTimeTicks()
+        if self.stopTime is not None:
+            now = min(now, self.stopTime)
+        numOfEvents = self.randomState.poisson(self.countRate * (now - self.lastTime) / float(TICKS_PER_SECOND))
+        events = numpy.zeros(numOfEvents, dtype=driverEventDtype)
+        events['timestamp'] = numpy.sort(self.randomState.randint(self.lastTime, max(now, self.lastTime + 1),
+                                                                  size=numOfEvents))
+        events['deviceID'] = self.deviceID
+        channels = numpy.searchsorted(self.cumulativeProbabilities, self.randomState.uniform(size=numOfEvents))
+        events['channel'] = numpy.minimum(channels, self.numOfChannels - 1)
+        events['numCounts'] = 1
+        self.lastTime = now
+        return events, now
+
+
+class driverEventRouter():
+    """
+    The data received callback of pyKromek for all the driverDevices, it splits each eventBatch by device. The
+    driver's time stamps are from its own clock, so a device is taken to have reported all its events up to the
+    newest time stamp of any device less maxLatency seconds.
+    """
+    def __init__(self, maxLatency=0.1, batchSize=4096, flushInterval=0.05):
+        import pyKromek
+        self.pyKromek = pyKromek
+        self.maxLatencyTicks = int(maxLatency * TICKS_PER_SECOND)
+        self.deviceQueues = {}
+        self.newestTimestamp = None
+        self.lock = threading.Lock()
+        pyKromek.setDataReceivedCallback(self.routeEventBatch, batchSize=batchSize, flushInterval=flushInterval)
+
+    def addDevice(self, deviceID):
+        with self.lock:
+            self.deviceQueues[deviceID] = Queue.Queue()
+        return self.deviceQueues[deviceID]
+
+    def routeEventBatch(self, eventBatch):
+        events = numpy.frombuffer(eventBatch, dtype=driverEventDtype)
+        if len(events) == 0:
+            return
+        with self.lock:
+            self.newestTimestamp = max(self.newestTimestamp, int(events['timestamp'].max()))
+            deviceQueues = self.deviceQueues.items()
+        for (deviceID, deviceQueue) in deviceQueues:
+            deviceEvents = events[events['deviceID'] == deviceID]
+            if len(deviceEvents) != 0:
+                deviceQueue.put(deviceEvents)
+
+    def getReportedTime(self):
+        with self.lock:
+            if self.newestTimestamp is None:
+                return None
+            return self.newestTimestamp - self.maxLatencyTicks
+
+    def close(self):
+        self.pyKromek.setDataReceivedCallback(None)
+
+
+class driverDevice():
+    """
+    A detector attached through pyKromek, deviceID from pyKromek.getDetectorIDs.
+
+    :param realTime: the real time limit in ms of the acquisition, 0 for none, see pyKromek.beginDataAcquisition.
+    """
+    def __init__(self, deviceID, eventRouter, realTime=0, liveTime=0):
+        self.deviceID = deviceID
+        self.eventRouter = eventRouter
+        self.eventQueue = eventRouter.addDevice(deviceID)
+        self.realTime = realTime
+        self.liveTime = liveTime
+        self.numOfChannels = TOTAL_RESULT_CHANNELS
+
+    def start(self):
+        self.eventRouter.pyKromek.beginDataAcquisition(self.deviceID, self.realTime, self.liveTime)
+
+    def stop(self):
+        # the events still waiting in pyKromek are delivered to the event queue, readEvents gets them after the stop
+        self.eventRouter.pyKromek.stopDataAcquisition(self.deviceID)
+        self.eventRouter.pyKromek.flushEvents()
+
+    def readEvents(self, timeout=None):
+        listOfEvents = []
+        try:
+            listOfEvents.append(self.eventQueue.get(timeout=timeout))
+            while True:
+                listOfEvents.append(self.eventQueue.get_nowait())
+        except Queue.Empty:
+            pass
+        if listOfEvents:
+            events = numpy.concatenate(listOfEvents)
+        else:
+            events = numpy.zeros(0, dtype=driverEventDtype)
+        return events, self.eventRouter.getReportedTime()
+
+
+def storeDeviceEvents(deviceState, events, reportedTime, writeTimeout):
+    # one read of a device into its ring buffer and accumulator
+    if len(events) != 0:
+        deviceState['ringBuffer'].write(events, timeout=writeTimeout)
+        deviceState['accumulator'].addEventBatch(events)
+    with deviceState['lock']:
+        deviceState['numOfReads'] += 1
+        deviceState['numOfEvents'] += len(events)
+        if reportedTime is not None:
+            deviceState['reportedTime'] = reportedTime
+
+
+def runDeviceWorker(deviceState, stopEvent, pollInterval, writeTimeout):
+    # The worker thread of one device, reads the device into its ring buffer and accumulator until stopped
+    device = deviceState['device']
+    try:
+        device.start()
+        try:
+            while not stopEvent.is_set():
+                events, reportedTime = device.readEvents(timeout=pollInterval)
+                storeDeviceEvents(deviceState, events, reportedTime, writeTimeout)
+        finally:
+            device.stop()
+        # the events the device gave before it stopped but that were not read yet
+        while True:
+            events, reportedTime = device.readEvents(timeout=0)
+            if len(events) == 0:
+                break
+            storeDeviceEvents(deviceState, events, reportedTime, writeTimeout)
+    except Exception:
+        with deviceState['lock']:
+            deviceState['error'] = sys.exc_info()
+    finally:
+        # everything this device will give is in the ring buffer
+        with deviceState['lock']:
+            deviceState['reportedTime'] = END_OF_TIME
+
+
+class acquisitionManager():
+    """
+    Runs the acquisition of several devices at once, one worker thread per device.
+
+    :param devices: simulatedDevice, driverDevice or anything with deviceID, numOfChannels, start(), stop() and
+                    readEvents(timeout) -> (events, reportedTime).
+    :param bufferCapacity: the number of events in the ring buffer of each device.
+    :param policy: what a worker does with a full ring buffer, see eventRingBuffer.
+    :param writeTimeout: for the 'block' policy, the longest time in seconds a worker waits for space, the
+                         longest time stop can take.
+    :param snapshotInterval: passed to the spectrumAccumulator of each device.
+    """
+    def __init__(self, devices, bufferCapacity=65536, policy='drop', pollInterval=0.05, writeTimeout=1.0,
+                 snapshotInterval=None):
+        self.pollInterval = pollInterval
+        self.writeTimeout = writeTimeout
+        self.stopEvent = threading.Event()
+        self.threads = []
+        self.startTime = None
+        self.stopTime = None
+        self.deviceStates = []
+        for device in devices:
+            deviceState = {}
+            deviceState['device'] = device
+            deviceState['ringBuffer'] = eventRingBuffer(capacity=bufferCapacity, policy=policy)
+            deviceState['accumulator'] = spectrumAccumulator(numOfChannels=device.numOfChannels,
+                                                             snapshotInterval=snapshotInterval)
+            deviceState['lock'] = threading.Lock()
+            deviceState['numOfReads'] = 0
+            deviceState['numOfEvents'] = 0
+            deviceState['reportedTime'] = None
+            deviceState['error'] = None
+            # events read from the ring buffer that are not yet in the merged stream
+            deviceState['pendingEvents'] = numpy.zeros(0, dtype=driverEventDtype)
+            self.deviceStates.append(deviceState)
+        self.deviceIDs = [deviceState['device'].deviceID for deviceState in self.deviceStates]
+        if len(set(self.deviceIDs)) != len(self.deviceIDs):
+            raise ValueError("The devices must have different deviceIDs, not " + str(self.deviceIDs))
+
+    def start(self):
+        self.stopEvent.clear()
+        self.startTime = time.time()
+        self.stopTime = None
+        for deviceState in self.deviceStates:
+            thread = threading.Thread(target=runDeviceWorker,
+                                      args=(deviceState, self.stopEvent, self.pollInterval, self.writeTimeout))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopEvent.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.stopTime = time.time()
+        self.raiseWorkerErrors()
+
+    def isRunning(self):
+        return any(thread.is_alive() for thread in self.threads)
+
+    def raiseWorkerErrors(self):
+        # raise the first error of a worker thread here, in the thread of the caller
+        for deviceState in self.deviceStates:
+            with deviceState['lock']:
+                error = deviceState['error']
+                deviceState['error'] = None
+            if error is not None:
+                (errorType, errorValue, errorTraceback) = error
+                raise errorType, errorValue, errorTraceback
+
+    def getMergedEvents(self):
+        """
+        :return: the events of all the devices in time stamp order, up to the time that every device has reported.
+                 Events with the same time stamp are in the order of the devices. Later calls return later events,
+                 after stop the rest of the events are returned.
+        """
+        self.raiseWorkerErrors()
+        # the reported time is read before the ring buffer, so that the events up to it are all in the buffer
+        reportedTimes = []
+        for deviceState in self.deviceStates:
+            with deviceState['lock']:
+                reportedTimes.append(deviceState['reportedTime'])
+        if None in reportedTimes:
+            return numpy.zeros(0, dtype=driverEventDtype)
+        mergeTime = min(reportedTimes)
+
+        listOfEvents = []
+        for deviceState in self.deviceStates:
+            pendingEvents = numpy.concatenate((deviceState['pendingEvents'], deviceState['ringBuffer'].read()))
+            # the events of a device are in time order, so the released events are the start of the array
+            releaseIndex = numpy.searchsorted(pendingEvents['timestamp'], mergeTime, side='right')
+            listOfEvents.append(pendingEvents[:releaseIndex])
+            deviceState['pendingEvents'] = pendingEvents[releaseIndex:]
+        mergedEvents = numpy.concatenate(listOfEvents)
+        # a stable sort keeps the order of the devices for equal time stamps
+        return mergedEvents[numpy.argsort(mergedEvents['timestamp'], kind='mergesort')]
+
+    def iterMergedEvents(self, pollInterval=None):
+        """
+        A generator of batches of merged events (see getMergedEvents) until the acquisition is stopped and all the
+        events are returned.
+        """
+        if pollInterval is None:
+            pollInterval = self.pollInterval
+        while True:
+            isRunning = self.isRunning()
+            mergedEvents = self.getMergedEvents()
+            if len(mergedEvents) != 0:
+                yield mergedEvents
+            if not isRunning:
+                break
+            time.sleep(pollInterval)
+
+    def getSpectrum(self, deviceID):
+        return self.deviceStates[self.deviceIDs.index(deviceID)]['accumulator'].getSpectrum()
+
+    def getMetrics(self):
+        """
+        :return: a dictionary for each deviceID of the backpressure metrics of the device, the events read, dropped
+                 or overwritten at the ring buffer, the fill level of the ring buffer now and at most, the time the
+                 worker waited for space, the events waiting for the merged stream and the mean event rate.
+        """
+        if self.startTime is None:
+            acquisitionTime = 0.0
+        elif self.stopTime is None:
+            acquisitionTime = time.time() - self.startTime
+        else:
+            acquisitionTime = self.stopTime - self.startTime
+        metricsDict = {}
+        for deviceState in self.deviceStates:
+            ringBuffer = deviceState['ringBuffer']
+            deviceMetrics = {}
+            with deviceState['lock']:
+                deviceMetrics['numOfReads'] = deviceState['numOfReads']
+                deviceMetrics['numOfEvents'] = deviceState['numOfEvents']
+            with ringBuffer.condition:
+                deviceMetrics['numOfDroppedEvents'] = ringBuffer.numOfDroppedEvents
+                deviceMetrics['numOfOverwrittenEvents'] = ringBuffer.numOfOverwrittenEvents
+                deviceMetrics['fillLevel'] = (ringBuffer.numOfWritten - ringBuffer.numOfRead) \
+                                             / float(ringBuffer.capacity)
+                deviceMetrics['maxFillLevel'] = ringBuffer.maxFillLevel / float(ringBuffer.capacity)
+                deviceMetrics['blockedTime'] = ringBuffer.blockedTime
+            deviceMetrics['numOfPendingEvents'] = len(deviceState['pendingEvents'])
+            if 0.0 < acquisitionTime:
+                deviceMetrics['eventRate'] = deviceMetrics['numOfEvents'] / acquisitionTime
+            else:
+                deviceMetrics['eventRate'] = 0.0
+            metricsDict[deviceState['device'].deviceID] = deviceMetrics
+        return metricsDict
+
+
+def printMetrics(metricsDict):
+    for deviceID in sorted(metricsDict.keys()):
+        deviceMetrics = metricsDict[deviceID]
+        print "Device", deviceID, ":", deviceMetrics['numOfEvents'], "events,", \
+            str('%.1f' % deviceMetrics['eventRate']), "events/s,", \
+            deviceMetrics['numOfDroppedEvents'], "dropped,", deviceMetrics['numOfOverwrittenEvents'], "overwritten,", \
+            "max fill", str('%.1f' % (100.0 * deviceMetrics['maxFillLevel'])) + "%,", \
+            "blocked", str('%.3f' % deviceMetrics['blockedTime']), "s"
+
+
+def runSimulatedAcquisition(numOfDevices=3, countRate=5000.0, acquisitionTime=2.0, bufferCapacity=65536,
+                            policy='drop', readerDelay=0.0, verbose=True):
+    """
+    Runs numOfDevices simulated devices at once while reading the merged stream, and checks that the stream is in
+    time order and that it holds every event that was not dropped.
+
+    :param readerDelay: extra seconds the reader sleeps between reads, a slow reader to show the backpressure.
+    :return: the acquisitionManager and the merged events
+    """
+    devices = [simulatedDevice(deviceID=deviceIndex + 1, countRate=countRate, seed=deviceIndex)
+               for deviceIndex in range(numOfDevices)]
+    manager = acquisitionManager(devices, bufferCapacity=bufferCapacity, policy=policy)
+    listOfEvents = []
+    manager.start()
+    stopTime = time.time() + acquisitionTime
+    for mergedEvents in manager.iterMergedEvents():
+        listOfEvents.append(mergedEvents)
+        if stopTime < time.time() and manager.isRunning():
+            manager.stop()
+        time.sleep(readerDelay)
+    if manager.isRunning():
+        manager.stop()
+    mergedEvents = numpy.concatenate(listOfEvents)
+
+    if (numpy.diff(mergedEvents['timestamp']) < 0).any():
+        raise ValueError("The merged events are not in time order.")
+    metricsDict = manager.getMetrics()
+    for deviceID in manager.deviceIDs:
+        deviceMetrics = metricsDict[deviceID]
+        numOfExpected = deviceMetrics['numOfEvents'] - deviceMetrics['numOfDroppedEvents'] \
+                        - deviceMetrics['numOfOverwrittenEvents']
+        if numpy.sum(mergedEvents['deviceID'] == deviceID) != numOfExpected:
+            raise ValueError("The merged events of device " + str(deviceID) + " are not all the events read.")
+    if verbose:
+        print len(mergedEvents), "merged events from", numOfDevices, "devices in time order,", \
+            str('%.2f' % acquisitionTime), "s with the", repr(policy), "policy"
+        printMetrics(metricsDict)
+    return manager, mergedEvents
+
+
+if __name__ == '__main__':
+    from quickPlots import quickPlotter
+    showPlot = True
+    numOfDevices = 3
+
+    manager, mergedEvents = runSimulatedAcquisition(numOfDevices=numOfDevices)
+    # a slow reader and small ring buffers, where the policies differ
+    for policy in ['drop', 'overwrite', 'block']:
+        runSimulatedAcquisition(numOfDevices=numOfDevices, countRate=50000.0, acquisitionTime=1.0,
+                                bufferCapacity=4096, policy=policy, readerDelay=0.2)
+
+    if showPlot:
+        plotDict = {}
+        plotDict['verbose'] = False
+        plotDict['doShow'] = True
+        plotDict['yData'] = [manager.getSpectrum(deviceID) for deviceID in manager.deviceIDs]
+        plotDict['xData'] = [numpy.arange(len(spectrum)) for spectrum in plotDict['yData']]
+        plotDict['legendLabel'] = ['device ' + str(deviceID) for deviceID in manager.deviceIDs]
+        plotDict['fmt'] = 'None'
+        plotDict['markersize'] = 5
+        plotDict['alpha'] = 1.0
+        plotDict['ls'] = 'solid'
+        plotDict['lineWidth'] = 1
+        plotDict['title'] = 'Simulated Kromek Spectra'
+        plotDict['xlabel'] = 'Channel Number'
+        plotDict['legendAutoLabel'] = False
+        plotDict['doLegend'] = True
+        plotDict['legendLoc'] = 0
+        plotDict['legendNumPoints'] = 3
+        plotDict['legendHandleLength'] = 5
+        quickPlotter(plotDict=plotDict)
@@ -0,0 +1,392 @@
+"""
+Event-mode (list-mode) files of Kromek detector events.
+
+A list file keeps every event as a fixed width record of kromekSpectrum.driverEventDtype (time stamp in ticks,
+deviceID, channel, numCounts), so a spectrum for any time window can be rebuilt later with numpy.bincount. The file
+is append only, a file header and then chunks of records:
+
+    file header:    8 byte magic, version, record size, ticks per second
+    each chunk:     chunk header (magic, number of records, first and last time stamp) then the records
+
+After each chunk is written a row of (file offset, number of records, first and last time stamp) is appended to the
+index file (fileName + '.idx'), so that a reader only reads the chunks in a time window. A chunk that was not
+completely written (the acquisition stopped in the middle of a write) is ignored by the reader and cut off when the
+file is appended to. The index is rebuilt from the chunk headers if it is missing or does not match the file.
+"""
+import os
+import threading
+import numpy
+from kromekSpectrum import driverEventDtype, TOTAL_RESULT_CHANNELS, TICKS_PER_SECOND
+
+LIST_FILE_MAGIC = 'KMKLISTM'
+LIST_FILE_VERSION = 1
+CHUNK_MAGIC = 'CHNK'
+INDEX_FILE_SUFFIX = '.idx'
+
+fileHeaderDtype = numpy.dtype([('magic', 'S8'),
+                               ('version', '<u4'),
+                               ('recordSize', '<u4'),
+                               ('ticksPerSecond', '<i8')])
+chunkHeaderDtype = numpy.dtype([('magic', 'S4'),
+                                ('numOfRecords', '<u4'),
+                                ('firstTimestamp', '<i8'),
+                                ('lastTimestamp', '<i8')])
+indexDtype = numpy.dtype([('offset', '<i8'),
+                          ('numOfRecords', '<i8'),
+                          ('firstTimestamp', '<i8'),
+                          ('lastTimestamp', '<i8')])
+
+
+def makeFileHeader():
+    fileHeader = numpy.zeros(1, dtype=fileHeaderDtype)
+    fileHeader['magic'] = LIST_FILE_MAGIC
+    fileHeader['version'] = LIST_FILE_VERSION
+    fileHeader['recordSize'] = driverEventDtype.itemsize
+    fileHeader['ticksPerSecond'] = TICKS_PER_SECOND
+    return fileHeader
+
+
+def readFileHeader(fileHandle, fileName=''):
+    fileHandle.seek(0)
+    fileHeader = numpy.fromfile(fileHandle, dtype=fileHeaderDtype, count=1)
+    if len(fileHeader) != 1 or fileHeader['magic'][0] != LIST_FILE_MAGIC:
+        raise IOError("The file " + fileName + " is not a Kromek list file.")
+    if fileHeader['version'][0] != LIST_FILE_VERSION or fileHeader['recordSize'][0] != driverEventDtype.itemsize:
+        raise IOError("The list file " + fileName + " is version " + str(fileHeader['version'][0]) + " with " +
+                      str(fileHeader['recordSize'][0]) + " byte records, only version " + str(LIST_FILE_VERSION) +
+                      " with " + str(driverEventDtype.itemsize) + " byte records can be read.")
+    return fileHeader[0]
+
+
+def scanChunks(fileHandle, startOffset=fileHeaderDtype.itemsize):
+    """
+    Makes the index of a list file from the chunk headers, starting at the chunk at startOffset.
+
+    :return: an array of indexDtype of the complete chunks, and the offset of the end of the last one.
+    """
+    fileHandle.seek(0, os.SEEK_END)
+    fileSize = fileHandle.tell()
+    listOfRows = []
+    offset = startOffset
+    while offset + chunkHeaderDtype.itemsize <= fileSize:
+        fileHandle.seek(offset)
+        chunkHeader = numpy.fromfile(fileHandle, dtype=chunkHeaderDtype, count=1)[0]
+        chunkEnd = offset + chunkHeaderDtype.itemsize + int(chunkHeader['numOfRecords']) * driverEventDtype.itemsize
+        # the writer never writes an empty chunk
+        if chunkHeader['magic'] != CHUNK_MAGIC or chunkHeader['numOfRecords'] == 0 or fileSize < chunkEnd:
+            break
+        listOfRows.append((offset, chunkHeader['numOfRecords'], chunkHeader['firstTimestamp'],
+                           chunkHeader['lastTimestamp']))
+        offset = chunkEnd
+    return numpy.array(listOfRows, dtype=indexDtype), offset
+
+
+def loadIndex(fileHandle, fileName):
+    """
+    :return: the index of the complete chunks of the list file, from the index file as far as it matches the chunk
+             headers and from the chunk headers after that, and the offset of the end of the last complete chunk.
+    """
+    index = numpy.zeros(0, dtype=indexDtype)
+    indexFileName = fileName + INDEX_FILE_SUFFIX
+    if os.path.exists(indexFileName):
+        index = numpy.fromfile(indexFileName, dtype=indexDtype)
+    # the rows of the index file are only trusted up to the first one that does not match the file
+    fileHandle.seek(0, os.SEEK_END)
+    fileSize = fileHandle.tell()
+    chunkEnds = index['offset'] + chunkHeaderDtype.itemsize + index['numOfRecords'] * driverEventDtype.itemsize
+    expectedOffsets = numpy.concatenate(([fileHeaderDtype.itemsize], chunkEnds[:-1]))
+    isValid = (index['offset'] == expectedOffsets) & (chunkEnds <= fileSize)
+    numOfValidRows = len(index) if isValid.all() else int(numpy.argmin(isValid))
+    index = index[:numOfValidRows]
+    if numOfValidRows != 0:
+        # check the last trusted chunk header, a file written over by a new one has a different one
+        fileHandle.seek(index['offset'][-1])
+        chunkHeader = numpy.fromfile(fileHandle, dtype=chunkHeaderDtype, count=1)[0]
+        if chunkHeader['magic'] != CHUNK_MAGIC or chunkHeader['numOfRecords'] != index['numOfRecords'][-1]:
+            index = index[:0]
+    startOffset = fileHeaderDtype.itemsize if len(index) == 0 else int(chunkEnds[len(index) - 1])
+    scannedIndex, endOffset = scanChunks(fileHandle, startOffset=startOffset)
+    return numpy.concatenate((index, scannedIndex)), endOffset
+
+
+class listModeWriter():
+    """
+    Writes events to a list file a chunk at a time. Thread safe, addEventBatch can be the callback of
+    pyKromek.setDataReceivedCallback and writeEvents can be given the batches of
+    kromekControl.acquisitionManager.iterMergedEvents.
+
+    :param chunkSize: the number of events in each chunk, the events are held in memory until a chunk is full.
+    :param append: add to an existing file, otherwise it is written over.
+    """
+    def __init__(self, fileName, chunkSize=65536, append=True):
+        self.fileName = fileName
+        self.chunkSize = int(chunkSize)
+        self.lock = threading.Lock()
+        self.pendingEvents = []
+        self.numOfPendingEvents = 0
+        self.numOfWrittenEvents = 0
+        self.numOfChunks = 0
+        indexFileName = fileName + INDEX_FILE_SUFFIX
+        if append and os.path.exists(fileName):
+            self.fileHandle = open(fileName, 'r+b')
+            readFileHeader(self.fileHandle, fileName)
+            index, endOffset = loadIndex(self.fileHandle, fileName)
+            # cut off an incomplete chunk and make the index file match the file
+            self.fileHandle.truncate(endOffset)
+            self.fileHandle.seek(endOffset)
+            index.tofile(indexFileName)
+            self.numOfChunks = len(index)
+            self.numOfWrittenEvents = int(index['numOfRecords'].sum())
+        else:
+            self.fileHandle = open(fileName, 'wb')
+            makeFileHeader().tofile(self.fileHandle)
+            self.fileHandle.flush()
+            numpy.zeros(0, dtype=indexDtype).tofile(indexFileName)
+        self.indexFileHandle = open(indexFileName, 'ab')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, excTraceback):
+        self.close()
+
+    def writeEvents(self, events):
+        """
+        :param events: an array of driverEventDtype, or anything numpy.frombuffer can read as one.
+        """
+        if not isinstance(events, numpy.ndarray):
+            events = numpy.frombuffer(events, dtype=driverEventDtype)
+        if len(events) == 0:
+            return
+        with self.lock:
+            # copy, the events may be a view of a buffer that is reused
+            self.pendingEvents.append(numpy.array(events, dtype=driverEventDtype))
+            self.numOfPendingEvents += len(events)
+            if self.chunkSize <= self.numOfPendingEvents:
+                pendingEvents = numpy.concatenate(self.pendingEvents)
+                numOfFullChunks = len(pendingEvents) // self.chunkSize
+                for chunkIndex in range(numOfFullChunks):
+                    self.writeChunk(pendingEvents[chunkIndex * self.chunkSize:(chunkIndex + 1) * self.chunkSize])
+                self.pendingEvents = [pendingEvents[numOfFullChunks * self.chunkSize:]]
+                self.numOfPendingEvents = len(self.pendingEvents[0])
+
+    def addEventBatch(self, eventBatch):
+        self.writeEvents(eventBatch)
+
+    def writeChunk(self, events):
+        # call with the lock held
+        chunkHeader = numpy.zeros(1, dtype=chunkHeaderDtype)
+        chunkHeader['magic'] = CHUNK_MAGIC
+        chunkHeader['numOfRecords'] = len(events)
+        chunkHeader['firstTimestamp'] = events['timestamp'].min()
+        chunkHeader['lastTimestamp'] = events['timestamp'].max()
+        offset = self.fileHandle.tell()
+        # the header and records in one write, the index row only once the chunk is in the file
+        self.fileHandle.write(chunkHeader.tostring() + events.tostring())
+        self.fileHandle.flush()
+        indexRow = numpy.array([(offset, len(events), chunkHeader['firstTimestamp'][0],
+                                 chunkHeader['lastTimestamp'][0])], dtype=indexDtype)
+        self.indexFileHandle.write(indexRow.tostring())
+        self.indexFileHandle.flush()
+        self.numOfWrittenEvents += len(events)
+        self.numOfChunks += 1
+
+    def flush(self):
+        # write the held events as a short chunk
+        with self.lock:
+            if self.numOfPendingEvents != 0:
+                self.writeChunk(numpy.concatenate(self.pendingEvents))
+            self.pendingEvents = []
+            self.numOfPendingEvents = 0
+
+    def close(self):
+        if self.fileHandle.closed:
+            return
+        self.flush()
+        self.fileHandle.close()
+        self.indexFileHandle.close()
+
+
+class listModeReader():
+    """
+    Reads a list file made by listModeWriter, only the chunks that overlap the requested time window are read.
+    Time windows are in ticks, startTime <= timestamp < stopTime, None for no limit.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.fileHandle = open(fileName, 'rb')
+        self.fileHeader = readFileHeader(self.fileHandle, fileName)
+        self.ticksPerSecond = int(self.fileHeader['ticksPerSecond'])
+        self.index, self.endOffset = loadIndex(self.fileHandle, fileName)
+        self.numOfEvents = int(self.index['numOfRecords'].sum())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, excTraceback):
+        self.close()
+
+    def close(self):
+        self.fileHandle.close()
+
+    def getTimeRange(self):
+        if len(self.index) == 0:
+            return None, None
+        return int(self.index['firstTimestamp'].min()), int(self.index['lastTimestamp'].max())
+
+    def iterChunks(self, startTime=None, stopTime=None):
+        """
+        A generator of the events of each chunk that overlaps the time window, not filtered by time.
+        """
+        isInWindow = numpy.ones(len(self.index), dtype=bool)
+        if startTime is not None:
+            isInWindow &= startTime <= self.index['lastTimestamp']
+        if stopTime is not None:
+            isInWindow &= self.index['firstTimestamp'] < stopTime
+        for indexRow in self.index[isInWindow]:
+            self.fileHandle.seek(int(indexRow['offset']) + chunkHeaderDtype.itemsize)
+            yield numpy.fromfile(self.fileHandle, dtype=driverEventDtype, count=int(indexRow['numOfRecords']))
+
+    def selectEvents(self, events, startTime=None, stopTime=None, deviceID=None):
+        isSelected = numpy.ones(len(events), dtype=bool)
+        if startTime is not None:
+            isSelected &= startTime <= events['timestamp']
+        if stopTime is not None:
+            isSelected &= events['timestamp'] < stopTime
+        if deviceID is not None:
+            isSelected &= events['deviceID'] == deviceID
+        if isSelected.all():
+            return events
+        return events[isSelected]
+
+    def readEvents(self, startTime=None, stopTime=None, deviceID=None):
+        """
+        :return: an array of driverEventDtype of the events in the time window, of one device or all of them.
+        """
+        listOfEvents = [self.selectEvents(events, startTime, stopTime, deviceID)
+                        for events in self.iterChunks(startTime, stopTime)]
+        if not listOfEvents:
+            return numpy.zeros(0, dtype=driverEventDtype)
+        return numpy.concatenate(listOfEvents)
+
+    def getSpectrum(self, startTime=None, stopTime=None, deviceID=None, numOfChannels=TOTAL_RESULT_CHANNELS):
+        """
+        :return: the counts in each channel of the events in the time window, like kr_GetAcquiredData.
+        """
+        return self.getSpectra([startTime, stopTime], deviceID=deviceID, numOfChannels=numOfChannels)[0]
+
+    def getSpectra(self, timeEdges, deviceID=None, numOfChannels=TOTAL_RESULT_CHANNELS):
+        """
+        The spectra of several time windows in one pass over the file, with one bincount per chunk.
+
+        :param timeEdges: increasing times in ticks, window i is from timeEdges[i] to timeEdges[i + 1]. The first
+                          and last can be None for no limit.
+        :return: a 2-D array of the counts, one row for each window.
+        """
+        numOfWindows = len(timeEdges) - 1
+        startTime = timeEdges[0]
+        stopTime = timeEdges[-1]
+        innerEdges = numpy.asarray(timeEdges[1:-1], dtype=numpy.int64)
+        spectra = numpy.zeros((numOfWindows, numOfChannels), dtype=numpy.int64)
+        for events in self.iterChunks(startTime, stopTime):
+            events = self.selectEvents(events, startTime, stopTime, deviceID)
+            channels = events['channel'].astype(numpy.int64)
+            inRange = channels < numOfChannels
+            if not inRange.all():
+                events = events[inRange]
+                channels = channels[inRange]
+            windowIndexes = numpy.searchsorted(innerEdges, events['timestamp'], side='right')
+            # a 2-D histogram of (window, channel) with one bincount
+            if (events['numCounts'] == 1).all():
+                chunkCounts = numpy.bincount(windowIndexes * numOfChannels + channels,
+                                             minlength=numOfWindows * numOfChannels)
+            else:
+                chunkCounts = numpy.bincount(windowIndexes * numOfChannels + channels, weights=events['numCounts'],
+                                             minlength=numOfWindows * numOfChannels).astype(numpy.int64)
+            spectra += chunkCounts.reshape((numOfWindows, numOfChannels))
+        return spectra
+
+    def getSpectraByInterval(self, interval, deviceID=None, numOfChannels=TOTAL_RESULT_CHANNELS):
+        """
+        :param interval: the length in seconds of each window, from the first event in the file.
+        :return: the start time in ticks of each window and the spectra, see getSpectra.
+        """
+        firstTimestamp, lastTimestamp = self.getTimeRange()
+        if firstTimestamp is None:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, numOfChannels), dtype=numpy.int64)
+        intervalTicks = int(round(interval * self.ticksPerSecond))
+        timeEdges = numpy.arange(firstTimestamp, lastTimestamp + intervalTicks + 1, intervalTicks)
+        return timeEdges[:-1], self.getSpectra(timeEdges, deviceID=deviceID, numOfChannels=numOfChannels)
+
+
+def captureListMode(manager, fileName, acquisitionTime, chunkSize=65536, append=False, verbose=True):
+    """
+    Runs a kromekControl.acquisitionManager for acquisitionTime seconds and writes its merged event stream to a
+    list file.
+
+    :return: the number of events written
+    """
+    import time
+    with listModeWriter(fileName, chunkSize=chunkSize, append=append) as writer:
+        manager.start()
+        stopTime = time.time() + acquisitionTime
+        for mergedEvents in manager.iterMergedEvents():
+            writer.writeEvents(mergedEvents)
+            if stopTime < time.time() and manager.isRunning():
+                manager.stop()
+        if manager.isRunning():
+            manager.stop()
+    if verbose:
+        print "Wrote", writer.numOfWrittenEvents, "events in", writer.numOfChunks, "chunks to", fileName
+    return writer.numOfWrittenEvents
+
+
+if __name__ == '__main__':
+    import tempfile
+    from kromekControl import acquisitionManager, simulatedDevice
+    from quickPlots import quickPlotter
+    showPlot = True
+    numOfDevices = 2
+    snapshotInterval = 0.5
+
+    fileName = os.path.join(tempfile.gettempdir(), 'kromekListModeTest.kmk')
+    devices = [simulatedDevice(deviceID=deviceIndex + 1, countRate=20000.0, seed=deviceIndex)
+               for deviceIndex in range(numOfDevices)]
+    manager = acquisitionManager(devices)
+    captureListMode(manager, fileName, acquisitionTime=2.0, chunkSize=8192)
+
+    # rebuild the spectra from the file and check them against the ones accumulated during the acquisition
+    with listModeReader(fileName) as reader:
+        firstTimestamp, lastTimestamp = reader.getTimeRange()
+        print reader.numOfEvents, "events in", len(reader.index), "chunks over", \
+            str('%.2f' % ((lastTimestamp - firstTimestamp) / float(reader.ticksPerSecond))), "s"
+        for deviceID in manager.deviceIDs:
+            if not numpy.array_equal(reader.getSpectrum(deviceID=deviceID), manager.getSpectrum(deviceID)):
+                raise ValueError("The spectrum of device " + str(deviceID) + " from the list file is not the same.")
+        print "The spectra rebuilt from the list file are the same as the acquired ones."
+        windowStarts, spectra = reader.getSpectraByInterval(snapshotInterval)
+        middleTime = (firstTimestamp + lastTimestamp) // 2
+        secondHalf = reader.getSpectrum(startTime=middleTime)
+        print len(spectra), "spectra of", snapshotInterval, "s,", secondHalf.sum(), "events in the second half"
+
+    if showPlot:
+        plotDict = {}
+        plotDict['verbose'] = False
+        plotDict['doShow'] = True
+        plotDict['yData'] = [spectrum for spectrum in spectra]
+        plotDict['xData'] = [numpy.arange(len(spectrum)) for spectrum in spectra]
+        plotDict['legendLabel'] = [str('%.1f' % ((windowStart - firstTimestamp) / float(TICKS_PER_SECOND))) + " s"
+                                   for windowStart in windowStarts]
+        plotDict['fmt'] = 'None'
+        plotDict['markersize'] = 5
+        plotDict['alpha'] = 1.0
+        plotDict['ls'] = 'solid'
+        plotDict['lineWidth'] = 1
+        plotDict['title'] = 'Spectra Rebuilt From a List File'
+        plotDict['xlabel'] = 'Channel Number'
+        plotDict['legendAutoLabel'] = False
+        plotDict['doLegend'] = True
+        plotDict['legendLoc'] = 0
+        plotDict['legendNumPoints'] = 3
+        plotDict['legendHandleLength'] = 5
+        quickPlotter(plotDict=plotDict)
@@ -0,0 +1,396 @@
+"""
+Streaming spectrum accumulation for the Kromek detectors driven by the C++ code in cppDriverCode.
+
+The driver (IntervalCountProcessor) reads 63 byte data reports from the detector, a report id byte followed by up
+to 31 two byte words, each with a 12 bit channel number and a valid bit. DriverMgr passes them on as SReport
+structures (SpectrometerData.h) of up to 31 channel hits. Here the reports are handled a batch at a time as numpy
+arrays, so that there is no per-event Python overhead, and added to a preallocated histogram of
+TOTAL_RESULT_CHANNELS channels with time-sliced snapshots.
+"""
+import numpy
+import threading
+from collections import deque
+
+# Highest channel number returned by the detector, TOTAL_RESULT_CHANNELS in SpectrometerData.h
+TOTAL_RESULT_CHANNELS = 4096
+# The number of channel hits in one report, SReport.data in SpectrometerData.h
+REPORT_CHANNELS = 31
+# The size in bytes of a data report from the detector, REPORT_SIZE in IntervalCountProcessor.cpp
+REPORT_SIZE = 63
+# The id of the data reports, DATA_IN_REPORT in IntervalCountProcessor.cpp
+DATA_IN_REPORT = 4
+# The driver time stamps are in ticks of 100 ns, TICK_TIME_NS in kmkTime.h
+TICKS_PER_SECOND = 10000000
+
+# The memory layout of SReport, aligned like the C struct so that an array of SReports from the driver can be used
+# with numpy.frombuffer without a copy.
+reportDtype = numpy.dtype([('reportID', numpy.int32),
+                           ('numValidElements', numpy.int32),
+                           ('data', numpy.int16, (REPORT_CHANNELS,))], align=True)
+# The memory layout of pyKromekEvent (cppDriverCode/pyKromek.hpp), the events in the eventBatch objects that the
+# pyKromek extension passes to its data received callback.
+driverEventDtype = numpy.dtype([('timestamp', '<i8'),
+                                ('deviceID', '<u4'),
+                                ('channel', '<u2'),
+                                ('numCounts', '<u2')])
+
+
+def getReportChannels(reports):
+    """
+    :param reports: an array of reportDtype.
+    :return: the channel numbers of all the valid elements, in report order, and the index of the report for each.
+    """
+    reports = numpy.asarray(reports, dtype=reportDtype)
+    validMask = numpy.arange(REPORT_CHANNELS) < reports['numValidElements'][:, numpy.newaxis]
+    channels = reports['data'][validMask].astype(numpy.int64)
+    reportIndexes = numpy.nonzero(validMask)[0]
+    return channels, reportIndexes
+
+
+def decodeRawReports(rawReports):
+    """
+    The array version of IntervalCountProcessor::ProcessDataReport, for many raw reports at once.
+
+    :param rawReports: bytes or an array of uint8 holding a whole number of REPORT_SIZE byte data reports.
+    :return: an array of reportDtype.
+    """
+    rawReports = numpy.frombuffer(rawReports, dtype=numpy.uint8) if isinstance(rawReports, (str, bytearray)) \
+        else numpy.asarray(rawReports, dtype=numpy.uint8)
+    rawReports = rawReports.reshape((-1, REPORT_SIZE))
+    highBytes = rawReports[:, 1::2].astype(numpy.int16)
+    lowBytes = rawReports[:, 2::2].astype(numpy.int16)
+    # the least significant bit of the second byte marks a valid value, the first invalid value ends the report
+    validMask = numpy.cumprod(lowBytes & 0x1, axis=1).astype(bool)
+    reports = numpy.zeros(len(rawReports), dtype=reportDtype)
+    reports['reportID'] = rawReports[:, 0]
+    reports['numValidElements'] = validMask.sum(axis=1)
+    # the channel number is 12 bit, the 8 bits of the first byte and the top 4 bits of the second byte
+    reports['data'] = numpy.where(validMask, ((highBytes << 4) & 0xFF0) + ((lowBytes >> 4) & 0xF), 0)
+    return reports
+
+
+def encodeRawReports(reports):
+    """
+    The inverse of decodeRawReports, to make raw data reports like the detector's from an array of reportDtype.
+
+    :return: an array of uint8 with shape (len(reports), REPORT_SIZE)
+    """
+    reports = numpy.asarray(reports, dtype=reportDtype)
+    validMask = numpy.arange(REPORT_CHANNELS) < reports['numValidElements'][:, numpy.newaxis]
+    channels = reports['data'].astype(numpy.int32)
+    rawReports = numpy.zeros((len(reports), REPORT_SIZE), dtype=numpy.uint8)
+    rawReports[:, 0] = reports['reportID']
+    rawReports[:, 1::2] = numpy.where(validMask, (channels >> 4) & 0xFF, 0)
+    rawReports[:, 2::2] = numpy.where(validMask, ((channels & 0xF) << 4) + 0x1, 0)
+    return rawReports
+
+
+class spectrumAccumulator():
+    """
+    Adds batches of detector reports to a preallocated histogram. Each call works on the whole batch with numpy,
+    the cost per event is that of numpy.bincount.
+
+    With snapshotInterval set, the counts are also kept in time slices of that length, starting at the first time
+    stamp. A slice is finished and added to the snapshots when a later event falls outside it, or by
+    finishSnapshot. Slices without any events are kept as snapshots of zeros, so the snapshots are evenly spaced
+    in time.
+    """
+    def __init__(self, numOfChannels=TOTAL_RESULT_CHANNELS, snapshotInterval=None, maxNumOfSnapshots=None):
+        """
+        :param numOfChannels: the length of the histogram, events in higher channels are dropped and counted.
+        :param snapshotInterval: the length of the time slices in seconds, None for no snapshots.
+        :param maxNumOfSnapshots: the number of most recent snapshots that are kept, None to keep all of them.
+        """
+        self.numOfChannels = numOfChannels
+        self.snapshotInterval = snapshotInterval
+        if snapshotInterval is None:
+            self.snapshotTicks = None
+        else:
+            self.snapshotTicks = int(round(snapshotInterval * TICKS_PER_SECOND))
+        self.lock = threading.Lock()
+        self.counts = numpy.zeros(numOfChannels, dtype=numpy.int64)
+        self.sliceCounts = numpy.zeros(numOfChannels, dtype=numpy.int64)
+        self.snapshots = deque(maxlen=maxNumOfSnapshots)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts[:] = 0
+            self.sliceCounts[:] = 0
+            self.snapshots.clear()
+            self.sliceStart = None
+            self.firstTimestamp = None
+            self.lastTimestamp = None
+            self.numOfReports = 0
+            self.numOfEvents = 0
+            self.numOfDroppedEvents = 0
+
+    def addReports(self, reports, timestamps=None):
+        """
+        :param reports: an array of reportDtype, or anything numpy.frombuffer can read as one.
+        :param timestamps: the time stamp in ticks of each report, or one for the whole batch. Only needed for
+                           snapshots.
+        """
+        if not isinstance(reports, numpy.ndarray):
+            reports = numpy.frombuffer(reports, dtype=reportDtype)
+        channels, reportIndexes = getReportChannels(reports)
+        if timestamps is not None and numpy.ndim(timestamps) != 0:
+            timestamps = numpy.asarray(timestamps, dtype=numpy.int64)[reportIndexes]
+        self.addChannels(channels, timestamps, numOfReports=len(reports))
+
+    def addRawReports(self, rawReports, timestamps=None):
+        """
+        :param rawReports: bytes or an array of uint8 holding a whole number of REPORT_SIZE byte data reports.
+        """
+        self.addReports(decodeRawReports(rawReports), timestamps)
+
+    def addEventBatch(self, eventBatch, deviceID=None):
+        """
+        :param eventBatch: a pyKromek.eventBatch, or an array of driverEventDtype. Use as the callback of
+                           pyKromek.setDataReceivedCallback.
+        :param deviceID: only add the events of this detector, None for all of them.
+        """
+        if not isinstance(eventBatch, numpy.ndarray):
+            eventBatch = numpy.frombuffer(eventBatch, dtype=driverEventDtype)
+        if deviceID is not None:
+            eventBatch = eventBatch[eventBatch['deviceID'] == deviceID]
+        channels = eventBatch['channel']
+        timestamps = eventBatch['timestamp']
+        if (eventBatch['numCounts'] != 1).any():
+            channels = numpy.repeat(channels, eventBatch['numCounts'])
+            timestamps = numpy.repeat(timestamps, eventBatch['numCounts'])
+        self.addChannels(channels, timestamps)
+
+    def addChannels(self, channels, timestamps=None, numOfReports=0):
+        """
+        :param channels: the channel number of each event, like the DataReceivedCallback of the driver.
+        :param timestamps: the time stamp in ticks of each event, or one for the whole batch, in increasing order.
+        """
+        channels = numpy.asarray(channels, dtype=numpy.int64)
+        inRange = (0 <= channels) & (channels < self.numOfChannels)
+        if not inRange.all():
+            numOfDroppedEvents = len(channels) - int(inRange.sum())
+            channels = channels[inRange]
+            if timestamps is not None and numpy.ndim(timestamps) != 0:
+                timestamps = numpy.asarray(timestamps)[inRange]
+        else:
+            numOfDroppedEvents = 0
+
+        with self.lock:
+            self.numOfReports += numOfReports
+            self.numOfEvents += len(channels)
+            self.numOfDroppedEvents += numOfDroppedEvents
+            if timestamps is not None and 0 < numpy.size(timestamps):
+                if self.firstTimestamp is None:
+                    self.firstTimestamp = int(numpy.min(timestamps))
+                self.lastTimestamp = int(numpy.max(timestamps))
+
+            if self.snapshotTicks is None or timestamps is None or len(channels) == 0:
+                self.counts += numpy.bincount(channels, minlength=self.numOfChannels)
+                if self.snapshotTicks is not None:
+                    self.sliceCounts += numpy.bincount(channels, minlength=self.numOfChannels)
+                return
+
+            if self.sliceStart is None:
+                self.sliceStart = self.firstTimestamp
+            # the slice of each event, counted from the current slice, events from before it are in the current slice
+            sliceIndexes = numpy.maximum((numpy.asarray(timestamps, dtype=numpy.int64) - self.sliceStart)
+                                         // self.snapshotTicks, 0)
+            if numpy.ndim(sliceIndexes) == 0:
+                sliceIndexes = numpy.repeat(sliceIndexes, len(channels))
+            numOfSlices = int(sliceIndexes.max()) + 1
+            # a 2-D histogram of (slice, channel) with one bincount
+            slicedCounts = numpy.bincount(sliceIndexes * self.numOfChannels + channels,
+                                          minlength=numOfSlices * self.numOfChannels)
+            slicedCounts = slicedCounts.reshape((numOfSlices, self.numOfChannels))
+            self.counts += slicedCounts.sum(axis=0)
+            self.sliceCounts += slicedCounts[0]
+            for sliceIndex in range(1, numOfSlices):
+                self.storeSnapshot(self.sliceStart + self.snapshotTicks)
+                self.sliceCounts[:] = slicedCounts[sliceIndex]
+
+    def storeSnapshot(self, sliceStop):
+        # called with the lock held
+        self.snapshots.append((self.sliceStart, sliceStop, self.sliceCounts.copy()))
+        self.sliceStart = sliceStop
+        self.sliceCounts[:] = 0
+
+    def finishSnapshot(self, timestamp=None):
+        """
+        Ends the current time slice early and stores it as a snapshot, for example at the end of an acquisition.
+
+        :param timestamp: the end of the slice in ticks, the last time stamp by default.
+        """
+        with self.lock:
+            if self.sliceStart is None:
+                return
+            if timestamp is None:
+                timestamp = self.lastTimestamp
+            self.storeSnapshot(int(timestamp))
+
+    def getSpectrum(self):
+        with self.lock:
+            return self.counts.copy()
+
+    def getSnapshots(self):
+        """
+        :return: sliceStarts, sliceStops in ticks and an array of the counts in each slice, with shape
+                 (number of snapshots, numOfChannels).
+        """
+        with self.lock:
+            if len(self.snapshots) == 0:
+                return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), \
+                    numpy.zeros((0, self.numOfChannels), dtype=numpy.int64)
+            sliceStarts, sliceStops, slicedCounts = zip(*self.snapshots)
+            return numpy.array(sliceStarts, dtype=numpy.int64), numpy.array(sliceStops, dtype=numpy.int64), \
+                numpy.array(slicedCounts)
+
+    def getRealTime(self):
+        # in seconds, from the first to the last time stamp
+        if self.firstTimestamp is None:
+            return 0.0
+        return (self.lastTimestamp - self.firstTimestamp) / float(TICKS_PER_SECOND)
+
+
+def makeSyntheticSpectrumShape(numOfChannels=TOTAL_RESULT_CHANNELS, numOfPeaks=5, seed=0):
+    # the probability of each channel, Gaussian peaks on an exponential background
+    randomState = numpy.random.RandomState(seed)
+    channels = numpy.arange(numOfChannels)
+    shape = numpy.exp(-channels / (numOfChannels / 6.0)) + 0.01
+    for peakIndex in range(numOfPeaks):
+        mean = randomState.uniform(0.05, 0.9) * numOfChannels
+        sigma = randomState.uniform(0.002, 0.01) * numOfChannels
+        shape += randomState.uniform(0.1, 1.0) * numpy.exp(-(channels - mean)**2 / (2.0 * sigma**2))
+    return shape / shape.sum()
+
+
+def makeSyntheticReports(numOfReports, probabilities=None, meanEventsPerReport=8.0, countRate=1000.0, startTime=0,
+                         randomState=None):
+    """
+    Reports like the ones the driver gives, in place of a real detector.
+
+    :param probabilities: the probability of each channel, makeSyntheticSpectrumShape() by default.
+    :param meanEventsPerReport: the mean of the Poisson number of valid elements in each report, limited to 1-31.
+    :param countRate: the mean number of events per second, for the time stamps.
+    :param startTime: the time stamp in ticks of the start of the reports.
+    :return: an array of reportDtype and the time stamp in ticks of each report.
+    """
+    if probabilities is None:
+        probabilities = makeSyntheticSpectrumShape()
+    if randomState is None:
+        randomState = numpy.random.RandomState(0)
+    numOfValidElements = numpy.clip(randomState.poisson(meanEventsPerReport, numOfReports), 1, REPORT_CHANNELS)
+    cumulativeProbabilities = numpy.cumsum(probabilities)
+    cumulativeProbabilities /= cumulativeProbabilities[-1]
+    channels = numpy.searchsorted(cumulativeProbabilities, randomState.uniform(size=(numOfReports,
+                                                                                     REPORT_CHANNELS)))
+    channels = numpy.minimum(channels, len(probabilities) - 1)
+    validMask = numpy.arange(REPORT_CHANNELS) < numOfValidElements[:, numpy.newaxis]
+    reports = numpy.zeros(numOfReports, dtype=reportDtype)
+    reports['reportID'] = DATA_IN_REPORT
+    reports['numValidElements'] = numOfValidElements
+    reports['data'] = numpy.where(validMask, channels, 0)
+    # a report is sent after its events, the time between events is exponential
+    reportIntervals = randomState.gamma(numOfValidElements, TICKS_PER_SECOND / float(countRate))
+    timestamps = startTime + numpy.cumsum(reportIntervals).astype(numpy.int64)
+    return reports, timestamps
+
+
+def iterSyntheticReports(numOfBatches, reportsPerBatch=1000, probabilities=None, meanEventsPerReport=8.0,
+                         countRate=1000.0, seed=0):
+    """
+    A generator of batches of (reports, timestamps), continuous in time, like the callbacks of a running detector.
+    """
+    randomState = numpy.random.RandomState(seed)
+    if probabilities is None:
+        probabilities = makeSyntheticSpectrumShape()
+    startTime = 0
+    for batchIndex in range(numOfBatches):
+        reports, timestamps = makeSyntheticReports(reportsPerBatch, probabilities=probabilities,
+                                                   meanEventsPerReport=meanEventsPerReport, countRate=countRate,
+                                                   startTime=startTime, randomState=randomState)
+        startTime = timestamps[-1]
+        yield reports, timestamps
+
+
+def benchmarkSpectrumAccumulator(numOfBatches=20, reportsPerBatch=5000, snapshotInterval=1.0, verbose=True):
+    """
+    Compares adding whole batches of reports with spectrumAccumulator to adding them one event at a time, the
+    way a Python callback for each event of the driver would, and checks that the spectra are the same.
+
+    :return: a dictionary of the total time in seconds for each method
+    """
+    import time
+    listOfBatches = list(iterSyntheticReports(numOfBatches, reportsPerBatch=reportsPerBatch))
+    timesDict = {}
+
+    startTime = time.time()
+    perEventCounts = numpy.zeros(TOTAL_RESULT_CHANNELS, dtype=numpy.int64)
+    for (reports, timestamps) in listOfBatches:
+        for report in reports:
+            for channel in report['data'][:report['numValidElements']]:
+                perEventCounts[channel] += 1
+    timesDict['perEvent'] = time.time() - startTime
+
+    startTime = time.time()
+    accumulator = spectrumAccumulator(snapshotInterval=snapshotInterval)
+    for (reports, timestamps) in listOfBatches:
+        accumulator.addReports(reports, timestamps)
+    accumulator.finishSnapshot()
+    timesDict['spectrumAccumulator'] = time.time() - startTime
+
+    if not numpy.array_equal(perEventCounts, accumulator.getSpectrum()):
+        raise ValueError("spectrumAccumulator and the per event loop have different spectra.")
+    sliceStarts, sliceStops, slicedCounts = accumulator.getSnapshots()
+    if not numpy.array_equal(slicedCounts.sum(axis=0), perEventCounts):
+        raise ValueError("The snapshots of spectrumAccumulator do not add up to the spectrum.")
+
+    if verbose:
+        print "Accumulated", accumulator.numOfEvents, "events in", accumulator.numOfReports, "reports over", \
+            str('%.1f' % accumulator.getRealTime()), "s into", len(slicedCounts), "snapshots,", \
+            "the same spectrum as the per event loop."
+        for methodName in sorted(timesDict.keys()):
+            print methodName + ":", str('%.3f' % timesDict[methodName]), "s total,", \
+                str('%.3E' % (timesDict[methodName] / float(accumulator.numOfEvents))), "s per event,", \
+                str('%.2f' % (timesDict['perEvent'] / timesDict[methodName])), "times faster than the per event loop"
+    return timesDict
+
+
+if __name__ == '__main__':
+    from quickPlots import quickPlotter
+    doBenchmark = True
+    showPlot = True
+    snapshotInterval = 1.0
+
+    if doBenchmark:
+        benchmarkSpectrumAccumulator(snapshotInterval=snapshotInterval)
+
+    # a synthetic acquisition, sent to the accumulator as raw detector reports
+    accumulator = spectrumAccumulator(snapshotInterval=snapshotInterval)
+    for (reports, timestamps) in iterSyntheticReports(10):
+        accumulator.addRawReports(encodeRawReports(reports), timestamps)
+    accumulator.finishSnapshot()
+    sliceStarts, sliceStops, slicedCounts = accumulator.getSnapshots()
+    print accumulator.numOfEvents, "events in", len(slicedCounts), "snapshots of", snapshotInterval, "s"
+
+    if showPlot:
+        plotDict = {}
+        plotDict['verbose'] = False
+        plotDict['doShow'] = True
+        plotDict['yData'] = [accumulator.getSpectrum()] + [snapshotCounts for snapshotCounts in slicedCounts]
+        plotDict['xData'] = [numpy.arange(accumulator.numOfChannels)] * (len(slicedCounts) + 1)
+        plotDict['legendLabel'] = ['total'] + ['snapshot ' + str(snapshotIndex + 1)
+                                               for snapshotIndex in range(len(slicedCounts))]
+        plotDict['fmt'] = 'None'
+        plotDict['markersize'] = 5
+        plotDict['alpha'] = 1.0
+        plotDict['ls'] = 'solid'
+        plotDict['lineWidth'] = 1
+        plotDict['title'] = 'Synthetic Kromek Spectrum'
+        plotDict['xlabel'] = 'Channel Number'
+        plotDict['legendAutoLabel'] = False
+        plotDict['doLegend'] = True
+        plotDict['legendLoc'] = 0
+        plotDict['legendNumPoints'] = 3
+        plotDict['legendHandleLength'] = 5
+        quickPlotter(plotDict=plotDict)
@@ -1,5 +1,6 @@
 __author__ = 'chw3k5'
 import numpy, copy
+from multiprocessing import Pool
 from operator import itemgetter
 from scipy.optimize import curve_fit
 from mariscotti import mariscotti, peakFinder
@@ -16,7 +17,15 @@ def gaussian(x, a, b, c):
     return a * numpy.exp(float(-1.0) * ((x - b)**2.0) / (2.0 * (c**2)))
 
 
-def singleGaussFitter(spectrum, x, guessParameters, peakName='', showPlot=False, plotDict=None):
+def singleGaussFitter(spectrum, x, guessParameters, peakName='', showPlot=False, plotDict=None,
+                      windowSigmas=None, backgroundOrder=None):
+    """
+    :param windowSigmas: None (default) fits over the full spectrum. Otherwise only the channels within
+                         guessMean +/- windowSigmas * guessSigma are used, a peak is only a few sigma wide.
+    :param backgroundOrder: None (default) for no background, 0 for a constant, 1 for linear, 2 for quadratic.
+                            The background is fitted with the peak, but only the peak's parameters are returned.
+    :return: modelParams = [amplitude, mean, sigma], paramsError = [amplitude error, mean error, sigma error]
+    """
     if plotDict is None and showPlot:
         print "Cannot show plot, no plotDict was passed. Setting showPlot to False."
         showPlot = False
@@ -24,12 +33,38 @@ def singleGaussFitter(spectrum, x, guessParameters, peakName='', showPlot=False,
     (guessAplitude, guessMean, guessSigma) = guessParameters
     x = numpy.array(x)
     # here is where the fitting is calculated
-    modelParams, pcov = curve_fit(gaussian, x, spectrum, p0=guessParameters)
-    paramsError = numpy.sqrt(numpy.diag(pcov))
+    if windowSigmas is None and backgroundOrder is None:
+        modelParams, pcov = curve_fit(gaussian, x, spectrum, p0=guessParameters)
+        paramsError = numpy.sqrt(numpy.diag(pcov))
+        xFit = x
+        fittedModel = gaussian(x, *modelParams)
+    else:
+        if windowSigmas is None:
+            (startIndex, stopIndex) = (0, len(x))
+        else:
+            halfWidth = windowSigmas * abs(float(guessSigma))
+            # at least one more data point than free parameters
+            numOfFreeParams = 3
+            if backgroundOrder is not None:
+                numOfFreeParams += backgroundOrder + 1
+            (startIndex, stopIndex) = getWindowIndexes(x, guessMean - halfWidth, guessMean + halfWidth,
+                                                       minNumOfPoints=numOfFreeParams + 1)
+        xFit = numpy.asarray(x[startIndex:stopIndex], dtype=float)
+        spectrumWindow = numpy.asarray(spectrum[startIndex:stopIndex], dtype=float)
+        backgroundCenter = 0.5 * (xFit[0] + xFit[-1])
+        model, jacobian = makeMultiGaussFunctions(1, backgroundOrder, backgroundCenter)
+        allParams, pcov = curve_fit(model, xFit, spectrumWindow,
+                                    p0=makeMultiGaussGuess(xFit, spectrumWindow, [guessParameters], backgroundOrder),
+                                    jac=jacobian)
+        modelParams = allParams[:3]
+        # the sign of sigma is arbitrary in the model
+        modelParams[2] = abs(modelParams[2])
+        paramsError = numpy.sqrt(numpy.diag(pcov))[:3]
+        fittedModel = model(xFit, *allParams)
 
     if showPlot:
-        plotDict['yData'].extend([gaussian(x, guessAplitude, guessMean, guessSigma), gaussian(x, *modelParams)])
-        plotDict['xData'].extend([x, x])
+        plotDict['yData'].extend([gaussian(xFit, guessAplitude, guessMean, guessSigma), fittedModel])
+        plotDict['xData'].extend([xFit, xFit])
         plotDict['legendLabel'].extend(['guess' + peakName, 'fitted' + peakName])
         plotDict['fmt'].extend(['o', 'x'])
         plotDict['markersize'].extend([6, 6])
@@ -41,9 +76,41 @@ def singleGaussFitter(spectrum, x, guessParameters, peakName='', showPlot=False,
         return modelParams, paramsError
 
 
+def printFitResults(fitNum, numOfFitsInList, guessParameters, modelParams, paramsError):
+    formatStr = '%1.4f'
+    print "fitting for the found peak", fitNum + 1, "of", numOfFitsInList
+    print "in amplitude (guess, fitted, error) = (" + \
+          str(formatStr % guessParameters[0]) + ", " +\
+          str(formatStr % modelParams[0]) + ", " +\
+          str(formatStr % paramsError[0]) + ")"
+    print "in mean (guess, fitted, error) = (" + \
+          str(formatStr % guessParameters[1]) + ", " +\
+          str(formatStr % modelParams[1]) + ", " +\
+          str(formatStr % paramsError[1]) + ")"
+    print "in sigma (guess, fitted, error) = (" + \
+          str(formatStr % guessParameters[2]) + ", " +\
+          str(formatStr % modelParams[2]) + ", " +\
+          str(formatStr % paramsError[2]) + ")\n"
+
+
 def listGaussFitter(spectrum, x,
                     errFactor=1, numberOfIndexesToSmoothOver=1, showPlot_peakFinder=False,
-                    showPlot_gaussFitters=False, verbose=False):
+                    showPlot_gaussFitters=False, jointFit=False, windowSigmas=None, backgroundOrder=None, workers=1,
+                    verbose=False):
+    """
+    :param jointFit: False (default) fits the found peaks one at a time over the full spectrum, from the highest
+                     to the lowest, subtracting each fit before the next. True uses deconvolveGaussFitter to fit
+                     each cluster of overlapping peaks together with a shared background, only over a window
+                     around that cluster.
+    :param windowSigmas: the fit window around each peak is mean +/- windowSigmas * sigma. None (default) fits
+                         over the full spectrum with jointFit=False, and uses 3.0 with jointFit=True.
+    :param backgroundOrder: 0 for a constant, 1 for linear, 2 for quadratic. None (default) is no background with
+                            jointFit=False, and a constant (0, as in deconvolveGaussFitter) with jointFit=True. Use
+                            deconvolveGaussFitter with backgroundOrder=None for joint fits without a background.
+    :param workers: jointFit=True only, the number of processes used to fit the independent clusters.
+    :return: a list of tuples, [(modelParams, paramsError), ] in the order of the peaks from peakFinder. With
+             jointFit=True the peaks of a cluster that did not converge are None.
+    """
     # apply the mariscotti peak finding algorithm
     guessParametersSet = peakFinder(spectrum, x,
                                     numberOfIndexesToSmoothOver=numberOfIndexesToSmoothOver,
@@ -92,34 +159,47 @@ def listGaussFitter(spectrum, x,
     # get the model parameters and Error for all the found peaks in the list.
     # list of tuple, [(modelParam, paramsError), ]
     # where modelParam = [amplitude, mean, sigma],  paramsError = [amplitude error, mean error, sigma error]
-    modelInfo = []
     numOfFitsInList = len(guessParametersSet)
-    formatStr = '%1.4f'
-    spectrumForFitter = copy.copy(spectrum)
-    for (fitNum, guessParameters) in list(enumerate(guessParametersSet)):
-        modelParams, paramsError, plotDict = \
-            singleGaussFitter(spectrumForFitter, x, guessParameters,
-                              peakName=' peak ' + str(fitNum + 1),
-                              showPlot=True,
-                              plotDict=plotDict)
-        # quickPlotter(plotDict=plotDict)
-        # subtract the fit from the spectrum so that the next peak can't find it.
-        spectrumForFitter -= gaussian(x, *modelParams)
-        modelInfo.append((modelParams, paramsError))
+    if jointFit:
+        if windowSigmas is None:
+            windowSigmas = 3.0
+        if backgroundOrder is None:
+            backgroundOrder = 0
+        fitterOutput = deconvolveGaussFitter(spectrum, x, guessParametersSet,
+                                             windowSigmas=windowSigmas,
+                                             backgroundOrder=backgroundOrder,
+                                             workers=workers,
+                                             plotDict=plotDict,
+                                             verbose=verbose)
+        modelInfo = fitterOutput[0]
         if verbose:
-            print "fitting for the found peak", fitNum + 1, "of", numOfFitsInList
-            print "in amplitude (guess, fitted, error) = (" + \
-                  str(formatStr % guessParameters[0]) + ", " +\
-                  str(formatStr % modelParams[0]) + ", " +\
-                  str(formatStr % paramsError[0]) + ")"
-            print "in mean (guess, fitted, error) = (" + \
-                  str(formatStr % guessParameters[1]) + ", " +\
-                  str(formatStr % modelParams[1]) + ", " +\
-                  str(formatStr % paramsError[1]) + ")"
-            print "in sigma (guess, fitted, error) = (" + \
-                  str(formatStr % guessParameters[2]) + ", " +\
-                  str(formatStr % modelParams[2]) + ", " +\
-                  str(formatStr % paramsError[2]) + ")\n"
+            for (fitNum, guessParameters) in list(enumerate(guessParametersSet)):
+                if modelInfo[fitNum] is None:
+                    print "the fit for the found peak", fitNum + 1, "of", numOfFitsInList, "did not converge\n"
+                else:
+                    printFitResults(fitNum, numOfFitsInList, guessParameters, *modelInfo[fitNum])
+    else:
+        modelInfo = []
+        spectrumForFitter = copy.copy(spectrum)
+        for (fitNum, guessParameters) in list(enumerate(guessParametersSet)):
+            if showPlot_gaussFitters:
+                modelParams, paramsError, plotDict = \
+                    singleGaussFitter(spectrumForFitter, x, guessParameters,
+                                      peakName=' peak ' + str(fitNum + 1),
+                                      showPlot=True,
+                                      plotDict=plotDict,
+                                      windowSigmas=windowSigmas,
+                                      backgroundOrder=backgroundOrder)
+            else:
+                modelParams, paramsError = singleGaussFitter(spectrumForFitter, x, guessParameters,
+                                                             windowSigmas=windowSigmas,
+                                                             backgroundOrder=backgroundOrder)
+            # quickPlotter(plotDict=plotDict)
+            # subtract the fit from the spectrum so that the next peak can't find it.
+            spectrumForFitter -= gaussian(x, *modelParams)
+            modelInfo.append((modelParams, paramsError))
+            if verbose:
+                printFitResults(fitNum, numOfFitsInList, guessParameters, modelParams, paramsError)
 
 
     if showPlot_gaussFitters:
@@ -128,60 +208,375 @@ def listGaussFitter(spectrum, x,
     return modelInfo
 
 
-def deconvolveGaussFitter():
-    # loop through and see if it is worth trying to fit to the other local maxima
-    gg_init=models.Gaussian1D(modelParamsList[0])
-    len_maximaList = len(maximaList)
-    if 1 < len_maximaList:
-        for loopIndex in range(1,len_maximaList):
-            R_last = R_val_current
-            (x_mean,x_apml) = maximaList[loopIndex]
-            gg_init=current_models+models.Gaussian1D(x_apml, x_mean, 5)
-            gg_Fit = fitter(gg_init,x,counts)
-            fit_info = fitter.fit_info
-            R_val_current = fit_info['final_func_val']
-            if showFitterPlots: testSpecPlotting(counts,x,gg_Fit,gg_init, showPlot=True)
-            if R_val_current <= R_last*(1.-fractionalRimprovment):
-                modelParamsList.append((gg_Fit.parameters[0], gg_Fit.parameters[1], gg_Fit.parameters[2]))
-                current_models += models.Gaussian1D(modelParamsList[loopIndex])
-            else:
-                break
-
-    return
-
+def makeMultiGaussFunctions(numOfPeaks, backgroundOrder, backgroundCenter):
+    """
+    The model of a cluster of overlapping peaks, the sum of numOfPeaks gaussians on a polynomial background,
+    and its analytic Jacobian. Both take the curve_fit signature f(x, *params) with
+    params = [a1, b1, c1, a2, b2, c2, ..., p0, p1, ...] and the background
+    p0 + p1 * (x - backgroundCenter) + p2 * (x - backgroundCenter)**2 + ...
 
+    :param backgroundOrder: None for no background, 0 for a constant, 1 for linear, 2 for quadratic.
+    :param backgroundCenter: the background polynomial is centered in the window so that the terms stay
+                             well-conditioned for large channel numbers or energies.
+    """
+    if backgroundOrder is None:
+        numOfBackgroundParams = 0
+    else:
+        numOfBackgroundParams = backgroundOrder + 1
+
+    def peakTerms(x, params):
+        # arrays of shape (len(x), numOfPeaks)
+        peakParams = numpy.reshape(params[:3 * numOfPeaks], (numOfPeaks, 3))
+        amplitudes = peakParams[:, 0]
+        means = peakParams[:, 1]
+        sigmas = peakParams[:, 2]
+        xMinusMean = x[:, numpy.newaxis] - means
+        expTerms = numpy.exp(-(xMinusMean**2.0) / (2.0 * (sigmas**2)))
+        return amplitudes, sigmas, xMinusMean, expTerms
+
+    def model(x, *params):
+        x = numpy.asarray(x, dtype=float)
+        params = numpy.asarray(params, dtype=float)
+        amplitudes, sigmas, xMinusMean, expTerms = peakTerms(x, params)
+        modelValues = numpy.dot(expTerms, amplitudes)
+        if 0 < numOfBackgroundParams:
+            # numpy.polyval wants the highest power first
+            modelValues += numpy.polyval(params[3 * numOfPeaks:][::-1], x - backgroundCenter)
+        return modelValues
+
+    def jacobian(x, *params):
+        x = numpy.asarray(x, dtype=float)
+        params = numpy.asarray(params, dtype=float)
+        amplitudes, sigmas, xMinusMean, expTerms = peakTerms(x, params)
+        gaussTerms = expTerms * amplitudes
+        jac = numpy.empty((len(x), len(params)))
+        # d/da, d/db, d/dc of a * exp(-(x - b)**2 / (2 * c**2))
+        jac[:, 0:3 * numOfPeaks:3] = expTerms
+        jac[:, 1:3 * numOfPeaks:3] = gaussTerms * xMinusMean / (sigmas**2)
+        jac[:, 2:3 * numOfPeaks:3] = gaussTerms * (xMinusMean**2.0) / (sigmas**3)
+        for power in range(numOfBackgroundParams):
+            jac[:, 3 * numOfPeaks + power] = (x - backgroundCenter)**power
+        return jac
+
+    return model, jacobian
+
+
+def getWindowIndexes(x, windowMin, windowMax, minNumOfPoints=1):
+    """
+    :param x: the channels or energies of the spectrum, in increasing order.
+    :return: startIndex, stopIndex so that x[startIndex:stopIndex] is between windowMin and windowMax. The
+             window is widened evenly on both sides when it has fewer than minNumOfPoints.
+    """
+    x = numpy.asarray(x)
+    startIndex = int(numpy.searchsorted(x, windowMin, side='left'))
+    stopIndex = int(numpy.searchsorted(x, windowMax, side='right'))
+    lenX = len(x)
+    while stopIndex - startIndex < min(minNumOfPoints, lenX):
+        startIndex = max(startIndex - 1, 0)
+        stopIndex = min(stopIndex + 1, lenX)
+    return startIndex, stopIndex
+
+
+def findPeakClusters(guessParametersSet, windowSigmas=3.0):
+    """
+    Peaks whose mean +/- windowSigmas * sigma windows overlap are put in the same cluster, to be fit together.
+
+    :return: a list of tuples, [(windowMin, windowMax, peakIndexes), ] in order of increasing windowMin, where
+             peakIndexes are the indexes of that cluster's peaks in guessParametersSet.
+    """
+    peakClusters = []
+    if len(guessParametersSet) == 0:
+        return peakClusters
+    guessArray = numpy.array(guessParametersSet, dtype=float)
+    halfWidths = windowSigmas * numpy.abs(guessArray[:, 2])
+    windowMins = guessArray[:, 1] - halfWidths
+    windowMaxs = guessArray[:, 1] + halfWidths
+    for peakIndex in numpy.argsort(windowMins, kind='mergesort'):
+        if peakClusters and windowMins[peakIndex] <= peakClusters[-1][1]:
+            (windowMin, windowMax, peakIndexes) = peakClusters[-1]
+            peakClusters[-1] = (windowMin, max(windowMax, windowMaxs[peakIndex]), peakIndexes + [int(peakIndex)])
+        else:
+            peakClusters.append((windowMins[peakIndex], windowMaxs[peakIndex], [int(peakIndex)]))
+    return peakClusters
+
+
+def makeMultiGaussGuess(xWindow, spectrumWindow, guessParametersList, backgroundOrder=0):
+    """
+    :return: p0 for the functions of makeMultiGaussFunctions, [a1, b1, c1, ..., p0, p1, ...] where the background
+             guess is the line through the ends of the window and the amplitudes are measured from it.
+    """
+    if backgroundOrder is None:
+        backgroundGuess = []
+    else:
+        backgroundGuess = [0.0] * (backgroundOrder + 1)
+        backgroundGuess[0] = 0.5 * (spectrumWindow[0] + spectrumWindow[-1])
+        if 1 <= backgroundOrder and xWindow[0] < xWindow[-1]:
+            backgroundGuess[1] = (spectrumWindow[-1] - spectrumWindow[0]) / (xWindow[-1] - xWindow[0])
+    p0 = []
+    for (guessAplitude, guessMean, guessSigma) in guessParametersList:
+        if backgroundGuess:
+            # the peak sits on top of the background
+            guessAplitude = max(guessAplitude - backgroundGuess[0], 0.1 * guessAplitude)
+        p0.extend([guessAplitude, guessMean, abs(guessSigma)])
+    p0.extend(backgroundGuess)
+    return p0
+
+
+def fitPeakCluster(xWindow, spectrumWindow, guessParametersList, backgroundOrder=0):
+    """
+    Fits all the peaks of one cluster at the same time with a shared background, using only the channels in the
+    cluster's window.
+
+    :return: peakModelInfo, a list of (modelParams, paramsError) for each peak in guessParametersList, and
+             backgroundParams, backgroundErrors, backgroundCenter for the polynomial background. When the fit does
+             not converge, peakModelInfo is a None for each peak and backgroundParams and backgroundErrors are None.
+    """
+    xWindow = numpy.asarray(xWindow, dtype=float)
+    spectrumWindow = numpy.asarray(spectrumWindow, dtype=float)
+    numOfPeaks = len(guessParametersList)
+    backgroundCenter = 0.5 * (xWindow[0] + xWindow[-1])
+    p0 = makeMultiGaussGuess(xWindow, spectrumWindow, guessParametersList, backgroundOrder)
+
+    model, jacobian = makeMultiGaussFunctions(numOfPeaks, backgroundOrder, backgroundCenter)
+    try:
+        allParams, pcov = curve_fit(model, xWindow, spectrumWindow, p0=p0, jac=jacobian)
+        allErrors = numpy.sqrt(numpy.abs(numpy.diag(pcov)))
+    except (RuntimeError, ValueError):
+        # the fit did not converge, the other clusters are still fit
+        return [None] * numOfPeaks, None, None, backgroundCenter
+    # the sign of sigma is arbitrary in the model
+    allParams[2:3 * numOfPeaks:3] = numpy.abs(allParams[2:3 * numOfPeaks:3])
+
+    peakModelInfo = [(allParams[3 * peakIndex:3 * peakIndex + 3], allErrors[3 * peakIndex:3 * peakIndex + 3])
+                     for peakIndex in range(numOfPeaks)]
+    return peakModelInfo, allParams[3 * numOfPeaks:], allErrors[3 * numOfPeaks:], backgroundCenter
+
+
+def fitPeakClusterJob(job):
+    # a single argument for Pool.map
+    (xWindow, spectrumWindow, guessParametersList, backgroundOrder) = job
+    return fitPeakCluster(xWindow, spectrumWindow, guessParametersList, backgroundOrder=backgroundOrder)
+
+
+def deconvolveGaussFitter(spectrum, x, guessParametersSet, windowSigmas=3.0, backgroundOrder=0, workers=1,
+                          pool=None, plotDict=None, verbose=False):
+    """
+    The multi-peak fitter. The peaks from peakFinder are grouped into clusters of overlapping peaks
+    (findPeakClusters), and each cluster is fit jointly with a shared polynomial background and an analytic
+    Jacobian over only the channels in a window around it (fitPeakCluster). The clusters are independent, so
+    they can be fit in parallel.
+
+    :param guessParametersSet: the [amplitude, mean, sigma] guesses from peakFinder.
+    :param windowSigmas: the fit window around each peak is mean +/- windowSigmas * sigma.
+    :param backgroundOrder: None for no background, 0 for a constant, 1 for linear, 2 for quadratic.
+    :param workers: the number of processes used to fit the clusters, workers=1 fits them here, one at a time.
+    :param pool: An existing multiprocessing.Pool to use instead of making a new one.
+    :param plotDict: when given, the fitted model of each cluster is added to it.
+    :return: modelInfo, a list of tuple [(modelParams, paramsError), ] in the order of guessParametersSet, None
+             for the peaks of a cluster that did not converge, and clusterInfo, a list of dictionaries with the
+             window, peaks and background of each cluster, clusterDict['isFitted'] is False if it did not converge.
+             plotDict is also returned when it is given.
+    """
+    x = numpy.asarray(x, dtype=float)
+    spectrum = numpy.asarray(spectrum, dtype=float)
+    if backgroundOrder is None:
+        numOfBackgroundParams = 0
+    else:
+        numOfBackgroundParams = backgroundOrder + 1
+
+    peakClusters = findPeakClusters(guessParametersSet, windowSigmas=windowSigmas)
+    jobs = []
+    windowIndexes = []
+    for (windowMin, windowMax, peakIndexes) in peakClusters:
+        # at least one more data point than free parameters
+        startIndex, stopIndex = getWindowIndexes(x, windowMin, windowMax,
+                                                 minNumOfPoints=3 * len(peakIndexes) + numOfBackgroundParams + 1)
+        windowIndexes.append((startIndex, stopIndex))
+        jobs.append((x[startIndex:stopIndex], spectrum[startIndex:stopIndex],
+                     [guessParametersSet[peakIndex] for peakIndex in peakIndexes], backgroundOrder))
+    if verbose:
+        print "Fitting", len(guessParametersSet), "peaks in", len(peakClusters), "clusters."
+
+    if (1 < workers or pool is not None) and 1 < len(jobs):
+        if pool is None:
+            localPool = Pool(processes=workers)
+        else:
+            localPool = pool
+        try:
+            chunkSize = max((int(len(jobs) / (4.0 * max(workers, 1))), 1))
+            clusterResults = localPool.map(fitPeakClusterJob, jobs, chunkSize)
+        finally:
+            if pool is None:
+                localPool.close()
+                localPool.join()
+    else:
+        clusterResults = [fitPeakClusterJob(job) for job in jobs]
+
+    modelInfo = [None] * len(guessParametersSet)
+    clusterInfo = []
+    for (clusterIndex, (peakModelInfo, backgroundParams, backgroundErrors, backgroundCenter)) \
+            in list(enumerate(clusterResults)):
+        (windowMin, windowMax, peakIndexes) = peakClusters[clusterIndex]
+        (startIndex, stopIndex) = windowIndexes[clusterIndex]
+        for (peakIndex, modelParamsAndError) in zip(peakIndexes, peakModelInfo):
+            modelInfo[peakIndex] = modelParamsAndError
+        clusterDict = {}
+        clusterDict['peakIndexes'] = peakIndexes
+        clusterDict['startIndex'] = startIndex
+        clusterDict['stopIndex'] = stopIndex
+        clusterDict['backgroundOrder'] = backgroundOrder
+        clusterDict['backgroundCenter'] = backgroundCenter
+        clusterDict['backgroundParams'] = backgroundParams
+        clusterDict['backgroundErrors'] = backgroundErrors
+        clusterDict['isFitted'] = backgroundParams is not None
+        clusterInfo.append(clusterDict)
+
+        if plotDict is not None and clusterDict['isFitted']:
+            model, jacobian = makeMultiGaussFunctions(len(peakIndexes), backgroundOrder, backgroundCenter)
+            allParams = numpy.concatenate([modelParams for (modelParams, paramsError) in peakModelInfo]
+                                          + [backgroundParams])
+            xWindow = x[startIndex:stopIndex]
+            plotDict['yData'].append(model(xWindow, *allParams))
+            plotDict['xData'].append(xWindow)
+            plotDict['legendLabel'].append('fitted cluster ' + str(clusterIndex + 1))
+            plotDict['fmt'].append('x')
+            plotDict['markersize'].append(6)
+            plotDict['alpha'].append(0.5)
+            plotDict['ls'].append('dotted')
+            plotDict['lineWidth'].append(1)
+
+    if plotDict is None:
+        return modelInfo, clusterInfo
+    else:
+        return modelInfo, clusterInfo, plotDict
+
+
+def benchmarkGaussFitters(spectrum, x, errFactor=1, numberOfIndexesToSmoothOver=5, windowSigmas=3.0,
+                          backgroundOrder=0, workers=1, verbose=True):
+    """
+    Compares the time of the sequential full spectrum fits of listGaussFitter (jointFit=False) to the same fits
+    with a window of windowSigmas around each peak, and to the windowed joint cluster fits of
+    deconvolveGaussFitter, for the same found peaks. The fits that do not converge are skipped and counted.
+
+    :return: a dictionary of the total time in seconds for each method
+    """
+    import time
+    import sys
+    import os
+    # peakFinder prints its progress
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        guessParametersSet = peakFinder(spectrum, x, numberOfIndexesToSmoothOver=numberOfIndexesToSmoothOver,
+                                        errFactor=errFactor, verbose=False)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    timesDict = {}
+    resultsDict = {}
+    failuresDict = {}
+
+    # the sequential fits of listGaussFitter, over the full spectrum and windowed
+    for (methodName, windowSigmasThisMethod, backgroundOrderThisMethod) in \
+            [('sequential', None, None), ('windowed', windowSigmas, backgroundOrder)]:
+        startTime = time.time()
+        resultsDict[methodName] = []
+        failuresDict[methodName] = 0
+        spectrumForFitter = numpy.array(spectrum, dtype=float)
+        for guessParameters in guessParametersSet:
+            try:
+                modelParams, paramsError = singleGaussFitter(spectrumForFitter, x, guessParameters,
+                                                             windowSigmas=windowSigmasThisMethod,
+                                                             backgroundOrder=backgroundOrderThisMethod)
+            except RuntimeError:
+                failuresDict[methodName] += 1
+                resultsDict[methodName].append(None)
+                continue
+            spectrumForFitter -= gaussian(x, *modelParams)
+            resultsDict[methodName].append((modelParams, paramsError))
+        timesDict[methodName] = time.time() - startTime
+
+    startTime = time.time()
+    jointModelInfo, clusterInfo = deconvolveGaussFitter(spectrum, x, guessParametersSet,
+                                                        windowSigmas=windowSigmas,
+                                                        backgroundOrder=backgroundOrder,
+                                                        workers=workers)
+    timesDict['joint'] = time.time() - startTime
+
+    resultsDict['joint'] = jointModelInfo
+    failuresDict['joint'] = len([modelParamsAndError for modelParamsAndError in jointModelInfo
+                                 if modelParamsAndError is None])
 
+    if verbose:
+        print "Fitted", len(guessParametersSet), "peaks in", len(clusterInfo), "clusters in a spectrum of", \
+            len(x), "channels."
+        for methodName in ['windowed', 'joint']:
+            meanDifferences = [abs(sequentialInfo[0][1] - otherInfo[0][1]) for (sequentialInfo, otherInfo)
+                               in zip(resultsDict['sequential'], resultsDict[methodName])
+                               if sequentialInfo is not None and otherInfo is not None]
+            if meanDifferences:
+                print "The median difference of the fitted means of the", methodName, "and sequential fits is", \
+                    str('%1.4f' % numpy.median(meanDifferences))
+        for methodName in sorted(failuresDict.keys()):
+            if 0 < failuresDict[methodName]:
+                print failuresDict[methodName], "of the", methodName, "fits did not converge."
+        for methodName in sorted(timesDict.keys()):
+            print methodName + ":", str('%.3f' % timesDict[methodName]), "s total,", \
+                str('%.2f' % (timesDict['sequential'] / timesDict[methodName])), \
+                "times faster than the sequential fits"
+    return timesDict
 
 
 if __name__ == '__main__':
+    import os
+    from mariscotti import makeSyntheticSpectra
+    doBenchmark = True
     # A few options for this data
-    endIndex = 100
     verbose = True
     numberOfIndexesToSmoothOver = 5
     errFactor = 50
     showPlot_peakFinder = False
     showPlot_gaussFitters = True
+    jointFit = True
+    backgroundOrder = 1
+    workers = 1
 
 
-    # Get the test data
-    testDataFile = "/Users/jmo/Desktop/Data/Cs137_10uCi_32cm_PMT.TKA"
+    # Get the test data, the mixed source spectrum in the testData folder, the last column of each line
+    # without the live and real times
+    testDataFile = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testData',
+                                'Co60_36mm_Cs_144mm_Co57_195mm_PMT850V_10us_10-5-00_16384.tka.csv')
     if verbose:
         print "Getting the test data in the file.", testDataFile
-    testData = getTableData(testDataFile)
-    chan = testData['chan'][:endIndex]
-    spectrum = testData['data'][:endIndex]
-
+    testDataHandle = open(testDataFile, 'rU')
+    testData = []
+    for line in testDataHandle:
+        try:
+            testData.append(float(line.strip().split(',')[-1]))
+        except ValueError:
+            # the header line
+            pass
+    testDataHandle.close()
+    spectrum = numpy.array(testData[2:])
+    chan = numpy.arange(len(spectrum))
+
+    if doBenchmark:
+        print "Benchmark on", testDataFile
+        benchmarkGaussFitters(spectrum, chan, errFactor=errFactor,
+                              numberOfIndexesToSmoothOver=numberOfIndexesToSmoothOver,
+                              backgroundOrder=backgroundOrder, workers=workers)
+        print "\nBenchmark on a synthetic 16384 channel spectrum"
+        syntheticSpectrum = makeSyntheticSpectra(numOfSpectra=1)[0]
+        benchmarkGaussFitters(syntheticSpectrum, numpy.arange(len(syntheticSpectrum)), errFactor=errFactor,
+                              numberOfIndexesToSmoothOver=numberOfIndexesToSmoothOver,
+                              backgroundOrder=backgroundOrder, workers=workers)
 
     modelInfo = listGaussFitter(spectrum, chan,
                                 errFactor=errFactor,
                                 numberOfIndexesToSmoothOver=numberOfIndexesToSmoothOver,
                                 showPlot_peakFinder=showPlot_peakFinder,
                                 showPlot_gaussFitters=showPlot_gaussFitters,
+                                jointFit=jointFit,
+                                backgroundOrder=backgroundOrder,
+                                workers=workers,
                                 verbose=verbose)
-
-
-
-
-
-
-
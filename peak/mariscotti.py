@@ -103,11 +103,273 @@
 # Caleb Wheeler for the Fisk Cube sat program.
 #
 import numpy
-from smoothing import boxCar
+from smoothing import boxCar, boxCarBatch, convolveRows
 from quickPlots import quickPlotter, rescale
 from operator import itemgetter
 
 
+def calcGSD(y, vary, m):
+    # rudimentary peak finder based on Mariscotti [1966]
+    kernel1 = numpy.array([-1,2,-1])
+    # gsd stands for generalized second derivative
+    gsd = numpy.convolve(y, kernel1, 'same')
+
+    #   The line below was translated form IDL code that was in a mysterious loop that seemed to make the exact
+    #   same variable assignment 'm' times.
+    gsd = boxCar(gsd, kernalSize=m, mode='same')
+
+    kernel2 = numpy.array([1, 4, 1])
+    err = numpy.convolve(vary, kernel2, 'same')
+
+    #   The line below was translated form IDL code that was in a mysterious loop that seemed to make the exact
+    #   same variable assignment 'm' times.
+    err = boxCar(err, kernalSize=m, mode='same')
+    # standard deviation of the GSD
+    err = ((float(1.0) / (float(m) ** m)) * err) ** float(0.5)
+    return gsd, err
+
+
+def findCrossingsLoop(gsd, l1, l2):
+    icross = []
+    for i in range(l1 + 1, l2):
+        if (gsd[i] < 0.) and (gsd[i-1] > 0.):
+            icross.append(i - 1)
+        if (gsd[i] > 0.) and (gsd[i-1] < 0.):
+            icross.append(i)
+    return icross
+
+
+def findCrossings(gsd, l1, l2):
+    # The same crossings as findCrossingsLoop, from the sign changes of the GSD between channels i-1 and i
+    i = numpy.arange(l1 + 1, l2)
+    if len(i) == 0:
+        return numpy.zeros(0, dtype=int)
+    gsdNow = gsd[l1 + 1:l2]
+    gsdBefore = gsd[l1:l2 - 1]
+    # the last channel before a positive to negative crossing, the first channel after a negative to positive one
+    downCross = (gsdNow < 0.) & (gsdBefore > 0.)
+    upCross = (gsdNow > 0.) & (gsdBefore < 0.)
+    return numpy.where(downCross, i - 1, i)[downCross | upCross]
+
+
+def findPeaksInRegionsLoop(y, gsd, icross, maxAllowedError, pk_gsd=None):
+    gaussParameters = []
+    for i in range(len(icross) - 1):
+        icrossStart = icross[i]
+        icrossStop = icross[i + 1]
+        # check that that there are no subsections of zero length (can happen because of the cautious crossover finder
+        # used on a noising part of the data)
+        if icrossStart != icrossStop:
+            gsd_subSample = gsd[icrossStart:icrossStop]
+            # Determine is the subset is a peak of a vally
+            gsd_subSample_lessThenZero = gsd_subSample[gsd_subSample < 0.0]
+            count_gsd_subSample_lessThenZero = len(gsd_subSample_lessThenZero)
+            # this is true if the subsection is a peak
+            if count_gsd_subSample_lessThenZero == 0:
+                indexList = numpy.arange(len(gsd_subSample))
+                if pk_gsd is not None:
+                    maxval = max(gsd_subSample)
+                    indexOfPeak_gsd_subSample = list(indexList[gsd_subSample == maxval])
+                else:
+                    y_subSmaple = y[icrossStart:icrossStop]
+                    maxval = max(y_subSmaple)
+                    indexOfPeak_gsd_subSample = list(indexList[y_subSmaple == maxval])
+                numOfIndexWithPeakValue = len(indexOfPeak_gsd_subSample)
+                if 1 == numOfIndexWithPeakValue:
+                    indexOfPeak_y = indexOfPeak_gsd_subSample[0] + icross[i]
+                # if more than one index with the max value, take the max GSD value closest to the max y value
+                elif 1 < numOfIndexWithPeakValue:
+                    highestValueGSD = float('-Inf')
+                    chooseIndex = None
+                    for testIndex in indexOfPeak_gsd_subSample:
+                        currentValueGSD = gsd_subSample[testIndex]
+                        if highestValueGSD < currentValueGSD:
+                            highestValueGSD = currentValueGSD
+                            chooseIndex = testIndex
+
+                    indexOfPeak_y = chooseIndex + icross[i]
+                else:
+                    indexOfPeak_y = None
+                if indexOfPeak_y is not None:
+                    if maxAllowedError[indexOfPeak_y] < gsd[indexOfPeak_y]:
+                        sigma = float(icrossStop - icrossStart)/float(2.0)
+                        gaussParameters.append((maxval, indexOfPeak_y, sigma))
+    return gaussParameters
+
+
+def findPeaksInRegionBounds(values, gsd, regionStarts, regionStops, maxAllowedError):
+    """
+    The peaks in the regions [regionStarts[k], regionStops[k]) of the 1-D arrays values, gsd and maxAllowedError,
+    without a loop over the regions. The regions must be in order and not overlap, but they do not need to be next
+    to each other, so this works for the regions of many spectra in one flattened array. A region is a peak if the
+    GSD is never negative in it. The maximum of values in each region and the channel of that maximum (if there is
+    more than one, the one with the highest GSD value and then the lowest channel) are found for every region at once
+    with numpy.maximum.reduceat and numpy.minimum.reduceat.
+
+    :return: (peakIndexes, maxvals, sigmas) for the peaks that pass the maxAllowedError test, in order
+    """
+    regionStarts = numpy.asarray(regionStarts, dtype=int)
+    regionStops = numpy.asarray(regionStops, dtype=int)
+    numOfChannels = len(gsd)
+    emptyResult = (numpy.zeros(0, dtype=int), numpy.zeros(0), numpy.zeros(0))
+    if len(regionStarts) == 0:
+        return emptyResult
+    # a region is a peak if none of the GSD values in it are negative
+    cumulativeNegatives = numpy.zeros(numOfChannels + 1, dtype=int)
+    cumulativeNegatives[1:] = numpy.cumsum(gsd < 0.0)
+    isPeakRegion = (regionStarts != regionStops) & \
+                   (cumulativeNegatives[regionStops] == cumulativeNegatives[regionStarts])
+    if not numpy.any(isPeakRegion):
+        return emptyResult
+    # only the peak regions are needed from here on, reduceat is over [start, stop) for each region and the results
+    # at the odd indexes of regionBounds (between the regions) are not used
+    regionStarts = regionStarts[isPeakRegion]
+    regionStops = regionStops[isPeakRegion]
+    regionBounds = numpy.ravel(numpy.column_stack((regionStarts, regionStops)))
+    regionMax = numpy.maximum.reduceat(values, regionBounds)[::2]
+
+    # every channel in a region and the index of that region
+    regionLengths = regionStops - regionStarts
+    channelRegion = numpy.repeat(numpy.arange(len(regionStarts)), regionLengths)
+    channels = numpy.arange(len(channelRegion)) + numpy.repeat(regionStarts - (numpy.cumsum(regionLengths) -
+                                                                               regionLengths), regionLengths)
+    # the channels with the maximum value in their region, if there is more than one, use the one with the highest
+    # GSD value and then the lowest channel.
+    isRegionMax = values[channels] == regionMax[channelRegion]
+    maxGSD = numpy.full(numOfChannels, -numpy.inf)
+    maxGSD[channels] = numpy.where(isRegionMax, gsd[channels], -numpy.inf)
+    regionMaxGSD = numpy.maximum.reduceat(maxGSD, regionBounds)[::2]
+    isChosen = isRegionMax & (gsd[channels] == regionMaxGSD[channelRegion]) & (-numpy.inf < gsd[channels])
+    chosenChannels = numpy.full(numOfChannels, numOfChannels, dtype=int)
+    chosenChannels[channels] = numpy.where(isChosen, channels, numOfChannels)
+    indexOfPeak = numpy.minimum.reduceat(chosenChannels, regionBounds)[::2]
+
+    hasPeak = indexOfPeak < numOfChannels
+    peakIndexes = indexOfPeak[hasPeak]
+    isPeak = maxAllowedError[peakIndexes] < gsd[peakIndexes]
+    peakIndexes = peakIndexes[isPeak]
+    maxvals = regionMax[hasPeak][isPeak]
+    sigmas = (regionStops[hasPeak][isPeak] - regionStarts[hasPeak][isPeak]) / float(2.0)
+    return peakIndexes, maxvals, sigmas
+
+
+def findPeaksInRegions(y, gsd, icross, maxAllowedError, pk_gsd=None):
+    """
+    The array version of findPeaksInRegionsLoop, the same peaks are found without a loop over the crossing points.
+    The channels between each pair of crossing points are a region, see findPeaksInRegionBounds.
+
+    :return: a list of (maxval, indexOfPeak, sigma) for each peak
+    """
+    icross = numpy.asarray(icross, dtype=int)
+    if len(icross) < 2:
+        return []
+    if pk_gsd is not None:
+        values = numpy.asarray(gsd)
+    else:
+        values = numpy.asarray(y)
+    peakIndexes, maxvals, sigmas = findPeaksInRegionBounds(values, gsd, icross[:-1], icross[1:], maxAllowedError)
+    return [(maxval, peakIndex, sigma) for (maxval, peakIndex, sigma) in zip(maxvals, peakIndexes, sigmas)]
+
+
+peakTableDtype = [('spectrumIndex', int), ('channel', int), ('amplitude', float), ('sigma', float)]
+
+
+def calcGSDBatch(arrayOfSpectra, arrayOfVariances, m):
+    # calcGSD for every row (spectrum) of a 2-D array at once
+    gsd = boxCarBatch(convolveRows(arrayOfSpectra, [-1, 2, -1]), kernalSize=m)
+    err = boxCarBatch(convolveRows(arrayOfVariances, [1, 4, 1]), kernalSize=m)
+    # standard deviation of the GSD
+    err = ((float(1.0) / (float(m) ** m)) * err) ** float(0.5)
+    return gsd, err
+
+
+def mariscottiBatch(arrayOfSpectra, nsmooth=5, errFactor=1.0, err=None, pk_gsd=None):
+    """
+    The Mariscotti peak finder for many spectra of the same length at once, the GSD, its error, the crossing points
+    and the peaks are found for all the spectra together with array operations. The peaks of each spectrum are the
+    same as mariscotti(spectrum, nsmooth=nsmooth, errFactor=errFactor).
+
+    :param arrayOfSpectra: a 2-D array, (number of spectra) x (number of channels)
+    :param err: None (the spectra are counts, the variance is the spectrum) or the uncertainty of the values, a
+        single value or an array that can be broadcast to the shape of arrayOfSpectra.
+    :return: a structured array with the fields 'spectrumIndex', 'channel', 'amplitude' and 'sigma' (in channels),
+        one row for each peak, in order of spectrumIndex and then channel. See splitPeakTable.
+    """
+    arrayOfSpectra = numpy.asarray(arrayOfSpectra, dtype=float)
+    if arrayOfSpectra.ndim != 2:
+        raise ValueError("arrayOfSpectra must be a 2-D array, (number of spectra) x (number of channels).")
+    (numOfSpectra, numOfChannels) = numpy.shape(arrayOfSpectra)
+    if numOfSpectra == 0:
+        return numpy.zeros(0, dtype=peakTableDtype)
+    m = nsmooth
+    if err is None:
+        arrayOfVariances = arrayOfSpectra
+    else:
+        arrayOfVariances = numpy.ones(numpy.shape(arrayOfSpectra)) * numpy.asarray(err, dtype=float) ** 2.0
+    gsd, gsdErr = calcGSDBatch(arrayOfSpectra, arrayOfVariances, m)
+
+    # the zero crossings of every spectrum, see findCrossings
+    l1 = 4 * (m - 1) / 2 + 1
+    l2 = numOfChannels - l1
+    if l2 <= l1 + 1:
+        return numpy.zeros(0, dtype=peakTableDtype)
+    gsdNow = gsd[:, l1 + 1:l2]
+    gsdBefore = gsd[:, l1:l2 - 1]
+    downCross = (gsdNow < 0.) & (gsdBefore > 0.)
+    upCross = (gsdNow > 0.) & (gsdBefore < 0.)
+    (crossRows, crossColumns) = numpy.nonzero(downCross | upCross)
+    icross = crossColumns + l1 + 1 - downCross[crossRows, crossColumns].astype(int)
+    # crossing points in the flattened arrays, the regions are between crossing points of the same spectrum
+    flatCross = crossRows * numOfChannels + icross
+    isSameSpectrum = crossRows[:-1] == crossRows[1:]
+    regionStarts = flatCross[:-1][isSameSpectrum]
+    regionStops = flatCross[1:][isSameSpectrum]
+
+    if pk_gsd is not None:
+        values = numpy.ravel(gsd)
+    else:
+        values = numpy.ravel(arrayOfSpectra)
+    peakIndexes, maxvals, sigmas = findPeaksInRegionBounds(values, numpy.ravel(gsd), regionStarts, regionStops,
+                                                           float(errFactor) * numpy.ravel(gsdErr))
+    peakTable = numpy.zeros(len(peakIndexes), dtype=peakTableDtype)
+    peakTable['spectrumIndex'] = peakIndexes // numOfChannels
+    peakTable['channel'] = peakIndexes % numOfChannels
+    peakTable['amplitude'] = maxvals
+    peakTable['sigma'] = sigmas
+    return peakTable
+
+
+def splitPeakTable(peakTable, numOfSpectra):
+    # a list with the rows of peakTable for each spectrum (ragged, some spectra can have no peaks)
+    splitIndexes = numpy.searchsorted(peakTable['spectrumIndex'], numpy.arange(1, numOfSpectra))
+    return numpy.split(peakTable, splitIndexes)
+
+
+def peakFinderBatch(arrayOfSpectra,
+                    x,
+                    numberOfIndexesToSmoothOver=1,
+                    errFactor=1):
+    """
+    peakFinder for many spectra with the same x values at once, see mariscottiBatch.
+
+    :return: a structured array with the fields 'spectrumIndex', 'channel', 'amplitude', 'mean' and 'sigma', where
+        mean and sigma are in the units of x. The peaks are in order of spectrumIndex and, like peakFinder, from the
+        highest to the lowest amplitude for each spectrum.
+    """
+    peakTable = mariscottiBatch(arrayOfSpectra, nsmooth=numberOfIndexesToSmoothOver, errFactor=errFactor)
+    x = numpy.asarray(x, dtype=float)
+    energySpacing = (float(x[-1]) - float(x[0]))/float(len(x) - 1)
+    outputDtype = [('spectrumIndex', int), ('channel', int), ('amplitude', float), ('mean', float), ('sigma', float)]
+    guessTable = numpy.zeros(len(peakTable), dtype=outputDtype)
+    for fieldName in ['spectrumIndex', 'channel', 'amplitude']:
+        guessTable[fieldName] = peakTable[fieldName]
+    guessTable['mean'] = x[peakTable['channel']]
+    guessTable['sigma'] = peakTable['sigma'] * energySpacing
+    # a stable sort keeps the order of equal amplitudes the same as sorted(..., reverse=True) in peakFinder
+    sortIndexes = numpy.lexsort((-guessTable['amplitude'], guessTable['spectrumIndex']))
+    return guessTable[sortIndexes]
+
+
 def mariscotti(y, **kwargs):
 
     keys = kwargs.keys()
@@ -151,39 +413,26 @@ def mariscotti(y, **kwargs):
     else:
         verbose = False
 
+    # kwargs useLoops, the original (slower) loops over the channels and crossing points, for comparisons
+    if 'useLoops' in keys:
+        useLoops = kwargs['useLoops']
+    else:
+        useLoops = False
+
     if verbose:
         print "Starting the Mariscotti peak finding and Gaussian parametrization algorithm."
 
-    # rudimentary peak finder based on Mariscotti [1966]
-    kernel1 = numpy.array([-1,2,-1])
-    # gsd stands for generalized second derivative
-    gsd = numpy.convolve(y, kernel1, 'same')
-
-    #   The line below was translated form IDL code that was in a mysterious loop that seemed to make the exact
-    #   same variable assignment 'm' times.
-    gsd = boxCar(gsd, kernalSize=m, mode='same')
-
-    kernel2 = numpy.array([1, 4, 1])
-    err = numpy.convolve(vary, kernel2, 'same')
-
-    #   The line below was translated form IDL code that was in a mysterious loop that seemed to make the exact
-    #   same variable assignment 'm' times.
-    err = boxCar(err, kernalSize=m, mode='same')
-    # standard deviation of the GSD
-    err = ((float(1.0) / (float(m) ** m)) * err) ** float(0.5)
-
+    gsd, err = calcGSD(y, vary, m)
 
     # find the zero crossings
     l1 = 4 * (m - 1) / 2 + 1
     l2 = len(vary) - l1
-    icross = []
-    for i in range(l1 + 1, l2):
-        if (gsd[i] < 0.) and (gsd[i-1] > 0.):
-            icross.append(i - 1)
-        if (gsd[i] > 0.) and (gsd[i-1] < 0.):
-            icross.append(i)
+    if useLoops:
+        icross = findCrossingsLoop(gsd, l1, l2)
+    else:
+        icross = findCrossings(gsd, l1, l2)
 
-    if icross == []:
+    if len(icross) == 0:
         print 'No places where the second derivative crosses zero, so no peaks were found by Mariscotti algorithm.'
         if showPlot:
             plotDict = {}
@@ -218,53 +467,14 @@ def mariscotti(y, **kwargs):
             print "Mariscotti algorithm completed.\n"
         return []
 
-    # defined the outputs
-    gaussParameters = []
-
     # find the peaks
     maxAllowedError = f1 * err
-    for i in range(len(icross) - 1):
-        icrossStart = icross[i]
-        icrossStop = icross[i + 1]
-        # check that that there are no subsections of zero length (can happen because of the cautious crossover finder
-        # used on a noising part of the data)
-        if icrossStart != icrossStop:
-            gsd_subSample = gsd[icrossStart:icrossStop]
-            # Determine is the subset is a peak of a vally
-            gsd_subSample_lessThenZero = gsd_subSample[gsd_subSample < 0.0]
-            count_gsd_subSample_lessThenZero = len(gsd_subSample_lessThenZero)
-            # this is true if the subsection is a peak
-            if count_gsd_subSample_lessThenZero == 0:
-                indexList = numpy.arange(len(gsd_subSample))
-                if pk_gsd is not None:
-                    maxval = max(gsd_subSample)
-                    indexOfPeak_gsd_subSample = list(indexList[gsd_subSample == maxval])
-                else:
-                    y_subSmaple = y[icrossStart:icrossStop]
-                    maxval = max(y_subSmaple)
-                    indexOfPeak_gsd_subSample = list(indexList[y_subSmaple == maxval])
-                numOfIndexWithPeakValue = len(indexOfPeak_gsd_subSample)
-                if 1 == numOfIndexWithPeakValue:
-                    indexOfPeak_y = indexOfPeak_gsd_subSample[0] + icross[i]
-                # if more than one index with the max value, take the max GSD value closest to the max y value
-                elif 1 < numOfIndexWithPeakValue:
-                    highestValueGSD = float('-Inf')
-                    chooseIndex = None
-                    for testIndex in indexOfPeak_gsd_subSample:
-                        currentValueGSD = gsd_subSample[testIndex]
-                        if highestValueGSD < currentValueGSD:
-                            highestValueGSD = currentValueGSD
-                            chooseIndex = testIndex
-
-                    indexOfPeak_y = chooseIndex + icross[i]
-                else:
-                    indexOfPeak_y = None
-                if indexOfPeak_y is not None:
-                    if maxAllowedError[indexOfPeak_y] < gsd[indexOfPeak_y]:
-                        sigma = float(icrossStop - icrossStart)/float(2.0)
-                        gaussParameters.append((maxval, indexOfPeak_y, sigma))
+    if useLoops:
+        gaussParameters = findPeaksInRegionsLoop(y, gsd, icross, maxAllowedError, pk_gsd)
+    else:
+        gaussParameters = findPeaksInRegions(y, gsd, icross, maxAllowedError, pk_gsd)
 
-    if gaussParameters == []:
+    if len(gaussParameters) == 0:
         print "No peaks were found by the Mariscotti algorithm, "+ \
               "but there were places where the second derivative crossed zero."
         print "This can happen if the maximum allowed error at a peak is greater then the generalized "+\
@@ -306,10 +516,10 @@ def mariscotti(y, **kwargs):
             quickPlotter(plotDict=plotDict)
         if verbose:
             print "Mariscotti algorithm completed.\n"
-        return gaussParameters
+        return []
 
     else:
-        gaussParametersArray = numpy.array(gaussParameters)
+        gaussParametersArray = numpy.array(gaussParameters, dtype=float)
         numOfPeaksFound = len(gaussParametersArray[:,0])
         if verbose:
             optional_s = ''
@@ -389,8 +599,106 @@ def peakFinder(spectrum,
 
 
 
+def benchmarkMariscotti(listOfSpectra, numberOfIndexesToSmoothOver=5, errFactor=1, pk_gsd=None, repeats=3,
+                        verbose=True):
+    """
+    Compares the time of mariscotti with the array operations (default) to the original loops (useLoops=True), and
+    checks that both return the same gaussParametersArray for every spectrum.
+
+    :return: a dictionary of the total time in seconds for each method
+    """
+    import time
+    kwargs = {'nsmooth': numberOfIndexesToSmoothOver, 'errFactor': errFactor}
+    if pk_gsd is not None:
+        kwargs['pk_gsd'] = pk_gsd
+    timesDict = {}
+    resultsDict = {}
+    for useLoops in [True, False]:
+        methodName = 'useLoops=' + str(useLoops)
+        resultsDict[methodName] = []
+        startTime = time.time()
+        for spectrum in listOfSpectra:
+            for repeatIndex in range(repeats):
+                gaussParametersArray = mariscotti(spectrum, useLoops=useLoops, **kwargs)
+            resultsDict[methodName].append(numpy.array(gaussParametersArray))
+        timesDict[methodName] = time.time() - startTime
+    numOfPeaks = 0
+    for (loopResult, arrayResult) in zip(resultsDict['useLoops=True'], resultsDict['useLoops=False']):
+        if not numpy.array_equal(loopResult, arrayResult):
+            raise ValueError("The array and loop versions of mariscotti found different peaks.")
+        numOfPeaks += len(loopResult)
+
+    if verbose:
+        numOfCalls = len(listOfSpectra) * repeats
+        print "mariscotti found", numOfPeaks, "peaks in", len(listOfSpectra), "spectra, the same for both methods."
+        for methodName in sorted(timesDict.keys()):
+            print methodName + ":", str('%.3f' % timesDict[methodName]), "s total,", \
+                str('%.3E' % (timesDict[methodName] / float(numOfCalls))), "s per spectrum,", \
+                str('%.2f' % (timesDict['useLoops=True'] / timesDict[methodName])), "times faster than the loops"
+    return timesDict
+
+
+def benchmarkMariscottiBatch(arrayOfSpectra, numberOfIndexesToSmoothOver=5, errFactor=1, verbose=True):
+    """
+    Compares the time of mariscottiBatch to calling mariscotti for one spectrum at a time, and checks that the
+    peaks are the same.
+
+    :return: a dictionary of the total time in seconds for each method
+    """
+    import time
+    import sys
+    import os
+    timesDict = {}
+    startTime = time.time()
+    peakTable = mariscottiBatch(arrayOfSpectra, nsmooth=numberOfIndexesToSmoothOver, errFactor=errFactor)
+    timesDict['mariscottiBatch'] = time.time() - startTime
+    # mariscotti prints a message for spectra without peaks
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        startTime = time.time()
+        listOfResults = [numpy.array(mariscotti(spectrum, nsmooth=numberOfIndexesToSmoothOver, errFactor=errFactor))
+                         for spectrum in arrayOfSpectra]
+        timesDict['mariscotti'] = time.time() - startTime
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    for (singleResult, batchResult) in zip(listOfResults, splitPeakTable(peakTable, len(arrayOfSpectra))):
+        if len(singleResult) != len(batchResult) or \
+                (0 < len(batchResult) and not numpy.allclose(singleResult, numpy.column_stack(
+                    (batchResult['amplitude'], batchResult['channel'], batchResult['sigma'])))):
+            raise ValueError("mariscottiBatch and mariscotti found different peaks.")
+
+    if verbose:
+        print "mariscottiBatch found", len(peakTable), "peaks in", len(arrayOfSpectra), "spectra of", \
+            numpy.shape(arrayOfSpectra)[1], "channels, the same as mariscotti."
+        for methodName in sorted(timesDict.keys()):
+            print methodName + ":", str('%.3f' % timesDict[methodName]), "s total,", \
+                str('%.2f' % (timesDict['mariscotti'] / timesDict[methodName])), "times faster than mariscotti"
+    return timesDict
+
+
+def makeSyntheticSpectra(numOfSpectra=10, numOfChannels=16384, numOfPeaks=12):
+    # Poisson counts of Gaussian peaks on an exponential background
+    numpy.random.seed(0)
+    channels = numpy.arange(numOfChannels)
+    listOfSpectra = []
+    for spectrumIndex in range(numOfSpectra):
+        expected = 200.0 * numpy.exp(-channels / (numOfChannels / 4.0)) + 2.0
+        for peakIndex in range(numOfPeaks):
+            mean = numpy.random.uniform(0.05, 0.95) * numOfChannels
+            sigma = numpy.random.uniform(0.002, 0.01) * numOfChannels
+            expected += numpy.random.uniform(20.0, 500.0) * numpy.exp(-(channels - mean)**2 / (2.0 * sigma**2))
+        listOfSpectra.append(numpy.random.poisson(expected).astype(float))
+    return listOfSpectra
+
+
 if __name__ == '__main__':
+    import os
+    import glob
     from dataGetter import getTableData
+    doDemo = True
+    doBenchmark = True
     # A few options for this data
     endIndex = 100
     verbose = True
@@ -398,16 +706,41 @@ if __name__ == '__main__':
     errFactor = 50
     showPlot = True
 
-    # Get the test data
-    testDataFile = "Am-241.csv"
-    if verbose:
-        print "Getting the test data in the file.", testDataFile
-    testData = getTableData(testDataFile)
-    chan = testData['chan'][:endIndex]
-    data = testData['data'][:endIndex]
-
-    # apply the mariscotti peak finding algorithm
-    gaussParametersArray = numpy.array(mariscotti(data, nsmooth=numberOfIndexesToSmoothOver,
-                                                  errFactor=errFactor, plot=showPlot, verbose=verbose))
-
-
+    if doBenchmark:
+        # the .tka.csv spectra in the testData folder, the last column of each line, without the live and real times
+        testDataFolder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testData')
+        listOfSpectra = []
+        for testDataFile in sorted(glob.glob(os.path.join(testDataFolder, '*.tka.csv'))):
+            testDataHandle = open(testDataFile, 'rU')
+            spectrum = []
+            for line in testDataHandle:
+                try:
+                    spectrum.append(float(line.strip().split(',')[-1]))
+                except ValueError:
+                    # the header line
+                    pass
+            testDataHandle.close()
+            listOfSpectra.append(numpy.array(spectrum[2:]))
+        print "Benchmark on the", len(listOfSpectra), "spectra in", testDataFolder
+        benchmarkMariscotti(listOfSpectra, numberOfIndexesToSmoothOver=numberOfIndexesToSmoothOver, errFactor=1)
+        print "\nBenchmark on synthetic 16384 channel spectra"
+        benchmarkMariscotti(makeSyntheticSpectra(), numberOfIndexesToSmoothOver=numberOfIndexesToSmoothOver,
+                            errFactor=1)
+        benchmarkMariscotti(makeSyntheticSpectra(), numberOfIndexesToSmoothOver=numberOfIndexesToSmoothOver,
+                            errFactor=1, pk_gsd=True)
+        print "\nBenchmark of mariscottiBatch on many short spectra"
+        benchmarkMariscottiBatch(numpy.array(makeSyntheticSpectra(numOfSpectra=500, numOfChannels=1024, numOfPeaks=4)),
+                                 numberOfIndexesToSmoothOver=numberOfIndexesToSmoothOver, errFactor=1)
+
+    if doDemo:
+        # Get the test data
+        testDataFile = "Am-241.csv"
+        if verbose:
+            print "Getting the test data in the file.", testDataFile
+        testData = getTableData(testDataFile)
+        chan = testData['chan'][:endIndex]
+        data = testData['data'][:endIndex]
+
+        # apply the mariscotti peak finding algorithm
+        gaussParametersArray = numpy.array(mariscotti(data, nsmooth=numberOfIndexesToSmoothOver,
+                                                      errFactor=errFactor, plot=showPlot, verbose=verbose))
@@ -1,9 +1,17 @@
 import numpy
+from multiprocessing import Pool
 from scipy.optimize import least_squares
 from operator import itemgetter
 
 from quickPlots import quickPlotter
-from pulseReadIn import loadPulses, saveProcessedData
+from pulseReadIn import saveProcessedData, getSortedFileIds, loadPulseFile, iterPulseFiles, spillPulseDicts,\
+    waveformDataTypes
+from sumOfPowersFitter import sumOfPowersFitter, estimateSumOfPowers, pronyEstimateBatch
+
+
+# 'nonlinear' is a least squares fit, 'linear' is the closed form estimate from Prony's method, and 'linearSeed' is
+# a least squares fit that starts from the linear estimate.
+fitModes = ['nonlinear', 'linear', 'linearSeed']
 
 
 def initializeTestPlots(doShow, verbose, doSave=False, plotFileName='plot', title=None):
@@ -133,6 +141,117 @@ def calcIntegral(yData, xData, plotDict):
     return integral, plotDict
 
 
+def removeOutliersBatch(arrayOfPulses, multiplesOfMedianStdForRejection=2.0):
+    # The same rejection as removeOutliers, done for every row (pulse) of a 2-D array at once.
+    dataMedian = numpy.median(arrayOfPulses, axis=1)[:, numpy.newaxis]
+    difference = numpy.abs(arrayOfPulses - dataMedian)
+    medianOfDifference = numpy.median(difference, axis=1)[:, numpy.newaxis]
+    # rows with a median difference of zero have no outliers, like the single pulse version
+    hasSpread = medianOfDifference != 0.0
+    testValues = numpy.where(hasSpread, difference / numpy.where(hasSpread, medianOfDifference, 1.0), 0.0)
+    outliersMask = multiplesOfMedianStdForRejection < testValues
+    cleanedArray = numpy.where(outliersMask, dataMedian, arrayOfPulses)
+    return cleanedArray, numpy.logical_not(outliersMask)
+
+
+def convDataBatch(arrayOfPulses, conv_channels):
+    # The same top hat convolution as convData (numpy.convolve with mode='same') for every row at once.
+    # The rows are zero padded and the kernel is applied as a sum of shifted slices.
+    (numOfPulses, numOfSamples) = numpy.shape(arrayOfPulses)
+    leftPad = conv_channels - 1 - ((conv_channels - 1) // 2)
+    paddedArray = numpy.zeros((numOfPulses, numOfSamples + conv_channels - 1))
+    paddedArray[:, leftPad:leftPad + numOfSamples] = arrayOfPulses
+    smoothedData = numpy.zeros((numOfPulses, numOfSamples))
+    for shift in range(conv_channels):
+        smoothedData += paddedArray[:, shift:shift + numOfSamples] / float(conv_channels)
+    return smoothedData
+
+
+def calcIntegralBatch(arrayOfPulses, startIndexes, xSteps):
+    # The same mid point trapezoid integral as calcIntegral for every row at once. Each row is only
+    # integrated from its startIndex onward, over a uniform grid with the spacing xSteps for that row.
+    (numOfPulses, numOfSamples) = numpy.shape(arrayOfPulses)
+    rowIndexes = numpy.arange(numOfPulses)
+    columnIndexes = numpy.arange(numOfSamples)[numpy.newaxis, :]
+    keptXData = (columnIndexes - startIndexes[:, numpy.newaxis]) * xSteps[:, numpy.newaxis]
+    midXPoints = numpy.zeros((numOfPulses, numOfSamples + 1))
+    midYPoints = numpy.zeros((numOfPulses, numOfSamples + 1))
+    # Calculate the midpoints of the x and y data
+    midXPoints[:, 1:-1] = (keptXData[:, 1:] + keptXData[:, :-1]) / 2.0
+    midYPoints[:, 1:-1] = (arrayOfPulses[:, 1:] + arrayOfPulses[:, :-1]) / 2.0
+    # the start and end points need to be treated differently
+    midXPoints[:, -1] = keptXData[:, -1]
+    midYPoints[:, -1] = arrayOfPulses[:, -1]
+    midXPoints[rowIndexes, startIndexes] = keptXData[rowIndexes, startIndexes]
+    midYPoints[rowIndexes, startIndexes] = arrayOfPulses[rowIndexes, startIndexes]
+    # dx is the bases of each trapezoid, dy is the average height of the trapezoid
+    dx = midXPoints[:, 1:] - midXPoints[:, :-1]
+    dy = (midYPoints[:, 1:] + midYPoints[:, :-1]) / 2.0
+    keptMask = columnIndexes >= startIndexes[:, numpy.newaxis]
+    integral = numpy.sum(numpy.where(keptMask, dx * dy, 0.0), axis=1)
+    return integral
+
+
+def pulsePipelineBatch(arrayOfPulses, xData, multiplesOfMedianStdForRejection=None, conv_channels=1,
+                       trimBeforeMin=True):
+    """
+    The array version of pulsePipeline for many pulses of the same length.
+
+    :param arrayOfPulses: 2-D array with one pulse per row, (N_pulses x N_samples).
+    :param xData: the time data, either one row shared by all the pulses or a 2-D array like arrayOfPulses.
+    :return: a dictionary of columns, one entry per pulse for 'integral', 'startIndex', 'keptLen', 'xStep'
+        and 'deltaX'. 'arrayData' and 'smoothedData' are 2-D arrays, the kept data for a single pulse is
+        found with getKeptDataBatch.
+    """
+    arrayOfPulses = numpy.array(arrayOfPulses, dtype=float, ndmin=2)
+    (numOfPulses, numOfSamples) = numpy.shape(arrayOfPulses)
+    xData = numpy.array(xData, dtype=float)
+    if xData.ndim == 1:
+        xData = numpy.tile(xData, (numOfPulses, 1))
+    rowIndexes = numpy.arange(numOfPulses)
+    batchDict = {}
+
+    # Remove Outliers from this data
+    if multiplesOfMedianStdForRejection is not None:
+        arrayOfPulses, removalMask \
+            = removeOutliersBatch(arrayOfPulses, multiplesOfMedianStdForRejection=multiplesOfMedianStdForRejection)
+    batchDict['arrayData'] = arrayOfPulses
+
+    # Convolutions
+    if conv_channels > 1:
+        smoothedData = convDataBatch(arrayOfPulses, conv_channels)
+        batchDict['smoothedData'] = smoothedData
+    else:
+        smoothedData = arrayOfPulses
+        batchDict['smoothedData'] = None
+
+    # trim all the data prior to the minimum
+    if trimBeforeMin:
+        startIndexes = numpy.argmin(smoothedData, axis=1)
+        keptData = arrayOfPulses
+    else:
+        startIndexes = numpy.zeros(numOfPulses, dtype=int)
+        keptData = smoothedData
+    batchDict['startIndex'] = startIndexes
+    batchDict['keptLen'] = numOfSamples - startIndexes
+    nextIndexes = numpy.minimum(startIndexes + 1, numOfSamples - 1)
+    batchDict['xStep'] = xData[rowIndexes, nextIndexes] - xData[rowIndexes, startIndexes]
+    batchDict['deltaX'] = (batchDict['keptLen'] - 1) * batchDict['xStep']
+
+    # calculate integral
+    batchDict['integral'] = calcIntegralBatch(keptData, startIndexes, batchDict['xStep'])
+    batchDict['keptDataArray'] = keptData
+    return batchDict
+
+
+def getKeptDataBatch(batchDict, pulseIndex):
+    # the trimmed data and its uniform time grid for a single pulse from the output of pulsePipelineBatch
+    startIndex = batchDict['startIndex'][pulseIndex]
+    keptData = batchDict['keptDataArray'][pulseIndex, startIndex:]
+    keptXData = numpy.arange(len(keptData)) * batchDict['xStep'][pulseIndex]
+    return keptData, keptXData
+
+
 def naturalPower(xData, amplitude, tau):
     return amplitude * numpy.exp(-xData / tau)
 
@@ -161,7 +280,46 @@ def sumOfNaturalPowers(level, yData, xData):
     return optimizeFunc
 
 
-def fittingSumOfPowers(yData, xData, levelNum, plotDict, upperBoundAmp=float('inf')):
+def appendSumOfPowersPlots(plotDict, sortedFittedAmpTau, cost, residuals, yData, xData):
+    if (plotDict['doShow'] or plotDict['savePlot']):
+        paramString = 'Fitted (amp, tau) ['
+        for (amp, tau) in sortedFittedAmpTau:
+            paramString += '(' + str('%.3E' % amp) + ', ' + str('%.2E' % tau) + '), '
+        paramString = paramString[:-2] + ']'
+
+        plotDict = appendToTestPlots(plotDict,
+                                     residuals + yData,
+                                     xData,
+                                     legendLabel=paramString,
+                                     fmt='None',
+                                     markersize=4,
+                                     alpha=1.0,
+                                     ls='solid',
+                                     lineWidth=1)
+        plotDict = appendToTestPlots(plotDict,
+                                     residuals,
+                                     xData,
+                                     legendLabel='Level ' + str(len(sortedFittedAmpTau)) + ' Residuals, cost=' + str('%.6E' % cost),
+                                     fmt='None',
+                                     markersize=4,
+                                     alpha=1.0,
+                                     ls='solid',
+                                     lineWidth=1)
+    return plotDict
+
+
+def fittingSumOfPowers(yData, xData, levelNum, plotDict, upperBoundAmp=float('inf'), fitEngine=None,
+                       guessAmpTau=None):
+    # fitEngine is a sumOfPowersFitter with analytic Jacobians and warm starts, it is always used for levelNum > 4.
+    # guessAmpTau is an optional list of (amp, tau) to start the fit from, such as the output of estimateSumOfPowers.
+    if fitEngine is None and 4 < levelNum:
+        fitEngine = sumOfPowersFitter(numOfExponents=levelNum, upperBoundAmp=upperBoundAmp, warmStart=False)
+    if fitEngine is not None:
+        sortedFittedAmpTau, cost, lsq_results = fitEngine.fit(yData, xData, guessAmpTau)
+        if sortedFittedAmpTau is not None:
+            plotDict = appendSumOfPowersPlots(plotDict, sortedFittedAmpTau, cost, lsq_results['fun'], yData, xData)
+        return sortedFittedAmpTau, cost, plotDict
+
     guessParams = []
     guessAmp = yData[0]
     if guessAmp < 0:
@@ -177,8 +335,13 @@ def fittingSumOfPowers(yData, xData, levelNum, plotDict, upperBoundAmp=float('in
     guessTau = 1.0 / (1.0 + ((yData[-1] - yData[0]) / (xData[-1] - xData[0])))
     lowerBoundTau = float(0)
     upperBoundTau = float('inf')
-    guessParams.append((guessAmp, lowerBoundAmp, upperBoundAmp, guessTau, lowerBoundTau, upperBoundTau))
-    guessParams = guessParams * levelNum
+    if guessAmpTau is None:
+        guessParams.append((guessAmp, lowerBoundAmp, upperBoundAmp, guessTau, lowerBoundTau, upperBoundTau))
+        guessParams = guessParams * levelNum
+    else:
+        for (guessAmp, guessTau) in guessAmpTau:
+            guessAmp = numpy.clip(guessAmp, lowerBoundAmp, upperBoundAmp)
+            guessParams.append((guessAmp, lowerBoundAmp, upperBoundAmp, guessTau, lowerBoundTau, upperBoundTau))
 
     guesses = []
     lowerBounds = []
@@ -207,40 +370,44 @@ def fittingSumOfPowers(yData, xData, levelNum, plotDict, upperBoundAmp=float('in
             TauIndex = (2 * paramsIndex) + 1
             fittedAmpTau.append((lsq_results['x'][AmpIndex], lsq_results['x'][TauIndex]))
         sortedFittedAmpTau = sorted(fittedAmpTau, key=itemgetter(0), reverse=isPositive)
-        # print "guesses", guesses
-        # print "results", sortedFittedAmpTau
-        if (plotDict['doShow'] or plotDict['savePlot']):
-            paramString = 'Fitted (amp, tau) ['
-            for (amp, tau) in sortedFittedAmpTau:
-                paramString += '(' + str('%.3E' % amp) + ', ' + str('%.2E' % tau) + '), '
-            paramString = paramString[:-2] + ']'
-
-            plotDict = appendToTestPlots(plotDict,
-                                         optimizeFunc(lsq_results['x']) + yData,
-                                         xData,
-                                         legendLabel=paramString,
-                                         fmt='None',
-                                         markersize=4,
-                                         alpha=1.0,
-                                         ls='solid',
-                                         lineWidth=1)
-            plotDict = appendToTestPlots(plotDict,
-                                         residuals,
-                                         xData,
-                                         legendLabel='Level ' + str(levelNum) + ' Residuals, cost=' + str('%.6E' % cost),
-                                         fmt='None',
-                                         markersize=4,
-                                         alpha=1.0,
-                                         ls='solid',
-                                         lineWidth=1)
+        plotDict = appendSumOfPowersPlots(plotDict, sortedFittedAmpTau, cost, residuals, yData, xData)
     else:
         sortedFittedAmpTau = None
         cost = float('inf')
     return sortedFittedAmpTau, cost, plotDict
 
 
+def fitPulse(pulseDict, keptData, keptXData, plotDict, numOfExponents=1, upperBoundAmp=float('inf'),
+             fitEngine=None, fitMode='nonlinear', estimate=None):
+    # estimate is (estimatedAmpTau, estimatedCost) when the linear estimate was already done for a batch of pulses
+    if fitMode not in fitModes:
+        raise ValueError("fitMode must be one of " + str(fitModes) + ", not '" + str(fitMode) + "'")
+    if fitMode != 'nonlinear' and estimate is None:
+        estimate = estimateSumOfPowers(keptData, keptXData, numOfExponents)
+    if fitMode == 'linear':
+        fittedAmpTau, pulseDict['fittedCost'] = estimate
+    else:
+        if estimate is None:
+            guessAmpTau = None
+        else:
+            guessAmpTau = estimate[0]
+        # fit with a sum of exponential
+        fittedAmpTau, pulseDict['fittedCost'], plotDict \
+            = fittingSumOfPowers(keptData, keptXData, numOfExponents, plotDict, upperBoundAmp, fitEngine, guessAmpTau)
+    if fittedAmpTau is not None:
+        for (index, (amp, tau)) in list(enumerate(fittedAmpTau)):
+            pulseDict['fittedAmp' + str(index + 1)] = amp
+            pulseDict['fittedTau' + str(index + 1)] = tau
+    else:
+        for index in range(numOfExponents):
+            pulseDict['fittedAmp' + str(index + 1)] = None
+            pulseDict['fittedTau' + str(index + 1)] = None
+    return pulseDict, plotDict
+
+
 def pulsePipeline(pulseDict, plotDict, multiplesOfMedianStdForRejection=None, conv_channels=1, trimBeforeMin=True,
-                  numOfExponents=1, calcFitForEachPulse=False, upperBoundAmp=float('inf')):
+                  numOfExponents=1, calcFitForEachPulse=False, upperBoundAmp=float('inf'), fitEngine=None,
+                  fitMode='nonlinear'):
     arrayData = pulseDict['arrayData']
     xData = pulseDict['xData']
 
@@ -286,7 +453,7 @@ def pulsePipeline(pulseDict, plotDict, multiplesOfMedianStdForRejection=None, co
         keptLen = len(keptXData)
         xStep = keptXData[1] - keptXData[0]
         pulseDict['keptLen'] = keptLen
-        pulseDict['keptXData'] = numpy.arange(0.0, keptLen * float(xStep), xStep)
+        pulseDict['keptXData'] = numpy.arange(keptLen) * float(xStep)
         pulseDict['deltaX'] = pulseDict['keptXData'][-1] - pulseDict['keptXData'][0]
 
         if (plotDict['doShow'] or plotDict['savePlot']):
@@ -310,17 +477,11 @@ def pulsePipeline(pulseDict, plotDict, multiplesOfMedianStdForRejection=None, co
                                                    pulseDict['keptXData'],
                                                    plotDict)
     if calcFitForEachPulse:
-        # fit with a sum of exponential
-        fittedAmpTau, pulseDict['fittedCost'], plotDict \
-            = fittingSumOfPowers(pulseDict['keptData'], pulseDict['keptXData'], numOfExponents, plotDict, upperBoundAmp)
-        if fittedAmpTau is not None:
-            for (index, (amp, tau)) in list(enumerate(fittedAmpTau)):
-                pulseDict['fittedAmp' + str(index + 1)] = amp
-                pulseDict['fittedTau' + str(index + 1)] = tau
-        else:
-            for index in range(numOfExponents):
-                pulseDict['fittedAmp' + str(index + 1)] = None
-                pulseDict['fittedTau' + str(index + 1)] = None
+        pulseDict, plotDict = fitPulse(pulseDict, pulseDict['keptData'], pulseDict['keptXData'], plotDict,
+                                       numOfExponents=numOfExponents,
+                                       upperBoundAmp=upperBoundAmp,
+                                       fitEngine=fitEngine,
+                                       fitMode=fitMode)
     return pulseDict, plotDict
 
 
@@ -496,29 +657,189 @@ def calcP_funcForSI(charArray1, charArray2,
 
 
 
-def extractPulseInfo(folderName, fileNamePrefix='', filenameSuffix='',
-                     columnNamesToIgnore=['time'],
-                     skipRows=1, delimiter=',',
-                     trimBeforeMin=True,
-                     multiplesOfMedianStdForRejection=None,
-                     conv_channels=1,
-                     numOfExponents=1,
-                     calcFitForEachPulse=False,
-                     upperBoundAmp=float('inf'),
-                     showTestPlots_Pulses=False,
-                     testModeReadIn=False,
-                     verbose=True):
+def processPulseTable(tableDict, columnNamesToIgnore,
+                      trimBeforeMin=True,
+                      multiplesOfMedianStdForRejection=None,
+                      conv_channels=1,
+                      numOfExponents=1,
+                      calcFitForEachPulse=False,
+                      upperBoundAmp=float('inf'),
+                      showTestPlots_Pulses=False,
+                      useBatchPipeline=False,
+                      useFitEngine=False,
+                      charAmpTau=None,
+                      fitMode='nonlinear',
+                      verbose=True):
+    uniqueID = tableDict['uniqueID']
+    # A new fit engine for each table, the warm starts are then the same no matter how the files are split
+    # between processes.
+    if calcFitForEachPulse and useFitEngine:
+        fitEngine = sumOfPowersFitter(numOfExponents=numOfExponents, upperBoundAmp=upperBoundAmp,
+                                      warmStart=True, charAmpTau=charAmpTau)
+    else:
+        fitEngine = None
+    dataKeys = []
+    tableDict['xData'] = None
+    tableDictKeys = tableDict.keys()
+    for testKey in tableDictKeys:
+        if not testKey.lower() in columnNamesToIgnore:
+            dataKeys.append(testKey)
+        if 'time' == testKey.lower():
+            tableDict['xData'] = tableDict[testKey]
+
+    # The batch pipeline can not make the plots for each individual pulse.
+    if useBatchPipeline and not showTestPlots_Pulses and dataKeys != []:
+        return processPulseTableBatch(tableDict, dataKeys,
+                                      trimBeforeMin=trimBeforeMin,
+                                      multiplesOfMedianStdForRejection=multiplesOfMedianStdForRejection,
+                                      conv_channels=conv_channels,
+                                      numOfExponents=numOfExponents,
+                                      calcFitForEachPulse=calcFitForEachPulse,
+                                      upperBoundAmp=upperBoundAmp,
+                                      fitEngine=fitEngine,
+                                      fitMode=fitMode,
+                                      verbose=verbose)
+
+    listOfPulseDicts = []
+    plotDict = initializeTestPlots(showTestPlots_Pulses, verbose)
+    for key in dataKeys:
+        # make a new dictionary for each pulse, there may be many pulses in tableDict
+        pulseDict = {}
+        # assign the pulse yData
+        pulseDict['arrayData'] = tableDict[key]
+        # if the pulse has x Data, assign it
+        if tableDict['xData'] is None:
+            pulseDict['xData'] = len(pulseDict['arrayData'])
+        else:
+            pulseDict['xData'] = tableDict['xData']
+        # assign a unique iD to this pulse for later identification.
+        pulseDict['uniqueID'] = key.replace(' ', '_') + '_' + uniqueID
+        pulseDict['rawDataFileName'] = tableDict['fileName']
+
+        # process the pulse
+        pulseDict, plotDict = pulsePipeline(pulseDict, plotDict,
+                                            multiplesOfMedianStdForRejection,
+                                            conv_channels, trimBeforeMin,
+                                            numOfExponents, calcFitForEachPulse,
+                                            upperBoundAmp, fitEngine, fitMode)
+        listOfPulseDicts.append(pulseDict)
+
+    if showTestPlots_Pulses:
+        quickPlotter(plotDict  = plotDict)
+    return listOfPulseDicts
+
+
+def processPulseTableBatch(tableDict, dataKeys,
+                           trimBeforeMin=True,
+                           multiplesOfMedianStdForRejection=None,
+                           conv_channels=1,
+                           numOfExponents=1,
+                           calcFitForEachPulse=False,
+                           upperBoundAmp=float('inf'),
+                           fitEngine=None,
+                           fitMode='nonlinear',
+                           verbose=True):
+    # all the pulses in a table share the same time data, so they are stacked into a single 2-D array
+    arrayOfPulses = numpy.vstack([tableDict[key] for key in dataKeys])
+    if tableDict['xData'] is None:
+        xData = numpy.arange(numpy.shape(arrayOfPulses)[1], dtype=float)
+    else:
+        xData = tableDict['xData']
+    batchDict = pulsePipelineBatch(arrayOfPulses, xData,
+                                   multiplesOfMedianStdForRejection=multiplesOfMedianStdForRejection,
+                                   conv_channels=conv_channels,
+                                   trimBeforeMin=trimBeforeMin)
+    # the linear estimate is done for all the pulses in the table at once
+    if calcFitForEachPulse and fitMode != 'nonlinear':
+        estimatedAmps, estimatedTaus, estimatedCosts = pronyEstimateBatch(batchDict['keptDataArray'],
+                                                                          batchDict['startIndex'],
+                                                                          batchDict['xStep'],
+                                                                          numOfExponents=numOfExponents)
+    else:
+        estimatedCosts = None
+
+    # unpack the columns of results into the same pulse dictionaries that pulsePipeline makes
+    plotDict = initializeTestPlots(False, verbose)
+    listOfPulseDicts = []
+    for (pulseIndex, key) in list(enumerate(dataKeys)):
+        pulseDict = {}
+        pulseDict['arrayData'] = batchDict['arrayData'][pulseIndex, :]
+        pulseDict['xData'] = xData
+        pulseDict['uniqueID'] = key.replace(' ', '_') + '_' + tableDict['uniqueID']
+        pulseDict['rawDataFileName'] = tableDict['fileName']
+        if batchDict['smoothedData'] is None:
+            pulseDict['smoothedData'] = None
+        else:
+            pulseDict['smoothedData'] = batchDict['smoothedData'][pulseIndex, :]
+        if trimBeforeMin:
+            pulseDict['keptData'], pulseDict['keptXData'] = getKeptDataBatch(batchDict, pulseIndex)
+            pulseDict['keptLen'] = batchDict['keptLen'][pulseIndex]
+            pulseDict['deltaX'] = batchDict['deltaX'][pulseIndex]
+        else:
+            pulseDict['keptData'] = None
+            pulseDict['keptXData'] = None
+        pulseDict['integral'] = batchDict['integral'][pulseIndex]
+        if calcFitForEachPulse:
+            keptData, keptXData = getKeptDataBatch(batchDict, pulseIndex)
+            if estimatedCosts is None:
+                estimate = None
+            elif numpy.isfinite(estimatedCosts[pulseIndex]):
+                estimate = (zip(estimatedAmps[pulseIndex], estimatedTaus[pulseIndex]), estimatedCosts[pulseIndex])
+            else:
+                estimate = (None, float('inf'))
+            pulseDict, plotDict = fitPulse(pulseDict, keptData, keptXData, plotDict,
+                                           numOfExponents=numOfExponents,
+                                           upperBoundAmp=upperBoundAmp,
+                                           fitEngine=fitEngine,
+                                           fitMode=fitMode,
+                                           estimate=estimate)
+        listOfPulseDicts.append(pulseDict)
+    return listOfPulseDicts
+
 
-    listOfDataDicts = loadPulses(folderName,
-                                 fileNamePrefix=fileNamePrefix,
-                                 filenameSuffix=filenameSuffix,
-                                 skipRows=skipRows,
-                                 delimiter=delimiter,
-                                 testMode=testModeReadIn,
-                                 verbose=verbose)
+def loadAndProcessPulseFile(jobArgs):
+    # One file of work for a process pool, the read-in and the processing of all of the pulses in that file.
+    (uniqueID, fileName, skipRows, delimiter, columnNamesToIgnore, tableCache, processKwargs) = jobArgs
+    tableDict = loadPulseFile(uniqueID, fileName, skipRows=skipRows, delimiter=delimiter, tableCache=tableCache)
+    return processPulseTable(tableDict, columnNamesToIgnore, **processKwargs)
+
+
+def iterPulseInfo(folderName, fileNamePrefix='', filenameSuffix='',
+                  columnNamesToIgnore=['time'],
+                  skipRows=1, delimiter=',',
+                  trimBeforeMin=True,
+                  multiplesOfMedianStdForRejection=None,
+                  conv_channels=1,
+                  numOfExponents=1,
+                  calcFitForEachPulse=False,
+                  upperBoundAmp=float('inf'),
+                  showTestPlots_Pulses=False,
+                  testModeReadIn=False,
+                  useBatchPipeline=False,
+                  useFitEngine=False,
+                  charAmpTau=None,
+                  fitMode='nonlinear',
+                  workers=1,
+                  pool=None,
+                  tableCache=None,
+                  prefetch=2,
+                  sortedIDs=None,
+                  verbose=True):
+    """
+    The generator version of extractPulseInfo, the list of processed pulse dictionaries for each file is yielded as
+    soon as the file is done, in the order of the files. Only a few files are in memory at a time.
+
+    :param prefetch: with workers=1, the number of files that a separate thread reads ahead while the pulses of
+        the current file are processed (see pulseReadIn.iterPulseFiles). prefetch=0 reads each file when it is
+        needed.
+    :param sortedIDs: None (default) processes all the matching files in the folder, otherwise only the
+        (uniqueID, fileName) files in this list (from pulseReadIn.getSortedFileIds) are processed.
+    """
+    if (1 < workers or pool is not None) and showTestPlots_Pulses:
+        print "The test plots for each pulse can only be shown when workers=1, the files will be processed serially."
+        workers = 1
+        pool = None
 
-    numOfDataDicts = len(listOfDataDicts)
-    modLen = max((int(numOfDataDicts / 200.0), 1))
     if verbose:
         if conv_channels > 1:
             print "The data is to be smoothed with a top hat kernel of " + str(conv_channels) + " channels."
@@ -528,52 +849,167 @@ def extractPulseInfo(folderName, fileNamePrefix='', filenameSuffix='',
     columnNamesToIgnore.append('fileName'.lower())
     columnNamesToIgnore.append('uniqueID'.lower())
     columnNamesToIgnore.append('xData'.lower())
+    processKwargs = {'trimBeforeMin': trimBeforeMin,
+                     'multiplesOfMedianStdForRejection': multiplesOfMedianStdForRejection,
+                     'conv_channels': conv_channels,
+                     'numOfExponents': numOfExponents,
+                     'calcFitForEachPulse': calcFitForEachPulse,
+                     'upperBoundAmp': upperBoundAmp,
+                     'showTestPlots_Pulses': showTestPlots_Pulses,
+                     'useBatchPipeline': useBatchPipeline,
+                     'useFitEngine': useFitEngine,
+                     'charAmpTau': charAmpTau,
+                     'fitMode': fitMode,
+                     'verbose': verbose}
+
+    if sortedIDs is None:
+        sortedIDs = getSortedFileIds(folderName, fileNamePrefix, filenameSuffix, verbose)
+    if testModeReadIn:
+        sortedIDs = sortedIDs[:13]
+    numOfFiles = len(sortedIDs)
+    modLen = max((int(numOfFiles / 200.0), 1))
+
+    if 1 < workers or pool is not None:
+        # the worker processes do not print, the progress is reported here for all of them together
+        processKwargs['verbose'] = False
+        jobs = [(uniqueID, fileName, skipRows, delimiter, columnNamesToIgnore[:], tableCache, processKwargs)
+                for (uniqueID, fileName) in sortedIDs]
+        if pool is None:
+            localPool = Pool(processes=workers)
+        else:
+            localPool = pool
+        try:
+            chunkSize = max((int(numOfFiles / (4.0 * workers)), 1))
+            # imap returns the results in the order of the jobs, no matter which process finishes first
+            for (IDindex, pulseDictsThisFile) in list(enumerate(localPool.imap(loadAndProcessPulseFile, jobs,
+                                                                              chunkSize))):
+                if verbose:
+                    if IDindex % modLen == 0:
+                        print "File read-in and pulse operations are " \
+                              + str('%02.2f' % (IDindex * 100.0 / float(numOfFiles))) + " % complete."
+                yield pulseDictsThisFile
+        finally:
+            if pool is None:
+                localPool.close()
+                localPool.join()
+        return
+
+    tableDicts = iterPulseFiles(sortedIDs, skipRows=skipRows, delimiter=delimiter, tableCache=tableCache,
+                                prefetch=prefetch)
+    for (IDindex, tableDict) in list(enumerate(tableDicts)):
+        pulseDictsThisFile = processPulseTable(tableDict, columnNamesToIgnore, **processKwargs)
+        if verbose:
+            if IDindex % modLen == 0:
+                print "File read-in and pulse operations are " \
+                      + str('%02.2f' % (IDindex * 100.0 / float(numOfFiles))) + " % complete."
+        yield pulseDictsThisFile
 
-    # initialize the dictionary to extract data from processed pulses
-    listOfPulseDicts = []
 
+def filterPulseInfo(pulseDictsPerFile, outlierFilter):
+    # the pulses of each file from iterPulseInfo without the outliers, the pulses that the filter holds back at
+    # the start are yielded with a later file
+    for pulseDictsThisFile in pulseDictsPerFile:
+        yield outlierFilter.filterPulses(pulseDictsThisFile)
+    yield outlierFilter.flush()
 
-    for IDindex in range(numOfDataDicts):
-        tableDict = listOfDataDicts[IDindex]
-        uniqueID = tableDict['uniqueID']
-        tableDict = listOfDataDicts[IDindex]
-        dataKeys = []
-        tableDict['xData'] = None
-        tableDictKeys = tableDict.keys()
-        for testKey in tableDictKeys:
-            if not testKey.lower() in columnNamesToIgnore:
-                dataKeys.append(testKey)
-            if 'time' == testKey.lower():
-                tableDict['xData'] = tableDict[testKey]
-        plotDict = initializeTestPlots(showTestPlots_Pulses, verbose)
-        for key in dataKeys:
-            # make a new dictionary for each pulse, there may be many pulses in tableDict
-            pulseDict = {}
-            # assign the pulse yData
-            pulseDict['arrayData'] = tableDict[key]
-            # if the pulse has x Data, assign it
-            if tableDict['xData'] is None:
-                pulseDict['xData'] = len(pulseDict['arrayData'])
-            else:
-                pulseDict['xData'] = tableDict['xData']
-            # assign a unique iD to this pulse for later identification.
-            pulseDict['uniqueID'] = key.replace(' ', '_') + '_' + uniqueID
-            pulseDict['rawDataFileName'] = tableDict['fileName']
-
-            # process the pulse
-            pulseDict, plotDict = pulsePipeline(pulseDict, plotDict,
-                                                multiplesOfMedianStdForRejection,
-                                                conv_channels, trimBeforeMin,
-                                                numOfExponents, calcFitForEachPulse,
-                                                upperBoundAmp)
-            listOfPulseDicts.append(pulseDict)
-
-        if showTestPlots_Pulses:
-            quickPlotter(plotDict  = plotDict)
-
-        if verbose:
-            if IDindex % modLen == 0:
-                print "Pulse operations are " \
-                      + str('%02.2f' % (IDindex * 100.0 / float(numOfDataDicts))) + " % complete."
 
+def extractPulseInfo(folderName, fileNamePrefix='', filenameSuffix='',
+                     columnNamesToIgnore=['time'],
+                     skipRows=1, delimiter=',',
+                     trimBeforeMin=True,
+                     multiplesOfMedianStdForRejection=None,
+                     conv_channels=1,
+                     numOfExponents=1,
+                     calcFitForEachPulse=False,
+                     upperBoundAmp=float('inf'),
+                     showTestPlots_Pulses=False,
+                     testModeReadIn=False,
+                     useBatchPipeline=False,
+                     useFitEngine=False,
+                     charAmpTau=None,
+                     fitMode='nonlinear',
+                     workers=1,
+                     pool=None,
+                     waveformStores=None,
+                     tableCache=None,
+                     prefetch=2,
+                     pulseWriter=None,
+                     keepWaveforms=True,
+                     sortedIDs=None,
+                     charAccumulator=None,
+                     outlierFilter=None,
+                     verbose=True):
+    """
+    Read in and process all the pulse files in a folder.
+
+    :param workers: The number of processes used to read in and process the files. With workers=1 (default)
+        everything is done in this process. The pulses are returned in the same order either way.
+    :param pool: An existing multiprocessing.Pool to use instead of making a new one for this folder.
+    :param useFitEngine: Use a sumOfPowersFitter (analytic Jacobians, warm started from the previous pulse in the
+        same file) for calcFitForEachPulse.
+    :param charAmpTau: list of (amp, tau) of the fitted characteristic function, the start for the first fit of
+        each file when useFitEngine is True.
+    :param fitMode: how the sum of exponentials is found when calcFitForEachPulse is True. 'nonlinear' (default) is
+        the least squares fit, 'linear' is the much faster closed form estimate of Prony's method (vectorized over
+        all the pulses of a file with useBatchPipeline=True), and 'linearSeed' is the least squares fit started
+        from the linear estimate.
+    :param waveformStores: None (default) or a dictionary of raggedWaveformStore (see makeWaveformStores). The
+        waveforms of each file are moved to disk as soon as the file is processed and lazyPulseDicts are returned,
+        so only the scalars of each pulse stay in memory.
+    :param tableCache: None (default) or a dataGetter.parsedTableCache, files that were read before with the same
+        options are loaded from the cache instead of being parsed again.
+    :param prefetch: see iterPulseInfo.
+    :param sortedIDs: see iterPulseInfo.
+    :param pulseWriter: None (default) or a pulseReadIn.incrementalPulseWriter, the pulses of each file are saved
+        as soon as the file is processed.
+    :param keepWaveforms: If False, the waveforms (pulseReadIn.waveformDataTypes) are removed from the returned
+        pulse dictionaries after they are written by the pulseWriter, so that memory use does not grow with the
+        waveforms of every file in the folder.
+    :param charAccumulator: None (default) or a pulseStatistics.charPulseAccumulator, the pulses of each file are
+        added as soon as the file is processed, so the characteristic function is ready at the end of the read-in
+        even with keepWaveforms=False.
+    :param outlierFilter: None (default) or a pulseStatistics.streamingOutlierFilter, outlier pulses are removed
+        before they are saved, added to the charAccumulator or returned.
+    """
+    listOfPulseDicts = []
+    pulseDictsPerFile = iterPulseInfo(folderName,
+                                      fileNamePrefix=fileNamePrefix,
+                                      filenameSuffix=filenameSuffix,
+                                      columnNamesToIgnore=columnNamesToIgnore,
+                                      skipRows=skipRows,
+                                      delimiter=delimiter,
+                                      trimBeforeMin=trimBeforeMin,
+                                      multiplesOfMedianStdForRejection=multiplesOfMedianStdForRejection,
+                                      conv_channels=conv_channels,
+                                      numOfExponents=numOfExponents,
+                                      calcFitForEachPulse=calcFitForEachPulse,
+                                      upperBoundAmp=upperBoundAmp,
+                                      showTestPlots_Pulses=showTestPlots_Pulses,
+                                      testModeReadIn=testModeReadIn,
+                                      useBatchPipeline=useBatchPipeline,
+                                      useFitEngine=useFitEngine,
+                                      charAmpTau=charAmpTau,
+                                      fitMode=fitMode,
+                                      workers=workers,
+                                      pool=pool,
+                                      tableCache=tableCache,
+                                      prefetch=prefetch,
+                                      sortedIDs=sortedIDs,
+                                      verbose=verbose)
+    if outlierFilter is not None:
+        pulseDictsPerFile = filterPulseInfo(pulseDictsPerFile, outlierFilter)
+    for pulseDictsThisFile in pulseDictsPerFile:
+        if pulseWriter is not None:
+            pulseWriter.write(pulseDictsThisFile)
+        if charAccumulator is not None:
+            charAccumulator.addPulses([pulseDict for pulseDict in pulseDictsThisFile
+                                       if pulseDict['keptData'] is not None])
+        if waveformStores is not None:
+            pulseDictsThisFile = spillPulseDicts(pulseDictsThisFile, waveformStores)
+        elif not keepWaveforms:
+            for pulseDict in pulseDictsThisFile:
+                for pulseDataType in waveformDataTypes:
+                    if pulseDataType in pulseDict.keys():
+                        del pulseDict[pulseDataType]
+        listOfPulseDicts.extend(pulseDictsThisFile)
     return listOfPulseDicts
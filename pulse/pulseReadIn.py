@@ -1,4 +1,4 @@
-import string, numpy, os, glob
+import string, numpy, os, glob, sys, shutil, threading, Queue, json
 from operator import itemgetter
 
 from dataGetter import getTableData, getTableRowData
@@ -45,29 +45,515 @@ def getNextOutputFile(fileBase, isCSV=False, isSeries=True):
     return fileName
 
 
+def getBinaryFileNames(fileBase):
+    # The binary (.npy) files for a single pulse data type, see saveProcessedBinary
+    return {'data': fileBase + '.npy', 'uniqueID': fileBase + '_uniqueID.npy', 'offsets': fileBase + '_offsets.npy'}
+
+
+def deleteBinaryFiles(fileBase):
+    for fileName in getBinaryFileNames(fileBase).values():
+        if os.path.isfile(fileName):
+            os.remove(fileName)
+    return
+
+
+def saveProcessedBinary(listOfHeaderNames, listOfArrays, outPutFileBase, verbose=False):
+    """
+    Save one pulse data type in a binary columnar form, the fast alternative to saveProcessedData. The uniqueIDs are
+    saved in outPutFileBase + '_uniqueID.npy' as fixed length strings. Data with a single value per pulse is saved as
+    one array in outPutFileBase + '.npy'. Data with an array per pulse (such as 'keptData') is saved as a ragged array,
+    all the pulses one after the other in outPutFileBase + '.npy', with the start of each pulse in
+    outPutFileBase + '_offsets.npy'. The values are saved without any loss of precision and the files can be
+    memory mapped when they are read in by readInSavedBinaryData. A missing value (None) of data with a single number
+    per pulse is saved as nan.
+    """
+    deleteBinaryFiles(outPutFileBase)
+    fileNames = getBinaryFileNames(outPutFileBase)
+    if verbose:
+        print "\nSaving data to the binary file " + fileNames['data'] + ".\n"
+    numpy.save(fileNames['uniqueID'], numpy.array([str(header) for header in listOfHeaderNames]))
+    arrayOfData = numpy.asarray(listOfArrays)
+    if arrayOfData.dtype == object:
+        # arrays of different lengths, or single values with None for the missing ones
+        isRagged = any([isinstance(dataArray, (list, numpy.ndarray)) for dataArray in listOfArrays])
+    else:
+        isRagged = arrayOfData.ndim == 2
+    if isRagged:
+        # a ragged array, one array for each pulse
+        listOfLengths = [len(dataArray) for dataArray in listOfArrays]
+        offsets = numpy.zeros(len(listOfLengths) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(listOfLengths)
+        if listOfLengths == []:
+            values = numpy.zeros(0)
+        else:
+            values = numpy.concatenate([numpy.asarray(dataArray, dtype=float) for dataArray in listOfArrays])
+        numpy.save(fileNames['data'], values)
+        numpy.save(fileNames['offsets'], offsets)
+    else:
+        if arrayOfData.dtype == object:
+            try:
+                arrayOfData = numpy.array([float('nan') if datum is None else float(datum) for datum in listOfArrays])
+            except (TypeError, ValueError):
+                raise ValueError("The data for " + outPutFileBase + " must be numbers (or None), strings, or an " +
+                                 "array for each pulse.")
+        numpy.save(fileNames['data'], arrayOfData)
+    if verbose:
+        print "File writing is complete for", fileNames['data']
+    return
+
+
+def loadBinaryColumns(fileBase, mmapMode='r'):
+    """
+    Read in the files made by saveProcessedBinary.
+
+    :return: (uniqueIDs, values, offsets) offsets is None for data with a single value per pulse, otherwise the data
+        for pulse i is values[offsets[i]:offsets[i + 1]]. With mmapMode='r' the values stay on disk until they are used.
+    """
+    fileNames = getBinaryFileNames(fileBase)
+    uniqueIDs = numpy.load(fileNames['uniqueID'])
+    if os.path.isfile(fileNames['offsets']):
+        values = numpy.load(fileNames['data'], mmap_mode=mmapMode)
+        offsets = numpy.load(fileNames['offsets'])
+    else:
+        values = numpy.load(fileNames['data'])
+        offsets = None
+    return uniqueIDs, values, offsets
+
+
+def makeUniqueIDIndex(listOfPulseDicts):
+    # uniqueID -> position in listOfPulseDicts, so that the saved data is matched to the pulses with a dictionary
+    # look up instead of a search of the list
+    uniqueIDIndex = {}
+    for (listIndex, pulseDict) in list(enumerate(listOfPulseDicts)):
+        uniqueIDIndex[pulseDict['uniqueID']] = listIndex
+    return uniqueIDIndex
+
+
+def readInSavedBinaryData(fileBase, pulseDataType, listOfPulseDicts=[], mmapMode='r'):
+    # The binary version of readInSavedRowData, the ragged data are views of the (memory mapped) values
+    uniqueIDIndex = makeUniqueIDIndex(listOfPulseDicts)
+    uniqueIDs, values, offsets = loadBinaryColumns(fileBase, mmapMode=mmapMode)
+    isString = values.dtype.kind in 'SU'
+    for (rowIndex, testID) in list(enumerate(uniqueIDs)):
+        testID = str(testID)
+        if offsets is None:
+            if isString:
+                datum = str(values[rowIndex])
+            else:
+                datum = values[rowIndex]
+        else:
+            datum = values[offsets[rowIndex]:offsets[rowIndex + 1]]
+        if testID in uniqueIDIndex:
+            listOfPulseDicts[uniqueIDIndex[testID]][pulseDataType] = datum
+        else:
+            uniqueIDIndex[testID] = len(listOfPulseDicts)
+            listOfPulseDicts.append({'uniqueID':testID, pulseDataType:datum})
+    return listOfPulseDicts
+
+
+def exportBinaryToCSV(fileBase, outPutFileBase=None, delimiter=',', verbose=False):
+    # write the binary data of saveProcessedBinary to the row per pulse CSV format of saveProcessedData
+    if outPutFileBase is None:
+        outPutFileBase = fileBase
+    uniqueIDs, values, offsets = loadBinaryColumns(fileBase, mmapMode='r')
+    if offsets is None:
+        listOfArrays = list(values)
+    else:
+        listOfArrays = [numpy.array(values[offsets[rowIndex]:offsets[rowIndex + 1]])
+                        for rowIndex in range(len(uniqueIDs))]
+    saveProcessedData([str(uniqueID) for uniqueID in uniqueIDs], listOfArrays, outPutFileBase,
+                      delimiter=delimiter, saveAsColumns=False, verbose=verbose)
+    return
+
+
+waveformDataTypes = ['arrayData', 'xData', 'smoothedData', 'keptData', 'keptXData']
+
+
+class raggedWaveformStore():
+    """
+    Arrays of different lengths saved one after the other in a single raw binary file on disk. Arrays are appended
+    while the pulses are processed and read back as slices of a read only memory map, so the waveforms are only in
+    memory while they are being used.
+    """
+    def __init__(self, fileName, dtype=float):
+        self.fileName = fileName
+        self.dtype = numpy.dtype(dtype)
+        self.offsets = [0]
+        self.fileHandle = open(self.fileName, 'wb')
+        self.memmap = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, dataArray):
+        dataArray = numpy.ascontiguousarray(dataArray, dtype=self.dtype)
+        dataArray.tofile(self.fileHandle)
+        self.offsets.append(self.offsets[-1] + len(dataArray))
+        # the memory map is remade the next time it is needed, to include the new data
+        self.memmap = None
+        return len(self.offsets) - 2
+
+    def getMemmap(self):
+        if self.memmap is None:
+            if not self.fileHandle.closed:
+                self.fileHandle.flush()
+            if self.offsets[-1] == 0:
+                # numpy can not memory map an empty file
+                self.memmap = numpy.zeros(0, dtype=self.dtype)
+            else:
+                self.memmap = numpy.memmap(self.fileName, dtype=self.dtype, mode='r', shape=(self.offsets[-1],))
+        return self.memmap
+
+    def __getitem__(self, index):
+        return self.getMemmap()[self.offsets[index]:self.offsets[index + 1]]
+
+    def getLengths(self):
+        return numpy.diff(self.offsets)
+
+    def close(self):
+        if not self.fileHandle.closed:
+            self.fileHandle.close()
+
+
+class lazyPulseDict():
+    """
+    Used in place of a pulse dictionary, pulseDict['keptData'] works the same, but the waveforms are kept in
+    raggedWaveformStore files and only the per-pulse scalars are in memory. Setting a waveform data type makes it a
+    regular (in memory) value again.
+
+    :param sharedIndexes: None or a dictionary of the arrays already in the stores, {(key, id(array)): index}, so that
+        an array shared by many pulses (the xData of a file) is saved once, see spillPulseDicts.
+    """
+    def __init__(self, pulseDict, waveformStores, sharedIndexes=None):
+        self.scalars = {}
+        self.waveformStores = waveformStores
+        self.waveformIndexes = {}
+        for key in pulseDict.keys():
+            value = pulseDict[key]
+            if key in waveformStores.keys() and isinstance(value, numpy.ndarray):
+                if sharedIndexes is None:
+                    self.waveformIndexes[key] = waveformStores[key].append(value)
+                else:
+                    sharedKey = (key, id(value))
+                    if sharedKey not in sharedIndexes.keys():
+                        sharedIndexes[sharedKey] = waveformStores[key].append(value)
+                    self.waveformIndexes[key] = sharedIndexes[sharedKey]
+            else:
+                self.scalars[key] = value
+
+    def __getitem__(self, key):
+        if key in self.waveformIndexes.keys():
+            return self.waveformStores[key][self.waveformIndexes[key]]
+        return self.scalars[key]
+
+    def __setitem__(self, key, value):
+        if key in self.waveformIndexes.keys():
+            del self.waveformIndexes[key]
+        self.scalars[key] = value
+
+    def __delitem__(self, key):
+        if key in self.waveformIndexes.keys():
+            del self.waveformIndexes[key]
+        else:
+            del self.scalars[key]
+
+    def __contains__(self, key):
+        return key in self.waveformIndexes.keys() or key in self.scalars.keys()
+
+    def keys(self):
+        return self.scalars.keys() + self.waveformIndexes.keys()
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
+def makeWaveformStores(fileBase, pulseDataTypes=waveformDataTypes):
+    # one raggedWaveformStore per data type, with the files fileBase + '_' + pulseDataType + '.bin'
+    waveformStores = {}
+    for pulseDataType in pulseDataTypes:
+        waveformStores[pulseDataType] = raggedWaveformStore(fileBase + '_' + pulseDataType + '.bin')
+    return waveformStores
+
+
+def spillPulseDicts(listOfPulseDicts, waveformStores):
+    # move the waveforms of each pulse dictionary to disk, a list of lazyPulseDict is returned. The pulses of a file
+    # share the same xData array, it is saved once. The pulse dictionaries keep their arrays while this runs, so the
+    # id of an array is not reused.
+    sharedIndexes = {}
+    return [lazyPulseDict(pulseDict, waveformStores, sharedIndexes) for pulseDict in listOfPulseDicts]
+
+
+class incrementalPulseWriter():
+    """
+    Saves the pulses of a folder a few at a time, as they are processed, in the same files that
+    pulseGroup.saveOutputDict makes. For fileFormat='csv' each call to write appends rows to the files of
+    saveProcessedData. For fileFormat='npy' the arrays of each pulse are appended to raw files on disk and the files
+    of saveProcessedBinary are made by close(), only the scalar values are kept in memory until then.
+    With appendMode=True the pulses are added to the end of the files that are already saved.
+    """
+    def __init__(self, outPutFileBase, pulseDataTypesToSave, fileFormat='csv', delimiter=',', appendMode=False,
+                 verbose=False):
+        self.outPutFileBase = outPutFileBase
+        self.pulseDataTypesToSave = [pulseDataType for pulseDataType in pulseDataTypesToSave
+                                     if pulseDataType != 'uniqueID']
+        self.fileFormat = fileFormat
+        self.delimiter = delimiter
+        self.verbose = verbose
+        self.appendToExisting = appendMode
+        self.appendMode = appendMode
+        self.uniqueIDs = []
+        self.scalarLists = {}
+        self.waveformStores = {}
+        self.numOfPulses = 0
+
+    def write(self, listOfPulseDicts):
+        # like makeOutputDict, a pulse with a value of None for any of the data types is not saved
+        listOfPulseDicts = [pulseDict for pulseDict in listOfPulseDicts
+                            if not any([pulseDict[pulseDataType] is None
+                                        for pulseDataType in self.pulseDataTypesToSave])]
+        listOfHeaderNames = [pulseDict['uniqueID'] for pulseDict in listOfPulseDicts]
+        for pulseDataType in self.pulseDataTypesToSave:
+            fileBaseName = self.outPutFileBase + '_' + pulseDataType
+            listOfData = [pulseDict[pulseDataType] for pulseDict in listOfPulseDicts]
+            if self.fileFormat == 'npy':
+                if pulseDataType not in self.scalarLists.keys() and pulseDataType not in self.waveformStores.keys():
+                    if listOfData == []:
+                        continue
+                    if isinstance(listOfData[0], (list, numpy.ndarray)):
+                        self.waveformStores[pulseDataType] = raggedWaveformStore(fileBaseName + '.bin')
+                    else:
+                        self.scalarLists[pulseDataType] = []
+                if pulseDataType in self.waveformStores.keys():
+                    for datum in listOfData:
+                        self.waveformStores[pulseDataType].append(datum)
+                else:
+                    self.scalarLists[pulseDataType].extend(listOfData)
+            else:
+                saveProcessedData(listOfHeaderNames, listOfData, fileBaseName, delimiter=self.delimiter,
+                                  saveAsColumns=False, appendMode=self.appendMode, verbose=False)
+        self.uniqueIDs.extend(listOfHeaderNames)
+        self.numOfPulses += len(listOfHeaderNames)
+        self.appendMode = True
+
+    def close(self):
+        if self.fileFormat == 'npy':
+            for pulseDataType in self.pulseDataTypesToSave:
+                fileBaseName = self.outPutFileBase + '_' + pulseDataType
+                isSaved = os.path.isfile(getBinaryFileNames(fileBaseName)['data'])
+                if self.appendToExisting and isSaved and self.numOfPulses == 0:
+                    # nothing to add
+                    continue
+                if pulseDataType in self.waveformStores.keys():
+                    saveWaveformStoreAsBinary(self.waveformStores[pulseDataType], self.uniqueIDs, fileBaseName,
+                                              appendMode=self.appendToExisting and isSaved)
+                elif self.appendToExisting and isSaved:
+                    appendProcessedBinary(self.uniqueIDs, self.scalarLists.get(pulseDataType, []), fileBaseName)
+                else:
+                    saveProcessedBinary(self.uniqueIDs, self.scalarLists.get(pulseDataType, []), fileBaseName)
+        if self.verbose:
+            print self.numOfPulses, "pulses were saved to the files starting with " + self.outPutFileBase + "."
+        self.uniqueIDs = []
+        self.scalarLists = {}
+        self.waveformStores = {}
+
+
+def readBinaryDataHeader(fileHandle):
+    # read the header of a .npy file, the file handle is left at the start of the data
+    numpy.lib.format.read_magic(fileHandle)
+    return numpy.lib.format.read_array_header_1_0(fileHandle)
+
+
+def saveWaveformStoreAsBinary(waveformStore, listOfHeaderNames, outPutFileBase, appendMode=False):
+    """
+    Make the ragged files of saveProcessedBinary from a raggedWaveformStore, without reading the data into memory.
+    With appendMode the pulses in the store are added after the pulses that are already saved in outPutFileBase.
+    """
+    waveformStore.close()
+    fileNames = getBinaryFileNames(outPutFileBase)
+    uniqueIDs = numpy.array([str(header) for header in listOfHeaderNames])
+    offsets = numpy.array(waveformStore.offsets, dtype=numpy.int64)
+    listOfDataFileNames = [waveformStore.fileName]
+    if appendMode:
+        oldUniqueIDs = numpy.load(fileNames['uniqueID'])
+        oldOffsets = numpy.load(fileNames['offsets'])
+        uniqueIDs = numpy.concatenate((oldUniqueIDs, uniqueIDs))
+        offsets = numpy.concatenate((oldOffsets, oldOffsets[-1] + offsets[1:]))
+        oldDataFileName = fileNames['data'] + '.old'
+        os.rename(fileNames['data'], oldDataFileName)
+        listOfDataFileNames.insert(0, oldDataFileName)
+    else:
+        deleteBinaryFiles(outPutFileBase)
+    numpy.save(fileNames['uniqueID'], uniqueIDs)
+    numpy.save(fileNames['offsets'], offsets)
+    outputFileHandle = open(fileNames['data'], 'wb')
+    numpy.lib.format.write_array_header_1_0(outputFileHandle,
+                                            {'descr': numpy.lib.format.dtype_to_descr(waveformStore.dtype),
+                                             'fortran_order': False,
+                                             'shape': (int(offsets[-1]),)})
+    for dataFileName in listOfDataFileNames:
+        dataFileHandle = open(dataFileName, 'rb')
+        if dataFileName != waveformStore.fileName:
+            readBinaryDataHeader(dataFileHandle)
+        shutil.copyfileobj(dataFileHandle, outputFileHandle)
+        dataFileHandle.close()
+        os.remove(dataFileName)
+    outputFileHandle.close()
+    return
+
+
+def appendProcessedBinary(listOfHeaderNames, listOfArrays, outPutFileBase):
+    # add pulses to the end of the files of saveProcessedBinary, for data with a single value per pulse
+    uniqueIDs, values, offsets = loadBinaryColumns(outPutFileBase)
+    listOfAllHeaderNames = list(uniqueIDs) + list(listOfHeaderNames)
+    if values.dtype.kind in 'SU':
+        listOfAllArrays = [str(value) for value in values] + list(listOfArrays)
+    else:
+        listOfAllArrays = list(values) + list(listOfArrays)
+    saveProcessedBinary(listOfAllHeaderNames, listOfAllArrays, outPutFileBase)
+    return
+
+
+def removeSavedPulses(outPutFileBase, pulseDataTypes, uniqueIDsToRemove, fileFormat='csv', delimiter=','):
+    """
+    Remove the pulses with the uniqueIDs in uniqueIDsToRemove from the files of pulseGroup.saveOutputDict,
+    the files are outPutFileBase + '_' + pulseDataType for each of the pulseDataTypes.
+    """
+    uniqueIDsToRemove = set([str(uniqueID) for uniqueID in uniqueIDsToRemove])
+    if uniqueIDsToRemove == set():
+        return
+    for pulseDataType in pulseDataTypes:
+        if pulseDataType == 'uniqueID':
+            continue
+        fileBaseName = outPutFileBase + '_' + pulseDataType
+        if fileFormat == 'npy':
+            if os.path.isfile(getBinaryFileNames(fileBaseName)['data']):
+                removeBinaryRows(fileBaseName, uniqueIDsToRemove)
+        else:
+            fileName = getNextOutputFile(fileBaseName, isCSV=delimiter==',', isSeries=False)
+            if os.path.isfile(fileName):
+                removeSavedRows(fileName, uniqueIDsToRemove, delimiter=delimiter)
+    return
+
+
+def removeSavedRows(fileName, uniqueIDsToRemove, delimiter=','):
+    # rewrite a file of saveProcessedData (one row per pulse) without the rows of uniqueIDsToRemove
+    tempFileName = fileName + '.tmp'
+    inputFileHandle = open(fileName, 'r')
+    outputFileHandle = open(tempFileName, 'w')
+    for line in inputFileHandle:
+        if line.split(delimiter, 1)[0].strip() not in uniqueIDsToRemove:
+            outputFileHandle.write(line)
+    inputFileHandle.close()
+    outputFileHandle.close()
+    os.rename(tempFileName, fileName)
+    return
+
+
+def removeBinaryRows(fileBase, uniqueIDsToRemove):
+    # rewrite the files of saveProcessedBinary without the pulses of uniqueIDsToRemove
+    uniqueIDs, values, offsets = loadBinaryColumns(fileBase)
+    keepIndexes = [rowIndex for (rowIndex, uniqueID) in list(enumerate(uniqueIDs))
+                   if str(uniqueID) not in uniqueIDsToRemove]
+    listOfHeaderNames = [str(uniqueIDs[rowIndex]) for rowIndex in keepIndexes]
+    if offsets is None:
+        saveProcessedBinary(listOfHeaderNames, values[keepIndexes], fileBase)
+    else:
+        # the kept pulses are copied one at a time through a store on disk
+        waveformStore = raggedWaveformStore(fileBase + '.bin', dtype=values.dtype)
+        for rowIndex in keepIndexes:
+            waveformStore.append(values[offsets[rowIndex]:offsets[rowIndex + 1]])
+        del values
+        saveWaveformStoreAsBinary(waveformStore, listOfHeaderNames, fileBase)
+    return
+
+
+def getManifestFileName(outPutFileBase):
+    return outPutFileBase + '_manifest.json'
+
+
+def loadManifest(outPutFileBase):
+    """
+    The record of the raw data files that were processed and saved to the files starting with outPutFileBase.
+
+    :return: None if there is no manifest, otherwise a dictionary with 'parameters' (the processing options) and
+        'files', a dictionary with the file name as the key and a dictionary of 'size', 'mtime' and 'uniqueIDs' (the
+        uniqueIDs of the saved pulses from that file) as the value.
+    """
+    manifestFileName = getManifestFileName(outPutFileBase)
+    if not os.path.isfile(manifestFileName):
+        return None
+    manifestFileHandle = open(manifestFileName, 'r')
+    manifest = json.load(manifestFileHandle)
+    manifestFileHandle.close()
+    return manifest
+
+
+def saveManifest(outPutFileBase, manifest):
+    # the manifest is written to a temporary file first, so an interrupted run does not leave a partial manifest
+    manifestFileName = getManifestFileName(outPutFileBase)
+    tempFileName = manifestFileName + '.tmp'
+    manifestFileHandle = open(tempFileName, 'w')
+    json.dump(manifest, manifestFileHandle, indent=1, sort_keys=True)
+    manifestFileHandle.close()
+    if os.path.isfile(manifestFileName):
+        os.remove(manifestFileName)
+    os.rename(tempFileName, manifestFileName)
+    return
+
+
+def getFileStat(fileName):
+    fileStat = os.stat(fileName)
+    return {'size': fileStat.st_size, 'mtime': fileStat.st_mtime}
+
+
+def findFilesToProcess(sortedIDs, manifest):
+    """
+    Compare the files in sortedIDs (see getSortedFileIds) to a manifest from loadManifest.
+
+    :return: (sortedIDsToProcess, fileNamesToRemove) the files that are new or have changed (size or modification
+        time) since they were processed, and the files in the manifest whose saved pulses need to be removed because
+        the file has changed or no longer exists.
+    """
+    sortedIDsToProcess = []
+    fileNamesToRemove = []
+    currentFileNames = set()
+    for (uniqueID, fileName) in sortedIDs:
+        currentFileNames.add(fileName)
+        if fileName not in manifest['files'].keys():
+            sortedIDsToProcess.append((uniqueID, fileName))
+        else:
+            fileRecord = manifest['files'][fileName]
+            fileStat = getFileStat(fileName)
+            if fileStat['size'] != fileRecord['size'] or fileStat['mtime'] != fileRecord['mtime']:
+                sortedIDsToProcess.append((uniqueID, fileName))
+                fileNamesToRemove.append(fileName)
+    for fileName in manifest['files'].keys():
+        if fileName not in currentFileNames:
+            fileNamesToRemove.append(fileName)
+    return sortedIDsToProcess, fileNamesToRemove
+
+
 def readInSavedRowData(fileName, pulseDataType, listOfPulseDicts=[]):
-    # create the uniqueID list from list of existing pulse dictionaries.
-    uniqueIDList = []
-    for pulseDict in listOfPulseDicts:
-        uniqueIDList.append(pulseDict['uniqueID'])
+    # create the uniqueID index from list of existing pulse dictionaries.
+    uniqueIDIndex = makeUniqueIDIndex(listOfPulseDicts)
     # read-in and get the data table to assign to pulse dictionaries.
     tableDict = getTableRowData(fileName)
     # test to make sure is this data can be mapped to an existing pulse dictionary
     IDsThisTable = tableDict.keys()
     for testID in IDsThisTable:
-        if testID in uniqueIDList:
+        if testID in uniqueIDIndex:
             # This is the case where the uniqueID corresponds to an existing pulse dictionary
-            listIndex = uniqueIDList.index(testID)
-            pulseDict = listOfPulseDicts[listIndex]
+            pulseDict = listOfPulseDicts[uniqueIDIndex[testID]]
             pulseDict[pulseDataType] = tableDict[testID]
         else:
-            uniqueIDList.append(testID)
+            uniqueIDIndex[testID] = len(listOfPulseDicts)
             listOfPulseDicts.append({'uniqueID':testID, pulseDataType:tableDict[testID]})
     return listOfPulseDicts
 
 
-def loadPulses(folderName, fileNamePrefix='', filenameSuffix='',
-               skipRows=1, delimiter=',', testMode=False, verbose=True):
+def getSortedFileIds(folderName, fileNamePrefix='', filenameSuffix='', verbose=True):
     searchString = fileNamePrefix + "*" + filenameSuffix
     if verbose:
         print "\nLoading data from the folder " + folderName + "."
@@ -87,6 +573,23 @@ def loadPulses(folderName, fileNamePrefix='', filenameSuffix='',
         uniqueFileIds.append((uniqueID, fileName))
     # Sort the unique parts of each file
     sortedIDs = sorted(uniqueFileIds, key=itemgetter(0))
+    return sortedIDs
+
+
+def loadPulseFile(uniqueID, fileName, skipRows=1, delimiter=',', tableCache=None):
+    # tableCache is None or a dataGetter.parsedTableCache
+    if tableCache is None:
+        tableDict = getTableData(fileName, skiprows=skipRows, delimiter=delimiter)
+    else:
+        tableDict = tableCache.getTableData(fileName, skiprows=skipRows, delimiter=delimiter)
+    tableDict['fileName'] = fileName
+    tableDict['uniqueID'] = uniqueID
+    return tableDict
+
+
+def loadPulses(folderName, fileNamePrefix='', filenameSuffix='',
+               skipRows=1, delimiter=',', testMode=False, tableCache=None, verbose=True):
+    sortedIDs = getSortedFileIds(folderName, fileNamePrefix, filenameSuffix, verbose)
     numOfFiles = len(sortedIDs)
     modLen = max((int(numOfFiles / 200.0), 1))
     listOfDataDicts = []
@@ -95,15 +598,70 @@ def loadPulses(folderName, fileNamePrefix='', filenameSuffix='',
             if IDindex % modLen == 0:
                 print "File read-in is " \
                       + str('%02.2f' % (IDindex*100.0/float(numOfFiles))) + " % complete."
-        tableDict = getTableData(fileName, skiprows=skipRows, delimiter=delimiter)
-        tableDict['fileName'] = fileName
-        tableDict['uniqueID'] = uniqueID
+        tableDict = loadPulseFile(uniqueID, fileName, skipRows=skipRows, delimiter=delimiter, tableCache=tableCache)
         listOfDataDicts.append(tableDict)
         if (testMode and (IDindex == 12)):
             break
     return listOfDataDicts
 
 
+def prefetchPulseFiles(sortedIDs, skipRows, delimiter, tableCache, tableQueue, stopEvent):
+    # The read thread of iterPulseFiles, (isError, tableDict or sys.exc_info()) is put in the queue for each file
+    for (uniqueID, fileName) in sortedIDs:
+        try:
+            queueItem = (False, loadPulseFile(uniqueID, fileName, skipRows=skipRows, delimiter=delimiter,
+                                              tableCache=tableCache))
+        except Exception:
+            queueItem = (True, sys.exc_info())
+        # wait for space in the queue, unless the reading is stopped
+        while not stopEvent.is_set():
+            try:
+                tableQueue.put(queueItem, timeout=0.1)
+                break
+            except Queue.Full:
+                pass
+        if stopEvent.is_set() or queueItem[0]:
+            return
+
+
+def iterPulseFiles(sortedIDs, skipRows=1, delimiter=',', tableCache=None, prefetch=2):
+    """
+    A generator of the tableDict of each file in sortedIDs (see getSortedFileIds), in order. A thread reads up to
+    prefetch files ahead, so that the disk reads overlap with the processing of the tables and at most
+    prefetch + 1 tables are in memory at once. With prefetch=0 each file is read when it is needed.
+    """
+    if prefetch < 1:
+        for (uniqueID, fileName) in sortedIDs:
+            yield loadPulseFile(uniqueID, fileName, skipRows=skipRows, delimiter=delimiter, tableCache=tableCache)
+        return
+    tableQueue = Queue.Queue(maxsize=prefetch)
+    stopEvent = threading.Event()
+    readThread = threading.Thread(target=prefetchPulseFiles,
+                                  args=(sortedIDs, skipRows, delimiter, tableCache, tableQueue, stopEvent))
+    readThread.daemon = True
+    readThread.start()
+    try:
+        for fileIndex in range(len(sortedIDs)):
+            (isError, queueItem) = tableQueue.get()
+            if isError:
+                (errorType, errorValue, errorTraceback) = queueItem
+                raise errorType, errorValue, errorTraceback
+            yield queueItem
+    finally:
+        # this also stops the read thread when the generator is not used to the end
+        stopEvent.set()
+        readThread.join()
+
+
+def iterPulses(folderName, fileNamePrefix='', filenameSuffix='',
+               skipRows=1, delimiter=',', testMode=False, tableCache=None, prefetch=2, verbose=True):
+    # The generator version of loadPulses, see iterPulseFiles
+    sortedIDs = getSortedFileIds(folderName, fileNamePrefix, filenameSuffix, verbose)
+    if testMode:
+        sortedIDs = sortedIDs[:13]
+    return iterPulseFiles(sortedIDs, skipRows=skipRows, delimiter=delimiter, tableCache=tableCache, prefetch=prefetch)
+
+
 def saveProcessedData(listOfHeaderNames, listOfArrays, outPutFileBase,
                       maxDataArraysPerFile=20, delimiter=',',
                       saveAsColumns=False, appendMode=False, verbose=False):
@@ -170,7 +728,7 @@ def saveProcessedData(listOfHeaderNames, listOfArrays, outPutFileBase,
             data = listOfArrays[headerIndex]
             if type(data) is numpy.float64:
                 dataString = delimiter + str(data)
-            elif type(data) in [list, numpy.ndarray]:
+            elif isinstance(data, (list, numpy.ndarray)):
                 dataString = ''
                 for datum in data:
                     dataString += delimiter + str(datum)
@@ -109,6 +109,15 @@ if __name__ == '__main__':
     calcFitForEachPulse = True
 
 
+    """
+    How the sum of exponents is found for each pulse when calcFitForEachPulse is True.
+    'nonlinear' is a least squares fit for each pulse (default).
+    'linear' is a fast closed form estimate (Prony's method), good enough for histograms and cuts.
+    'linearSeed' is the least squares fit that starts from the 'linear' estimate.
+    """
+    fitMode = 'nonlinear'
+
+
     """
     These are the data types that will be saved in the output folder after processing.
     Current options include:
@@ -160,6 +169,85 @@ if __name__ == '__main__':
     """
     testModeReadIn = True
 
+
+    """
+    The number of processes used to read in and process the pulse files in step 1. workers=1 does everything
+    in a single process. The results are the same for any number of workers, a good choice is the number of
+    cores on your computer.
+    """
+    workers = 1
+
+
+    """
+    The file format for the processed pulse data that is saved in step 1 and loaded back in the later steps.
+    'csv' is the original text format, one row per pulse. 'npy' is a binary format with a single data file per
+    data type, this is much faster to save and load and the data is memory mapped when it is read back in.
+    """
+    fileFormat = 'csv'
+
+
+    """
+    If True, the waveforms of each pulse are moved to disk (memory mapped files in the outputFolder) as soon as
+    each file is processed. Only the per pulse scalars are kept in memory, use this when the data does not fit in RAM.
+    """
+    spillWaveforms = False
+
+
+    """
+    None or a folder for a cache of the parsed raw data files. The first read-in of a file saves the parsed table in
+    a binary form, later runs of step 1 load that instead of parsing the text again. A file that is changed, or
+    different read-in options, are parsed again. The cache is kept below maxCacheBytes by removing the entries that
+    were used the longest time ago.
+    """
+    cacheFolder = None
+    maxCacheBytes = int(2 * 1024**3)
+
+
+    """
+    If True, the pulses of each file are saved as soon as that file is processed, while the next files are read in
+    by a separate thread. Only the scalar values of each pulse are kept in memory, so the memory used does not
+    depend on the number of files. The saved files are the same as with streaming = False.
+    """
+    streaming = False
+
+
+    """
+    If True, only the raw data files that are new or have changed since the last run of step 1 are processed, and
+    their pulses are added to the saved files. A manifest of the processed files is saved in the outputFolder for
+    each folder. Everything is processed again when any of the processing options above are changed.
+    """
+    incremental = False
+
+
+    """
+    This is used to remove outliers from the data. This uses a method that is simple but effective for pulses that
+    have astronomically high values. We use the standard deviation from the median instead of the mean to make us
+    able to remove data the has values equal to inanity, float('inf), or that are so high they would skew the mean.
+    Each data type is in a tuple with the name and the value of standard deviation from the median such as
+    ('cost', 1.37)
+    This is available only for things that are one entry per pulse such as
+    'integral', 'fittedCost', 'fittedAmp1', 'fittedTau1', 'fittedAmp2' ...
+    see the documentation for pulseDataTypesToSave for more information on these types.
+    """
+    pulseDataTypesToRemoveOutliers = [('integral', float(100)),
+                                      ('deltaX', float(10))]
+    if calcFitForEachPulse:
+        pulseDataTypesToRemoveOutliers.append(('fittedCost', float(4)))
+        for functionNumber in range(1, numOfExponents + 1):
+            pulseDataTypesToRemoveOutliers.append(('fittedAmp' + str(functionNumber), float(10)))
+            pulseDataTypesToRemoveOutliers.append(('fittedTau' + str(functionNumber), float(10)))
+
+
+    """
+    If True, the outliers are removed while the pulses are processed in step 1 (approximate running medians, see
+    pulseStatistics.streamingOutlierFilter), so the outliers are never saved and step 3 is not needed.
+    """
+    removeOutliersInStep1 = False
+    if removeOutliersInStep1:
+        pulseDataTypesToRemoveOutliersStep1 = pulseDataTypesToRemoveOutliers
+    else:
+        pulseDataTypesToRemoveOutliersStep1 = None
+
     if preformStep1:
         if verbose:
             print "Preforming Step 1: Processing raw Pulse Data."
@@ -172,6 +260,15 @@ if __name__ == '__main__':
                                               calcFitForEachPulse=calcFitForEachPulse,
                                               showTestPlots_Pulses=showTestPlots_Pulses,
                                               testModeReadIn=testModeReadIn,
+                                              fitMode=fitMode,
+                                              workers=workers,
+                                              fileFormat=fileFormat,
+                                              spillWaveforms=spillWaveforms,
+                                              cacheFolder=cacheFolder,
+                                              maxCacheBytes=maxCacheBytes,
+                                              streaming=streaming,
+                                              incremental=incremental,
+                                              pulseDataTypesToRemoveOutliers=pulseDataTypesToRemoveOutliersStep1,
                                               verbose=verbose)
     ####################
     ####################
@@ -196,7 +293,8 @@ if __name__ == '__main__':
             print "\nPreforming Step 2: Loading processed pulse data."
         groupDict = loadSavedGroupsOfPulses(outputFolder,
                                             folderList,
-                                            pulseDataTypesToLoad)
+                                            pulseDataTypesToLoad,
+                                            fileFormat=fileFormat)
 
     ####################
     ####################
@@ -204,22 +302,8 @@ if __name__ == '__main__':
     ####################
     ####################
     """
-    This is used to remove outliers from the data. This uses a method that is simple but effective for pulses that
-    have astronomically high values. We use the standard deviation from the median instead of the mean to make us
-    able to remove data the has values equal to inanity, float('inf), or that are so high they would skew the mean.
-    Each data type is in a tuple with the name and the value of standard deviation from the median such as
-    ('cost', 1.37)
-    This is available only for things that are one entry per pulse such as
-    'integral', 'fittedCost', 'fittedAmp1', 'fittedTau1', 'fittedAmp2' ...
-    see the documentation for pulseDataTypesToSave for more information on these types.
+    The outliers are removed for the data types in pulseDataTypesToRemoveOutliers, see the options of step 1.
     """
-    pulseDataTypesToRemoveOutliers = [('integral', float(100)),
-                                      ('deltaX', float(10))]
-    if calcFitForEachPulse:
-        pulseDataTypesToRemoveOutliers.append(('fittedCost', float(4)))
-        for functionNumber in range(1, numOfExponents + 1):
-            pulseDataTypesToRemoveOutliers.append(('fittedAmp' + str(functionNumber), float(10)))
-            pulseDataTypesToRemoveOutliers.append(('fittedTau' + str(functionNumber), float(10)))
 
 
     if preformStep3:
@@ -386,7 +470,8 @@ if __name__ == '__main__':
         groupDict = loadSavedPulseWithCharPulseData(outputFolder,
                                                     folderList,
                                                     pulseDataTypesToLoad,
-                                                    characteristicFunctionFolders)
+                                                    characteristicFunctionFolders,
+                                                    fileFormat=fileFormat)
 
 
     ####################
@@ -443,6 +528,7 @@ if __name__ == '__main__':
                                                            xTruncateAfter_s=xTruncateAfter_s,
                                                            useFittedFunction=useFittedFunction,
                                                            numOfExponents=numOfExponents,
+                                                           fileFormat=fileFormat,
                                                            verbose=verbose)
 
 
@@ -467,7 +553,8 @@ if __name__ == '__main__':
             print '\nFinally, Step 10: Making a histogram for each set of pulses showing the shaping indicator (SI)'
         groupDict = loadSavedGroupsOfPulses(outputFolder,
                                             folderList,
-                                            ['SI'])
+                                            ['SI'],
+                                            fileFormat=fileFormat)
         histogramDict = makeSIhistograms(groupDict,
                                          plotFolder,
                                          histBins=SI_histBins,
@@ -1,23 +1,45 @@
 import getpass
 import numpy
 import os
+import time
+from multiprocessing import Pool
 from matplotlib import pyplot as plt
 
-from pulseReadIn import saveProcessedData, readInSavedRowData
+from pulseReadIn import saveProcessedData, saveProcessedBinary, loadBinaryColumns, waveformDataTypes,\
+    makeWaveformStores, spillPulseDicts, incrementalPulseWriter, getSortedFileIds, loadManifest, saveManifest,\
+    getFileStat, findFilesToProcess, removeSavedPulses
 from pulseOperations import extractPulseInfo, removeOutliers, initializeTestPlots, appendToTestPlots,\
     calcP_funcForSI
+from pulseStatistics import charPulseAccumulator, streamingOutlierFilter
+from pulseTable import makePulseTable, memoryWaveformStore, offsetWaveformStore
 from peak.gaussFitter import gaussian
 from peak.mariscotti import peakFinder
 from quickPlots import quickHistograms, ls, quickPlotter
-from dataGetter import getTableRowData
+from dataGetter import getTableRowData, parsedTableCache
 
 
 upperBoundAmp=float(1000)
 
 
-class pulseGroup():
+class pulseGroup(object):
+    """
+    The pulses of one folder are kept in self.pulseTable (see pulseTable.pulseTable). self.listOfPulseDicts is a list
+    of pulseRow views of the table that work like pulse dictionaries, setting it makes a new table.
+    """
     def __init__(self, listOfPulseDicts=[]):
         self.listOfPulseDicts = listOfPulseDicts
+        self.waveformStores = None
+
+
+    def getListOfPulseDicts(self):
+        return self.pulseTable.getRows()
+
+
+    def setListOfPulseDicts(self, listOfPulseDicts):
+        self.pulseTable = makePulseTable(listOfPulseDicts)
+
+
+    listOfPulseDicts = property(getListOfPulseDicts, setListOfPulseDicts)
 
 
     def processPulses(self,
@@ -35,8 +57,25 @@ class pulseGroup():
                       upperBoundAmp=upperBoundAmp,
                       showTestPlots_Pulses=False,
                       testModeReadIn=False,
+                      useBatchPipeline=False,
+                      useFitEngine=False,
+                      charAmpTau=None,
+                      fitMode='nonlinear',
+                      workers=1,
+                      pool=None,
+                      spillFileBase=None,
+                      tableCache=None,
+                      prefetch=2,
+                      pulseWriter=None,
+                      keepWaveforms=True,
+                      sortedIDs=None,
+                      charAccumulator=None,
+                      outlierFilter=None,
                       verbose=True):
-
+        # with spillFileBase the waveforms are kept on disk in the files spillFileBase + '_<pulseDataType>.bin'
+        if spillFileBase is not None:
+            self.closeWaveformStores()
+            self.waveformStores = makeWaveformStores(spillFileBase)
         self.listOfPulseDicts = extractPulseInfo(folderName=folderName,
                                                  fileNamePrefix=fileNamePrefix,
                                                  filenameSuffix=filenameSuffix,
@@ -50,20 +89,74 @@ class pulseGroup():
                                                  calcFitForEachPulse=calcFitForEachPulse,
                                                  upperBoundAmp=upperBoundAmp,
                                                  showTestPlots_Pulses=showTestPlots_Pulses,
-                                                 testModeReadIn=testModeReadIn)
+                                                 testModeReadIn=testModeReadIn,
+                                                 useBatchPipeline=useBatchPipeline,
+                                                 useFitEngine=useFitEngine,
+                                                 charAmpTau=charAmpTau,
+                                                 fitMode=fitMode,
+                                                 workers=workers,
+                                                 pool=pool,
+                                                 waveformStores=self.waveformStores,
+                                                 tableCache=tableCache,
+                                                 prefetch=prefetch,
+                                                 pulseWriter=pulseWriter,
+                                                 keepWaveforms=keepWaveforms,
+                                                 sortedIDs=sortedIDs,
+                                                 charAccumulator=charAccumulator,
+                                                 outlierFilter=outlierFilter,
+                                                 verbose=verbose)
+        if charAccumulator is not None:
+            self.setCharPulse(charAccumulator)
+
+
+    def spillWaveforms(self, spillFileBase, pulseDataTypes=waveformDataTypes):
+        # move the waveforms of pulses that are already in memory to disk, see lazyPulseDict
+        self.closeWaveformStores()
+        self.waveformStores = makeWaveformStores(spillFileBase, pulseDataTypes)
+        self.listOfPulseDicts = spillPulseDicts(self.listOfPulseDicts, self.waveformStores)
+
+
+    def closeWaveformStores(self):
+        # the files stay on disk and the lazy pulses can still be read
+        if self.waveformStores is not None:
+            for waveformStore in self.waveformStores.values():
+                waveformStore.close()
 
 
     def getSavedPulses(self,
                        folderName,
                        pulseDataTypes,
                        fileNamePrefix='',
-                       filenameSuffix='.csv'):
-        listOfPulseDicts = self.listOfPulseDicts[:]
+                       filenameSuffix='.csv',
+                       fileFormat='csv',
+                       mmapMode='r'):
+        # fileFormat is 'csv' or 'npy' (see saveOutputDict), filenameSuffix is only used for 'csv'
+        # each data type is joined to the pulses through the uniqueID index of the pulseTable
         for pulseDataType in pulseDataTypes:
-            fileName = os.path.join(folderName, fileNamePrefix + pulseDataType + filenameSuffix)
-
-            listOfPulseDicts = readInSavedRowData(fileName, pulseDataType, listOfPulseDicts)
-        self.listOfPulseDicts = listOfPulseDicts
+            if fileFormat == 'npy':
+                fileBase = os.path.join(folderName, fileNamePrefix + pulseDataType)
+                uniqueIDs, values, offsets = loadBinaryColumns(fileBase, mmapMode=mmapMode)
+                uniqueIDs = [str(uniqueID) for uniqueID in uniqueIDs]
+                if offsets is not None:
+                    self.pulseTable.mergeColumn(pulseDataType, uniqueIDs,
+                                                waveformStore=offsetWaveformStore(values, offsets))
+                elif values.dtype.kind in 'SU':
+                    self.pulseTable.mergeColumn(pulseDataType, uniqueIDs, [str(value) for value in values])
+                else:
+                    self.pulseTable.mergeColumn(pulseDataType, uniqueIDs, values)
+            else:
+                fileName = os.path.join(folderName, fileNamePrefix + pulseDataType + filenameSuffix)
+                tableDict = getTableRowData(fileName)
+                uniqueIDs = tableDict.keys()
+                values = [tableDict[uniqueID] for uniqueID in uniqueIDs]
+                if any([isinstance(value, list) for value in values]):
+                    waveformStore = memoryWaveformStore()
+                    waveformIndexes = [waveformStore.append(value) if isinstance(value, list) else -1
+                                       for value in values]
+                    self.pulseTable.mergeColumn(pulseDataType, uniqueIDs, waveformStore=waveformStore,
+                                                waveformIndexes=waveformIndexes)
+                else:
+                    self.pulseTable.mergeColumn(pulseDataType, uniqueIDs, values)
 
 
     def getSavedCharFunc(self,
@@ -80,100 +173,207 @@ class pulseGroup():
         self.outputDict = {}
         if 'uniqueID' not in pulseDataTypesToExtract:
             pulseDataTypesToExtract.append('uniqueID')
+        # if a data type is None for a pulse, that pulse is removed before it gets in with the rest of the data
+        keptRows = numpy.where(numpy.logical_not(self.pulseTable.getMissingMask(pulseDataTypesToExtract)))[0]
+        keptTable = self.pulseTable.takeRows(keptRows)
         for pulseDataType in pulseDataTypesToExtract:
-            self.outputDict[pulseDataType] = []
-        # do this operation for each pulse dictionary in this class
-        for pulseDict in self.listOfPulseDicts:
-            # extract the required data types for output
-            removeFlag = False
-            for pulseDataType in pulseDataTypesToExtract:
-                # if a data type is None we flag to remove this pulse before it get in with the rest of the data
-                if pulseDict[pulseDataType] is None:
-                    removeFlag = True
-            if not removeFlag:
-                for pulseDataType in pulseDataTypesToExtract:
-                    datum = pulseDict[pulseDataType]
-                    self.outputDict[pulseDataType].append(datum)
-
-        # Change the data from a lists to arrays
-        for pulseDataType in self.outputDict.keys():
-            self.outputDict[pulseDataType] = numpy.array(self.outputDict[pulseDataType])
+            if keptTable.isWaveform(pulseDataType):
+                self.outputDict[pulseDataType] = numpy.array(keptTable.getColumn(pulseDataType))
+            else:
+                self.outputDict[pulseDataType] = numpy.array(keptTable.getColumn(pulseDataType).tolist())
 
 
     def saveOutputDict(self, outPutFileBase, pulseDataTypesToSave,
                        maxDataArraysPerFile=100, delimiter=',',
-                       saveAsColumns=False, verbose=True):
+                       saveAsColumns=False, fileFormat='csv', verbose=True):
+        # fileFormat='csv' is the text format of saveProcessedData, 'npy' is the binary format of saveProcessedBinary
         if 'uniqueID' in pulseDataTypesToSave:
             pulseDataTypesToSave.remove('uniqueID')
         for saveDataType in pulseDataTypesToSave:
             listOfHeaderNames = self.outputDict['uniqueID']
             listOfDataArrays = self.outputDict[saveDataType]
             fileBaseName = outPutFileBase + '_' + saveDataType
-            saveProcessedData(listOfHeaderNames, listOfDataArrays, fileBaseName,
-                              maxDataArraysPerFile=maxDataArraysPerFile, delimiter=delimiter,
-                              saveAsColumns=saveAsColumns, verbose=verbose)
+            if fileFormat == 'npy':
+                saveProcessedBinary(listOfHeaderNames, listOfDataArrays, fileBaseName, verbose=verbose)
+            else:
+                saveProcessedData(listOfHeaderNames, listOfDataArrays, fileBaseName,
+                                  maxDataArraysPerFile=maxDataArraysPerFile, delimiter=delimiter,
+                                  saveAsColumns=saveAsColumns, verbose=verbose)
 
 
     def removeOutliers(self, parameter, multiplesOfMedianStdForRejection=5.0):
-        self.makeOutputDict([parameter])
-        oldArray, keepMask = removeOutliers(self.outputDict[parameter],
-                                            multiplesOfMedianStdForRejection=multiplesOfMedianStdForRejection)
-        newListOfPulsesDicts = []
-        for (listIndex, keepFlag) in list(enumerate(keepMask)):
-            if keepFlag:
-                newListOfPulsesDicts.append(self.listOfPulseDicts[listIndex])
-        self.listOfPulseDicts = newListOfPulsesDicts
+        # pulses without a value for the parameter are not outliers and are kept
+        hasValue = numpy.logical_not(self.pulseTable.getMissingMask([parameter]))
+        oldArray, keepMaskWithValue = removeOutliers(self.pulseTable.getFloatColumn(parameter)[hasValue],
+                                                     multiplesOfMedianStdForRejection=multiplesOfMedianStdForRejection)
+        keepMask = numpy.ones(len(self.pulseTable), dtype=bool)
+        keepMask[hasValue] = keepMaskWithValue
+        self.pulseTable = self.pulseTable.takeRows(keepMask)
+
+
+    def removeOutliersStreaming(self, outlierFilter):
+        # one pass over the pulses for all the data types of a pulseStatistics.streamingOutlierFilter
+        values = numpy.column_stack([self.pulseTable.getFloatColumn(pulseDataType)
+                                     for pulseDataType in outlierFilter.pulseDataTypes])
+        self.pulseTable = self.pulseTable.takeRows(outlierFilter.getKeepMask(values))
 
 
     def filterPulses(self, pulseDataTypesForFilter):
-        for (pulseType, minVal, maxVal) in pulseDataTypesForFilter:
-            if maxVal < minVal:
-                junk = maxVal
-                maxVal = minVal
-                minVal = junk
-            newListOfPulsesDicts = []
-            for pulseDict in self.listOfPulseDicts[:]:
-                valueToFilter = pulseDict[pulseType]
-                if ((minVal <= valueToFilter) and  (valueToFilter <= maxVal)):
-                    newListOfPulsesDicts.append(pulseDict)
-            self.listOfPulseDicts = newListOfPulsesDicts
+        # the masks of all the filters are combined before the pulses are selected
+        self.pulseTable = self.pulseTable.takeRows(self.pulseTable.getRangeMask(pulseDataTypesForFilter))
+
+
+    def getPulseLengths(self):
+        # 'deltaXIndex' for the pulses that have it, otherwise the length of 'keptData'
+        pulseLengths = self.pulseTable.getWaveformLengths('keptData')
+        deltaXIndexes = self.pulseTable.getFloatColumn('deltaXIndex')
+        hasDeltaXIndex = numpy.isfinite(deltaXIndexes)
+        pulseLengths[hasDeltaXIndex] = deltaXIndexes[hasDeltaXIndex].astype(int)
+        return pulseLengths
 
 
     def calcMinLen(self):
-        lenList = []
-        for pulseDict in self.listOfPulseDicts:
-            try:
-                lenList.append(pulseDict['deltaXIndex'])
-            except KeyError:
-                lenList.append(len(pulseDict['keptData']))
-        self.minLen = numpy.min(lenList)
+        self.minLen = numpy.min(self.getPulseLengths())
+
 
+    def calcCharPulse(self, trackMedian=False):
+        # a running mean and variance, so that only one pulse at a time needs to be in memory
+        charAccumulator = charPulseAccumulator(trackMedian=trackMedian)
+        for (keptData, pulseLen) in zip(self.pulseTable.iterWaveforms('keptData'), self.getPulseLengths()):
+            charAccumulator.add(keptData, pulseLen)
+        self.setCharPulse(charAccumulator)
 
-    def calcCharPulse(self):
-        self.calcMinLen()
-        numOfPulses = len(self.listOfPulseDicts)
-        arrayOfAllPulses = numpy.zeros((self.minLen, numOfPulses))
-        for (pulseIndex, pulseDict) in list(enumerate(self.listOfPulseDicts)):
-            arrayOfAllPulses[:, pulseIndex] = pulseDict['keptData'][:self.minLen]
 
-        self.charPulse = numpy.mean(arrayOfAllPulses, axis=1)
+    def setCharPulse(self, charAccumulator):
+        # the characteristic function from a filled pulseStatistics.charPulseAccumulator, for example the one from
+        # processPulses(charAccumulator=...) or one that was merged from the accumulators of several processes
+        self.charAccumulator = charAccumulator
+        self.minLen = charAccumulator.minLen
+        self.charPulse = charAccumulator.getCharPulse()
+        self.charPulseUncertainty = charAccumulator.getUncertainty()
+        self.charPulseMedian = charAccumulator.getMedian()
 
 
-    def calcShapeIndicator(self, Pfunc):
+    def calcShapeIndicator(self, Pfunc, useMatrix=True, maxPulsesPerBlock=1000):
+        # useMatrix=False is the original loop over the pulses, see calcShapeIndicatorMatrix for the matrix method
+        if useMatrix:
+            SIArray = self.scoreShapeIndicators([Pfunc], maxPulsesPerBlock=maxPulsesPerBlock)[:, 0]
+            self.pulseTable.setColumn('SI', SIArray)
+            return
         minCharLen = len(Pfunc)
         SIList = []
-        for pulseDict in self.listOfPulseDicts:
-            testArray = pulseDict['keptData']
+        for testArray in self.pulseTable.iterWaveforms('keptData'):
             minLen = numpy.min((minCharLen, len(testArray)))
             # trim and normalize the array so the value of the integral is unity (one)
             normArray = testArray[:minLen] / (numpy.sum(testArray[:minLen]))
             # calculate the shaping index (SI)
             numerator = numpy.sum(normArray * Pfunc[:minLen])
             denominator = numpy.sum(normArray)
-            pulseDict['SI'] = numerator / denominator
-            SIList.append(pulseDict['SI'])
-
-
+            SIList.append(numerator / denominator)
+        self.pulseTable.setColumn('SI', SIList)
+
+
+    def scoreShapeIndicators(self, listOfPfuncs, maxPulsesPerBlock=1000):
+        # the SI of every pulse for each of the candidate P functions, an array of shape (numOfPulses, numOfPfuncs),
+        # the pulse dictionaries are not changed so that different P functions can be compared
+        maxCharLen = numpy.max([len(Pfunc) for Pfunc in listOfPfuncs])
+        numOfPulses = len(self.pulseTable)
+        SIArray = numpy.zeros((numOfPulses, len(listOfPfuncs)))
+        # the pulses are packed a block at a time so that at most maxPulsesPerBlock * maxCharLen values are in memory
+        for startIndex in range(0, numOfPulses, maxPulsesPerBlock):
+            blockTable = self.pulseTable.takeRows(numpy.arange(startIndex, min(startIndex + maxPulsesPerBlock,
+                                                                               numOfPulses)))
+            listOfArrays = blockTable.getColumn('keptData')
+            pulseMatrix, lengths = makePaddedPulseMatrix(listOfArrays, maxLen=maxCharLen)
+            SIArray[startIndex:startIndex + len(listOfArrays), :] = calcShapeIndicatorMatrix(pulseMatrix, lengths,
+                                                                                             listOfPfuncs)
+        return SIArray
+
+
+def makePaddedPulseMatrix(listOfArrays, maxLen=None):
+    """
+    Packs pulses of different lengths into one array, each row is a pulse followed by zeros.
+
+    :param listOfArrays: a list of 1-D arrays, such as pulseDict['keptData'].
+    :param maxLen: pulses longer than this are trimmed, None keeps the full length of the longest pulse.
+    :return: the array of shape (numOfPulses, maxLen) and the array of the (trimmed) length of each row
+    """
+    lengths = numpy.array([len(testArray) for testArray in listOfArrays], dtype=int)
+    if maxLen is not None:
+        lengths = numpy.minimum(lengths, maxLen)
+    if len(lengths) == 0:
+        return numpy.zeros((0, 0)), lengths
+    pulseMatrix = numpy.zeros((len(lengths), numpy.max(lengths)))
+    for (rowIndex, testArray) in list(enumerate(listOfArrays)):
+        pulseMatrix[rowIndex, :lengths[rowIndex]] = testArray[:lengths[rowIndex]]
+    return pulseMatrix, lengths
+
+
+def calcShapeIndicatorMatrix(pulseMatrix, lengths, listOfPfuncs):
+    """
+    The same SI values as the loop of pulseGroup.calcShapeIndicator with masked row sums of a padded pulse matrix.
+    A pulse is only compared to the first min(len(Pfunc), length) values of each P function. The zeros of the
+    padding take care of the numerator, the integral of each row is read from the cumulative sum of the rows.
+
+    :param pulseMatrix: the padded pulses from makePaddedPulseMatrix.
+    :param lengths: the number of values in each row of pulseMatrix.
+    :param listOfPfuncs: a list of P functions (1-D arrays) that are used at the same time, they can have different
+    lengths.
+    :return: the array of SI values with shape (numOfPulses, numOfPfuncs)
+    """
+    numOfPulses, numOfColumns = numpy.shape(pulseMatrix)
+    SIArray = numpy.zeros((numOfPulses, len(listOfPfuncs)))
+    if numOfPulses == 0:
+        return SIArray
+    cumulativeSums = numpy.cumsum(pulseMatrix, axis=1)
+    rowIndexes = numpy.arange(numOfPulses)
+    # P functions of the same length share one matrix product
+    charLens = numpy.array([min(len(Pfunc), numOfColumns) for Pfunc in listOfPfuncs])
+    for charLen in numpy.unique(charLens):
+        PfuncIndexes = numpy.where(charLens == charLen)[0]
+        PfuncMatrix = numpy.zeros((charLen, len(PfuncIndexes)))
+        for (columnIndex, PfuncIndex) in list(enumerate(PfuncIndexes)):
+            PfuncMatrix[:, columnIndex] = listOfPfuncs[PfuncIndex][:charLen]
+        minLens = numpy.minimum(lengths, charLen)
+        # an empty pulse has an integral of zero and an SI of nan, as in the loop
+        integrals = numpy.where(minLens > 0, cumulativeSums[rowIndexes, numpy.maximum(minLens - 1, 0)], 0.0)
+        # the normalized rows sum to one, so the SI is the numerator divided by the integral
+        SIArray[:, PfuncIndexes] = numpy.dot(pulseMatrix[:, :charLen], PfuncMatrix) / integrals[:, numpy.newaxis]
+    return SIArray
+
+
+def benchmarkShapeIndicator(listOfPulseDicts, listOfPfuncs, verbose=True):
+    """
+    Compares the time of the loop in pulseGroup.calcShapeIndicator, run once for each P function, to
+    pulseGroup.scoreShapeIndicators that scores all of the P functions in one pass.
+
+    :param listOfPulseDicts: pulse dictionaries with 'keptData', from extractPulseInfo.
+    :param listOfPfuncs: a list of P functions, such as the Pfunc from calcP_funcForSI.
+    :return: a dictionary of the total time in seconds for each method
+    """
+    timesDict = {}
+    singleGroup = pulseGroup(listOfPulseDicts)
+
+    startTime = time.time()
+    loopSIArray = numpy.zeros((len(listOfPulseDicts), len(listOfPfuncs)))
+    for (PfuncIndex, Pfunc) in list(enumerate(listOfPfuncs)):
+        singleGroup.calcShapeIndicator(Pfunc, useMatrix=False)
+        loopSIArray[:, PfuncIndex] = singleGroup.pulseTable.getColumn('SI')
+    timesDict['calcShapeIndicator loop'] = time.time() - startTime
+
+    startTime = time.time()
+    matrixSIArray = singleGroup.scoreShapeIndicators(listOfPfuncs)
+    timesDict['scoreShapeIndicators'] = time.time() - startTime
+
+    if not numpy.allclose(loopSIArray, matrixSIArray, rtol=1.0e-9, atol=1.0e-12):
+        raise ValueError("The SI values of scoreShapeIndicators are not the same as the loop in calcShapeIndicator.")
+    if verbose:
+        print "SI values of", len(listOfPulseDicts), "pulses for", len(listOfPfuncs), "P functions."
+        for methodName in sorted(timesDict.keys()):
+            print methodName + ":", str('%.3f' % timesDict[methodName]), "s total"
+        print "scoreShapeIndicators is", \
+            str('%.2f' % (timesDict['calcShapeIndicator loop'] / timesDict['scoreShapeIndicators'])), "times faster"
+    return timesDict
 
 
 def doExtractAndSavePulseInfo(parentFolder, folderList, outputFolder, pulseDataTypesToSave,
@@ -182,53 +382,185 @@ def doExtractAndSavePulseInfo(parentFolder, folderList, outputFolder, pulseDataT
                               calcFitForEachPulse=False,
                               showTestPlots_Pulses=False,
                               testModeReadIn=False,
+                              useBatchPipeline=False,
+                              useFitEngine=False,
+                              fitMode='nonlinear',
+                              workers=1,
+                              fileFormat='csv',
+                              spillWaveforms=False,
+                              cacheFolder=None,
+                              maxCacheBytes=int(2 * 1024**3),
+                              streaming=False,
+                              incremental=False,
+                              pulseDataTypesToRemoveOutliers=None,
                               verbose=True):
+    """
+    Step 1, read in, process and save the pulses of each folder in folderList.
+
+    With incremental=True a manifest of the processed files (outputFolder/<folder>_manifest.json) is kept for each
+    folder. Only the files that are new or changed since the last run are processed and their pulses are appended
+    to the saved files, the saved pulses of changed or deleted files are removed. If the processing options are
+    different from the last run, everything in the folder is processed again. The returned groupDict has only the
+    pulses that were processed in this run, load the saved data (step 2) for all the pulses.
+
+    With pulseDataTypesToRemoveOutliers, a list of (pulseDataType, multiplesOfMedianStdForRejection) as for
+    removeOutlierPulses, the outliers are removed with a streamingOutlierFilter as the pulses are processed, so they
+    are never saved. With incremental=True only the pulses of this run are used for the median estimates.
+    """
     groupDict = {}
-    for singleFolder in folderList:
-        folderName = os.path.join(parentFolder, singleFolder)
-        groupDict[singleFolder] = pulseGroup()
-        groupDict[singleFolder].processPulses(folderName=folderName,
-                                              fileNamePrefix=singleFolder + '_',
-                                              filenameSuffix='.txt',
-                                              columnNamesToIgnore=['time'],
-                                              skipRows=3,
-                                              delimiter='\t',
-                                              trimBeforeMin=True,
-                                              multiplesOfMedianStdForRejection=1000.0, # None or float, None means no rejection
-                                              conv_channels=smoothChannels,
-                                              numOfExponents=numOfExponents,
-                                              calcFitForEachPulse=calcFitForEachPulse,
-                                              upperBoundAmp=upperBoundAmp,
-                                              showTestPlots_Pulses=showTestPlots_Pulses,
-                                              testModeReadIn=testModeReadIn,
-                                              verbose=verbose)
-
-        outPutFileBase = os.path.join(outputFolder, singleFolder)
-        if pulseDataTypesToSave != []:
-            groupDict[singleFolder].makeOutputDict(pulseDataTypesToSave)
-
-            groupDict[singleFolder].saveOutputDict(outPutFileBase=outPutFileBase,
-                                                   pulseDataTypesToSave=pulseDataTypesToSave,
-                                                   maxDataArraysPerFile=100,
-                                                   delimiter=',',
-                                                   saveAsColumns=False,
-                                                   verbose=verbose)
+    # the options that change the saved data, a change in any of them means the folder is processed again
+    pipelineParameters = {'smoothChannels': smoothChannels,
+                          'numOfExponents': numOfExponents,
+                          'calcFitForEachPulse': calcFitForEachPulse,
+                          'upperBoundAmp': upperBoundAmp,
+                          'useBatchPipeline': useBatchPipeline,
+                          'useFitEngine': useFitEngine,
+                          'fitMode': fitMode,
+                          'fileFormat': fileFormat,
+                          'pulseDataTypesToSave': sorted([pulseDataType for pulseDataType in pulseDataTypesToSave
+                                                          if pulseDataType != 'uniqueID'])}
+    # the outlier cuts of step 1 change which pulses are saved, as lists so they compare equal after the json round trip
+    if pulseDataTypesToRemoveOutliers is None:
+        pipelineParameters['pulseDataTypesToRemoveOutliers'] = None
+    else:
+        pipelineParameters['pulseDataTypesToRemoveOutliers'] = [list(removeOutlierInfo) for removeOutlierInfo
+                                                                in pulseDataTypesToRemoveOutliers]
+    # with a cacheFolder, the parsed raw data files are saved in a binary form and reused the next time
+    if cacheFolder is None:
+        tableCache = None
+    else:
+        tableCache = parsedTableCache(cacheFolder, maxCacheBytes=maxCacheBytes)
+    # a single pool of processes is shared by all the folders, the files of each folder are split between them
+    if 1 < workers:
+        pool = Pool(processes=workers)
+    else:
+        pool = None
+    try:
+        for singleFolder in folderList:
+            folderName = os.path.join(parentFolder, singleFolder)
+            groupDict[singleFolder] = pulseGroup()
+            if spillWaveforms:
+                spillFileBase = os.path.join(outputFolder, singleFolder + '_waveforms')
+            else:
+                spillFileBase = None
+            outPutFileBase = os.path.join(outputFolder, singleFolder)
+            sortedIDs = None
+            appendMode = False
+            if incremental and pulseDataTypesToSave != []:
+                sortedIDs = getSortedFileIds(folderName, singleFolder + '_', '.txt', verbose)
+                if testModeReadIn:
+                    sortedIDs = sortedIDs[:13]
+                manifest = loadManifest(outPutFileBase)
+                if manifest is not None and manifest['parameters'] == pipelineParameters:
+                    sortedIDs, fileNamesToRemove = findFilesToProcess(sortedIDs, manifest)
+                    uniqueIDsToRemove = []
+                    for fileName in fileNamesToRemove:
+                        uniqueIDsToRemove.extend(manifest['files'][fileName]['uniqueIDs'])
+                        del manifest['files'][fileName]
+                    removeSavedPulses(outPutFileBase, pulseDataTypesToSave, uniqueIDsToRemove, fileFormat=fileFormat,
+                                      delimiter=',')
+                    appendMode = True
+                    if verbose:
+                        print len(sortedIDs), "new or changed files to process in " + folderName + ",", \
+                            len(fileNamesToRemove), "changed or deleted files to remove from the saved data."
+                else:
+                    if verbose and manifest is not None:
+                        print "The processing options have changed, all the files in " + folderName + \
+                              " will be processed again."
+                    manifest = {'parameters': pipelineParameters, 'files': {}}
+            # streaming saves the pulses of each file as it is processed, only the scalars (or lazy pulses) are kept
+            if (streaming or incremental) and pulseDataTypesToSave != []:
+                pulseWriter = incrementalPulseWriter(outPutFileBase, pulseDataTypesToSave, fileFormat=fileFormat,
+                                                     delimiter=',', appendMode=appendMode, verbose=verbose)
+            else:
+                pulseWriter = None
+            if pulseDataTypesToRemoveOutliers is None:
+                outlierFilter = None
+            else:
+                outlierFilter = streamingOutlierFilter(pulseDataTypesToRemoveOutliers)
+            groupDict[singleFolder].processPulses(folderName=folderName,
+                                                  fileNamePrefix=singleFolder + '_',
+                                                  filenameSuffix='.txt',
+                                                  columnNamesToIgnore=['time'],
+                                                  skipRows=3,
+                                                  delimiter='\t',
+                                                  trimBeforeMin=True,
+                                                  multiplesOfMedianStdForRejection=1000.0, # None or float, None means no rejection
+                                                  conv_channels=smoothChannels,
+                                                  numOfExponents=numOfExponents,
+                                                  calcFitForEachPulse=calcFitForEachPulse,
+                                                  upperBoundAmp=upperBoundAmp,
+                                                  showTestPlots_Pulses=showTestPlots_Pulses,
+                                                  testModeReadIn=testModeReadIn,
+                                                  useBatchPipeline=useBatchPipeline,
+                                                  useFitEngine=useFitEngine,
+                                                  fitMode=fitMode,
+                                                  workers=workers,
+                                                  pool=pool,
+                                                  spillFileBase=spillFileBase,
+                                                  tableCache=tableCache,
+                                                  pulseWriter=pulseWriter,
+                                                  keepWaveforms=not streaming,
+                                                  sortedIDs=sortedIDs,
+                                                  outlierFilter=outlierFilter,
+                                                  verbose=verbose)
+            if verbose and outlierFilter is not None:
+                outlierFilter.printSummary()
+
+            if pulseWriter is not None:
+                pulseWriter.close()
+                if incremental:
+                    # record the files of this run, the manifest is only saved after the pulses are saved
+                    for (uniqueID, fileName) in sortedIDs:
+                        fileRecord = getFileStat(fileName)
+                        fileRecord['uniqueIDs'] = []
+                        manifest['files'][fileName] = fileRecord
+                    singleTable = groupDict[singleFolder].pulseTable
+                    for (rawDataFileName, uniqueID) in zip(singleTable.getColumn('rawDataFileName'),
+                                                           singleTable.getColumn('uniqueID')):
+                        manifest['files'][rawDataFileName]['uniqueIDs'].append(uniqueID)
+                    saveManifest(outPutFileBase, manifest)
+            elif pulseDataTypesToSave != []:
+                groupDict[singleFolder].makeOutputDict(pulseDataTypesToSave)
+
+                groupDict[singleFolder].saveOutputDict(outPutFileBase=outPutFileBase,
+                                                       pulseDataTypesToSave=pulseDataTypesToSave,
+                                                       maxDataArraysPerFile=100,
+                                                       delimiter=',',
+                                                       saveAsColumns=False,
+                                                       fileFormat=fileFormat,
+                                                       verbose=verbose)
+            # all the waveforms of the folder are spilled, the files are closed and the lazy pulses are still read
+            groupDict[singleFolder].closeWaveformStores()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     return groupDict
 
 
-def loadSavedGroupsOfPulses(outputFolder, folderList, pulseDataTypesToLoad):
+def loadSavedGroupsOfPulses(outputFolder, folderList, pulseDataTypesToLoad, fileFormat='csv'):
     groupDict = {}
     for singleFolder in folderList:
         groupDict[singleFolder] = pulseGroup()
         groupDict[singleFolder].getSavedPulses(outputFolder,
                                                pulseDataTypes=pulseDataTypesToLoad,
-                                               fileNamePrefix=singleFolder + '_')
+                                               fileNamePrefix=singleFolder + '_',
+                                               fileFormat=fileFormat)
     return groupDict
 
 
-def removeOutlierPulses(groupDict, pulseDataTypesToRemoveOutliers):
+def removeOutlierPulses(groupDict, pulseDataTypesToRemoveOutliers, streaming=False, verbose=False):
+    # streaming=True uses a pulseStatistics.streamingOutlierFilter, a single pass for all of the data types
     folderList = groupDict.keys()
     for singleFolder in folderList:
+        if streaming:
+            outlierFilter = streamingOutlierFilter(pulseDataTypesToRemoveOutliers)
+            groupDict[singleFolder].removeOutliersStreaming(outlierFilter)
+            if verbose:
+                print singleFolder + ":",
+                outlierFilter.printSummary()
+            continue
         for (pulseDataType, multiplesOfMedianStdForRejection) in pulseDataTypesToRemoveOutliers:
             groupDict[singleFolder].removeOutliers(pulseDataType, multiplesOfMedianStdForRejection)
     return groupDict
@@ -309,6 +641,42 @@ def doFindHistPeaks(outHistDict, errFactor, smoothIndexesForPeakFinder,  verbose
     return
 
 
+def benchmarkFilterPulses(listOfPulseDicts, pulseDataTypesForFilter, verbose=True):
+    """
+    Compares the time of the original pulseGroup.filterPulses, a new list of pulse dictionaries for each filter, to
+    the combined masks of the pulseTable.
+
+    :param listOfPulseDicts: pulse dictionaries with the data types of pulseDataTypesForFilter.
+    :param pulseDataTypesForFilter: a list of (pulseDataType, minVal, maxVal), see pulseGroup.filterPulses.
+    :return: a dictionary of the total time in seconds for each method
+    """
+    timesDict = {}
+    startTime = time.time()
+    keptPulseDicts = listOfPulseDicts
+    for (pulseType, minVal, maxVal) in pulseDataTypesForFilter:
+        if maxVal < minVal:
+            minVal, maxVal = maxVal, minVal
+        keptPulseDicts = [pulseDict for pulseDict in keptPulseDicts
+                          if (minVal <= pulseDict[pulseType]) and (pulseDict[pulseType] <= maxVal)]
+    timesDict['list of pulse dictionaries'] = time.time() - startTime
+
+    singleGroup = pulseGroup(listOfPulseDicts)
+    startTime = time.time()
+    singleGroup.filterPulses(pulseDataTypesForFilter)
+    timesDict['pulseTable masks'] = time.time() - startTime
+
+    if [pulseDict['uniqueID'] for pulseDict in keptPulseDicts] != list(singleGroup.pulseTable.getColumn('uniqueID')):
+        raise ValueError("The pulses kept by the pulseTable masks are not the same as for the list of pulses.")
+    if verbose:
+        print "Filtering", len(listOfPulseDicts), "pulses with", len(pulseDataTypesForFilter), "filters,", \
+            len(keptPulseDicts), "pulses are kept."
+        for methodName in sorted(timesDict.keys()):
+            print methodName + ":", str('%.4f' % timesDict[methodName]), "s total"
+        print "The pulseTable masks are", \
+            str('%.2f' % (timesDict['list of pulse dictionaries'] / timesDict['pulseTable masks'])), "times faster"
+    return timesDict
+
+
 def filterPulsesForGroups(groupDict, pulseFilterDict):
     dictKeys = pulseFilterDict.keys()
     for key in dictKeys:
@@ -330,11 +698,13 @@ def makeCharacteristicFunction(groupDict, characteristicFunctionFolders, outputF
 def loadSavedPulseWithCharPulseData(outputFolder,
                                     folderList,
                                     pulseDataTypesToLoad,
-                                    characteristicFunctionFolders):
+                                    characteristicFunctionFolders,
+                                    fileFormat='csv'):
 
     groupDict = loadSavedGroupsOfPulses(outputFolder,
                                         folderList,
-                                        pulseDataTypesToLoad)
+                                        pulseDataTypesToLoad,
+                                        fileFormat=fileFormat)
     for characteristicFunctionFolder in characteristicFunctionFolders:
         groupDict[characteristicFunctionFolder].getSavedCharFunc(outputFolder,
                                                                  fileNamePrefix=characteristicFunctionFolder + '_',
@@ -352,6 +722,7 @@ def calcSI(groupDict,
            useFittedFunction=True,
            numOfExponents=2,
            upperBoundAmp=upperBoundAmp,
+           fileFormat='csv',
            verbose=True):
     charArrays = []
     for characteristicFunctionFolder in characteristicFunctionFolders:
@@ -371,7 +742,7 @@ def calcSI(groupDict,
         outPutFileBase = os.path.join(outputFolder, singleFolder)
         groupDict[singleFolder].saveOutputDict(outPutFileBase, ["SI"],
                        maxDataArraysPerFile=int(9223372036854775807), delimiter=',',
-                       saveAsColumns=False, verbose=verbose)
+                       saveAsColumns=False, fileFormat=fileFormat, verbose=verbose)
     return groupDict, charPulseDict1, charPulseDict2
 
 
@@ -403,3 +774,38 @@ def makeSIhistograms(groupDict,
 
     return histogramDict
 
+
+
+if __name__ == '__main__':
+    numOfPulses = 2000
+    numOfPfuncs = 4
+    # simulated pulses of different lengths and P functions of the form of calcP_funcForSI
+    numpy.random.seed(0)
+    xStep = 1.0e-8
+    listOfPulseDicts = []
+    for pulseIndex in range(numOfPulses):
+        xData = numpy.arange(numpy.random.randint(800, 1200)) * xStep
+        height = numpy.random.uniform(50.0, 250.0)
+        fastFraction = numpy.random.uniform(0.6, 0.9)
+        keptData = height * fastFraction * numpy.exp(-xData / 3.0e-7) + \
+                   height * (1.0 - fastFraction) * numpy.exp(-xData / 2.0e-6) + \
+                   numpy.random.normal(0.0, 2.0, len(xData))
+        listOfPulseDicts.append({'keptData':keptData, 'uniqueID':str(pulseIndex)})
+    listOfPfuncs = []
+    for PfuncIndex in range(numOfPfuncs):
+        xData = numpy.arange(1000 + 50 * PfuncIndex) * xStep
+        charPulse1 = numpy.exp(-xData / (2.5e-7 + 2.0e-8 * PfuncIndex))
+        charPulse2 = 0.7 * numpy.exp(-xData / 3.0e-7) + 0.3 * numpy.exp(-xData / 2.0e-6)
+        listOfPfuncs.append((charPulse1 - charPulse2) / (charPulse1 + charPulse2))
+
+    benchmarkShapeIndicator(listOfPulseDicts, listOfPfuncs, verbose=True)
+
+    numOfFilterPulses = 1000000
+    listOfPulseDicts = [{'uniqueID':str(pulseIndex), 'integral':integral, 'deltaX':deltaX, 'fittedCost':fittedCost}
+                        for (pulseIndex, integral, deltaX, fittedCost)
+                        in zip(range(numOfFilterPulses),
+                               numpy.random.normal(1.0e-6, 1.0e-7, numOfFilterPulses),
+                               numpy.random.normal(5.0e-6, 1.0e-6, numOfFilterPulses),
+                               numpy.random.uniform(0.0, 1.0, numOfFilterPulses))]
+    pulseDataTypesForFilter = [('integral', 8.0e-7, 1.2e-6), ('deltaX', 3.0e-6, 7.0e-6), ('fittedCost', 0.0, 0.9)]
+    benchmarkFilterPulses(listOfPulseDicts, pulseDataTypesForFilter, verbose=True)
@@ -0,0 +1,394 @@
+import copy
+import numpy
+
+
+class p2QuantileSketch():
+    """
+    The P-squared estimate of a quantile (Jain and Chlamtac 1985) for many streams of values at the same time, such as
+    one stream for each sample index of the pulses. Only 5 markers per stream are kept, no matter how many values are
+    added. Each call to add takes one new value for every stream, or for the streams in a mask.
+    """
+    def __init__(self, numOfStreams, quantile=0.5):
+        self.numOfStreams = numOfStreams
+        self.quantile = float(quantile)
+        self.counts = numpy.zeros(numOfStreams, dtype=numpy.int64)
+        # the first 5 values of each stream, then the heights and (0 based) positions of the 5 markers
+        self.heights = numpy.zeros((5, numOfStreams))
+        self.positions = numpy.tile(numpy.arange(5.0)[:, numpy.newaxis], (1, numOfStreams))
+        # the desired positions of the markers are (count - 1) * desiredIncrements
+        self.desiredIncrements = numpy.array([0.0, self.quantile / 2.0, self.quantile,
+                                              (1.0 + self.quantile) / 2.0, 1.0])
+
+    def add(self, values, mask=None):
+        values = numpy.asarray(values, dtype=float)[:self.numOfStreams]
+        if mask is None:
+            streamIndexes = numpy.arange(self.numOfStreams)
+        else:
+            streamIndexes = numpy.where(numpy.asarray(mask)[:self.numOfStreams])[0]
+        # streams with fewer than 5 values only store the value, they are sorted into markers at the 5th value
+        isStarting = self.counts[streamIndexes] < 5
+        if numpy.any(isStarting):
+            startIndexes = streamIndexes[isStarting]
+            self.heights[self.counts[startIndexes], startIndexes] = values[startIndexes]
+            self.counts[startIndexes] += 1
+            fullIndexes = startIndexes[self.counts[startIndexes] == 5]
+            self.heights[:, fullIndexes] = numpy.sort(self.heights[:, fullIndexes], axis=0)
+            streamIndexes = streamIndexes[numpy.logical_not(isStarting)]
+            if len(streamIndexes) == 0:
+                return
+        values = values[streamIndexes]
+        heights = self.heights[:, streamIndexes]
+        positions = self.positions[:, streamIndexes]
+        self.counts[streamIndexes] += 1
+        # the cell k of each new value, the extreme markers move out to any new minimum or maximum
+        heights[0] = numpy.minimum(heights[0], values)
+        heights[4] = numpy.maximum(heights[4], values)
+        cellIndexes = numpy.clip(numpy.sum(values[numpy.newaxis, :] >= heights[1:], axis=0), 0, 3)
+        positions += numpy.arange(5)[:, numpy.newaxis] > cellIndexes[numpy.newaxis, :]
+        desiredPositions = self.desiredIncrements[:, numpy.newaxis] * (self.counts[streamIndexes] - 1)
+        # adjust the 3 middle markers with the parabolic formula, or the linear one if the parabola is not monotonic
+        for markerIndex in range(1, 4):
+            offsets = desiredPositions[markerIndex] - positions[markerIndex]
+            toRight = positions[markerIndex + 1] - positions[markerIndex]
+            toLeft = positions[markerIndex - 1] - positions[markerIndex]
+            steps = numpy.where((1.0 <= offsets) & (1.0 < toRight), 1.0, 0.0) + \
+                    numpy.where((offsets <= -1.0) & (toLeft < -1.0), -1.0, 0.0)
+            if not numpy.any(steps):
+                continue
+            heightRight = heights[markerIndex + 1] - heights[markerIndex]
+            heightLeft = heights[markerIndex] - heights[markerIndex - 1]
+            parabolic = heights[markerIndex] + steps / (toRight - toLeft) * \
+                        ((-toLeft + steps) * heightRight / toRight + (toRight - steps) * heightLeft / -toLeft)
+            linear = heights[markerIndex] + steps * numpy.where(0.0 < steps, heightRight / toRight,
+                                                                heightLeft / -toLeft)
+            isParabolic = (heights[markerIndex - 1] < parabolic) & (parabolic < heights[markerIndex + 1])
+            newHeights = numpy.where(isParabolic, parabolic, linear)
+            heights[markerIndex] = numpy.where(steps != 0.0, newHeights, heights[markerIndex])
+            positions[markerIndex] += steps
+        self.heights[:, streamIndexes] = heights
+        self.positions[:, streamIndexes] = positions
+
+    def merge(self, otherSketch):
+        # the values of a stream with fewer than 5 values are added exactly, otherwise the markers are combined:
+        # the extremes are the overall extremes and the middle heights are weighted by the number of values
+        numOfStreams = min(self.numOfStreams, otherSketch.numOfStreams)
+        self.truncate(numOfStreams)
+        otherCounts = otherSketch.counts[:numOfStreams]
+        otherHeights = otherSketch.heights[:, :numOfStreams]
+        isFull = 5 <= self.counts
+        isOtherFull = 5 <= otherCounts
+        isBoth = isFull & isOtherFull
+        if numpy.any(isBoth):
+            weights = otherCounts[isBoth] / (self.counts[isBoth] + otherCounts[isBoth]).astype(float)
+            self.heights[1:4, isBoth] = (1.0 - weights) * self.heights[1:4, isBoth] + \
+                                        weights * otherHeights[1:4, isBoth]
+            self.heights[0, isBoth] = numpy.minimum(self.heights[0, isBoth], otherHeights[0, isBoth])
+            self.heights[4, isBoth] = numpy.maximum(self.heights[4, isBoth], otherHeights[4, isBoth])
+            self.counts[isBoth] += otherCounts[isBoth]
+            self.positions[:, isBoth] = numpy.round(self.desiredIncrements[:, numpy.newaxis] *
+                                                    (self.counts[isBoth] - 1))
+        # streams that only have 5 or more values in the other sketch start from its markers
+        isOnlyOther = numpy.logical_not(isFull) & isOtherFull
+        firstValues = self.heights[:, isOnlyOther].copy()
+        firstCounts = self.counts[isOnlyOther].copy()
+        self.heights[:, isOnlyOther] = otherHeights[:, isOnlyOther]
+        self.positions[:, isOnlyOther] = otherSketch.positions[:, :numOfStreams][:, isOnlyOther]
+        self.counts[isOnlyOther] = otherCounts[isOnlyOther]
+        for valueIndex in range(4):
+            mask = numpy.zeros(numOfStreams, dtype=bool)
+            mask[isOnlyOther] = valueIndex < firstCounts
+            values = numpy.zeros(numOfStreams)
+            values[isOnlyOther] = firstValues[valueIndex]
+            self.add(values, mask)
+            # the first values of the other sketch
+            self.add(otherHeights[valueIndex], numpy.logical_not(isOtherFull) & (valueIndex < otherCounts))
+
+    def truncate(self, numOfStreams):
+        # keep only the first numOfStreams streams
+        self.numOfStreams = min(self.numOfStreams, numOfStreams)
+        self.counts = self.counts[:self.numOfStreams]
+        self.heights = self.heights[:, :self.numOfStreams]
+        self.positions = self.positions[:, :self.numOfStreams]
+
+    def getQuantile(self):
+        quantiles = self.heights[2].copy()
+        # the streams with fewer than 5 values use the values themselves, nan for streams without values
+        for streamIndex in numpy.where(self.counts < 5)[0]:
+            if self.counts[streamIndex] == 0:
+                quantiles[streamIndex] = float('nan')
+            else:
+                quantiles[streamIndex] = numpy.percentile(self.heights[:self.counts[streamIndex], streamIndex],
+                                                          100.0 * self.quantile)
+        return quantiles
+
+
+class charPulseAccumulator():
+    """
+    The characteristic function of a group of pulses from a running mean and variance at each sample index
+    (Welford's algorithm), the pulses are added one at a time so the memory use only depends on the pulse length.
+    Accumulators that were filled in different processes (or from different folders) are combined with merge.
+
+    :param trackMedian: also keep a p2QuantileSketch of the median at each sample index.
+    """
+    def __init__(self, trackMedian=False):
+        self.trackMedian = trackMedian
+        self.numOfPulses = 0
+        self.minLen = None
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.means = numpy.zeros(0)
+        self.sumOfSquaredDiffs = numpy.zeros(0)
+        self.medianSketch = None
+
+    def growTo(self, newLen):
+        oldLen = len(self.means)
+        if oldLen < newLen:
+            self.counts = numpy.concatenate((self.counts, numpy.zeros(newLen - oldLen, dtype=numpy.int64)))
+            self.means = numpy.concatenate((self.means, numpy.zeros(newLen - oldLen)))
+            self.sumOfSquaredDiffs = numpy.concatenate((self.sumOfSquaredDiffs, numpy.zeros(newLen - oldLen)))
+
+    def add(self, keptData, pulseLen=None):
+        # pulseLen is the number of samples to use, len(keptData) by default
+        if pulseLen is None:
+            pulseLen = len(keptData)
+        keptData = numpy.asarray(keptData[:pulseLen], dtype=float)
+        pulseLen = len(keptData)
+        self.growTo(pulseLen)
+        self.counts[:pulseLen] += 1
+        deltas = keptData - self.means[:pulseLen]
+        self.means[:pulseLen] += deltas / self.counts[:pulseLen]
+        self.sumOfSquaredDiffs[:pulseLen] += deltas * (keptData - self.means[:pulseLen])
+        self.numOfPulses += 1
+        if self.minLen is None or pulseLen < self.minLen:
+            self.minLen = pulseLen
+        if self.trackMedian:
+            if self.medianSketch is None:
+                self.medianSketch = p2QuantileSketch(pulseLen)
+            # the median is only needed for the samples that every pulse has
+            self.medianSketch.truncate(self.minLen)
+            self.medianSketch.add(keptData)
+
+    def addPulses(self, listOfPulseDicts):
+        # the same pulse length as pulseGroup.calcMinLen, 'deltaXIndex' if the pulse has one
+        for pulseDict in listOfPulseDicts:
+            try:
+                pulseLen = pulseDict['deltaXIndex']
+            except KeyError:
+                pulseLen = None
+            self.add(pulseDict['keptData'], pulseLen)
+
+    def merge(self, otherAccumulator):
+        # Chan et al. pairwise combination of the means and variances
+        self.growTo(len(otherAccumulator.means))
+        otherLen = len(otherAccumulator.means)
+        counts = self.counts[:otherLen]
+        otherCounts = otherAccumulator.counts
+        totalCounts = counts + otherCounts
+        safeCounts = numpy.maximum(totalCounts, 1).astype(float)
+        deltas = otherAccumulator.means - self.means[:otherLen]
+        self.means[:otherLen] += deltas * otherCounts / safeCounts
+        self.sumOfSquaredDiffs[:otherLen] += otherAccumulator.sumOfSquaredDiffs + \
+                                             deltas ** 2 * counts * otherCounts / safeCounts
+        self.counts[:otherLen] = totalCounts
+        if self.medianSketch is not None and otherAccumulator.medianSketch is not None:
+            # P-squared sketches can not be combined exactly, see p2QuantileSketch.merge
+            self.medianSketch.merge(otherAccumulator.medianSketch)
+        elif otherAccumulator.medianSketch is not None:
+            self.medianSketch = copy.deepcopy(otherAccumulator.medianSketch)
+        if otherAccumulator.minLen is not None:
+            if self.minLen is None or otherAccumulator.minLen < self.minLen:
+                self.minLen = otherAccumulator.minLen
+        self.numOfPulses += otherAccumulator.numOfPulses
+
+    def getCharPulse(self):
+        # the mean over the samples that every pulse has, the same as the original pulseGroup.calcCharPulse
+        return self.means[:self.minLen].copy()
+
+    def getVariance(self):
+        counts = self.counts[:self.minLen]
+        return self.sumOfSquaredDiffs[:self.minLen] / numpy.maximum(counts - 1, 1)
+
+    def getUncertainty(self):
+        # the standard error of the mean at each sample index
+        return numpy.sqrt(self.getVariance() / numpy.maximum(self.counts[:self.minLen], 1))
+
+    def getMedian(self):
+        if self.medianSketch is None:
+            return None
+        return self.medianSketch.getQuantile()[:self.minLen]
+
+
+class centroidQuantileSketch():
+    """
+    Quantiles of a single stream of values that arrive in batches, such as the values of one pulse data type for
+    each processed file. The values are kept as weighted centroids (a simple form of the t-digest), when there are
+    more than 2 * maxNumOfCentroids of them they are combined into maxNumOfCentroids centroids of equal weight. The
+    memory does not grow with the number of values and sketches from different processes are combined with merge.
+    """
+    def __init__(self, maxNumOfCentroids=1000):
+        self.maxNumOfCentroids = maxNumOfCentroids
+        self.means = numpy.zeros(0)
+        self.weights = numpy.zeros(0)
+        self.isSorted = True
+
+    def __len__(self):
+        return int(numpy.sum(self.weights))
+
+    def add(self, values, weights=None):
+        # values that are not finite are ignored
+        values = numpy.asarray(values, dtype=float).ravel()
+        if weights is None:
+            weights = numpy.ones(len(values))
+        isFinite = numpy.isfinite(values)
+        self.means = numpy.concatenate((self.means, values[isFinite]))
+        self.weights = numpy.concatenate((self.weights, numpy.asarray(weights, dtype=float)[isFinite]))
+        self.isSorted = False
+        if 2 * self.maxNumOfCentroids < len(self.means):
+            self.compress()
+
+    def merge(self, otherSketch):
+        self.add(otherSketch.means, otherSketch.weights)
+
+    def sort(self):
+        if not self.isSorted:
+            sortIndexes = numpy.argsort(self.means, kind='mergesort')
+            self.means = self.means[sortIndexes]
+            self.weights = self.weights[sortIndexes]
+            self.isSorted = True
+
+    def compress(self):
+        self.sort()
+        cumulativeWeights = numpy.cumsum(self.weights)
+        totalWeight = cumulativeWeights[-1]
+        centerWeights = cumulativeWeights - self.weights / 2.0
+        groupIndexes = numpy.minimum((centerWeights * self.maxNumOfCentroids / totalWeight).astype(int),
+                                     self.maxNumOfCentroids - 1)
+        weights = numpy.bincount(groupIndexes, weights=self.weights)
+        weightedSums = numpy.bincount(groupIndexes, weights=self.weights * self.means)
+        isUsed = 0.0 < weights
+        self.means = weightedSums[isUsed] / weights[isUsed]
+        self.weights = weights[isUsed]
+
+    def getQuantile(self, quantile=0.5):
+        # the same as numpy.percentile while the values are not yet combined into centroids
+        if len(self.means) == 0:
+            return float('nan')
+        self.sort()
+        return weightedQuantile(self.means, self.weights, quantile)
+
+    def getMAD(self):
+        # the median of the absolute deviations from the median
+        if len(self.means) == 0:
+            return float('nan')
+        deviations = numpy.abs(self.means - self.getQuantile(0.5))
+        sortIndexes = numpy.argsort(deviations, kind='mergesort')
+        return weightedQuantile(deviations[sortIndexes], self.weights[sortIndexes], 0.5)
+
+
+def weightedQuantile(sortedValues, weights, quantile):
+    # linear interpolation between the centers of the weights of sorted values
+    cumulativeWeights = numpy.cumsum(weights)
+    centerWeights = cumulativeWeights - weights / 2.0
+    return numpy.interp(quantile * cumulativeWeights[-1], centerWeights, sortedValues)
+
+
+class streamingOutlierFilter():
+    """
+    The outlier cut of pulseOperations.removeOutliers for per-pulse values ('integral', 'fittedCost', ...), done
+    while the pulses are processed instead of as a separate pass over the saved data. The median and the median of
+    the absolute deviations (MAD) of each data type come from a centroidQuantileSketch that is updated with each
+    batch of pulses. A pulse is an outlier when multiplesOfMedianStdForRejection < abs(value - median) / MAD for any
+    of the data types. Unlike removeOutlierPulses, all the data types are judged with the estimates of all the pulses
+    at the same time, not one data type after another.
+
+    :param pulseDataTypesToRemoveOutliers: a list of (pulseDataType, multiplesOfMedianStdForRejection) tuples, the
+        same as for removeOutlierPulses.
+    :param minNumOfPulses: the pulses are held back until this many pulses have been seen, so that the first pulses
+        are not judged with the estimates of only a few pulses.
+    """
+    def __init__(self, pulseDataTypesToRemoveOutliers, minNumOfPulses=100, maxNumOfCentroids=1000):
+        self.pulseDataTypes = [pulseDataType for (pulseDataType, multiples) in pulseDataTypesToRemoveOutliers]
+        self.multiples = numpy.array([float(multiples) for (pulseDataType, multiples)
+                                      in pulseDataTypesToRemoveOutliers])
+        self.minNumOfPulses = minNumOfPulses
+        self.sketches = [centroidQuantileSketch(maxNumOfCentroids) for pulseDataType in self.pulseDataTypes]
+        self.heldPulseDicts = []
+        self.heldValues = []
+        self.numOfPulses = 0
+        self.rejectedCounts = numpy.zeros(len(self.pulseDataTypes), dtype=int)
+        self.numOfRejectedPulses = 0
+
+    def getValues(self, listOfPulseDicts):
+        # an array with a row for each pulse, missing and None values are nan, they are not used for the estimates
+        # and never make a pulse an outlier
+        values = numpy.zeros((len(listOfPulseDicts), len(self.pulseDataTypes))) * float('nan')
+        for (pulseIndex, pulseDict) in list(enumerate(listOfPulseDicts)):
+            for (typeIndex, pulseDataType) in list(enumerate(self.pulseDataTypes)):
+                value = pulseDict.get(pulseDataType, None)
+                if value is not None:
+                    values[pulseIndex, typeIndex] = value
+        return values
+
+    def update(self, values):
+        for (typeIndex, sketch) in list(enumerate(self.sketches)):
+            sketch.add(values[:, typeIndex])
+        self.numOfPulses += len(values)
+
+    def merge(self, otherFilter):
+        # combine the estimates of a filter with the same data types, for example from another process
+        for (sketch, otherSketch) in zip(self.sketches, otherFilter.sketches):
+            sketch.merge(otherSketch)
+        self.numOfPulses += otherFilter.numOfPulses
+
+    def getMedians(self):
+        return numpy.array([sketch.getQuantile(0.5) for sketch in self.sketches])
+
+    def getMADs(self):
+        return numpy.array([sketch.getMAD() for sketch in self.sketches])
+
+    def getOutliersMask(self, values):
+        # True for the rows of values that are outliers
+        differences = numpy.abs(values - self.getMedians())
+        MADs = self.getMADs()
+        # as in removeOutliers, nothing is rejected for a data type with a MAD of zero
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            testValues = numpy.where((MADs != 0.0) & numpy.isfinite(MADs), differences / MADs, 0.0)
+            outliersMask = self.multiples < testValues
+        self.rejectedCounts += numpy.sum(outliersMask, axis=0)
+        return numpy.any(outliersMask, axis=1)
+
+    def getKeepMask(self, values):
+        # all the values at once (a row for each pulse, a column for each data type), the estimates are updated
+        # with all of them and True is returned for the rows that are not outliers
+        self.update(values)
+        outliersMask = self.getOutliersMask(values)
+        self.numOfRejectedPulses += int(numpy.sum(outliersMask))
+        return numpy.logical_not(outliersMask)
+
+    def filterPulses(self, listOfPulseDicts):
+        # the estimates are updated with all the new pulses first, then the pulses that are not outliers are
+        # returned, including any held back pulses from before
+        values = self.getValues(listOfPulseDicts)
+        self.update(values)
+        self.heldPulseDicts.extend(listOfPulseDicts)
+        self.heldValues.append(values)
+        if self.numOfPulses < self.minNumOfPulses:
+            return []
+        return self.flush()
+
+    def flush(self):
+        # judge the pulses that are still held back, call this after the last pulses are added
+        heldPulseDicts = self.heldPulseDicts
+        if heldPulseDicts == []:
+            return []
+        outliersMask = self.getOutliersMask(numpy.concatenate(self.heldValues))
+        self.heldPulseDicts = []
+        self.heldValues = []
+        self.numOfRejectedPulses += int(numpy.sum(outliersMask))
+        return [pulseDict for (pulseDict, isOutlier) in zip(heldPulseDicts, outliersMask) if not isOutlier]
+
+    def printSummary(self):
+        print self.numOfRejectedPulses, "of", self.numOfPulses, "pulses were removed as outliers."
+        for (pulseDataType, median, MAD, rejectedCount) in zip(self.pulseDataTypes, self.getMedians(),
+                                                               self.getMADs(), self.rejectedCounts):
+            print "   ", pulseDataType + ": median", str('%.4E' % median) + ", MAD", str('%.4E' % MAD) + ",", \
+                rejectedCount, "outliers"
@@ -0,0 +1,452 @@
+import numpy
+
+from pulseReadIn import lazyPulseDict
+
+
+class memoryWaveformStore():
+    """
+    The in memory version of pulseReadIn.raggedWaveformStore, with the same append, indexing and getLengths.
+    """
+    def __init__(self):
+        self.arrays = []
+        self.lengths = []
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def append(self, dataArray):
+        dataArray = numpy.asarray(dataArray)
+        self.arrays.append(dataArray)
+        self.lengths.append(len(dataArray))
+        return len(self.arrays) - 1
+
+    def __getitem__(self, index):
+        return self.arrays[index]
+
+    def getLengths(self):
+        return numpy.array(self.lengths, dtype=int)
+
+    def close(self):
+        pass
+
+
+class offsetWaveformStore():
+    """
+    The waveforms of a data type saved by pulseReadIn.saveProcessedBinary, waveform i is values[offsets[i]:offsets[i + 1]]
+    (a view of the memory mapped values). Read only, like the stores of other tables.
+    """
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = numpy.asarray(offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def getLengths(self):
+        return numpy.diff(self.offsets)
+
+    def close(self):
+        pass
+
+
+def isWaveformValue(value):
+    return isinstance(value, (list, numpy.ndarray))
+
+
+def makeColumn(values):
+    # numbers are kept in a numeric array, anything else (strings, None for a missing value) in an object array
+    column = numpy.array(values)
+    if column.ndim == 1 and column.dtype.kind in 'biuf':
+        return column
+    column = numpy.empty(len(values), dtype=object)
+    for (rowIndex, value) in list(enumerate(values)):
+        column[rowIndex] = value
+    return column
+
+
+def concatenateColumns(column1, column2):
+    # an empty column does not change the type of the other
+    if len(column1) == 0:
+        return column2
+    if len(column2) == 0:
+        return column1
+    if column1.dtype.kind in 'biuf' and column2.dtype.kind in 'biuf':
+        return numpy.concatenate((column1, column2))
+    return numpy.concatenate((column1.astype(object), column2.astype(object)))
+
+
+def makeMissingColumn(numOfRows):
+    column = numpy.empty(numOfRows, dtype=object)
+    column[:] = None
+    return column
+
+
+class pulseRow():
+    """
+    One pulse of a pulseTable that works like a pulse dictionary, reads and writes go to the columns of the table.
+    A missing value is None, as in the pulse dictionaries of extractPulseInfo.
+    """
+    def __init__(self, table, rowIndex):
+        self.table = table
+        self.rowIndex = rowIndex
+
+    def __getitem__(self, key):
+        return self.table.getValue(self.rowIndex, key)
+
+    def __setitem__(self, key, value):
+        self.table.setValue(self.rowIndex, key, value)
+
+    def __delitem__(self, key):
+        self.table.setValue(self.rowIndex, key, None)
+
+    def __contains__(self, key):
+        return key in self.table
+
+    def keys(self):
+        return self.table.keys()
+
+    def get(self, key, default=None):
+        if key in self.table:
+            return self.table.getValue(self.rowIndex, key)
+        return default
+
+
+def getWaveformSource(pulseDict, key):
+    # (store, index) of a waveform that is already in a waveform store, so that it is not copied
+    if isinstance(pulseDict, lazyPulseDict):
+        if key in pulseDict.waveformIndexes.keys():
+            return pulseDict.waveformStores[key], pulseDict.waveformIndexes[key]
+    elif isinstance(pulseDict, pulseRow):
+        table = pulseDict.table
+        if key in table.waveformIndexes.keys():
+            index = table.waveformIndexes[key][pulseDict.rowIndex]
+            if 0 <= index:
+                return table.waveformStores[key], index
+    return None
+
+
+class pulseTable():
+    """
+    The pulses of a pulseGroup as columns. Each per-pulse value ('integral', 'uniqueID', ...) is a numpy array with a
+    row for each pulse. Each waveform data type ('keptData', ...) is an array of indexes into a waveform store, a
+    memoryWaveformStore or the pulseReadIn.raggedWaveformStore of spilled pulses, an index of -1 is a pulse without
+    that waveform. Selecting pulses with takeRows only selects indexes, the waveforms are not copied.
+    """
+    def __init__(self):
+        self.numOfRows = 0
+        self.columns = {}
+        self.waveformIndexes = {}
+        self.waveformStores = {}
+        # uniqueID -> row, made the first time it is needed and kept up to date when pulses are appended
+        self.uniqueIDIndex = None
+
+    def __len__(self):
+        return self.numOfRows
+
+    def __contains__(self, key):
+        return key in self.columns.keys() or key in self.waveformIndexes.keys()
+
+    def keys(self):
+        return self.columns.keys() + self.waveformIndexes.keys()
+
+    def isWaveform(self, key):
+        return key in self.waveformIndexes.keys()
+
+    def appendPulses(self, listOfPulseDicts):
+        numOfNewRows = len(listOfPulseDicts)
+        newKeys = []
+        for pulseDict in listOfPulseDicts:
+            for key in pulseDict.keys():
+                if key not in newKeys:
+                    newKeys.append(key)
+        for key in newKeys:
+            if self.isWaveform(key) or key not in self.columns.keys() and \
+                    any([getWaveformSource(pulseDict, key) is not None or isWaveformValue(pulseDict.get(key, None))
+                         for pulseDict in listOfPulseDicts]):
+                self.appendWaveforms(key, listOfPulseDicts)
+            else:
+                newColumn = makeColumn([pulseDict.get(key, None) for pulseDict in listOfPulseDicts])
+                if key in self.columns.keys():
+                    self.columns[key] = concatenateColumns(self.columns[key], newColumn)
+                else:
+                    self.columns[key] = concatenateColumns(makeMissingColumn(self.numOfRows), newColumn)
+        # the data types that the new pulses do not have are missing for them
+        for key in self.columns.keys():
+            if key not in newKeys:
+                self.columns[key] = concatenateColumns(self.columns[key], makeMissingColumn(numOfNewRows))
+        for key in self.waveformIndexes.keys():
+            if key not in newKeys:
+                self.waveformIndexes[key] = numpy.concatenate((self.waveformIndexes[key],
+                                                               -numpy.ones(numOfNewRows, dtype=int)))
+        if self.uniqueIDIndex is not None:
+            for rowIndex in range(self.numOfRows, self.numOfRows + numOfNewRows):
+                self.uniqueIDIndex[self.columns['uniqueID'][rowIndex]] = rowIndex
+        self.numOfRows += numOfNewRows
+
+    def getUniqueIDIndex(self):
+        if self.uniqueIDIndex is None:
+            if 'uniqueID' in self.columns.keys():
+                self.uniqueIDIndex = dict([(uniqueID, rowIndex) for (rowIndex, uniqueID)
+                                           in list(enumerate(self.columns['uniqueID']))])
+            else:
+                self.uniqueIDIndex = {}
+        return self.uniqueIDIndex
+
+    def getRowIndexes(self, uniqueIDs):
+        # the rows of the uniqueIDs, new pulses are appended for the uniqueIDs that are not in the table yet
+        uniqueIDIndex = self.getUniqueIDIndex()
+        rowIndexes = numpy.array([uniqueIDIndex.get(uniqueID, -1) for uniqueID in uniqueIDs], dtype=int)
+        isNew = rowIndexes < 0
+        if numpy.any(isNew):
+            firstNewRow = self.numOfRows
+            self.appendPulses([{'uniqueID':uniqueID} for (uniqueID, isNewID) in zip(uniqueIDs, isNew) if isNewID])
+            rowIndexes[isNew] = numpy.arange(firstNewRow, self.numOfRows)
+        return rowIndexes
+
+    def mergeColumn(self, key, uniqueIDs, values=None, waveformStore=None, waveformIndexes=None):
+        """
+        A hash join of saved data onto the table by uniqueID, the same result as pulseReadIn.readInSavedRowData.
+
+        :param uniqueIDs: the uniqueID of each saved value.
+        :param values: the per-pulse values in the order of uniqueIDs, or None for waveforms.
+        :param waveformStore: for waveforms, the store with the saved waveforms.
+        :param waveformIndexes: the index in waveformStore for each of the uniqueIDs (-1 for none), by default
+            0, 1, 2, ...
+        """
+        rowIndexes = self.getRowIndexes(uniqueIDs)
+        if waveformStore is None:
+            newColumn = makeColumn(values)
+            if key in self.waveformIndexes.keys():
+                del self.waveformIndexes[key]
+                del self.waveformStores[key]
+            if key in self.columns.keys():
+                column = self.columns[key]
+            elif newColumn.dtype.kind in 'biuf' and len(numpy.unique(rowIndexes)) == self.numOfRows:
+                column = numpy.zeros(self.numOfRows, dtype=newColumn.dtype)
+            else:
+                column = makeMissingColumn(self.numOfRows)
+            if column.dtype.kind in 'biuf' and newColumn.dtype.kind in 'biuf':
+                column = column.astype(numpy.result_type(column, newColumn))
+            else:
+                column = column.astype(object)
+            column[rowIndexes] = newColumn
+            self.columns[key] = column
+            if key == 'uniqueID':
+                self.uniqueIDIndex = None
+            return
+        if waveformIndexes is None:
+            waveformIndexes = numpy.arange(len(uniqueIDs))
+        waveformIndexes = numpy.asarray(waveformIndexes, dtype=int)
+        if key in self.columns.keys():
+            del self.columns[key]
+        if key not in self.waveformIndexes.keys():
+            self.waveformIndexes[key] = -numpy.ones(self.numOfRows, dtype=int)
+            self.waveformStores[key] = waveformStore
+        elif len(numpy.unique(rowIndexes)) == self.numOfRows:
+            # every waveform is replaced
+            self.waveformIndexes[key] = -numpy.ones(self.numOfRows, dtype=int)
+            self.waveformStores[key] = waveformStore
+        if self.waveformStores[key] is waveformStore:
+            self.waveformIndexes[key][rowIndexes] = waveformIndexes
+        else:
+            for (rowIndex, index) in zip(rowIndexes, waveformIndexes):
+                if index < 0:
+                    self.waveformIndexes[key][rowIndex] = -1
+                else:
+                    self.waveformIndexes[key][rowIndex] = self.appendToStore(key, waveformStore[index])
+
+    def appendWaveforms(self, key, listOfPulseDicts):
+        if key not in self.waveformIndexes.keys():
+            self.waveformIndexes[key] = -numpy.ones(self.numOfRows, dtype=int)
+            self.waveformStores[key] = None
+        sources = [getWaveformSource(pulseDict, key) for pulseDict in listOfPulseDicts]
+        # the waveforms that are already in the store of this table are used without a copy, the store of
+        # other tables and of spilled pulses is only read, so the table changes to a memoryWaveformStore the first
+        # time a waveform needs to be added
+        if self.waveformStores[key] is None:
+            for source in sources:
+                if source is not None:
+                    self.waveformStores[key] = source[0]
+                    break
+        store = self.waveformStores[key]
+        needsCopy = False
+        for (pulseDict, source) in zip(listOfPulseDicts, sources):
+            if source is None:
+                needsCopy = isWaveformValue(pulseDict.get(key, None))
+            else:
+                needsCopy = source[0] is not store
+            if needsCopy:
+                break
+        if needsCopy and not isinstance(store, memoryWaveformStore):
+            self.copyToMemoryStore(key)
+            store = self.waveformStores[key]
+        newIndexes = -numpy.ones(len(listOfPulseDicts), dtype=int)
+        for (rowIndex, (pulseDict, source)) in list(enumerate(zip(listOfPulseDicts, sources))):
+            if source is None:
+                value = pulseDict.get(key, None)
+            elif source[0] is store:
+                newIndexes[rowIndex] = source[1]
+                continue
+            else:
+                value = source[0][source[1]]
+            if isWaveformValue(value):
+                newIndexes[rowIndex] = store.append(value)
+        self.waveformIndexes[key] = numpy.concatenate((self.waveformIndexes[key], newIndexes))
+
+    def appendToStore(self, key, dataArray):
+        # a single waveform, see appendWaveforms
+        if not isinstance(self.waveformStores[key], memoryWaveformStore):
+            self.copyToMemoryStore(key)
+        return self.waveformStores[key].append(dataArray)
+
+    def copyToMemoryStore(self, key):
+        oldStore = self.waveformStores[key]
+        newStore = memoryWaveformStore()
+        oldIndexes = self.waveformIndexes[key]
+        newIndexes = -numpy.ones(len(oldIndexes), dtype=int)
+        for (rowIndex, index) in list(enumerate(oldIndexes)):
+            if 0 <= index:
+                newIndexes[rowIndex] = newStore.append(oldStore[index])
+        self.waveformStores[key] = newStore
+        self.waveformIndexes[key] = newIndexes
+
+    def getValue(self, rowIndex, key):
+        if key in self.columns.keys():
+            return self.columns[key][rowIndex]
+        elif key in self.waveformIndexes.keys():
+            index = self.waveformIndexes[key][rowIndex]
+            if index < 0:
+                return None
+            return self.waveformStores[key][index]
+        raise KeyError(key)
+
+    def setValue(self, rowIndex, key, value):
+        if self.isWaveform(key) or key not in self.columns.keys() and isWaveformValue(value):
+            if key not in self.waveformIndexes.keys():
+                self.waveformIndexes[key] = -numpy.ones(self.numOfRows, dtype=int)
+                self.waveformStores[key] = memoryWaveformStore()
+            if isWaveformValue(value):
+                self.waveformIndexes[key][rowIndex] = self.appendToStore(key, value)
+            else:
+                self.waveformIndexes[key][rowIndex] = -1
+            return
+        if key not in self.columns.keys():
+            self.columns[key] = makeMissingColumn(self.numOfRows)
+        column = self.columns[key]
+        if column.dtype.kind in 'biuf':
+            newColumn = makeColumn([value])
+            if newColumn.dtype.kind not in 'biuf':
+                column = column.astype(object)
+            elif numpy.result_type(column, newColumn) != column.dtype:
+                column = column.astype(numpy.result_type(column, newColumn))
+        column[rowIndex] = value
+        self.columns[key] = column
+        if key == 'uniqueID':
+            self.uniqueIDIndex = None
+
+    def setColumn(self, key, values):
+        # a whole column at once, values has a value (or waveform) for each row
+        if key in self.waveformIndexes.keys():
+            del self.waveformIndexes[key]
+            del self.waveformStores[key]
+        if key in self.columns.keys():
+            del self.columns[key]
+        if any([isWaveformValue(value) for value in values]):
+            self.waveformIndexes[key] = -numpy.ones(self.numOfRows, dtype=int)
+            self.waveformStores[key] = memoryWaveformStore()
+            for (rowIndex, value) in list(enumerate(values)):
+                if isWaveformValue(value):
+                    self.waveformIndexes[key][rowIndex] = self.waveformStores[key].append(value)
+        else:
+            self.columns[key] = makeColumn(values)
+        if key == 'uniqueID':
+            self.uniqueIDIndex = None
+
+    def getColumn(self, key):
+        # an array for a per-pulse value, a list of arrays (None for a missing waveform) for a waveform data type
+        if key in self.columns.keys():
+            return self.columns[key]
+        if self.numOfRows == 0 and key not in self.waveformIndexes.keys():
+            return makeMissingColumn(0)
+        return list(self.iterWaveforms(key))
+
+    def getFloatColumn(self, key):
+        # missing values, and data types the table does not have, are nan
+        if key not in self.columns.keys():
+            return numpy.zeros(self.numOfRows) * float('nan')
+        column = self.columns[key]
+        if column.dtype.kind in 'biuf':
+            return column.astype(float)
+        return numpy.array([float('nan') if value is None else float(value) for value in column])
+
+    def iterWaveforms(self, key):
+        # an empty table has no values for any key, such as a folder with no new pulses in an incremental run
+        if self.numOfRows == 0:
+            return
+        store = self.waveformStores[key]
+        for index in self.waveformIndexes[key]:
+            if index < 0:
+                yield None
+            else:
+                yield store[index]
+
+    def getWaveformLengths(self, key):
+        # 0 for a missing waveform
+        indexes = self.waveformIndexes[key]
+        if self.waveformStores[key] is None:
+            return numpy.zeros(len(indexes), dtype=int)
+        lengths = self.waveformStores[key].getLengths()
+        return numpy.where(0 <= indexes, lengths[numpy.maximum(indexes, 0)], 0)
+
+    def getMissingMask(self, keys):
+        # True for the pulses that are missing a value (None) for any of the keys
+        missingMask = numpy.zeros(self.numOfRows, dtype=bool)
+        for key in keys:
+            if key in self.waveformIndexes.keys():
+                missingMask |= self.waveformIndexes[key] < 0
+            elif key in self.columns.keys():
+                column = self.columns[key]
+                if column.dtype.kind not in 'biuf':
+                    missingMask |= numpy.array([value is None for value in column], dtype=bool)
+            else:
+                missingMask[:] = True
+        return missingMask
+
+    def getRangeMask(self, pulseDataTypesForFilter):
+        # True for the pulses with minVal <= value <= maxVal for all of the (pulseDataType, minVal, maxVal),
+        # missing values are never in range
+        keepMask = numpy.ones(self.numOfRows, dtype=bool)
+        for (pulseDataType, minVal, maxVal) in pulseDataTypesForFilter:
+            if maxVal < minVal:
+                minVal, maxVal = maxVal, minVal
+            values = self.getFloatColumn(pulseDataType)
+            with numpy.errstate(invalid='ignore'):
+                keepMask &= (minVal <= values) & (values <= maxVal)
+        return keepMask
+
+    def takeRows(self, rowIndexes):
+        # a new table with the rows of a boolean mask or an array of row indexes, sharing the waveform stores
+        newTable = pulseTable()
+        for key in self.columns.keys():
+            newTable.columns[key] = self.columns[key][rowIndexes]
+        for key in self.waveformIndexes.keys():
+            newTable.waveformIndexes[key] = self.waveformIndexes[key][rowIndexes]
+            newTable.waveformStores[key] = self.waveformStores[key]
+        if len(newTable.columns) + len(newTable.waveformIndexes) == 0:
+            newTable.numOfRows = len(numpy.arange(self.numOfRows)[rowIndexes])
+        else:
+            newTable.numOfRows = len((newTable.columns.values() + newTable.waveformIndexes.values())[0])
+        return newTable
+
+    def getRows(self):
+        return [pulseRow(self, rowIndex) for rowIndex in range(self.numOfRows)]
+
+
+def makePulseTable(listOfPulseDicts):
+    # a pulseTable from pulse dictionaries, lazyPulseDicts or the pulseRows of another table
+    table = pulseTable()
+    table.appendPulses(listOfPulseDicts)
+    return table
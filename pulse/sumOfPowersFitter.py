@@ -0,0 +1,360 @@
+import time
+import numpy
+from scipy.optimize import least_squares
+from operator import itemgetter
+
+
+"""
+A fitter for a sum of any number of exponential functions
+    Amp1 * exp(- x / tau1) + Amp2 * exp(- x / tau2) + ...
+The parameters are always ordered as (Amp1, Tau1, Amp2, Tau2, ...), the same as in pulseOperations.fittingSumOfPowers.
+"""
+
+
+def sumOfPowersModel(params, xData):
+    amps = numpy.array(params[0::2])
+    taus = numpy.array(params[1::2])
+    return numpy.sum(amps[:, numpy.newaxis] * numpy.exp(-xData[numpy.newaxis, :] / taus[:, numpy.newaxis]), axis=0)
+
+
+def sumOfPowersResiduals(params, xData, yData):
+    return sumOfPowersModel(params, xData) - yData
+
+
+def sumOfPowersJacobian(params, xData, yData):
+    # d(residual)/d(Amp) = exp(-x / tau) and d(residual)/d(tau) = Amp * x * exp(-x / tau) / tau^2
+    amps = numpy.array(params[0::2])
+    taus = numpy.array(params[1::2])
+    exponentials = numpy.exp(-xData[:, numpy.newaxis] / taus[numpy.newaxis, :])
+    jacobian = numpy.zeros((len(xData), len(params)))
+    jacobian[:, 0::2] = exponentials
+    jacobian[:, 1::2] = exponentials * xData[:, numpy.newaxis] * (amps / (taus ** 2))[numpy.newaxis, :]
+    return jacobian
+
+
+def getAmpBounds(yData, upperBoundAmp=float('inf')):
+    # The amplitudes have the same sign as the first data point, see fittingSumOfPowers
+    if yData[0] < 0:
+        return -numpy.abs(upperBoundAmp), float(0), False
+    else:
+        return float(0), numpy.abs(upperBoundAmp), True
+
+
+def naiveGuessAmpTau(yData, xData, numOfExponents):
+    # tau is guessed from the time it takes the pulse to fall to 1/e of the first value, the components are spread
+    # out in tau by factors of 4 around that value and share the first value equally.
+    firstValue = float(yData[0])
+    belowIndexes = numpy.where(numpy.abs(yData) < numpy.abs(firstValue) / numpy.e)[0]
+    if len(belowIndexes) == 0 or belowIndexes[0] == 0:
+        tau = (xData[-1] - xData[0]) / 2.0
+    else:
+        tau = xData[belowIndexes[0]] - xData[0]
+    if not tau > 0:
+        tau = float(1)
+    guessAmpTau = []
+    for index in range(numOfExponents):
+        guessAmpTau.append((firstValue / float(numOfExponents),
+                            tau * (4.0 ** (index - ((numOfExponents - 1) / 2.0)))))
+    return guessAmpTau
+
+
+class sumOfPowersFitter():
+    def __init__(self, numOfExponents=1, upperBoundAmp=float('inf'), warmStart=True, charAmpTau=None):
+        """
+        Fits a sum of exponential functions with analytic Jacobians. The starting point for each fit is, in order of
+        preference, the last successful fit (warmStart=True), the fit of the group's characteristic function
+        (charAmpTau), or a naive guess. The warm start amplitudes are rescaled to the first value of the new pulse.
+
+        :param numOfExponents: the number of exponential functions in the sum, any positive integer.
+        :param upperBoundAmp: the maximum absolute value of the amplitudes.
+        :param warmStart: if True, start each fit from the previous successful fit.
+        :param charAmpTau: list of (amp, tau) from a fit of the characteristic function, see setCharacteristicFunction.
+        """
+        self.numOfExponents = numOfExponents
+        self.upperBoundAmp = upperBoundAmp
+        self.warmStart = warmStart
+        self.charAmpTau = charAmpTau
+        self.lastAmpTau = None
+        self.numOfFits = 0
+        self.numOfFunctionEvaluations = 0
+
+
+    def setCharacteristicFunction(self, charPulse, xStep):
+        charPulse = numpy.array(charPulse, dtype=float)
+        xData = numpy.arange(len(charPulse)) * float(xStep)
+        lastAmpTau = self.lastAmpTau
+        self.lastAmpTau = None
+        sortedFittedAmpTau, cost, lsq_results = self.fit(charPulse, xData)
+        self.lastAmpTau = lastAmpTau
+        if sortedFittedAmpTau is not None:
+            self.charAmpTau = sortedFittedAmpTau
+        return sortedFittedAmpTau
+
+
+    def guessAmpTau(self, yData, xData):
+        if self.warmStart and self.lastAmpTau is not None:
+            startAmpTau = self.lastAmpTau
+        elif self.charAmpTau is not None and len(self.charAmpTau) == self.numOfExponents:
+            startAmpTau = self.charAmpTau
+        else:
+            return naiveGuessAmpTau(yData, xData, self.numOfExponents)
+        # rescale the amplitudes to the height of this pulse
+        ampSum = numpy.sum([amp for (amp, tau) in startAmpTau])
+        if ampSum == 0.0:
+            return naiveGuessAmpTau(yData, xData, self.numOfExponents)
+        scale = float(yData[0]) / ampSum
+        return [(amp * scale, tau) for (amp, tau) in startAmpTau]
+
+
+    def fit(self, yData, xData, guessAmpTau=None):
+        # guessAmpTau, a list of (amp, tau), replaces the usual starting point when it is given
+        yData = numpy.array(yData, dtype=float)
+        xData = numpy.array(xData, dtype=float)
+        lowerBoundAmp, upperBoundAmp, isPositive = getAmpBounds(yData, self.upperBoundAmp)
+        # The fit is done in units where the pulse length and height are of order one, this keeps the amplitudes
+        # and the time constants (typically ~1e-7 s) on the same scale for the solver.
+        xScale = float(xData[-1] - xData[0])
+        if not xScale > 0:
+            xScale = float(1)
+        yScale = float(numpy.max(numpy.abs(yData)))
+        if not yScale > 0:
+            yScale = float(1)
+        guesses = []
+        lowerBounds = []
+        upperBounds = []
+        if guessAmpTau is None:
+            guessAmpTau = self.guessAmpTau(yData, xData)
+        for (guessAmp, guessTau) in guessAmpTau:
+            # least_squares needs the starting point to be inside of the bounds
+            guessAmp = numpy.clip(guessAmp, lowerBoundAmp, upperBoundAmp)
+            if guessAmp == 0.0:
+                guessAmp = (-1.0e-12, 1.0e-12)[int(isPositive)] * yScale
+            guesses.extend([guessAmp / yScale, guessTau / xScale])
+            lowerBounds.extend([lowerBoundAmp / yScale, float(0)])
+            upperBounds.extend([upperBoundAmp / yScale, float('inf')])
+        lowerBounds = numpy.array(lowerBounds)
+        upperBounds = numpy.array(upperBounds)
+        # The unbounded Levenberg-Marquardt solver has much less overhead per iteration, its result is kept when
+        # it is inside of the bounds. Otherwise the fit is redone with the bounded trust region solver.
+        lsq_results = None
+        if len(guesses) <= len(xData):
+            lsq_results = least_squares(sumOfPowersResiduals,
+                                        numpy.array(guesses),
+                                        jac=sumOfPowersJacobian,
+                                        method='lm',
+                                        args=(xData / xScale, yData / yScale))
+            self.numOfFunctionEvaluations += lsq_results['nfev']
+            if not (numpy.all(lowerBounds <= lsq_results['x']) and numpy.all(lsq_results['x'] <= upperBounds)):
+                lsq_results = None
+        if lsq_results is None:
+            lsq_results = least_squares(sumOfPowersResiduals,
+                                        numpy.array(guesses),
+                                        jac=sumOfPowersJacobian,
+                                        bounds=(lowerBounds, upperBounds),
+                                        args=(xData / xScale, yData / yScale))
+            self.numOfFunctionEvaluations += lsq_results['nfev']
+        self.numOfFits += 1
+        # back to the units of the data, the cost scales with yScale^2
+        lsq_results['x'][0::2] *= yScale
+        lsq_results['x'][1::2] *= xScale
+        lsq_results['fun'] *= yScale
+        lsq_results['cost'] *= yScale ** 2
+        if lsq_results['success']:
+            fittedAmpTau = []
+            for paramsIndex in range(self.numOfExponents):
+                fittedAmpTau.append((lsq_results['x'][2 * paramsIndex], lsq_results['x'][(2 * paramsIndex) + 1]))
+            sortedFittedAmpTau = sorted(fittedAmpTau, key=itemgetter(0), reverse=isPositive)
+            self.lastAmpTau = sortedFittedAmpTau
+            return sortedFittedAmpTau, lsq_results['cost'], lsq_results
+        else:
+            return None, float('inf'), lsq_results
+
+
+def pronyEstimateBatch(arrayOfPulses, startIndexes, xSteps, numOfExponents=1, blockSize=None):
+    """
+    A closed form (no iterations) estimate of the sum of exponential parameters for many pulses at once using Prony's
+    method. The kept part of each row is summed in blocks of blockSize samples, which averages down the noise and
+    keeps the sum of exponentials form. The block sums are modeled as S[j] = a_1 * S[j - 1] + ... + a_p * S[j - p]
+    with p=numOfExponents. The roots z of the polynomial of a_k give the time constants,
+    tau = -blockSize * xStep / ln(z), and the amplitudes are then a linear least squares problem on the full data.
+    All the sums are masked row sums, so every row is solved at once with stacked (p x p) linear algebra.
+
+    :param arrayOfPulses: 2-D array, one pulse per row, only the samples from startIndexes onward are used for each row.
+    :param startIndexes: array of the first sample of each row, the kept data from pulsePipelineBatch.
+    :param xSteps: array of the time between samples for each row.
+    :param blockSize: the number of samples in each block sum, a single value or one for each row. The default gives
+        16 blocks for each kept pulse.
+    :return: (amps, taus, costs) amps and taus are (N_pulses x numOfExponents) arrays sorted in the same way as
+        fittingSumOfPowers. Pulses where the method does not give decaying exponentials are NaN, with a cost of inf.
+    """
+    arrayOfPulses = numpy.array(arrayOfPulses, dtype=float, ndmin=2)
+    (numOfPulses, numOfSamples) = numpy.shape(arrayOfPulses)
+    startIndexes = numpy.array(startIndexes, dtype=int) * numpy.ones(numOfPulses, dtype=int)
+    xSteps = numpy.array(xSteps, dtype=float) * numpy.ones(numOfPulses)
+    keptLens = numOfSamples - startIndexes
+    if blockSize is None:
+        blockSize = numpy.maximum(keptLens // 16, 1)
+    blockSize = numpy.array(blockSize, dtype=int) * numpy.ones(numOfPulses, dtype=int)
+    rowIndexes = numpy.arange(numOfPulses)
+    columnIndexes = numpy.arange(numOfSamples)[numpy.newaxis, :]
+    keptMask = columnIndexes >= startIndexes[:, numpy.newaxis]
+    maskedPulses = numpy.where(keptMask, arrayOfPulses, 0.0)
+
+    # block sums from the cumulative sum of each row, S[j] is the sum of the samples start + j * d to start + (j + 1) * d
+    cumulativeSum = numpy.zeros((numOfPulses, numOfSamples + 1))
+    cumulativeSum[:, 1:] = numpy.cumsum(maskedPulses, axis=1)
+    numOfBlocks = keptLens // blockSize
+    maxNumOfBlocks = int(numpy.max(numOfBlocks))
+    blockIndexes = numpy.arange(maxNumOfBlocks)[numpy.newaxis, :]
+    blockMask = blockIndexes < numOfBlocks[:, numpy.newaxis]
+    blockStarts = numpy.minimum(startIndexes[:, numpy.newaxis] + blockIndexes * blockSize[:, numpy.newaxis],
+                                numOfSamples)
+    blockStops = numpy.minimum(blockStarts + blockSize[:, numpy.newaxis], numOfSamples)
+    blockSums = numpy.where(blockMask,
+                            cumulativeSum[rowIndexes[:, numpy.newaxis], blockStops] -
+                            cumulativeSum[rowIndexes[:, numpy.newaxis], blockStarts], 0.0)
+
+    # the shifted copies S[j - k] for k = 0, 1, ..., p, only for the j with all the lags in the pulse
+    predictionMask = blockMask & (blockIndexes >= numOfExponents)
+    lagged = numpy.zeros((numOfExponents + 1, numOfPulses, maxNumOfBlocks))
+    for lag in range(numOfExponents + 1):
+        lagged[lag, :, lag:] = blockSums[:, :maxNumOfBlocks - lag]
+    lagged *= predictionMask[numpy.newaxis, :, :]
+
+    # normal equations for the linear prediction coefficients
+    normalMatrix = numpy.zeros((numOfPulses, numOfExponents, numOfExponents))
+    normalVector = numpy.zeros((numOfPulses, numOfExponents))
+    for j in range(numOfExponents):
+        normalVector[:, j] = numpy.sum(lagged[0] * lagged[j + 1], axis=1)
+        for k in range(j, numOfExponents):
+            normalMatrix[:, j, k] = numpy.sum(lagged[j + 1] * lagged[k + 1], axis=1)
+            normalMatrix[:, k, j] = normalMatrix[:, j, k]
+    predictionCoefficients = numpy.einsum('pjk,pk->pj', numpy.linalg.pinv(normalMatrix), normalVector)
+
+    # the roots of z^p - a_1 z^(p-1) - ... - a_p are the eigenvalues of the companion matrix
+    companionMatrix = numpy.zeros((numOfPulses, numOfExponents, numOfExponents))
+    companionMatrix[:, 0, :] = predictionCoefficients
+    for k in range(1, numOfExponents):
+        companionMatrix[:, k, k - 1] = 1.0
+    roots = numpy.linalg.eigvals(companionMatrix)
+    isDecaying = numpy.all((numpy.abs(roots.imag) <= 1.0e-12 * numpy.abs(roots.real)) &
+                           (0.0 < roots.real) & (roots.real < 1.0), axis=1)
+    roots = numpy.where(isDecaying[:, numpy.newaxis], roots.real, 0.5)
+    taus = -(blockSize * xSteps)[:, numpy.newaxis] / numpy.log(roots)
+
+    # linear least squares for the amplitudes with the basis functions z^(m / blockSize), m is the sample number after
+    # the start
+    keptSampleNumber = numpy.where(keptMask, columnIndexes - startIndexes[:, numpy.newaxis], 0)
+    basis = roots[:, :, numpy.newaxis] ** (keptSampleNumber / blockSize[:, numpy.newaxis].astype(float))[:, numpy.newaxis, :]
+    basis *= keptMask[:, numpy.newaxis, :]
+    gramMatrix = numpy.einsum('pjn,pkn->pjk', basis, basis)
+    projection = numpy.einsum('pjn,pn->pj', basis, maskedPulses)
+    amps = numpy.einsum('pjk,pk->pj', numpy.linalg.pinv(gramMatrix), projection)
+
+    residuals = numpy.einsum('pj,pjn->pn', amps, basis) - maskedPulses
+    costs = 0.5 * numpy.sum(residuals ** 2, axis=1)
+
+    # the amplitudes have the same sign as the first kept value, as in fittingSumOfPowers
+    isPositive = arrayOfPulses[rowIndexes, startIndexes] >= 0
+    hasRightSign = numpy.where(isPositive[:, numpy.newaxis], amps >= 0, amps <= 0)
+    isValid = isDecaying & numpy.all(hasRightSign, axis=1) & numpy.isfinite(costs)
+    sortOrder = numpy.argsort(numpy.where(isPositive[:, numpy.newaxis], -amps, amps), axis=1)
+    amps = amps[rowIndexes[:, numpy.newaxis], sortOrder]
+    taus = taus[rowIndexes[:, numpy.newaxis], sortOrder]
+    amps[~isValid, :] = numpy.nan
+    taus[~isValid, :] = numpy.nan
+    costs[~isValid] = float('inf')
+    return amps, taus, costs
+
+
+def estimateSumOfPowers(yData, xData, numOfExponents=1, blockSize=None):
+    # pronyEstimateBatch for a single pulse, the output is in the same form as fittingSumOfPowers
+    yData = numpy.array(yData, dtype=float)
+    amps, taus, costs = pronyEstimateBatch(yData[numpy.newaxis, :], [0], [xData[1] - xData[0]],
+                                           numOfExponents=numOfExponents, blockSize=blockSize)
+    if numpy.isfinite(costs[0]):
+        return zip(amps[0], taus[0]), costs[0]
+    else:
+        return None, float('inf')
+
+
+def benchmarkSumOfPowersFitter(listOfKeptData, xStep, numOfExponents=2, upperBoundAmp=float('inf'), verbose=True):
+    """
+    Compares the time of pulseOperations.fittingSumOfPowers (finite difference Jacobians and the same guess for every
+    component) to the sumOfPowersFitter with and without warm starts.
+
+    :param listOfKeptData: a list of trimmed pulses, such as pulseDict['keptData'] from extractPulseInfo.
+    :param xStep: the time between samples.
+    :return: a dictionary of the total time in seconds for each method
+    """
+    from pulseOperations import fittingSumOfPowers, initializeTestPlots
+    plotDict = initializeTestPlots(doShow=False, verbose=False)
+    listOfXData = [numpy.arange(len(keptData)) * float(xStep) for keptData in listOfKeptData]
+    timesDict = {}
+    costsDict = {}
+
+    startTime = time.time()
+    costsDict['fittingSumOfPowers'] = []
+    for (keptData, keptXData) in zip(listOfKeptData, listOfXData):
+        fittedAmpTau, cost, plotDict = fittingSumOfPowers(keptData, keptXData, numOfExponents, plotDict, upperBoundAmp)
+        costsDict['fittingSumOfPowers'].append(cost)
+    timesDict['fittingSumOfPowers'] = time.time() - startTime
+
+    for warmStart in [False, True]:
+        methodName = 'sumOfPowersFitter warmStart=' + str(warmStart)
+        fitter = sumOfPowersFitter(numOfExponents=numOfExponents, upperBoundAmp=upperBoundAmp, warmStart=warmStart)
+        startTime = time.time()
+        costsDict[methodName] = []
+        for (keptData, keptXData) in zip(listOfKeptData, listOfXData):
+            fittedAmpTau, cost, lsq_results = fitter.fit(keptData, keptXData)
+            costsDict[methodName].append(cost)
+        timesDict[methodName] = time.time() - startTime
+
+    if verbose:
+        numOfPulses = len(listOfKeptData)
+        referenceTime = timesDict['fittingSumOfPowers']
+        print "Fitting", numOfPulses, "pulses with a sum of", numOfExponents, "exponential functions."
+        for methodName in sorted(timesDict.keys()):
+            print methodName + ":", str('%.3f' % timesDict[methodName]), "s total,", \
+                str('%.3E' % (timesDict[methodName] / float(numOfPulses))), "s per pulse,", \
+                str('%.2f' % (referenceTime / timesDict[methodName])), "times faster than fittingSumOfPowers,", \
+                "median cost", str('%.4E' % numpy.median(costsDict[methodName]))
+    return timesDict
+
+
+if __name__ == '__main__':
+    import os
+    import getpass
+    from pulseOperations import extractPulseInfo
+    numOfExponents = 2
+    maxNumOfPulses = 200
+
+    # The recorded traces to use for the benchmark, see pulseScript.py
+    if getpass.getuser() == "chw3k5":  # Caleb Wheeler's User name on his own computer
+        folderName = os.path.join('/Users/chw3k5/Desktop/new CHC traces', 'CHC alpha traces')
+    else:
+        folderName = ''
+    if os.path.isdir(folderName):
+        listOfPulseDicts = extractPulseInfo(folderName,
+                                            fileNamePrefix=os.path.basename(folderName) + '_',
+                                            filenameSuffix='.txt',
+                                            skipRows=3,
+                                            delimiter='\t',
+                                            multiplesOfMedianStdForRejection=1000.0,
+                                            testModeReadIn=True,
+                                            verbose=False)
+        listOfKeptData = [pulseDict['keptData'] for pulseDict in listOfPulseDicts][:maxNumOfPulses]
+        xStep = listOfPulseDicts[0]['keptXData'][1]
+    else:
+        print "No recorded traces were found at '" + folderName + "', using simulated pulses for the benchmark."
+        numpy.random.seed(0)
+        xStep = 1.0e-8
+        xData = numpy.arange(1000) * xStep
+        listOfKeptData = []
+        for pulseIndex in range(maxNumOfPulses):
+            height = -numpy.random.uniform(50.0, 250.0)
+            listOfKeptData.append(height * 0.8 * numpy.exp(-xData / 3.0e-7) +
+                                  height * 0.2 * numpy.exp(-xData / 2.0e-6) +
+                                  numpy.random.normal(0.0, 2.0, len(xData)))
+
+    benchmarkSumOfPowersFitter(listOfKeptData, xStep, numOfExponents=numOfExponents, verbose=True)
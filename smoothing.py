@@ -88,3 +88,29 @@ def boxCar(anArray, kernalSize = 3, mode='same'):
     kernel = numpy.ones((kernalSize))
     convArray = numpy.convolve(anArray, kernel, mode=mode)
     return convArray
+
+
+def convolveRows(arrayOfRows, kernel):
+    # numpy.convolve(row, kernel, mode='same') for every row of a 2-D array at once. The rows are joined into one
+    # array with len(kernel) - 1 zeros between them, so that a single numpy.convolve does not mix the rows.
+    # The rows must be at least as long as the kernel.
+    arrayOfRows = numpy.asarray(arrayOfRows, dtype=float)
+    kernel = numpy.asarray(kernel, dtype=float)
+    (numOfRows, rowLen) = numpy.shape(arrayOfRows)
+    kernelLen = len(kernel)
+    if rowLen < kernelLen:
+        raise ValueError("The rows (length " + str(rowLen) + ") must be at least as long as the kernel (length " +
+                         str(kernelLen) + ").")
+    if numOfRows == 0:
+        return numpy.zeros((0, rowLen))
+    paddedLen = rowLen + kernelLen - 1
+    paddedArray = numpy.zeros((numOfRows, paddedLen))
+    paddedArray[:, :rowLen] = arrayOfRows
+    fullConv = numpy.convolve(numpy.ravel(paddedArray), kernel, mode='full')[:numOfRows * paddedLen]
+    centerOffset = (kernelLen - 1) // 2
+    return fullConv.reshape((numOfRows, paddedLen))[:, centerOffset:centerOffset + rowLen]
+
+
+def boxCarBatch(arrayOfRows, kernalSize=3):
+    # boxCar with mode='same' for every row of a 2-D array
+    return convolveRows(arrayOfRows, numpy.ones((kernalSize)))